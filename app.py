@@ -2,11 +2,40 @@ import os
 import json
 import google.generativeai as genai
 import streamlit as st
+import numpy as np
+import pandas as pd
 import datetime
 import re
+import unicodedata
 import hashlib
+import hmac
+import base64
+import secrets
+import copy
+import sys
+import time
+import threading
+import itertools
+import logging
+import cProfile
+import pstats
+from array import array
+import csv
+import io
+import gzip
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import Counter, deque
 import firebase_admin 
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists, Conflict, NotFound, DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+import backup_firestore
+from prompt_correcao import (GravadorFixtures, montar_prompt_correcao, formatar_rubrica, parse_feedback_sections,
+                             extrair_nota_sentido, PROMPT_CORRECAO_TEMPLATE, PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA)
+from verificador_ortografico import VerificadorOrtografico, verificar_texto, formatar_apontamentos
+from armazenamento_compacto import (CAMPOS_CARTAO, CAMPOS_HISTORICO, SUFIXO_COMPACTADO, TEXTO_MINIMO_BYTES, carregar_compressor,
+                                    compactar_campos, campos_para_json, formato_entrada_compacta, formato_entrada_completa,
+                                    referencia_propria, migrar, treinar_e_salvar)
 
 # --- ESTILIZAÇÃO CUSTOMIZADA DA INTERFACE (CSS INJETADO) ---
 st.markdown(
@@ -109,7 +138,36 @@ if not GOOGLE_API_KEY:
 
 genai.configure(api_key=GOOGLE_API_KEY)
 
-model = genai.GenerativeModel('models/gemini-2.5-flash')
+# --- ROTEAMENTO DE MODELOS DO GEMINI ---
+# As rotas são avaliadas em ordem: entram como candidatas as que comportam o tamanho
+# (resposta do usuário + resposta esperada). Entre as candidatas, vale a primeira cuja
+# latência observada (p90) cabe no orçamento da requisição. Em timeout, cota esgotada ou
+# indisponibilidade, a correção cai automaticamente para o modelo de fallback.
+# GEMINI_ROTAS_MODELOS aceita a mesma lista em JSON para ajustar sem mexer no código.
+ROTAS_MODELOS_PADRAO = [
+    {"max_caracteres": 1500, "modelo": "models/gemini-2.5-flash-lite", "timeout": 20},
+    {"max_caracteres": None, "modelo": "models/gemini-2.5-flash", "timeout": 60},
+]
+MODELO_FALLBACK = os.getenv("GEMINI_MODELO_FALLBACK", "models/gemini-2.0-flash")
+ORCAMENTO_LATENCIA_PADRAO = float(os.getenv("GEMINI_ORCAMENTO_LATENCIA", "60")) # segundos por correção
+TIMEOUT_MINIMO_GEMINI = 5
+ERROS_PARA_FALLBACK = (DeadlineExceeded, ResourceExhausted, ServiceUnavailable, TimeoutError)
+
+def _carregar_rotas_modelos():
+    rotas_json = os.getenv("GEMINI_ROTAS_MODELOS")
+    if rotas_json:
+        try:
+            return json.loads(rotas_json)
+        except ValueError:
+            st.warning("GEMINI_ROTAS_MODELOS não é um JSON válido. Usando as rotas padrão.")
+    return ROTAS_MODELOS_PADRAO
+
+ROTAS_MODELOS = _carregar_rotas_modelos()
+
+@st.cache_resource
+def obter_modelo_gemini(nome_modelo):
+    """Uma instância de GenerativeModel por nome de modelo, compartilhada pelo processo."""
+    return genai.GenerativeModel(nome_modelo)
 
 # --- CONFIGURAÇÃO DO FIRESTORE ---
 # Caminho para o arquivo JSON da sua chave de serviço do Google Cloud para TESTE LOCAL
@@ -154,6 +212,10 @@ db = firestore.client() # Inicializa o cliente Firestore
 USERS_COLLECTION = "users"
 CARDS_COLLECTION = "user_cards" # Para armazenar cartões de cada usuário (subcoleção)
 FEEDBACK_COLLECTION = "feedback_history" # Para armazenar histórico de feedback de cada usuário (subcoleção)
+SUMMARY_COLLECTION = "feedback_summaries" # Resumos por cartão do histórico já compactado (subcoleção)
+ARCHIVE_COLLECTION = "feedback_archive" # Entradas do histórico já compactado, em lotes gzip (subcoleção)
+SHARED_DECKS_COLLECTION = "shared_decks" # Baralhos compartilhados publicados pelo admin
+SHARED_DECK_CARDS_COLLECTION = "cards" # Cartões de um baralho compartilhado (subcoleção)
 
 # --- Constantes para Nomes de Arquivo e Diretório Base (para compatibilidade/local) ---
 BASE_DATA_DIR = "data"
@@ -164,6 +226,184 @@ USERS_FILE = os.path.join(BASE_DATA_DIR, "users.json") # (localmente, para inici
 # --- DEFINIÇÃO DO ADMINISTRADOR ---
 ADMIN_USERNAME = "admin"
 
+# --- CAMADA DE CACHE COMPARTILHADO (PARA VÁRIAS RÉPLICAS ATRÁS DE UM BALANCEADOR) ---
+# Sem SHARED_CACHE_URL o cache fica no próprio processo (comportamento de réplica única).
+# Com SHARED_CACHE_URL=redis://host:6379/0 (requer 'pip install redis'), usuários, baralhos,
+# correções do Gemini e agregados por usuário ficam num Redis (ou servidor compatível) visto por
+# todas as réplicas. Toda invalidação é publicada num canal para que cada réplica descarte
+# as cópias locais (L1 e baralho em memória) daquela chave.
+SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL")
+CACHE_PREFIXO = "discursivas"
+CACHE_VERSAO_ESQUEMA = 1 # Incrementar quando o formato dos valores mudar: chaves antigas são ignoradas
+CACHE_CANAL_INVALIDACAO = f"{CACHE_PREFIXO}:invalidacao"
+CACHE_TTL_USUARIOS = 300
+CACHE_TTL_CARTOES = 6 * 3600
+CACHE_TTL_CORRECOES = 7 * 24 * 3600
+CACHE_TTL_AGREGADOS = 3600
+CACHE_TTL_L1 = 30 # segundos de cópia local por réplica quando o backend é remoto
+
+class CacheEmProcesso:
+    """Backend padrão: dicionário com expiração no próprio processo; publicações vão aos assinantes locais."""
+    def __init__(self):
+        self._dados = {}
+        self._lock = threading.Lock()
+        self._assinantes = {}
+
+    def get(self, chave):
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is None:
+                return None
+            valor, expira_em = item
+            if expira_em is not None and expira_em < datetime.datetime.now().timestamp():
+                del self._dados[chave]
+                return None
+            return valor
+
+    def set(self, chave, valor, ttl=None):
+        expira_em = datetime.datetime.now().timestamp() + ttl if ttl else None
+        with self._lock:
+            self._dados[chave] = (valor, expira_em)
+
+    def delete(self, *chaves):
+        with self._lock:
+            for chave in chaves:
+                self._dados.pop(chave, None)
+
+    def publish(self, canal, mensagem):
+        for callback in list(self._assinantes.get(canal, [])):
+            callback(mensagem)
+
+    def subscribe(self, canal, callback):
+        self._assinantes.setdefault(canal, []).append(callback)
+
+
+class CacheRedis:
+    """
+    Backend no protocolo do Redis. Aceita uma URL (redis://, rediss://, unix://) ou um cliente já
+    construído com a mesma interface — por exemplo fakeredis.FakeRedis() ou um redis-server local em testes.
+    """
+    def __init__(self, url=None, cliente=None):
+        if cliente is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("SHARED_CACHE_URL definido, mas o pacote 'redis' não está instalado.")
+            cliente = redis.Redis.from_url(url)
+        self._cliente = cliente
+        self._pubsub = None
+
+    def get(self, chave):
+        valor = self._cliente.get(chave)
+        return valor.decode("utf-8") if isinstance(valor, bytes) else valor
+
+    def set(self, chave, valor, ttl=None):
+        self._cliente.set(chave, valor, ex=ttl)
+
+    def delete(self, *chaves):
+        if chaves:
+            self._cliente.delete(*chaves)
+
+    def publish(self, canal, mensagem):
+        self._cliente.publish(canal, mensagem)
+
+    def subscribe(self, canal, callback):
+        def handler(mensagem_redis):
+            dados = mensagem_redis.get("data")
+            callback(dados.decode("utf-8") if isinstance(dados, bytes) else dados)
+        self._pubsub = self._cliente.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{canal: handler})
+        self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+class CacheCompartilhado:
+    """
+    Fachada usada pelo app: chaves versionadas '<prefixo>:v<versão>:<namespace>:<chave>', valores em JSON,
+    cópia local (L1) curta quando o backend é remoto e invalidação publicada para todas as réplicas.
+    """
+    def __init__(self, backend, ao_invalidar=None):
+        self.backend = backend
+        self.replica_id = hashlib.sha1(os.urandom(16)).hexdigest()[:12]
+        self._remoto = not isinstance(backend, CacheEmProcesso)
+        self._l1 = CacheEmProcesso()
+        self._ao_invalidar = ao_invalidar
+        backend.subscribe(CACHE_CANAL_INVALIDACAO, self._receber_invalidacao)
+
+    @staticmethod
+    def chave(namespace, chave):
+        return f"{CACHE_PREFIXO}:v{CACHE_VERSAO_ESQUEMA}:{namespace}:{chave}"
+
+    def obter(self, namespace, chave):
+        chave_completa = self.chave(namespace, chave)
+        try:
+            bruto = self._l1.get(chave_completa) if self._remoto else None
+            if bruto is None:
+                bruto = self.backend.get(chave_completa)
+                if bruto is not None and self._remoto:
+                    self._l1.set(chave_completa, bruto, CACHE_TTL_L1)
+            return json.loads(bruto) if bruto is not None else None
+        except Exception:
+            return None # Cache indisponível nunca derruba o app: cai na leitura normal
+
+    def gravar(self, namespace, chave, valor, ttl=None):
+        chave_completa = self.chave(namespace, chave)
+        bruto = json.dumps(valor, ensure_ascii=False, default=str)
+        try:
+            self.backend.set(chave_completa, bruto, ttl)
+            if self._remoto:
+                self._l1.set(chave_completa, bruto, CACHE_TTL_L1)
+        except Exception:
+            pass
+
+    def invalidar(self, namespace, chave, manter_local=False):
+        """Apaga a chave no backend e avisa as réplicas. manter_local=True preserva o estado em memória desta réplica."""
+        chave_completa = self.chave(namespace, chave)
+        self._l1.delete(chave_completa)
+        try:
+            self.backend.delete(chave_completa)
+            self.backend.publish(CACHE_CANAL_INVALIDACAO, json.dumps({
+                "origem": self.replica_id if manter_local else None,
+                "namespace": namespace,
+                "chave": chave,
+            }))
+        except Exception:
+            pass
+
+    def avisar(self, namespace, chave):
+        """Avisa as réplicas (inclusive esta) de uma mudança em (namespace, chave) sem apagar o valor do backend."""
+        try:
+            self.backend.publish(CACHE_CANAL_INVALIDACAO, json.dumps({"origem": None, "namespace": namespace, "chave": chave}))
+        except Exception:
+            pass
+
+    def _receber_invalidacao(self, mensagem):
+        try:
+            dados = json.loads(mensagem)
+        except (TypeError, ValueError):
+            return
+        if dados.get("origem") == self.replica_id:
+            return
+        self._l1.delete(self.chave(dados["namespace"], dados["chave"]))
+        if self._ao_invalidar:
+            self._ao_invalidar(dados["namespace"], dados["chave"])
+
+@st.cache_resource
+def obter_cache_compartilhado():
+    """Instância única por processo da camada de cache (backend escolhido por SHARED_CACHE_URL)."""
+    registro_baralhos = _registro_baralhos()
+
+    def ao_invalidar(namespace, chave):
+        # Outra réplica alterou os cartões: descarta o baralho em memória para recarregar na próxima leitura
+        if namespace == "cartoes":
+            with registro_baralhos["lock"]:
+                registro_baralhos["baralhos"].pop(chave, None)
+        elif namespace == "perfilador":
+            # Pedido de perfil para o usuário: as sessões dele nesta réplica passam a consultar o cache
+            _registro_perfilador()["armados"].add(chave)
+
+    backend = CacheRedis(SHARED_CACHE_URL) if SHARED_CACHE_URL else CacheEmProcesso()
+    return CacheCompartilhado(backend, ao_invalidar=ao_invalidar)
+
 # --- Funções Auxiliares para Caminhos de Arquivo por Usuário (e Global, se ainda usado localmente) ---
 def get_user_data_path(username):
     user_dir = os.path.join(BASE_DATA_DIR, username)
@@ -203,39 +443,529 @@ def adicionar_cartao_firestore(card_data, username): # NOVA FUNÇÃO
         card_to_add = card_data.copy()
         if 'doc_id' in card_to_add:
             del card_to_add['doc_id']
+        if PRATICA_POR_CONSULTA: # Campos de ordenação das consultas de prática (cartão nunca respondido)
+            card_to_add.update(campos_pratica())
         
-        doc_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).add(card_to_add)
+        doc_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).add(formato_cartao_armazenado(card_to_add))
         st.success(f"Cartão adicionado com ID: {doc_ref[1].id}")
         return doc_ref[1].id # Retorna o ID do documento criado
     except Exception as e:
         st.error(f"Erro ao adicionar cartão no Firestore: {e}")
         return None
 
-def atualizar_cartao_firestore(doc_id, card_data, username): # NOVA FUNÇÃO
-    """Atualiza um cartão existente no Firestore pelo seu doc_id."""
+def atualizar_cartoes_em_lote(username, atualizacoes):
+    """
+    Aplica várias atualizações ({doc_id: campos}) numa única escrita em lote.
+    A grade de gerenciamento limita a operação a uma página, bem abaixo do teto de 500 do Firestore.
+    """
+    if not atualizacoes:
+        return True
     try:
-        card_to_update = card_data.copy()
-        if 'doc_id' in card_to_update: # Não precisamos do doc_id no próprio documento
-            del card_to_update['doc_id']
-        
-        db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).document(doc_id).update(card_to_update)
-        st.success(f"Cartão com ID {doc_id} atualizado no Firestore.")
+        cartoes_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+        batch = db.batch()
+        for doc_id, campos in atualizacoes.items():
+            batch.update(cartoes_ref.document(doc_id), formato_cartao_armazenado({k: v for k, v in campos.items() if k != 'doc_id'}, atualizacao=True))
+        batch.commit()
         return True
     except Exception as e:
-        st.error(f"Erro ao atualizar cartão com ID {doc_id} no Firestore: {e}")
+        st.error(f"Erro ao atualizar {len(atualizacoes)} cartões no Firestore: {e}")
         return False
 
-def excluir_cartao_firestore(doc_id, username): # NOVA FUNÇÃO
-    """Exclui um cartão específico do Firestore pelo seu doc_id."""
+def excluir_cartoes_em_lote(username, doc_ids):
+    """Exclui vários cartões numa única escrita em lote."""
+    if not doc_ids:
+        return True
     try:
-        db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).document(doc_id).delete()
-        st.success(f"Cartão com ID {doc_id} excluído do Firestore.")
+        materializar_perguntas_historico(username, cartoes_proprios(username, doc_ids))
+        cartoes_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+        batch = db.batch()
+        for doc_id in doc_ids:
+            batch.delete(cartoes_ref.document(doc_id))
+        batch.commit()
         return True
     except Exception as e:
-        st.error(f"Erro ao excluir cartão com ID {doc_id} do Firestore: {e}")
+        st.error(f"Erro ao excluir {len(doc_ids)} cartões do Firestore: {e}")
         return False
 
 
+# --- ARMAZENAMENTO COMPACTO DE CARTÕES (COMPARTILHADO ENTRE AS SESSÕES DO USUÁRIO) ---
+# Cada sessão guardava três listas de dicionários completos (user_cartoes, ordenados e difíceis).
+# Agora existe um único baralho imutável por usuário no processo, e as sessões guardam apenas
+# arrays de índices inteiros apontando para ele.
+class Cartao:
+    """
+    Registro imutável de um cartão. Usa __slots__ (sem __dict__ por instância) e
+    aceita acesso no estilo card["materia"] / card.get("doc_id") para manter o código das abas.
+    A resposta esperada pode estar comprimida (formato compacto do Firestore) e só é
+    descomprimida quando lida.
+    """
+    __slots__ = ("doc_id", "materia", "assunto", "pergunta", "_resposta_esperada", "rubrica", "baralho_id", "_itens_rubrica")
+    CAMPOS = ("doc_id", "materia", "assunto", "pergunta", "resposta_esperada", "rubrica", "baralho_id")
+    _RUBRICA_NAO_VERIFICADA = object()
+
+    def __init__(self, doc_id, materia, assunto, pergunta, resposta_esperada, rubrica=None, baralho_id=None):
+        object.__setattr__(self, "doc_id", doc_id)
+        # Matérias e assuntos se repetem muito: internar as strings evita cópias duplicadas
+        object.__setattr__(self, "materia", sys.intern(str(materia)))
+        object.__setattr__(self, "assunto", sys.intern(str(assunto)))
+        object.__setattr__(self, "pergunta", pergunta)
+        object.__setattr__(self, "_resposta_esperada", resposta_esperada) # str, ou bytes comprimidos
+        object.__setattr__(self, "rubrica", rubrica) # Ver gerar_rubrica(); None se ainda não foi gerada
+        object.__setattr__(self, "baralho_id", baralho_id) # Baralho compartilhado de origem; None para cartões próprios
+        object.__setattr__(self, "_itens_rubrica", Cartao._RUBRICA_NAO_VERIFICADA)
+
+    def __setattr__(self, nome, valor):
+        raise AttributeError("Cartao é imutável. Publique uma nova versão do baralho.")
+
+    def __getitem__(self, campo):
+        if campo not in Cartao.CAMPOS:
+            raise KeyError(campo)
+        return getattr(self, campo)
+
+    def get(self, campo, padrao=None):
+        if campo not in Cartao.CAMPOS:
+            return padrao
+        return getattr(self, campo)
+
+    @property
+    def resposta_esperada(self):
+        valor = self._resposta_esperada
+        return compressor_textos().descomprimir(valor) if isinstance(valor, bytes) else valor
+
+    @property
+    def itens_rubrica(self):
+        """
+        Itens da rubrica vigente (ver rubrica_vigente). Conferir o hash descomprime a resposta esperada;
+        como o cartão é imutável, a conferência é feita uma vez por instância.
+        """
+        if self._itens_rubrica is Cartao._RUBRICA_NAO_VERIFICADA:
+            object.__setattr__(self, "_itens_rubrica", _conferir_rubrica(self))
+        return self._itens_rubrica
+
+    @property
+    def card_id(self):
+        """Chave usada para casar o cartão com as entradas do histórico de feedback."""
+        return (self.pergunta, self.materia, self.assunto)
+
+    def to_dict(self):
+        return {campo: getattr(self, campo) for campo in Cartao.CAMPOS}
+
+    def to_snapshot(self):
+        """Como to_dict(), mas sem descomprimir: a resposta comprimida vai em base64 (snapshots em JSON)."""
+        dados = {campo: getattr(self, campo) for campo in Cartao.CAMPOS if campo != "resposta_esperada"}
+        if isinstance(self._resposta_esperada, bytes):
+            dados["resposta_esperada" + SUFIXO_COMPACTADO] = self._resposta_esperada
+        else:
+            dados["resposta_esperada"] = self._resposta_esperada
+        return campos_para_json(dados)
+
+    @classmethod
+    def from_dict(cls, card_data, doc_id=None):
+        comprimida = card_data.get("resposta_esperada" + SUFIXO_COMPACTADO)
+        if isinstance(comprimida, str): # base64, vindo de um snapshot
+            comprimida = base64.b64decode(comprimida)
+        return cls(
+            doc_id if doc_id is not None else card_data.get("doc_id"),
+            card_data.get("materia", ""),
+            card_data.get("assunto", ""),
+            card_data.get("pergunta", ""),
+            bytes(comprimida) if comprimida is not None else card_data.get("resposta_esperada", ""),
+            card_data.get("rubrica"),
+            card_data.get("baralho_id"),
+        )
+
+
+class BaralhoUsuario:
+    """
+    Snapshot imutável dos cartões de um usuário. Qualquer alteração gera um novo
+    baralho com outra versão; as sessões comparam a versão para saber quando
+    recalcular seus arrays de índices.
+    """
+    __slots__ = ("username", "versao", "cartoes", "_posicao_por_doc_id")
+
+    def __init__(self, username, cartoes, versao):
+        self.username = username
+        self.versao = versao
+        self.cartoes = tuple(cartoes)
+        self._posicao_por_doc_id = {cartao.doc_id: i for i, cartao in enumerate(self.cartoes)}
+
+    def __len__(self):
+        return len(self.cartoes)
+
+    def posicao(self, doc_id):
+        return self._posicao_por_doc_id.get(doc_id)
+
+    def contem_igual(self, cartao):
+        """True se já existe um cartão com o mesmo doc_id e o mesmo conteúdo."""
+        posicao = self._posicao_por_doc_id.get(cartao.doc_id)
+        return posicao is not None and self.cartoes[posicao].to_snapshot() == cartao.to_snapshot()
+
+    def com_alteracoes(self, nova_versao, alterados=(), removidos=()):
+        """
+        Retorna um novo baralho aplicando os cartões adicionados/alterados e os doc_ids removidos.
+        Cartões alterados mantêm a posição; novos entram no final.
+        """
+        novos_cartoes = list(self.cartoes)
+        for cartao in alterados:
+            posicao = self._posicao_por_doc_id.get(cartao.doc_id)
+            if posicao is None:
+                novos_cartoes.append(cartao)
+            else:
+                novos_cartoes[posicao] = cartao
+        removidos = set(removidos)
+        if removidos:
+            novos_cartoes = [c for c in novos_cartoes if c.doc_id not in removidos]
+        return BaralhoUsuario(self.username, novos_cartoes, nova_versao)
+
+
+@st.cache_resource
+def _registro_baralhos():
+    """Registro do processo: um baralho por usuário, compartilhado por todas as sessões abertas."""
+    return {"lock": threading.Lock(), "baralhos": {}, "combinados": {}, "versoes": itertools.count(1)}
+
+def carregar_baralho(username):
+    """
+    Publica um novo baralho do usuário no registro do processo, lendo do cache compartilhado
+    (snapshot gravado por qualquer réplica) ou, na falta dele, do Firestore.
+    """
+    registro = _registro_baralhos()
+    cache = obter_cache_compartilhado()
+    snapshot = cache.obter("cartoes", username)
+    if snapshot is None:
+        snapshot = [campos_para_json(card_data) for card_data in carregar_cartoes(username)]
+        cache.gravar("cartoes", username, snapshot, CACHE_TTL_CARTOES)
+    cartoes = [Cartao.from_dict(card_data) for card_data in snapshot]
+    with registro["lock"]:
+        baralho = BaralhoUsuario(username, cartoes, next(registro["versoes"]))
+        registro["baralhos"][username] = baralho
+    return baralho
+
+def obter_baralho_proprio(username):
+    """Retorna o baralho dos cartões do próprio usuário, carregando do Firestore apenas se ainda não existir."""
+    baralho = _registro_baralhos()["baralhos"].get(username)
+    if baralho is None:
+        baralho = carregar_baralho(username)
+    return baralho
+
+def publicar_alteracoes_baralho(username, alterados=(), removidos=(), registro=None, conjunto_completo=False):
+    """
+    Aplica alterações (já gravadas no Firestore) gerando nova versão do baralho, sem reler a coleção.
+    Cartões idênticos aos atuais são ignorados; sem mudança efetiva, a versão não muda.
+    'registro' permite chamar a partir das threads dos listeners, fora do contexto do Streamlit.
+    'conjunto_completo' indica que 'alterados' já é o baralho inteiro (snapshot inicial do listener).
+    """
+    if registro is None:
+        registro = _registro_baralhos()
+        if username not in registro["baralhos"] and not conjunto_completo:
+            # Sem baralho no processo: parte do conjunto completo, não só dos cartões alterados
+            carregar_baralho(username)
+    with registro["lock"]:
+        atual = registro["baralhos"].get(username)
+        if atual is None and not conjunto_completo:
+            # Listener sem baralho no processo (descartado por invalidação): a próxima leitura carrega tudo
+            return None
+        if atual is None:
+            atual = BaralhoUsuario(username, [], 0)
+        alterados = [c for c in alterados if not atual.contem_igual(c)]
+        removidos = [doc_id for doc_id in removidos if atual.posicao(doc_id) is not None]
+        if not alterados and not removidos and username in registro["baralhos"]:
+            return atual
+        baralho = atual.com_alteracoes(next(registro["versoes"]), alterados, removidos)
+        registro["baralhos"][username] = baralho
+    return baralho
+
+def propagar_baralho_para_replicas(baralho):
+    """Grava o snapshot atualizado no cache compartilhado e avisa as outras réplicas para descartarem o delas."""
+    cache = obter_cache_compartilhado()
+    cache.invalidar("cartoes", baralho.username, manter_local=True)
+    cache.gravar("cartoes", baralho.username, [c.to_snapshot() for c in baralho.cartoes], CACHE_TTL_CARTOES)
+    cache.gravar("catalogo_assuntos", baralho.username, catalogo_do_baralho(baralho), CACHE_TTL_CARTOES)
+
+# --- BARALHOS COMPARTILHADOS (SOMENTE LEITURA, GRAVADOS UMA VEZ E ASSINADOS POR VÁRIOS USUÁRIOS) ---
+# O admin publica um baralho em 'shared_decks/<id>/cards' e os usuários o assinam (campo
+# 'baralhos_assinados' do documento do usuário). Os cartões ficam uma única vez no Firestore e uma
+# única vez na memória de cada processo, reaproveitados por todas as sessões; o campo 'versao' do
+# documento do baralho diz quando recarregar. Do lado do usuário fica apenas o histórico, cujas
+# entradas apontam o cartão por (pergunta, matéria, assunto) e por cartao_id "<baralho>:<cartão>".
+# obter_baralho() devolve a visão combinada (cartões próprios + assinados), então as abas de
+# estudo, difíceis e métricas tratam os dois tipos da mesma forma.
+CACHE_TTL_VERSAO_COMPARTILHADO = 60 # segundos até conferir de novo a versão publicada de um baralho
+
+class BaralhoCompartilhado:
+    """Snapshot imutável de um baralho compartilhado, com os cartões já no formato Cartao."""
+    __slots__ = ("deck_id", "nome", "versao", "cartoes")
+
+    def __init__(self, deck_id, nome, versao, cartoes):
+        self.deck_id = deck_id
+        self.nome = nome
+        self.versao = versao
+        self.cartoes = tuple(cartoes)
+
+@st.cache_resource
+def _registro_baralhos_compartilhados():
+    """Registro do processo: um snapshot por baralho compartilhado, visto por todas as sessões."""
+    return {"lock": threading.Lock(), "lock_carga": threading.Lock(), "baralhos": {}}
+
+def listar_baralhos_compartilhados():
+    """[{id, nome, versao, total_cartoes, ...}] dos baralhos publicados (cache compartilhado)."""
+    cache = obter_cache_compartilhado()
+    baralhos = cache.obter("baralhos_compartilhados", "todos")
+    if baralhos is None:
+        try:
+            baralhos = sorted(({"id": doc.id, **doc.to_dict()} for doc in db.collection(SHARED_DECKS_COLLECTION).stream()),
+                              key=lambda b: b.get("nome", ""))
+        except Exception as e:
+            st.error(f"Erro ao carregar os baralhos compartilhados: {e}")
+            return []
+        cache.gravar("baralhos_compartilhados", "todos", baralhos, CACHE_TTL_USUARIOS)
+    return baralhos
+
+def versao_baralho_compartilhado(deck_id):
+    """Versão publicada do baralho (conferida no Firestore no máximo a cada CACHE_TTL_VERSAO_COMPARTILHADO), ou None."""
+    cache = obter_cache_compartilhado()
+    dados = cache.obter("versao_baralho_compartilhado", deck_id)
+    if dados is None:
+        doc = db.collection(SHARED_DECKS_COLLECTION).document(deck_id).get()
+        dados = {"versao": doc.to_dict().get("versao", 0) if doc.exists else None,
+                 "nome": doc.to_dict().get("nome", deck_id) if doc.exists else deck_id}
+        cache.gravar("versao_baralho_compartilhado", deck_id, dados, CACHE_TTL_VERSAO_COMPARTILHADO)
+    return dados["versao"], dados["nome"]
+
+def obter_baralho_compartilhado(deck_id):
+    """Snapshot do baralho compartilhado no processo, recarregado só quando a versão publicada muda."""
+    registro = _registro_baralhos_compartilhados()
+    versao, nome = versao_baralho_compartilhado(deck_id)
+    if versao is None: # Baralho excluído
+        return None
+    atual = registro["baralhos"].get(deck_id)
+    if atual is not None and atual.versao == versao:
+        return atual
+    # Uma carga por vez: com muitos assinantes logando juntos, só a primeira sessão lê o Firestore
+    with registro["lock_carga"]:
+        atual = registro["baralhos"].get(deck_id)
+        if atual is not None and atual.versao == versao:
+            return atual
+        cartoes = []
+        for doc in db.collection(SHARED_DECKS_COLLECTION).document(deck_id).collection(SHARED_DECK_CARDS_COLLECTION).stream():
+            cartoes.append(Cartao.from_dict({**doc.to_dict(), "baralho_id": deck_id}, doc_id=f"{deck_id}:{doc.id}"))
+        baralho = BaralhoCompartilhado(deck_id, nome, versao, cartoes)
+        with registro["lock"]:
+            registro["baralhos"][deck_id] = baralho
+    return baralho
+
+def assinaturas_usuario(username):
+    """IDs dos baralhos compartilhados assinados pelo usuário (cache compartilhado)."""
+    cache = obter_cache_compartilhado()
+    assinados = cache.obter("assinaturas", username)
+    if assinados is None:
+        try:
+            doc = db.collection(USERS_COLLECTION).document(username).get()
+        except Exception as e:
+            st.error(f"Erro ao carregar os baralhos assinados por '{username}': {e}")
+            return []
+        assinados = (doc.to_dict() or {}).get("baralhos_assinados", []) if doc.exists else []
+        cache.gravar("assinaturas", username, assinados, CACHE_TTL_USUARIOS)
+    return assinados
+
+def alterar_assinatura(username, deck_id, assinar=True):
+    """Inclui (ou remove) o baralho compartilhado nas assinaturas do usuário."""
+    operacao = firestore.ArrayUnion([deck_id]) if assinar else firestore.ArrayRemove([deck_id])
+    db.collection(USERS_COLLECTION).document(username).update({"baralhos_assinados": operacao})
+    obter_cache_compartilhado().invalidar("assinaturas", username)
+
+def publicar_baralho_compartilhado(nome, cartoes, deck_id=None):
+    """
+    Publica (ou republica) um baralho compartilhado a partir de cartões de um usuário. O ID de cada
+    cartão compartilhado é o doc_id de origem, então republicar mantém o vínculo com o histórico dos
+    assinantes. Cartões que saíram da origem são excluídos. Retorna (deck_id, quantidade de cartões).
+    """
+    deck_ref = db.collection(SHARED_DECKS_COLLECTION).document(deck_id) if deck_id else db.collection(SHARED_DECKS_COLLECTION).document()
+    cards_ref = deck_ref.collection(SHARED_DECK_CARDS_COLLECTION)
+    novos = {cartao.doc_id: {"materia": cartao.materia, "assunto": cartao.assunto, "pergunta": cartao.pergunta,
+                             "resposta_esperada": cartao.resposta_esperada, "rubrica": cartao.rubrica}
+             for cartao in cartoes}
+    removidos = [ref for ref in cards_ref.list_documents() if ref.id not in novos]
+
+    batch, operacoes = db.batch(), 0
+    for ref, dados in [(cards_ref.document(card_id), dados) for card_id, dados in novos.items()] + [(ref, None) for ref in removidos]:
+        if dados is None:
+            batch.delete(ref)
+        else:
+            batch.set(ref, formato_cartao_armazenado(dados))
+        operacoes += 1
+        if operacoes >= 400:
+            batch.commit()
+            batch, operacoes = db.batch(), 0
+    if operacoes:
+        batch.commit()
+    # A versão só sobe depois que todos os cartões foram gravados
+    deck_ref.set({"nome": nome, "total_cartoes": len(novos), "atualizado_em": datetime.datetime.now().isoformat()}, merge=True)
+    deck_ref.update({"versao": firestore.Increment(1)})
+
+    cache = obter_cache_compartilhado()
+    cache.invalidar("versao_baralho_compartilhado", deck_ref.id)
+    cache.invalidar("baralhos_compartilhados", "todos")
+    return deck_ref.id, len(novos)
+
+def remover_copias_pessoais(username, deck_id):
+    """
+    Exclui os cartões próprios do usuário idênticos (mesma pergunta, matéria e assunto) a cartões do
+    baralho compartilhado. O histórico continua valendo, pois casa com o cartão compartilhado pela
+    mesma chave. Retorna a quantidade excluída.
+    """
+    compartilhado = obter_baralho_compartilhado(deck_id)
+    if compartilhado is None:
+        return 0
+    chaves_compartilhadas = {cartao.card_id for cartao in compartilhado.cartoes}
+    copias = [c.doc_id for c in obter_baralho_proprio(username).cartoes if c.card_id in chaves_compartilhadas]
+    materializar_perguntas_historico(username, cartoes_proprios(username, copias))
+    cards_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+    for inicio in range(0, len(copias), 400):
+        batch = db.batch()
+        for doc_id in copias[inicio:inicio + 400]:
+            batch.delete(cards_ref.document(doc_id))
+        batch.commit()
+    if copias:
+        propagar_baralho_para_replicas(publicar_alteracoes_baralho(username, removidos=copias))
+    return len(copias)
+
+def obter_baralho(username):
+    """
+    Baralho que as sessões usam: cartões próprios seguidos dos cartões dos baralhos assinados.
+    A visão combinada guarda só referências aos Cartao compartilhados e ganha nova versão quando
+    qualquer uma das partes muda.
+    """
+    proprio = obter_baralho_proprio(username)
+    assinados = _baralhos_assinados(username)
+    if not assinados:
+        return proprio
+    chave = (proprio.versao, tuple((b.deck_id, b.versao) for b in assinados))
+    registro = _registro_baralhos()
+    with registro["lock"]:
+        combinado = registro["combinados"].get(username)
+        if combinado is None or combinado[0] != chave:
+            cartoes = proprio.cartoes + tuple(cartao for b in assinados for cartao in b.cartoes)
+            combinado = (chave, BaralhoUsuario(username, cartoes, next(registro["versoes"])))
+            registro["combinados"][username] = combinado
+    return combinado[1]
+
+
+def calcular_ultimas_notas(historico, resumos=()):
+    """Mapeia card_id -> nota da tentativa mais recente (histórico recente tem prioridade sobre o compactado)."""
+    ultimas_notas = {}
+    for entry in reversed(historico):
+        card_id = (entry["pergunta"], entry["materia"], entry["assunto"])
+        if card_id not in ultimas_notas:
+            ultimas_notas[card_id] = entry.get("nota_sentido")
+    for resumo in resumos:
+        ultimas_notas.setdefault((resumo["pergunta"], resumo["materia"], resumo["assunto"]), resumo.get("ultima_nota"))
+    return ultimas_notas
+
+def obter_agregados_usuario(username, historico, resumos=()):
+    """
+    Agregados por usuário (última nota de cada cartão, total de respostas, soma/quantidade de notas),
+    somando o histórico recente e os resumos do compactado. Ficam no cache compartilhado e são
+    invalidados a cada gravação no histórico.
+    """
+    cache = obter_cache_compartilhado()
+    agregados = cache.obter("agregados", username)
+    if agregados is None:
+        notas = [entry["nota_sentido"] for entry in historico if entry.get("nota_sentido") is not None]
+        agregados = {
+            "ultimas_notas": [[*card_id, nota] for card_id, nota in calcular_ultimas_notas(historico, resumos).items()],
+            "total_respostas": len(historico) + sum(r.get("tentativas", 0) for r in resumos),
+            "soma_notas": sum(notas) + sum(r.get("soma_notas", 0) for r in resumos),
+            "notas_validas": len(notas) + sum(r.get("notas_validas", 0) for r in resumos),
+        }
+        cache.gravar("agregados", username, agregados, CACHE_TTL_AGREGADOS)
+    return agregados
+
+def ultimas_notas_de_agregados(agregados):
+    return {(pergunta, materia, assunto): nota for pergunta, materia, assunto, nota in agregados["ultimas_notas"]}
+
+def indices_cartoes_dificeis(baralho, ultimas_notas):
+    """Índices dos cartões cuja última nota ficou abaixo de 80."""
+    dificeis = array("I")
+    for i, cartao in enumerate(baralho.cartoes):
+        nota = ultimas_notas.get(cartao.card_id)
+        if nota is not None and nota < 80:
+            dificeis.append(i)
+    return dificeis
+
+def atualizar_indices_sessao(username, reordenar=True):
+    """
+    Recalcula os arrays de índices da sessão (ordem da aba "Todas as Perguntas" e
+    lista de difíceis) a partir do baralho compartilhado e do histórico da sessão.
+    Com reordenar=False apenas a lista de difíceis é recalculada.
+    """
+    if PRATICA_POR_CONSULTA:
+        # As abas de prática consultam o Firestore: basta descartar as listas já lidas
+        descartar_pratica_sessao(apenas_dificeis=not reordenar)
+        if reordenar:
+            st.session_state.baralho_versao = obter_baralho(username).versao
+        return
+    baralho = obter_baralho(username)
+    ultimas_notas = ultimas_notas_de_agregados(obter_agregados_usuario(
+        username, st.session_state.feedback_history, st.session_state.historico_resumos))
+    if reordenar:
+        st.session_state.ordered_cards_for_session = array("I", sorted(
+            range(len(baralho)),
+            key=lambda i: ultimas_notas.get(baralho.cartoes[i].card_id, -1)
+        ))
+    st.session_state.difficult_cards_for_session = indices_cartoes_dificeis(baralho, ultimas_notas)
+    st.session_state.baralho_versao = baralho.versao
+
+def sincronizar_indices_sessao(username):
+    """Se outra sessão publicou uma nova versão do baralho, os índices desta sessão ficaram inválidos."""
+    baralho = obter_baralho(username)
+    if st.session_state.get("baralho_versao") != baralho.versao:
+        atualizar_indices_sessao(username)
+    return baralho
+
+def cartoes_por_indices(baralho, indices):
+    """Materializa a visão (lista de referências, não cópias) dos cartões de um array de índices."""
+    return [baralho.cartoes[i] for i in indices]
+
+def _tamanho_profundo(obj, vistos=None):
+    """Soma sys.getsizeof do objeto e de tudo que ele referencia (dicts, listas, tuplas, Cartao)."""
+    if vistos is None:
+        vistos = set()
+    if id(obj) in vistos:
+        return 0
+    vistos.add(id(obj))
+    tamanho = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        tamanho += sum(_tamanho_profundo(k, vistos) + _tamanho_profundo(v, vistos) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        tamanho += sum(_tamanho_profundo(item, vistos) for item in obj)
+    elif isinstance(obj, (Cartao, BaralhoUsuario)):
+        tamanho += sum(_tamanho_profundo(getattr(obj, campo), vistos) for campo in obj.__slots__)
+    return tamanho
+
+def relatorio_memoria_sessao(username):
+    """
+    Compara a memória da sessão no formato antigo (três listas de dicionários completos)
+    com o formato compacto (dois arrays de índices + baralho compartilhado pelo processo).
+    """
+    baralho = obter_baralho(username)
+    ordenados = cartoes_por_indices(baralho, st.session_state.ordered_cards_for_session)
+    dificeis = cartoes_por_indices(baralho, st.session_state.difficult_cards_for_session)
+    formato_antigo = (
+        _tamanho_profundo([c.to_dict() for c in baralho.cartoes])
+        + _tamanho_profundo([c.to_dict() for c in ordenados])
+        + _tamanho_profundo([c.to_dict() for c in dificeis])
+    )
+    por_sessao = (
+        _tamanho_profundo(st.session_state.ordered_cards_for_session)
+        + _tamanho_profundo(st.session_state.difficult_cards_for_session)
+    )
+    return {
+        "antes_bytes_por_sessao": formato_antigo,
+        "depois_bytes_por_sessao": por_sessao,
+        "baralho_compartilhado_bytes": _tamanho_profundo(baralho),
+    }
+
+
 # Funções de histórico de feedback (JÁ ESTAVAM OTIMIZADAS PARA ADD)
 def carregar_historico_feedback(username):
     """
@@ -244,8 +974,10 @@ def carregar_historico_feedback(username):
     historico = []
     try:
         docs = db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION).order_by('timestamp').stream()
-        for doc in docs:
-            historico.append(doc.to_dict())
+        entradas = [sem_resposta_armazenada(doc.to_dict()) for doc in docs]
+        baralho = baralho_das_referencias(username, entradas) if any("pergunta" not in entrada for entrada in entradas) else None
+        for entrada in entradas:
+            historico.append(expandir_entrada_historico(entrada, baralho))
         return historico
     except Exception as e:
         st.error(f"Erro ao carregar histórico de feedback de '{username}' do Firestore: {e}")
@@ -255,185 +987,2866 @@ def salvar_historico_feedback(historico_data, username):
     """
     Salva as novas entradas de histórico de feedback no Firestore para um usuário específico.
     Assume que o 'historico_data' contém todas as entradas, e apenas a última é nova.
-    Se a lista está vazia, limpa a coleção.
+    Se a lista está vazia, limpa todo o histórico do usuário (limpar_historico_usuario).
     """
     try:
         user_feedback_ref = db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION)
         
         if historico_data: # Se há algo no histórico para salvar/atualizar
             last_entry = historico_data[-1] # Pega a última entrada adicionada ao histórico em memória
-            user_feedback_ref.add(last_entry) # Adiciona como um novo documento no Firestore
+            user_feedback_ref.add(entrada_historico_armazenada(last_entry)) # Adiciona como um novo documento no Firestore
+            obter_cache_compartilhado().invalidar("agregados", username)
         else: # Se a lista de histórico na sessão está vazia, significa que o usuário limpou.
-            # Limpa a coleção inteira no Firestore para este usuário.
-            current_docs_refs = user_feedback_ref.stream()
-            for doc_ref in current_docs_refs:
-                doc_ref.reference.delete()
+            limpar_historico_usuario(username)
         
     except Exception as e:
         st.error(f"Erro ao salvar histórico de feedback de '{username}' no Firestore: {e}")
 
 
+def registrar_entrada_historico(entrada, username, chave_idempotencia):
+    """
+    Grava uma entrada do histórico usando a chave de idempotência como ID do documento.
+    create() falha se o documento já existe, então uma submissão repetida não duplica o histórico.
+    Retorna True se a entrada foi gravada agora e False se era duplicada (ou em caso de erro).
+    Os agregados da turma (análise do admin) são atualizados no mesmo commit, a partir da entrada completa.
+    """
+    try:
+        # A entrada e os agregados da turma vão no mesmo commit: uma duplicata (create falha) não conta duas vezes
+        batch = db.batch()
+        batch.create(db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION).document(chave_idempotencia),
+                     entrada_historico_armazenada(entrada))
+        incluir_agregados_turma(batch, entrada, username)
+        batch.commit()
+        obter_cache_compartilhado().invalidar("agregados", username)
+    except AlreadyExists:
+        return False
+    except Exception as e:
+        st.error(f"Erro ao salvar histórico de feedback de '{username}' no Firestore: {e}")
+        return False
+    if PRATICA_POR_CONSULTA:
+        # A entrada já está gravada: uma falha aqui só atrasa a ordem da prática ("Preencher Campos de Prática" corrige)
+        try:
+            atualizar_campos_pratica(username, entrada)
+        except Exception:
+            pass
+    return True
+
+
+# --- ANÁLISE DA TURMA (AGREGADOS GLOBAIS INCREMENTAIS) ---
+# A visão do admin sobre todos os alunos não lê nenhum 'feedback_history': cada resposta registrada soma,
+# no mesmo commit da entrada, contadores em 'cohort_stats' por cartão (pergunta/matéria/assunto), por
+# matéria/assunto, por faixa de nota (histograma) e por dia, além da última atividade do aluno.
+# Os documentos quentes são fragmentados em AGREGADOS_SHARDS (firestore.Increment num shard ao acaso);
+# o histograma e o dia, que toda resposta de todos os alunos incrementa, em AGREGADOS_SHARDS_GLOBAIS.
+# Como vão no mesmo commit da entrada, a disputa num shard atrasaria (ou faria falhar) o registro da resposta.
+# Montar a análise lê um número de documentos que depende de matérias, dias e do top-N de cartões, e não
+# de quantos alunos ou respostas existem. "Recalcular" refaz tudo a partir do histórico (uma única
+# varredura por collection group, para dados anteriores a este recurso).
+COHORT_STATS_COLLECTION = "cohort_stats"
+AGREGADOS_SHARDS = int(os.getenv("AGREGADOS_SHARDS", "4"))
+AGREGADOS_SHARDS_GLOBAIS = int(os.getenv("AGREGADOS_SHARDS_GLOBAIS", "32")) # faixas e dia (lidos por consulta, não por ID)
+AGREGADOS_FAIXAS = 10 # histograma de notas em faixas de 10 pontos
+ANALISE_TURMA_TTL = 60 # segundos no cache compartilhado
+ANALISE_TURMA_CHAVE_PADRAO = "15_30" # chave de cache de obter_analise_turma() com os parâmetros padrão
+ANALISE_TURMA_MIN_TENTATIVAS = 3 # cartões com menos tentativas não entram no ranking de difíceis
+NOTA_DIFICIL = 80 # mesma régua da lista de perguntas difíceis
+
+def _id_agregado(dimensao, *partes, shard=None):
+    chave = hashlib.sha1("\n".join(str(p) for p in partes).encode("utf-8")).hexdigest()[:20] if partes else "total"
+    return f"{dimensao}_{chave}" if shard is None else f"{dimensao}_{chave}_{shard}"
+
+def _contadores_resposta(nota):
+    """Contadores de uma resposta (tentativas, soma e quantidade de notas, notas abaixo de 80)."""
+    return {"tentativas": 1, "soma_notas": nota if nota is not None else 0, "notas_validas": int(nota is not None),
+            "abaixo_de_80": int(nota is not None and nota < NOTA_DIFICIL)}
+
+def _agregados_da_entrada(entrada):
+    """(ID do documento no shard 0, campos fixos, contadores) de cada agregado que a entrada soma, exceto o do aluno."""
+    nota = entrada.get("nota_sentido")
+    dia = str(entrada.get("timestamp", ""))[:10] or datetime.date.today().isoformat()
+    materia, assunto, pergunta = entrada.get("materia", ""), entrada.get("assunto", ""), entrada.get("pergunta", "")
+    contadores = _contadores_resposta(nota)
+    agregados = [
+        (_id_agregado("cartao", pergunta, materia, assunto, shard=0),
+         {"dimensao": "cartao", "chave": _id_agregado("cartao", pergunta, materia, assunto),
+          "pergunta": pergunta[:300], "materia": materia, "assunto": assunto}, contadores),
+        (_id_agregado("assunto", materia, assunto, shard=0), {"dimensao": "assunto", "materia": materia, "assunto": assunto}, contadores),
+        (_id_agregado("dia", dia, shard=0), {"dimensao": "dia", "dia": dia}, contadores),
+    ]
+    if nota is not None:
+        agregados.append((_id_agregado("faixas", shard=0), {"dimensao": "faixas"}, {f"faixa_{min(int(nota) // 10, AGREGADOS_FAIXAS - 1)}": 1}))
+    return agregados
+
+def incluir_agregados_turma(batch, entrada, username):
+    """Acrescenta ao lote os incrementos dos agregados da turma para uma nova entrada do histórico."""
+    ref = db.collection(COHORT_STATS_COLLECTION)
+    nota = entrada.get("nota_sentido")
+    dia = str(entrada.get("timestamp", ""))[:10] or datetime.date.today().isoformat()
+    shard = secrets.randbelow(AGREGADOS_SHARDS)
+    shard_global = secrets.randbelow(AGREGADOS_SHARDS_GLOBAIS)
+    contadores = {campo: firestore.Increment(valor) for campo, valor in _contadores_resposta(nota).items()}
+    materia, assunto, pergunta = entrada.get("materia", ""), entrada.get("assunto", ""), entrada.get("pergunta", "")
+    batch.set(ref.document(_id_agregado("cartao", pergunta, materia, assunto, shard=shard)),
+              {"dimensao": "cartao", "chave": _id_agregado("cartao", pergunta, materia, assunto),
+               "pergunta": pergunta[:300], "materia": materia, "assunto": assunto, **contadores}, merge=True)
+    batch.set(ref.document(_id_agregado("assunto", materia, assunto, shard=shard)),
+              {"dimensao": "assunto", "materia": materia, "assunto": assunto, **contadores}, merge=True)
+    batch.set(ref.document(_id_agregado("dia", dia, shard=shard_global)),
+              {"dimensao": "dia", "dia": dia, **contadores}, merge=True)
+    if nota is not None:
+        batch.set(ref.document(_id_agregado("faixas", shard=shard_global)),
+                  {"dimensao": "faixas", f"faixa_{min(int(nota) // 10, AGREGADOS_FAIXAS - 1)}": firestore.Increment(1)}, merge=True)
+    # Um documento por aluno (só ele escreve nele): a contagem de ativos é uma agregação count()
+    batch.set(ref.document(_id_agregado("aluno", username)),
+              {"dimensao": "aluno", "username": username, "ultima_resposta": dia, "tentativas": firestore.Increment(1)}, merge=True)
+
+def _somar_shards(docs, chave):
+    """Soma os contadores numéricos dos shards de cada grupo (chave(doc) -> dicionário somado)."""
+    grupos = {}
+    for doc in docs:
+        dados = doc.to_dict()
+        grupo = grupos.setdefault(chave(dados), {})
+        for campo, valor in dados.items():
+            if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                grupo[campo] = grupo.get(campo, 0) + valor
+            else:
+                grupo.setdefault(campo, valor)
+    return grupos
+
+def _contar(consulta):
+    """count() no servidor (agregação: não traz os documentos)."""
+    resultado = consulta.count().get()
+    return int(resultado[0][0].value)
+
+def obter_analise_turma(limite_cartoes=15, dias_atividade=30):
+    """Análise de todos os alunos a partir dos agregados (com cache compartilhado de ANALISE_TURMA_TTL)."""
+    cache = obter_cache_compartilhado()
+    chave_cache = f"{limite_cartoes}_{dias_atividade}"
+    analise = cache.obter("analise_turma", chave_cache)
+    if analise is not None:
+        return analise
+    ref = db.collection(COHORT_STATS_COLLECTION)
+    hoje = datetime.date.today()
+    inicio_atividade = (hoje - datetime.timedelta(days=dias_atividade - 1)).isoformat()
+
+    assuntos = _somar_shards(ref.where("dimensao", "==", "assunto").stream(), lambda d: (d["materia"], d["assunto"]))
+    faixas = _somar_shards(ref.where("dimensao", "==", "faixas").stream(), lambda d: "faixas").get("faixas", {})
+    dias = _somar_shards(ref.where("dimensao", "==", "dia").where("dia", ">=", inicio_atividade).stream(), lambda d: d["dia"])
+
+    # Candidatos a cartões difíceis: os shards com mais notas abaixo de 80; depois, os totais exatos deles
+    candidatos = ref.where("dimensao", "==", "cartao").order_by("abaixo_de_80", direction=firestore.Query.DESCENDING)
+    chaves_candidatas = list(dict.fromkeys(doc.get("chave") for doc in candidatos.limit(limite_cartoes * AGREGADOS_SHARDS * 2).stream()))
+    referencias = [ref.document(f"{chave}_{shard}") for chave in chaves_candidatas for shard in range(AGREGADOS_SHARDS)]
+    cartoes = _somar_shards([doc for doc in db.get_all(referencias) if doc.exists], lambda d: d["chave"]) if referencias else {}
+
+    def media(grupo):
+        return round(grupo["soma_notas"] / grupo["notas_validas"], 1) if grupo.get("notas_validas") else None
+
+    cartoes_dificeis = sorted(
+        (c for c in cartoes.values() if c.get("notas_validas", 0) >= ANALISE_TURMA_MIN_TENTATIVAS),
+        key=lambda c: (media(c), -c["notas_validas"]))[:limite_cartoes]
+    analise = {
+        "total_respostas": sum(a.get("tentativas", 0) for a in assuntos.values()),
+        "media_geral": round(sum(a.get("soma_notas", 0) for a in assuntos.values()) /
+                             max(1, sum(a.get("notas_validas", 0) for a in assuntos.values())), 1),
+        "alunos_com_respostas": _contar(ref.where("dimensao", "==", "aluno")),
+        "ativos_7_dias": _contar(ref.where("dimensao", "==", "aluno").where(
+            "ultima_resposta", ">=", (hoje - datetime.timedelta(days=6)).isoformat())),
+        "ativos_30_dias": _contar(ref.where("dimensao", "==", "aluno").where(
+            "ultima_resposta", ">=", (hoje - datetime.timedelta(days=29)).isoformat())),
+        "faixas": [faixas.get(f"faixa_{i}", 0) for i in range(AGREGADOS_FAIXAS)],
+        "assuntos": sorted(({
+            "materia": a["materia"], "assunto": a["assunto"], "tentativas": a.get("tentativas", 0), "nota_media": media(a),
+            "abaixo_de_80_pct": round(100 * a.get("abaixo_de_80", 0) / a["notas_validas"], 1) if a.get("notas_validas") else None,
+        } for a in assuntos.values()), key=lambda a: (a["nota_media"] is None, a["nota_media"])),
+        "cartoes_dificeis": [{
+            "pergunta": c["pergunta"], "materia": c["materia"], "assunto": c["assunto"], "tentativas": c.get("tentativas", 0),
+            "nota_media": media(c), "abaixo_de_80_pct": round(100 * c.get("abaixo_de_80", 0) / c["notas_validas"], 1),
+        } for c in cartoes_dificeis],
+        "atividade": [{"dia": dia, "respostas": dias[dia].get("tentativas", 0)} for dia in sorted(dias)],
+    }
+    cache.gravar("analise_turma", chave_cache, analise, ANALISE_TURMA_TTL)
+    return analise
+
+def recalcular_agregados_turma():
+    """
+    Refaz os agregados da turma a partir de todo o histórico (entradas recentes e resumos do compactado),
+    com uma varredura por collection group. Para dados anteriores aos agregados ou após correções manuais;
+    respostas registradas durante o recálculo podem ficar de fora. Retorna o número de entradas somadas.
+    """
+    ref = db.collection(COHORT_STATS_COLLECTION)
+    # Soma em memória por documento de destino (um único shard) e grava em lotes
+    acumulado = {}
+    def somar(id_doc, fixos, incrementos):
+        destino = acumulado.setdefault(id_doc, dict(fixos))
+        for campo, valor in incrementos.items():
+            destino[campo] = destino.get(campo, 0) + valor
+
+    total = 0
+    for doc in db.collection_group(FEEDBACK_COLLECTION).stream():
+        entrada = doc.to_dict()
+        username = doc.reference.parent.parent.id
+        entrada = expandir_entrada_historico(entrada, obter_baralho_proprio(username) if "pergunta" not in entrada else None)
+        for id_doc, fixos, contadores in _agregados_da_entrada(entrada):
+            somar(id_doc, fixos, contadores)
+        dia = str(entrada.get("timestamp", ""))[:10] or datetime.date.today().isoformat()
+        aluno = acumulado.setdefault(_id_agregado("aluno", username), {"dimensao": "aluno", "username": username, "ultima_resposta": dia})
+        aluno["ultima_resposta"] = max(aluno["ultima_resposta"], dia)
+        aluno["tentativas"] = aluno.get("tentativas", 0) + 1
+        total += 1
+    # Os resumos do histórico compactado entram com seus totais (sem dia: já saíram da janela de atividade).
+    # Eles não guardam quantas notas ficaram abaixo de 80: estima-se pela proporção nas últimas notas mantidas.
+    for doc in db.collection_group(SUMMARY_COLLECTION).stream():
+        resumo = doc.to_dict()
+        materia, assunto, pergunta = resumo.get("materia", ""), resumo.get("assunto", ""), resumo.get("pergunta", "")
+        contadores = {"tentativas": resumo.get("tentativas", 0), "soma_notas": resumo.get("soma_notas", 0),
+                      "notas_validas": resumo.get("notas_validas", 0), "abaixo_de_80": 0}
+        notas_mantidas = [n["nota"] for n in resumo.get("notas", [])]
+        if notas_mantidas:
+            contadores["abaixo_de_80"] = round(resumo.get("notas_validas", 0) *
+                                               sum(n < NOTA_DIFICIL for n in notas_mantidas) / len(notas_mantidas))
+        somar(_id_agregado("cartao", pergunta, materia, assunto, shard=0),
+              {"dimensao": "cartao", "chave": _id_agregado("cartao", pergunta, materia, assunto),
+               "pergunta": pergunta[:300], "materia": materia, "assunto": assunto}, contadores)
+        somar(_id_agregado("assunto", materia, assunto, shard=0), {"dimensao": "assunto", "materia": materia, "assunto": assunto}, contadores)
+        total += resumo.get("tentativas", 0)
+
+    # Só depois da varredura completa: sobrescreve os documentos e apaga os que não existem mais (outros shards)
+    operacoes = [(ref.document(id_doc), dados) for id_doc, dados in acumulado.items()]
+    operacoes += [(doc.reference, None) for doc in ref.stream() if doc.id not in acumulado]
+    for inicio in range(0, len(operacoes), LOTE_MAX_ESCRITAS):
+        batch = db.batch()
+        for doc_ref, dados in operacoes[inicio:inicio + LOTE_MAX_ESCRITAS]:
+            if dados is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, dados)
+        batch.commit()
+    obter_cache_compartilhado().invalidar("analise_turma", ANALISE_TURMA_CHAVE_PADRAO)
+    return total
+
+# --- RETENÇÃO E COMPACTAÇÃO DO HISTÓRICO ---
+# Entradas de 'feedback_history' mais antigas que a janela de retenção são resumidas em um documento
+# por cartão em 'feedback_summaries' (tentativas, série de notas, lacunas mais frequentes) e
+# arquivadas em 'feedback_archive' (JSON Lines compactado com gzip, um documento por lote) no mesmo
+# commit que as apaga: o arquivo fica no Firestore, e não no disco de uma réplica, que some com o
+# contêiner. A subcoleção "quente" fica limitada à janela, não importa há quanto tempo o aluno usa o app.
+HISTORICO_JANELA_DIAS = int(os.getenv("HISTORICO_JANELA_DIAS", "90"))
+COMPACTACAO_PAGINA = 200 # Entradas por commit: 200 exclusões + até 200 resumos + os lotes do arquivo cabem em 500 operações
+ARQUIVO_LOTE_MAX_BYTES = 900_000 # Abaixo do limite de 1 MiB por documento do Firestore
+RESUMO_MAX_NOTAS = 200 # Tamanho máximo da série de notas guardada em cada resumo
+RESUMO_MAX_LACUNAS = 10
+
+def id_resumo_cartao(card_id):
+    return hashlib.sha1("\x1f".join(card_id).encode("utf-8")).hexdigest()
+
+def extrair_lacunas(lacunas_conteudo):
+    """Quebra o markdown de lacunas em itens normalizados (sem marcadores), ignorando 'nenhuma lacuna'."""
+    itens = []
+    for linha in (lacunas_conteudo or "").splitlines():
+        item = linha.strip().lstrip("-*•").strip()
+        if item and not item.lower().startswith("nenhuma lacuna"):
+            itens.append(item)
+    return itens
+
+def carregar_resumos_historico(username):
+    """Carrega os resumos por cartão do histórico compactado."""
+    try:
+        docs = db.collection(USERS_COLLECTION).document(username).collection(SUMMARY_COLLECTION).stream()
+        return [doc.to_dict() for doc in docs]
+    except Exception as e:
+        st.error(f"Erro ao carregar resumos do histórico de '{username}' do Firestore: {e}")
+        return []
+
+def _mesclar_no_resumo(resumo, entry):
+    nota = entry.get("nota_sentido")
+    resumo["tentativas"] = resumo.get("tentativas", 0) + 1
+    if nota is not None:
+        resumo["soma_notas"] = resumo.get("soma_notas", 0) + nota
+        resumo["notas_validas"] = resumo.get("notas_validas", 0) + 1
+        resumo["notas"] = (resumo.get("notas", []) + [{"timestamp": entry["timestamp"], "nota": nota}])[-RESUMO_MAX_NOTAS:]
+    if entry["timestamp"] >= resumo.get("ultimo_timestamp", ""):
+        resumo["ultimo_timestamp"] = entry["timestamp"]
+        resumo["ultima_nota"] = nota
+    lacunas = Counter(resumo.get("lacunas_frequentes", {}))
+    lacunas.update(extrair_lacunas(entry.get("lacunas_conteudo")))
+    resumo["lacunas_frequentes"] = dict(lacunas.most_common(RESUMO_MAX_LACUNAS))
+
+def lotes_arquivo_historico(linhas, inicio=0):
+    """
+    Agrupa as linhas JSON do arquivo em lotes gzip que cabem num documento do Firestore.
+    Retorna a lista de (bytes comprimidos, posição da primeira linha, posição depois da última).
+    """
+    dados = gzip.compress("".join(linhas).encode("utf-8"))
+    if len(dados) <= ARQUIVO_LOTE_MAX_BYTES or len(linhas) == 1:
+        return [(dados, inicio, inicio + len(linhas))]
+    meio = len(linhas) // 2
+    return lotes_arquivo_historico(linhas[:meio], inicio) + lotes_arquivo_historico(linhas[meio:], inicio + meio)
+
+def ler_lote_arquivado(lote):
+    """Entradas de um documento de 'feedback_archive' (bytes voltam ao tipo original)."""
+    texto = gzip.decompress(lote["dados"]).decode("utf-8")
+    return [json.loads(linha, object_hook=backup_firestore._decodificar) for linha in texto.splitlines()]
+
+def compactar_historico_usuario(username, janela_dias=HISTORICO_JANELA_DIAS):
+    """
+    Compacta as entradas com timestamp anterior a (agora - janela_dias). Para cada página, o lote
+    arquivado, os resumos e as exclusões vão no mesmo commit: uma falha no meio não perde entradas
+    nem as conta em dobro. Retorna (quantidade de entradas compactadas, documentos de arquivo gravados).
+    """
+    limite = (datetime.datetime.now() - datetime.timedelta(days=janela_dias)).isoformat()
+    user_ref = db.collection(USERS_COLLECTION).document(username)
+    feedback_ref = user_ref.collection(FEEDBACK_COLLECTION)
+    summary_ref = user_ref.collection(SUMMARY_COLLECTION)
+    archive_ref = user_ref.collection(ARCHIVE_COLLECTION)
+    consulta = feedback_ref.where("timestamp", "<", limite).order_by("timestamp").limit(COMPACTACAO_PAGINA)
+
+    total = 0
+    lotes_gravados = 0
+    while True:
+        pagina = list(consulta.stream())
+        if not pagina:
+            break
+        # O arquivo guarda as entradas completas (sem textos comprimidos nem referências a cartões)
+        baralho = obter_baralho_proprio(username)
+        entradas = [expandir_entrada_historico(doc.to_dict(), baralho) for doc in pagina]
+        linhas = [json.dumps({"doc_id": doc.id, **entry}, ensure_ascii=False, default=backup_firestore._codificar) + "\n"
+                  for doc, entry in zip(pagina, entradas)]
+        lotes = lotes_arquivo_historico(linhas)
+
+        por_cartao = {}
+        for entry in entradas:
+            por_cartao.setdefault((entry["pergunta"], entry["materia"], entry["assunto"]), []).append(entry)
+        resumo_refs = {card_id: summary_ref.document(id_resumo_cartao(card_id)) for card_id in por_cartao}
+        existentes = {snap.id: snap.to_dict() for snap in db.get_all(list(resumo_refs.values())) if snap.exists}
+
+        batch = db.batch()
+        for card_id, entries in por_cartao.items():
+            resumo_doc = resumo_refs[card_id]
+            resumo = existentes.get(resumo_doc.id) or {"pergunta": card_id[0], "materia": card_id[1], "assunto": card_id[2]}
+            for entry in entries:
+                _mesclar_no_resumo(resumo, entry)
+            resumo["atualizado_em"] = datetime.datetime.now().isoformat()
+            batch.set(resumo_doc, resumo)
+        for dados, inicio, fim in lotes:
+            batch.set(archive_ref.document(), {
+                "dados": dados, "entradas": fim - inicio, "ate": limite,
+                "primeiro_timestamp": entradas[inicio]["timestamp"], "ultimo_timestamp": entradas[fim - 1]["timestamp"],
+                "arquivado_em": datetime.datetime.now().isoformat()})
+        for doc in pagina:
+            batch.delete(doc.reference)
+        batch.commit()
+        total += len(pagina)
+        lotes_gravados += len(lotes)
+    if total:
+        obter_cache_compartilhado().invalidar("agregados", username)
+    return total, lotes_gravados
+
+def limpar_historico_usuario(username):
+    """
+    Apaga todo o histórico do usuário (entradas, resumos e arquivo) em commits de até LOTE_MAX_ESCRITAS
+    operações, desconta dos agregados da turma o que essas respostas tinham somado e zera os campos de
+    prática ('ultima_nota'/'ultima_resposta') dos cartões. Uma falha no meio deixa parte dos agregados
+    sem desconto; "Recalcular" na análise da turma os refaz. Retorna a quantidade de entradas apagadas.
+    """
+    user_ref = db.collection(USERS_COLLECTION).document(username)
+    agregados_ref = db.collection(COHORT_STATS_COLLECTION)
+    descontos = {}
+    def descontar(entrada):
+        for id_doc, fixos, contadores in _agregados_da_entrada(entrada):
+            destino = descontos.setdefault(id_doc, (fixos, {}))[1]
+            for campo, valor in contadores.items():
+                destino[campo] = destino.get(campo, 0) + valor
+
+    exclusoes = []
+    docs_recentes = list(user_ref.collection(FEEDBACK_COLLECTION).stream())
+    entradas = [doc.to_dict() for doc in docs_recentes]
+    baralho = baralho_das_referencias(username, entradas) if any("pergunta" not in entrada for entrada in entradas) else None
+    for entrada in entradas:
+        descontar(expandir_entrada_historico(entrada, baralho))
+    total = len(entradas)
+    # As entradas compactadas estão completas no arquivo; os resumos são derivados delas e não descontam de novo
+    for doc in user_ref.collection(ARCHIVE_COLLECTION).stream():
+        arquivadas = ler_lote_arquivado(doc.to_dict())
+        for entrada in arquivadas:
+            descontar(entrada)
+        total += len(arquivadas)
+        exclusoes.append(doc.reference)
+    exclusoes += [doc.reference for doc in docs_recentes]
+    exclusoes += [doc.reference for doc in user_ref.collection(SUMMARY_COLLECTION).stream()]
+    exclusoes.append(agregados_ref.document(_id_agregado("aluno", username)))
+    praticados = user_ref.collection(CARDS_COLLECTION).where("ultima_resposta", ">", "").stream()
+
+    operacoes = [(doc_ref, None) for doc_ref in exclusoes]
+    operacoes += [(agregados_ref.document(id_doc), {**fixos, **{campo: firestore.Increment(-valor) for campo, valor in contadores.items()}})
+                  for id_doc, (fixos, contadores) in descontos.items()]
+    operacoes += [(doc.reference, campos_pratica()) for doc in praticados]
+    for inicio in range(0, len(operacoes), LOTE_MAX_ESCRITAS):
+        batch = db.batch()
+        for doc_ref, dados in operacoes[inicio:inicio + LOTE_MAX_ESCRITAS]:
+            if dados is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, dados, merge=True)
+        batch.commit()
+    cache = obter_cache_compartilhado()
+    cache.invalidar("agregados", username)
+    cache.invalidar("analise_turma", ANALISE_TURMA_CHAVE_PADRAO)
+    return total
+
+
+# --- DETECÇÃO DE PERGUNTAS QUASE DUPLICADAS (MINHASH + LSH) ---
+# Cada pergunta vira um conjunto de shingles (trechos de DUPLICATAS_SHINGLE caracteres do texto
+# normalizado) e uma assinatura MinHash de DUPLICATAS_PERMUTACOES valores, cuja taxa de coincidência
+# estima a similaridade de Jaccard entre dois textos. A assinatura é fatiada em DUPLICATAS_BANDAS
+# bandas, e cada banda indexa o cartão em um balde (LSH). Só cartões que dividem algum balde são
+# comparados, então a busca não percorre o baralho inteiro. O índice fica no processo, um por
+# usuário, e acompanha as versões do baralho recalculando apenas as perguntas que mudaram.
+DUPLICATAS_PERMUTACOES = 128
+DUPLICATAS_BANDAS = 32 # 32 bandas de 4 linhas: pares acima de ~0,6 de similaridade quase sempre viram candidatos
+DUPLICATAS_SHINGLE = 5
+DUPLICATAS_LIMIAR = float(os.getenv("DUPLICATAS_LIMIAR", "0.7")) # Similaridade estimada para considerar duplicata
+_PRIMO_MINHASH = np.uint64((1 << 61) - 1)
+_gerador_minhash = np.random.RandomState(20240611) # Semente fixa: assinaturas comparáveis entre execuções
+_COEF_A_MINHASH = _gerador_minhash.randint(1, (1 << 61) - 1, size=DUPLICATAS_PERMUTACOES, dtype=np.uint64)
+_COEF_B_MINHASH = _gerador_minhash.randint(0, (1 << 61) - 1, size=DUPLICATAS_PERMUTACOES, dtype=np.uint64)
+
+def normalizar_texto_pergunta(texto):
+    """Minúsculas, sem acentos nem pontuação e com espaços colapsados."""
+    decomposto = unicodedata.normalize("NFKD", texto.lower())
+    sem_acentos = "".join(c for c in decomposto if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w\s]", " ", sem_acentos).split())
+
+def assinatura_minhash(texto):
+    normalizado = normalizar_texto_pergunta(texto)
+    shingles = {normalizado[i:i + DUPLICATAS_SHINGLE] for i in range(max(1, len(normalizado) - DUPLICATAS_SHINGLE + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # Como no datasketch: a multiplicação em 64 bits dá a volta, o que só embaralha mais os valores
+    permutados = ((hashes[:, None] * _COEF_A_MINHASH + _COEF_B_MINHASH) % _PRIMO_MINHASH) & np.uint64(0xFFFFFFFF)
+    return permutados.min(axis=0).astype(np.uint32) # 32 bits bastam para comparar e ocupam metade
+
+def similaridade_assinaturas(a, b):
+    return float(np.count_nonzero(a == b)) / DUPLICATAS_PERMUTACOES
+
+class IndiceDuplicatas:
+    """Assinaturas e baldes LSH das perguntas de um baralho."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versao = None
+        self.perguntas = {} # doc_id -> texto indexado
+        self.assinaturas = {} # doc_id -> assinatura
+        self.baldes = {} # (banda, bytes da banda) -> set(doc_id)
+
+    @staticmethod
+    def _chaves_baldes(assinatura):
+        linhas = DUPLICATAS_PERMUTACOES // DUPLICATAS_BANDAS
+        return [(banda, assinatura[banda * linhas:(banda + 1) * linhas].tobytes()) for banda in range(DUPLICATAS_BANDAS)]
+
+    def adicionar(self, doc_id, pergunta):
+        self.remover(doc_id)
+        assinatura = assinatura_minhash(pergunta)
+        self.perguntas[doc_id] = pergunta
+        self.assinaturas[doc_id] = assinatura
+        for chave in self._chaves_baldes(assinatura):
+            self.baldes.setdefault(chave, set()).add(doc_id)
+
+    def remover(self, doc_id):
+        assinatura = self.assinaturas.pop(doc_id, None)
+        self.perguntas.pop(doc_id, None)
+        if assinatura is None:
+            return
+        for chave in self._chaves_baldes(assinatura):
+            balde = self.baldes.get(chave)
+            if balde is not None:
+                balde.discard(doc_id)
+                if not balde:
+                    del self.baldes[chave]
+
+    def sincronizar(self, baralho):
+        """Aplica a diferença para o baralho: só perguntas novas ou editadas são recalculadas."""
+        atuais = {cartao.doc_id: cartao.pergunta for cartao in baralho.cartoes}
+        for doc_id in [d for d in self.perguntas if d not in atuais]:
+            self.remover(doc_id)
+        for doc_id, pergunta in atuais.items():
+            if self.perguntas.get(doc_id) != pergunta:
+                self.adicionar(doc_id, pergunta)
+        self.versao = baralho.versao
+
+    def _candidatos(self, assinatura):
+        candidatos = set()
+        for chave in self._chaves_baldes(assinatura):
+            candidatos.update(self.baldes.get(chave, ()))
+        return candidatos
+
+    def similares(self, pergunta, limiar=DUPLICATAS_LIMIAR, ignorar=None):
+        """[(similaridade, doc_id)] das perguntas indexadas quase idênticas à informada, da mais parecida à menos."""
+        assinatura = assinatura_minhash(pergunta)
+        encontrados = []
+        for doc_id in self._candidatos(assinatura):
+            if doc_id == ignorar:
+                continue
+            similaridade = similaridade_assinaturas(assinatura, self.assinaturas[doc_id])
+            if similaridade >= limiar:
+                encontrados.append((similaridade, doc_id))
+        return sorted(encontrados, reverse=True)
+
+    def grupos(self, limiar=DUPLICATAS_LIMIAR):
+        """Agrupa (union-find) os cartões ligados por pares acima do limiar. Retorna listas de doc_ids com 2+ cartões."""
+        pai, ligados = {}, set()
+        def raiz(doc_id):
+            while pai.get(doc_id, doc_id) != doc_id:
+                pai[doc_id] = pai.get(pai[doc_id], pai[doc_id])
+                doc_id = pai[doc_id]
+            return doc_id
+        for doc_id, assinatura in self.assinaturas.items():
+            for outro in self._candidatos(assinatura):
+                if outro <= doc_id or raiz(outro) == raiz(doc_id):
+                    continue
+                if similaridade_assinaturas(assinatura, self.assinaturas[outro]) >= limiar:
+                    pai[raiz(outro)] = raiz(doc_id)
+                    ligados.update((doc_id, outro))
+        por_raiz = {}
+        for doc_id in ligados:
+            por_raiz.setdefault(raiz(doc_id), []).append(doc_id)
+        return [sorted(membros) for membros in por_raiz.values() if len(membros) > 1]
+
+@st.cache_resource
+def _registro_indices_duplicatas():
+    """Registro do processo: um índice de duplicatas por usuário."""
+    return {"lock": threading.Lock(), "indices": {}}
+
+def obter_indice_duplicatas(username, baralho=None):
+    """Índice de duplicatas do usuário, sincronizado com a versão atual do baralho compartilhado."""
+    if baralho is None:
+        baralho = obter_baralho(username)
+    registro = _registro_indices_duplicatas()
+    with registro["lock"]:
+        indice = registro["indices"].setdefault(username, IndiceDuplicatas())
+    with indice.lock:
+        if indice.versao != baralho.versao:
+            indice.sincronizar(baralho)
+    return indice
+
+def perguntas_quase_identicas(username, pergunta, baralho=None, ignorar=None):
+    """[(similaridade, Cartao)] do baralho do usuário quase idênticos à pergunta."""
+    if baralho is None:
+        baralho = obter_baralho(username)
+    indice = obter_indice_duplicatas(username, baralho)
+    with indice.lock:
+        encontrados = indice.similares(pergunta, ignorar=ignorar)
+    return [(similaridade, baralho.cartoes[baralho.posicao(doc_id)])
+            for similaridade, doc_id in encontrados if baralho.posicao(doc_id) is not None]
+
+def grupos_duplicatas(username):
+    """Grupos de cartões quase duplicados do usuário, como listas de Cartao."""
+    baralho = obter_baralho(username)
+    indice = obter_indice_duplicatas(username, baralho)
+    with indice.lock:
+        grupos = indice.grupos()
+    return [[baralho.cartoes[baralho.posicao(doc_id)] for doc_id in grupo if baralho.posicao(doc_id) is not None] for grupo in grupos]
+
+def _mesclar_resumos(destino, origem):
+    """Soma no resumo 'destino' as tentativas do resumo de outro cartão (ver _mesclar_no_resumo)."""
+    for campo in ("tentativas", "soma_notas", "notas_validas"):
+        destino[campo] = destino.get(campo, 0) + origem.get(campo, 0)
+    destino["notas"] = sorted(destino.get("notas", []) + origem.get("notas", []), key=lambda n: n["timestamp"])[-RESUMO_MAX_NOTAS:]
+    if origem.get("ultimo_timestamp", "") > destino.get("ultimo_timestamp", ""):
+        destino["ultimo_timestamp"] = origem["ultimo_timestamp"]
+        destino["ultima_nota"] = origem.get("ultima_nota")
+    lacunas = Counter(destino.get("lacunas_frequentes", {}))
+    lacunas.update(origem.get("lacunas_frequentes", {}))
+    destino["lacunas_frequentes"] = dict(lacunas.most_common(RESUMO_MAX_LACUNAS))
+
+def mesclar_cartoes_duplicados(username, manter_doc_id, remover_doc_ids):
+    """
+    Mantém um cartão e exclui os duplicados. O histórico dos excluídos (entradas recentes e resumos do
+    compactado) passa para o cartão mantido, para que as tentativas não se percam. Cartões de baralhos
+    compartilhados podem ser o mantido, mas nunca são excluídos.
+    Retorna (cartões excluídos, entradas de histórico movidas).
+    """
+    baralho = obter_baralho(username)
+    manter = baralho.cartoes[baralho.posicao(manter_doc_id)]
+    removidos = [baralho.cartoes[baralho.posicao(doc_id)] for doc_id in remover_doc_ids
+                 if doc_id != manter_doc_id and baralho.posicao(doc_id) is not None]
+    removidos = [cartao for cartao in removidos if cartao.baralho_id is None]
+    user_ref = db.collection(USERS_COLLECTION).document(username)
+    summary_ref = user_ref.collection(SUMMARY_COLLECTION)
+    resumo_manter_ref = summary_ref.document(id_resumo_cartao(manter.card_id))
+    resumo_manter = None
+
+    # Primeiro as entradas recentes, em lotes: reapontá-las é idempotente, então uma falha no meio
+    # pode ser refeita com a mesma mesclagem
+    batch, operacoes, entradas_movidas = db.batch(), 0, 0
+    for cartao in removidos:
+        if cartao.card_id == manter.card_id: # Mesmo card_id: o histórico já conta para o cartão mantido
+            continue
+        # Entradas no formato compacto não têm a pergunta: são achadas pelo cartao_id
+        docs = {doc.id: doc for doc in user_ref.collection(FEEDBACK_COLLECTION).where("pergunta", "==", cartao.pergunta).stream()}
+        docs.update((doc.id, doc) for doc in user_ref.collection(FEEDBACK_COLLECTION).where("cartao_id", "==", cartao.doc_id).stream())
+        for doc in docs.values():
+            entrada = doc.to_dict()
+            if (entrada.get("materia"), entrada.get("assunto")) != (cartao.materia, cartao.assunto):
+                continue
+            campos = {"materia": manter.materia, "assunto": manter.assunto, "cartao_id": manter.doc_id}
+            if "pergunta" in entrada or not referencia_propria(manter.doc_id):
+                campos["pergunta"] = manter.pergunta
+            batch.update(doc.reference, campos)
+            operacoes += 1
+            entradas_movidas += 1
+            if operacoes >= 400:
+                batch.commit()
+                batch, operacoes = db.batch(), 0
+    if operacoes:
+        batch.commit()
+
+    # Depois, num único commit, os resumos somados e as exclusões (um grupo tem poucos cartões)
+    batch = db.batch()
+    for cartao in removidos:
+        if cartao.card_id != manter.card_id:
+            resumo_removido_ref = summary_ref.document(id_resumo_cartao(cartao.card_id))
+            resumo_removido = resumo_removido_ref.get()
+            if resumo_removido.exists:
+                if resumo_manter is None:
+                    snap_manter = resumo_manter_ref.get()
+                    resumo_manter = snap_manter.to_dict() if snap_manter.exists else {
+                        "pergunta": manter.pergunta, "materia": manter.materia, "assunto": manter.assunto}
+                _mesclar_resumos(resumo_manter, resumo_removido.to_dict())
+                batch.delete(resumo_removido_ref)
+        batch.delete(user_ref.collection(CARDS_COLLECTION).document(cartao.doc_id))
+    if resumo_manter is not None:
+        resumo_manter["atualizado_em"] = datetime.datetime.now().isoformat()
+        batch.set(resumo_manter_ref, resumo_manter)
+    batch.commit()
+
+    propagar_baralho_para_replicas(publicar_alteracoes_baralho(username, removidos=[c.doc_id for c in removidos]))
+    obter_cache_compartilhado().invalidar("agregados", username)
+    return len(removidos), entradas_movidas
+
+
+# --- BACKUP E RESTAURAÇÃO (VER backup_firestore.py, QUE TAMBÉM RODA PELA LINHA DE COMANDO) ---
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(BASE_DATA_DIR, "backups"))
+PADRAO_NOME_BACKUP = re.compile(r"^backup_(.+)_(\d{14})_(completo|incremental)\.jsonl\.gz$") # o escopo pode conter "_"
+
+def caminho_novo_backup(escopo, incremental):
+    tipo = "incremental" if incremental else "completo"
+    return os.path.join(BACKUP_DIR, f"backup_{escopo}_{datetime.datetime.now():%Y%m%d%H%M%S}_{tipo}.jsonl.gz")
+
+def ultimo_backup(escopo):
+    """Backup mais recente (completo ou incremental) do escopo, cuja marca serve de ponto de partida do próximo incremental."""
+    if not os.path.isdir(BACKUP_DIR):
+        return None
+    usuarios_escopo = None if escopo == "todos" else [escopo]
+    candidatos = []
+    for nome in os.listdir(BACKUP_DIR):
+        correspondencia = PADRAO_NOME_BACKUP.match(nome)
+        if not correspondencia or correspondencia.group(1) != escopo:
+            continue
+        caminho = os.path.join(BACKUP_DIR, nome)
+        try:
+            cabecalho = backup_firestore.ler_cabecalho_backup(caminho)
+        except Exception:
+            continue # arquivo ilegível não serve de ponto de partida
+        # O cabeçalho confirma o escopo (um usuário chamado "todos" não se confunde com o backup geral)
+        if cabecalho.get("usuarios") == usuarios_escopo:
+            candidatos.append((datetime.datetime.fromisoformat(cabecalho["marca"]), caminho))
+    return max(candidatos)[1] if candidatos else None
+
+def leitor_arquivo_backup(caminho):
+    """Função sem argumentos para o download_button: o arquivo só é lido quando o download é pedido."""
+    def ler():
+        with open(caminho, "rb") as arquivo:
+            return arquivo.read()
+    return ler
+
+def invalidar_caches_restaurados(usernames):
+    """Após uma restauração, descarta usuários, baralhos e agregados em cache (nesta e nas outras réplicas)."""
+    invalidar_cache_usuarios(*usernames)
+    cache = obter_cache_compartilhado()
+    for username in usernames:
+        cache.invalidar("cartoes", username)
+        cache.invalidar("agregados", username)
+
+
+# --- LISTENERS EM TEMPO REAL DO FIRESTORE (MODO OPCIONAL) ---
+# Com FIRESTORE_LISTENERS=1, cada usuário logado ganha um listener on_snapshot em 'user_cards'
+# (e em 'feedback_history' com FIRESTORE_LISTENERS_HISTORICO=1). As mudanças chegam documento
+# a documento e são aplicadas ao baralho compartilhado, então todas as sessões do usuário ficam
+# atualizadas sem polling e sem recarregar a coleção. Os listeners são contados por sessão:
+# o último logout (ou sessão encerrada) do usuário desliga o listener.
+def _flag_ambiente(nome):
+    return os.getenv(nome, "").strip().lower() in ("1", "true", "sim", "yes")
+
+FIRESTORE_LISTENERS = _flag_ambiente("FIRESTORE_LISTENERS")
+FIRESTORE_LISTENERS_HISTORICO = FIRESTORE_LISTENERS and _flag_ambiente("FIRESTORE_LISTENERS_HISTORICO")
+LISTENER_TIMEOUT_PRIMEIRO_SNAPSHOT = 10 # segundos esperando o snapshot inicial antes de cair na leitura normal
+LISTENER_INTERVALO_LIMPEZA = 60 # segundos entre as varreduras de sessões fechadas sem logout
+
+def obter_id_sessao():
+    """ID da sessão do Streamlit que está executando o script (ou None fora de uma sessão)."""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def _sessao_ativa(session_id):
+    """Verifica no runtime do Streamlit se a sessão ainda existe (abas fechadas não fazem logout)."""
+    from streamlit.runtime import Runtime
+    if not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(session_id)
+
+@st.cache_resource
+def _registro_listeners():
+    """Estado dos listeners do processo: sessões por usuário, watches ativos e histórico compartilhado."""
+    registro = {"lock": threading.Lock(), "usuarios": {}, "historicos": {}, "versoes": itertools.count(1)}
+    # Abas fechadas sem logout não passam por liberar_listeners: a varredura desliga os watches delas
+    threading.Thread(target=_varrer_listeners, args=(registro,), daemon=True, name="listeners_limpeza").start()
+    return registro
+
+def _desligar_watches(estado):
+    for watch in estado["watches"]:
+        try:
+            watch.unsubscribe()
+        except Exception:
+            pass
+
+def podar_listeners_inativos(registro):
+    """Desliga os listeners dos usuários sem nenhuma sessão ativa. Retorna quantos usuários foram desligados."""
+    with registro["lock"]:
+        inativos = []
+        for username, estado in registro["usuarios"].items():
+            estado["sessoes"] = {sid for sid in estado["sessoes"] if _sessao_ativa(sid)}
+            if not estado["sessoes"]:
+                inativos.append(username)
+        estados = [registro["usuarios"].pop(username) for username in inativos]
+        for username in inativos:
+            registro["historicos"].pop(username, None)
+    for estado in estados:
+        _desligar_watches(estado)
+    return len(estados)
+
+def _varrer_listeners(registro):
+    while True:
+        time.sleep(LISTENER_INTERVALO_LIMPEZA)
+        try:
+            podar_listeners_inativos(registro)
+        except Exception:
+            pass # A próxima varredura tenta de novo
+
+def _callback_cartoes(username, registro_baralhos, primeiro_snapshot):
+    def on_snapshot(docs, changes, read_time):
+        alterados, removidos = [], []
+        for change in changes:
+            if change.type.name == "REMOVED":
+                removidos.append(change.document.id)
+            else: # ADDED ou MODIFIED
+                alterados.append(Cartao.from_dict(change.document.to_dict(), doc_id=change.document.id))
+        if not primeiro_snapshot.is_set():
+            # Snapshot inicial traz o conjunto completo: substitui o baralho (descarta cartões que sumiram)
+            with registro_baralhos["lock"]:
+                atual = registro_baralhos["baralhos"].get(username)
+            ids_atuais = {c.doc_id for c in atual.cartoes} if atual else set()
+            removidos.extend(ids_atuais - {c.doc_id for c in alterados})
+        publicar_alteracoes_baralho(username, alterados, removidos, registro=registro_baralhos,
+                                    conjunto_completo=not primeiro_snapshot.is_set())
+        primeiro_snapshot.set()
+    return on_snapshot
+
+def _callback_historico(username, registro, primeiro_snapshot, registro_baralhos, cartoes_prontos):
+    def on_snapshot(docs, changes, read_time):
+        if any("pergunta" not in change.document.to_dict() for change in changes if change.type.name != "REMOVED"):
+            # Entradas por referência: a pergunta vem do baralho, que chega pelo listener de cartões
+            cartoes_prontos.wait(LISTENER_TIMEOUT_PRIMEIRO_SNAPSHOT)
+        baralho = registro_baralhos["baralhos"].get(username)
+        with registro["lock"]:
+            historico = registro["historicos"].setdefault(username, {"versao": 0, "por_doc_id": {}, "ordenado": ()})
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    historico["por_doc_id"].pop(change.document.id, None)
+                else:
+                    historico["por_doc_id"][change.document.id] = expandir_entrada_historico(
+                        sem_resposta_armazenada(change.document.to_dict()), baralho)
+            historico["ordenado"] = tuple(sorted(historico["por_doc_id"].values(), key=lambda e: e.get("timestamp", "")))
+            historico["versao"] = next(registro["versoes"])
+        primeiro_snapshot.set()
+    return on_snapshot
+
+def anexar_listeners(username, session_id):
+    """
+    Registra a sessão como interessada no usuário e, se for a primeira, liga os listeners.
+    Retorna True se os dados já estão no registro (snapshot inicial recebido), dispensando a leitura completa.
+    """
+    registro = _registro_listeners()
+    with registro["lock"]:
+        estado = registro["usuarios"].get(username)
+        novo = estado is None
+        if novo:
+            # Os eventos são criados ainda sob o lock: sessões concorrentes esperam o mesmo snapshot inicial
+            prontos = [threading.Event()] + ([threading.Event()] if FIRESTORE_LISTENERS_HISTORICO else [])
+            estado = {"sessoes": set(), "watches": [], "prontos": prontos}
+            registro["usuarios"][username] = estado
+        # Sessões que sumiram sem logout não contam mais
+        estado["sessoes"] = {sid for sid in estado["sessoes"] if _sessao_ativa(sid)}
+        estado["sessoes"].add(session_id)
+
+    if novo:
+        user_ref = db.collection(USERS_COLLECTION).document(username)
+        try:
+            estado["watches"].append(user_ref.collection(CARDS_COLLECTION).on_snapshot(
+                _callback_cartoes(username, _registro_baralhos(), estado["prontos"][0])))
+            if FIRESTORE_LISTENERS_HISTORICO:
+                estado["watches"].append(user_ref.collection(FEEDBACK_COLLECTION).on_snapshot(
+                    _callback_historico(username, registro, estado["prontos"][1], _registro_baralhos(), estado["prontos"][0])))
+        except Exception as e:
+            st.warning(f"Não foi possível ativar a sincronização em tempo real: {e}")
+            liberar_listeners(username, session_id)
+            return False
+
+    return all(evento.wait(LISTENER_TIMEOUT_PRIMEIRO_SNAPSHOT) for evento in estado["prontos"])
+
+def liberar_listeners(username, session_id):
+    """Remove a sessão da contagem; quando nenhuma sessão ativa resta, desliga os listeners do usuário."""
+    registro = _registro_listeners()
+    with registro["lock"]:
+        estado = registro["usuarios"].get(username)
+        if estado is None:
+            return
+        estado["sessoes"].discard(session_id)
+        estado["sessoes"] = {sid for sid in estado["sessoes"] if _sessao_ativa(sid)}
+        if estado["sessoes"]:
+            return
+        del registro["usuarios"][username]
+        registro["historicos"].pop(username, None)
+    _desligar_watches(estado)
+
+def historico_compartilhado(username):
+    """(versão, entradas ordenadas por timestamp) mantidas pelo listener de histórico, ou None."""
+    registro = _registro_listeners()
+    with registro["lock"]:
+        historico = registro["historicos"].get(username)
+        if historico is None:
+            return None
+        return historico["versao"], historico["ordenado"]
+
+def sincronizar_historico_sessao(username):
+    """Troca o histórico da sessão pelo mantido pelo listener, se houver versão mais nova."""
+    compartilhado = historico_compartilhado(username)
+    if compartilhado is None:
+        return
+    versao, entradas = compartilhado
+    if st.session_state.get("historico_versao") != versao:
+        st.session_state.feedback_history = list(entradas)
+        st.session_state.historico_versao = versao
+
+
+# --- TEXTOS LONGOS COMPRIMIDOS NO FIRESTORE (FORMATO OPCIONAL, VER armazenamento_compacto.py) ---
+# Com ARMAZENAMENTO_COMPACTO, as novas gravações comprimem as respostas esperadas e as lacunas longas
+# (campo '<campo>_z') e as entradas do histórico de cartões próprios guardam só o cartao_id. A leitura
+# entende os dois formatos, então ligar ou desligar o modo não exige migrar; a migração (ação do admin
+# ou linha de comando) converte o que já existe. A resposta esperada só é descomprimida quando é lida
+# (exibição, correção); as lacunas e a pergunta das entradas são resolvidas ao carregar o histórico.
+ARMAZENAMENTO_COMPACTO = _flag_ambiente("ARMAZENAMENTO_COMPACTO")
+TEXTO_COMPACTAR_MIN_BYTES = int(os.getenv("TEXTO_COMPACTAR_MIN_BYTES", str(TEXTO_MINIMO_BYTES)))
+
+@st.cache_resource
+def compressor_textos():
+    """Dicionários de compressão do Firestore; o mais recente comprime (recarregado ao treinar um novo)."""
+    return carregar_compressor(db)
+
+def formato_cartao_armazenado(dados, atualizacao=False):
+    """
+    Campos do cartão como vão para o Firestore. Em atualizações (update), a forma do campo que deixou
+    de valer (texto ou '<campo>_z') é apagada.
+    """
+    gravar = compactar_campos(dados, CAMPOS_CARTAO, compressor_textos(), TEXTO_COMPACTAR_MIN_BYTES) if ARMAZENAMENTO_COMPACTO else dict(dados)
+    if atualizacao:
+        for campo in CAMPOS_CARTAO:
+            if campo in dados:
+                gravar[campo + SUFIXO_COMPACTADO if campo in gravar else campo] = firestore.DELETE_FIELD
+    return gravar
+
+def entrada_historico_armazenada(entrada):
+    """Entrada do histórico como vai para o Firestore (formato compacto, se ligado)."""
+    if not ARMAZENAMENTO_COMPACTO:
+        return entrada
+    return formato_entrada_compacta(entrada, compressor_textos(), minimo=TEXTO_COMPACTAR_MIN_BYTES)
+
+def _pergunta_no_baralho(baralho):
+    def pergunta_do_cartao(doc_id):
+        posicao = baralho.posicao(doc_id) if baralho is not None else None
+        return baralho.cartoes[posicao].pergunta if posicao is not None else None
+    return pergunta_do_cartao
+
+def expandir_entrada_historico(entrada, baralho):
+    """Entrada lida do Firestore no formato completo; 'baralho' (próprio do usuário) resolve as entradas por referência."""
+    if "pergunta" in entrada and not any(campo.endswith(SUFIXO_COMPACTADO) for campo in entrada):
+        return entrada # Formato completo: nada a fazer (e nenhum acesso ao compressor)
+    return formato_entrada_completa(entrada, compressor_textos(), _pergunta_no_baralho(baralho))
+
+def materializar_perguntas_historico(username, cartoes):
+    """
+    Antes de excluir cartões próprios, grava a pergunta nas entradas do histórico que só têm a
+    referência, para que continuem casando com a pergunta (e com cópias em baralhos compartilhados).
+    """
+    feedback_ref = db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION)
+    batch, operacoes = db.batch(), 0
+    for cartao in cartoes:
+        for doc in feedback_ref.where("cartao_id", "==", cartao.doc_id).stream():
+            if "pergunta" not in doc.to_dict():
+                batch.update(doc.reference, {"pergunta": cartao.pergunta})
+                operacoes += 1
+                if operacoes >= LOTE_MAX_ESCRITAS:
+                    batch.commit()
+                    batch, operacoes = db.batch(), 0
+    if operacoes:
+        batch.commit()
+
+def cartoes_proprios(username, doc_ids):
+    baralho = obter_baralho_proprio(username)
+    return [baralho.cartoes[baralho.posicao(doc_id)] for doc_id in doc_ids if baralho.posicao(doc_id) is not None]
+
+
+# --- PRÁTICA POR CONSULTA NO FIRESTORE (FILTRO POR MATÉRIA/ASSUNTO, PAGINADA) ---
+# No modo padrão, o login lê o baralho inteiro e as abas de prática filtram em memória. Com
+# PRATICA_POR_CONSULTA, as abas consultam 'user_cards' no servidor (where matéria/assunto + order_by)
+# em páginas de PRATICA_PAGINA, com cursor (start_after no último documento lido), e o login não lê o
+# baralho: ele só é carregado quando uma aba precisa de todos os cartões (Gerenciar Cartões). Estudar
+# um assunto custa leituras proporcionais a ele. Para ordenar no servidor, cada cartão próprio guarda
+# 'ultima_nota' (-1 se nunca respondido ou sem nota) e 'ultima_resposta' (ISO; "" se nunca), atualizados
+# a cada resposta neste modo; o admin preenche os cartões existentes antes de ligá-lo. Os índices
+# compostos estão em firestore.indexes.json (cartões sem os campos ficam fora das consultas ordenadas
+# por eles). Cartões dos baralhos assinados já estão na memória do processo: entram no fim da lista,
+# filtrados sem leituras.
+PRATICA_POR_CONSULTA = _flag_ambiente("PRATICA_POR_CONSULTA")
+PRATICA_PAGINA = int(os.getenv("PRATICA_PAGINA", "20"))
+SEM_NOTA = -1
+ORDENS_PRATICA = {"ultima_nota": "Menor nota primeiro", "ultima_resposta": "Praticadas há mais tempo primeiro"}
+
+def campos_pratica(nota=None, timestamp=""):
+    return {"ultima_nota": nota if nota is not None else SEM_NOTA, "ultima_resposta": timestamp}
+
+def atualizar_campos_pratica(username, entrada):
+    """Copia a nota e o horário da resposta para o cartão próprio respondido (campos das consultas de prática)."""
+    if not referencia_propria(entrada.get("cartao_id")):
+        return
+    try:
+        db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).document(entrada["cartao_id"]).update(
+            campos_pratica(entrada.get("nota_sentido"), entrada["timestamp"]))
+    except NotFound:
+        pass # Cartão excluído enquanto a correção rodava
+
+def preencher_campos_pratica(username):
+    """
+    Recalcula 'ultima_nota' e 'ultima_resposta' dos cartões próprios a partir do histórico (recente e
+    compactado). Necessário uma vez antes de ligar PRATICA_POR_CONSULTA e depois de recorreções ou
+    restaurações. Retorna a quantidade de cartões atualizados.
+    """
+    historico = carregar_historico_feedback(username)
+    resumos = carregar_resumos_historico(username)
+    ultimas_notas = calcular_ultimas_notas(historico, resumos)
+    ultimas_respostas = {}
+    for resumo in resumos:
+        ultimas_respostas[(resumo["pergunta"], resumo["materia"], resumo["assunto"])] = resumo.get("ultimo_timestamp", "")
+    for entry in historico: # Ordenado por timestamp: a última entrada de cada cartão prevalece
+        ultimas_respostas[(entry["pergunta"], entry["materia"], entry["assunto"])] = entry["timestamp"]
+
+    cartoes_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+    batch, operacoes, total = db.batch(), 0, 0
+    for card_data in carregar_cartoes(username):
+        card_id = (card_data.get("pergunta", ""), card_data.get("materia", ""), card_data.get("assunto", ""))
+        campos = campos_pratica(ultimas_notas.get(card_id), ultimas_respostas.get(card_id, ""))
+        if all(card_data.get(campo) == valor for campo, valor in campos.items()):
+            continue
+        batch.update(cartoes_ref.document(card_data["doc_id"]), campos)
+        operacoes += 1
+        total += 1
+        if operacoes >= LOTE_MAX_ESCRITAS:
+            batch.commit()
+            batch, operacoes = db.batch(), 0
+    if operacoes:
+        batch.commit()
+    return total
+
+def baralho_das_referencias(username, entradas):
+    """
+    Cartões próprios que resolvem as entradas do histórico guardadas só com a referência. Na prática
+    por consulta, o baralho não é lido no login: busca só os cartões referenciados (get_all).
+    """
+    baralho = _registro_baralhos()["baralhos"].get(username)
+    if baralho is not None or not PRATICA_POR_CONSULTA:
+        return baralho if baralho is not None else obter_baralho_proprio(username)
+    cartoes_ref = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+    referencias = {entrada["cartao_id"] for entrada in entradas if "pergunta" not in entrada and entrada.get("cartao_id")}
+    docs = db.get_all([cartoes_ref.document(doc_id) for doc_id in referencias]) if referencias else []
+    return BaralhoUsuario(username, [Cartao.from_dict(doc.to_dict(), doc_id=doc.id) for doc in docs if doc.exists], 0)
+
+def catalogo_do_baralho(baralho):
+    return sorted({(cartao.materia, cartao.assunto) for cartao in baralho.cartoes})
+
+def catalogo_assuntos(username):
+    """
+    Pares (matéria, assunto) dos cartões do usuário, para os filtros das abas de prática sem ler o
+    baralho. Vem do cache compartilhado (regravado a cada alteração de cartões), do baralho já
+    carregado no processo ou, em último caso, de uma consulta com projeção só desses dois campos.
+    """
+    cache = obter_cache_compartilhado()
+    pares = cache.obter("catalogo_assuntos", username)
+    if pares is None:
+        baralho = _registro_baralhos()["baralhos"].get(username)
+        if baralho is not None:
+            pares = catalogo_do_baralho(baralho)
+        else:
+            consulta = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION).select(["materia", "assunto"])
+            pares = sorted({(doc.to_dict().get("materia", ""), doc.to_dict().get("assunto", "")) for doc in consulta.stream()})
+        cache.gravar("catalogo_assuntos", username, pares, CACHE_TTL_CARTOES)
+    pares = {tuple(par) for par in pares} # JSON devolve listas
+    for compartilhado in _baralhos_assinados(username):
+        pares.update(catalogo_do_baralho(compartilhado))
+    catalogo = {}
+    for materia, assunto in sorted(pares):
+        catalogo.setdefault(materia, []).append(assunto)
+    return catalogo
+
+def _baralhos_assinados(username):
+    return [b for b in (obter_baralho_compartilhado(deck_id) for deck_id in assinaturas_usuario(username)) if b is not None]
+
+def _consulta_pratica(username, materia, assunto, ordem, apenas_dificeis):
+    consulta = db.collection(USERS_COLLECTION).document(username).collection(CARDS_COLLECTION)
+    if materia is not None:
+        consulta = consulta.where("materia", "==", materia)
+    if assunto is not None:
+        consulta = consulta.where("assunto", "==", assunto)
+    if apenas_dificeis:
+        # A desigualdade obriga a ordenar primeiro pelo mesmo campo
+        return consulta.where("ultima_nota", ">=", 0).where("ultima_nota", "<", NOTA_DIFICIL).order_by("ultima_nota")
+    return consulta.order_by(ordem)
+
+def _cartoes_assinados_pratica(username, materia, assunto, apenas_dificeis):
+    """Cartões dos baralhos assinados que passam no filtro, ordenados pela última nota (agregados da sessão)."""
+    ultimas_notas = ultimas_notas_de_agregados(obter_agregados_usuario(
+        username, st.session_state.feedback_history, st.session_state.historico_resumos))
+    cartoes = [cartao for compartilhado in _baralhos_assinados(username) for cartao in compartilhado.cartoes
+               if (materia is None or cartao.materia == materia) and (assunto is None or cartao.assunto == assunto)]
+    notas = {cartao.doc_id: ultimas_notas.get(cartao.card_id) for cartao in cartoes}
+    notas = {doc_id: (nota if nota is not None else SEM_NOTA) for doc_id, nota in notas.items()}
+    if apenas_dificeis:
+        cartoes = [cartao for cartao in cartoes if 0 <= notas[cartao.doc_id] < NOTA_DIFICIL]
+    return sorted(cartoes, key=lambda cartao: notas[cartao.doc_id])
+
+def pratica_por_consulta(chave_estado, username, materia=None, assunto=None, ordem="ultima_nota", apenas_dificeis=False):
+    """
+    Estado da prática paginada de uma aba (na sessão): cartões já lidos, cursor, total e se acabou.
+    Recomeça quando o filtro muda. O total vem de count() no servidor, sem ler os documentos.
+    """
+    filtro = (username, materia, assunto, ordem, apenas_dificeis)
+    estado = st.session_state.get(chave_estado)
+    if estado is None or estado["filtro"] != filtro:
+        assinados = _cartoes_assinados_pratica(username, materia, assunto, apenas_dificeis)
+        estado = {"filtro": filtro, "cartoes": [], "vistos": set(), "cursor": None, "fim": False, "assinados": assinados,
+                  "total": _contar(_consulta_pratica(*filtro)) + len(assinados)}
+        st.session_state[chave_estado] = estado
+        carregar_proxima_pagina_pratica(estado)
+    return estado
+
+def carregar_proxima_pagina_pratica(estado):
+    """Lê a próxima página a partir do cursor. Retorna True se algum cartão novo entrou na lista."""
+    if estado["fim"]:
+        return False
+    consulta = _consulta_pratica(*estado["filtro"]).limit(PRATICA_PAGINA)
+    if estado["cursor"] is not None:
+        consulta = consulta.start_after(estado["cursor"])
+    pagina = list(consulta.stream())
+    antes = len(estado["cartoes"])
+    for doc in pagina:
+        # Um cartão respondido nesta sessão muda de posição e pode reaparecer numa página seguinte
+        if doc.id not in estado["vistos"]:
+            estado["vistos"].add(doc.id)
+            estado["cartoes"].append(Cartao.from_dict(doc.to_dict(), doc_id=doc.id))
+    if pagina:
+        estado["cursor"] = pagina[-1]
+    if len(pagina) < PRATICA_PAGINA:
+        estado["fim"] = True
+        estado["cartoes"].extend(estado["assinados"])
+    return len(estado["cartoes"]) > antes or (not estado["fim"] and carregar_proxima_pagina_pratica(estado))
+
+def carregar_todas_paginas_pratica(estado):
+    while carregar_proxima_pagina_pratica(estado):
+        pass
+
+def descartar_pratica_sessao(apenas_dificeis=False):
+    """Descarta as listas já lidas das abas de prática; a próxima exibição refaz a consulta."""
+    for sufixo in (("difficult",) if apenas_dificeis else ("tab1", "difficult")):
+        st.session_state.pop(f"pratica_{sufixo}", None)
+
+def filtros_pratica_por_consulta(sufixo, apenas_dificeis=False):
+    """Filtros de matéria/assunto (e ordem) de uma aba de prática no modo por consulta; retorna o estado paginado."""
+    username = st.session_state.logged_in_user
+    catalogo = catalogo_assuntos(username)
+    materia = st.selectbox("Filtrar por Matéria:", ["Todas"] + sorted(catalogo), key=f"filter_materia_{sufixo}")
+    assunto = st.selectbox("Filtrar por Assunto:", ["Todos"] + (catalogo.get(materia, []) if materia != "Todas" else
+                                                                sorted({a for assuntos in catalogo.values() for a in assuntos})),
+                           key=f"filter_assunto_{sufixo}")
+    ordem = "ultima_nota"
+    if not apenas_dificeis:
+        ordem = st.selectbox("Ordem:", list(ORDENS_PRATICA), format_func=ORDENS_PRATICA.get, key=f"order_{sufixo}")
+    return pratica_por_consulta(f"pratica_{sufixo}", username, None if materia == "Todas" else materia,
+                                None if assunto == "Todos" else assunto, ordem, apenas_dificeis)
+
+
 # --- Funções para Gerenciamento de Usuários e Senhas (AGORA NO FIRESTORE) ---
 def hash_password(password):
     """Gera o hash SHA256 de uma senha."""
     return hashlib.sha256(password.encode()).hexdigest()
 
 def carregar_usuarios():
-    """Carrega os usuários e seus hashes de senha do Firestore."""
+    """Carrega os usuários e seus hashes de senha (cache compartilhado ou Firestore)."""
+    cache = obter_cache_compartilhado()
+    users = cache.obter("usuarios", "todos")
+    if users is not None:
+        return users
     users = {}
     try:
         docs = db.collection(USERS_COLLECTION).stream() # Acessa a coleção 'users' principal
         for doc in docs:
             user_data = doc.to_dict()
             users[doc.id] = user_data.get('password_hash') # ID do documento é o username
+        cache.gravar("usuarios", "todos", users, CACHE_TTL_USUARIOS)
         return users
     except Exception as e:
         st.error(f"Erro ao carregar usuários do Firestore: {e}")
         return {}
 
-def salvar_usuarios(users_data):
-    """Salva os usuários e seus hashes de senha no Firestore."""
+def buscar_hash_senha(username):
+    """Hash da senha de um único usuário (um documento lido, com cache compartilhado), ou None se não existe."""
+    cache = obter_cache_compartilhado()
+    password_hash = cache.obter("usuario", username)
+    if password_hash is not None:
+        return password_hash
     try:
-        # Para cada usuário no users_data, atualiza/cria um documento no Firestore
-        for username, password_hash in users_data.items():
-            db.collection(USERS_COLLECTION).document(username).set({
-                'password_hash': password_hash,
-                'last_updated': datetime.datetime.now() # Opcional: adicionar timestamp
-            })
-        st.success("Usuários salvos no Firestore com sucesso!")
+        doc = db.collection(USERS_COLLECTION).document(username).get()
+    except Exception as e:
+        st.error(f"Erro ao buscar o usuário '{username}' no Firestore: {e}")
+        return None
+    if not doc.exists:
+        return None
+    password_hash = doc.to_dict().get('password_hash')
+    cache.gravar("usuario", username, password_hash, CACHE_TTL_USUARIOS)
+    return password_hash
+
+def invalidar_cache_usuarios(*usernames):
+    cache = obter_cache_compartilhado()
+    cache.invalidar("usuarios", "todos")
+    for username in usernames:
+        cache.invalidar("usuario", username)
+
+# Operações de usuário tocam apenas o documento afetado (antes, salvar_usuarios regravava todos)
+def criar_usuario(username, password_hash):
+    """
+    Cria o documento de um novo usuário com create(): a precondição de inexistência
+    é verificada pelo próprio Firestore, então duas criações simultâneas não se sobrescrevem.
+    """
+    try:
+        db.collection(USERS_COLLECTION).document(username).create({
+            'password_hash': password_hash,
+            'last_updated': datetime.datetime.now()
+        })
+        invalidar_cache_usuarios(username)
+        return True
+    except AlreadyExists:
+        st.error(f"O nome de usuário '{username}' já existe.")
+        return False
+    except Exception as e:
+        st.error(f"Erro ao criar usuário '{username}' no Firestore: {e}")
+        return False
+
+def atualizar_senha_usuario(username, password_hash):
+    """Atualiza somente o hash de senha do usuário (update() falha se o documento não existir)."""
+    try:
+        db.collection(USERS_COLLECTION).document(username).update({
+            'password_hash': password_hash,
+            'last_updated': datetime.datetime.now()
+        })
+        invalidar_cache_usuarios(username)
+        return True
+    except NotFound:
+        st.error(f"O usuário '{username}' não existe mais.")
+        return False
+    except Exception as e:
+        st.error(f"Erro ao atualizar a senha de '{username}' no Firestore: {e}")
+        return False
+
+def excluir_usuario(username):
+    """Exclui o documento do usuário junto com as subcoleções (cartões e histórico)."""
+    try:
+        db.recursive_delete(db.collection(USERS_COLLECTION).document(username))
+        invalidar_cache_usuarios(username)
+        obter_cache_compartilhado().invalidar("cartoes", username)
+        obter_cache_compartilhado().invalidar("agregados", username)
+        return True
     except Exception as e:
-        st.error(f"Erro ao salvar usuários no Firestore: {e}")
+        st.error(f"Erro ao excluir usuário '{username}' do Firestore: {e}")
+        return False
+
+# --- PROVISIONAMENTO DE USUÁRIOS EM LOTE (CSV) ---
+LOTE_MAX_ESCRITAS = 500 # Limite de operações por commit em lote do Firestore
+USERNAME_INVALIDO_RE = re.compile(r"[/\s]|^\.\.?$|^__.*__$") # Restrições de ID de documento do Firestore
+
+def ler_csv_usuarios(conteudo_bytes):
+    """
+    Lê um CSV com colunas 'usuario' e 'senha' (também aceita 'username'/'password'),
+    separado por vírgula ou ponto e vírgula. Retorna lista de (numero_linha, usuario, senha).
+    """
+    texto = conteudo_bytes.decode("utf-8-sig")
+    try:
+        dialeto = csv.Sniffer().sniff(texto[:2048], delimiters=",;")
+    except csv.Error:
+        dialeto = csv.excel
+    leitor = csv.DictReader(io.StringIO(texto), dialect=dialeto)
+    linhas = []
+    for numero, row in enumerate(leitor, start=2): # Linha 1 é o cabeçalho
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        linhas.append((numero, row.get("usuario") or row.get("username") or "", row.get("senha") or row.get("password") or ""))
+    return linhas
+
+def provisionar_usuarios_em_lote(linhas):
+    """
+    Cria contas em commits de até LOTE_MAX_ESCRITAS documentos. Cada lote confere antes quais
+    usuários já existem (get_all) e usa batch.create(); se outro admin criar um usuário entre a
+    checagem e o commit, o lote é refeito linha a linha. Retorna um relatório por linha do CSV.
+    """
+    relatorio = []
+    pendentes = []
+    vistos = set()
+    for numero, username, senha in linhas:
+        if not username or not senha:
+            relatorio.append({"linha": numero, "usuario": username, "resultado": "Erro: usuário e senha são obrigatórios"})
+        elif username == ADMIN_USERNAME:
+            relatorio.append({"linha": numero, "usuario": username, "resultado": "Erro: nome reservado"})
+        elif USERNAME_INVALIDO_RE.search(username):
+            relatorio.append({"linha": numero, "usuario": username, "resultado": "Erro: nome de usuário inválido"})
+        elif username in vistos:
+            relatorio.append({"linha": numero, "usuario": username, "resultado": "Erro: repetido no arquivo"})
+        else:
+            vistos.add(username)
+            pendentes.append((numero, username, hash_password(senha)))
+
+    criados = []
+    for inicio in range(0, len(pendentes), LOTE_MAX_ESCRITAS):
+        lote = pendentes[inicio:inicio + LOTE_MAX_ESCRITAS]
+        refs = {username: db.collection(USERS_COLLECTION).document(username) for _, username, _ in lote}
+        existentes = {snap.id for snap in db.get_all(list(refs.values())) if snap.exists}
+        agora = datetime.datetime.now()
+        a_criar = []
+        for numero, username, password_hash in lote:
+            if username in existentes:
+                relatorio.append({"linha": numero, "usuario": username, "resultado": "Ignorado: usuário já existe"})
+            else:
+                a_criar.append((numero, username, password_hash))
+        if not a_criar:
+            continue
+
+        batch = db.batch()
+        for _, username, password_hash in a_criar:
+            batch.create(refs[username], {'password_hash': password_hash, 'last_updated': agora})
+        try:
+            batch.commit()
+            resultados = [(numero, username, "Criado") for numero, username, _ in a_criar]
+        except Conflict:
+            # Corrida com outra criação: o lote é atômico, então refaz linha a linha
+            resultados = []
+            for numero, username, password_hash in a_criar:
+                try:
+                    refs[username].create({'password_hash': password_hash, 'last_updated': agora})
+                    resultados.append((numero, username, "Criado"))
+                except AlreadyExists:
+                    resultados.append((numero, username, "Ignorado: usuário já existe"))
+                except Exception as e:
+                    resultados.append((numero, username, f"Erro: {e}"))
+        except Exception as e:
+            resultados = [(numero, username, f"Erro: {e}") for numero, username, _ in a_criar]
+        for numero, username, resultado in resultados:
+            relatorio.append({"linha": numero, "usuario": username, "resultado": resultado})
+            if resultado == "Criado":
+                criados.append(username)
+
+    if criados:
+        # Usuários novos não tinham entrada individual no cache; basta invalidar a listagem
+        obter_cache_compartilhado().invalidar("usuarios", "todos")
+    relatorio.sort(key=lambda item: item["linha"])
+    return relatorio
 
 # Garante que o usuário admin exista na primeira execução
 def inicializar_admin_existencia():
-    users = carregar_usuarios()
-    if ADMIN_USERNAME not in users:
+    # Executa a cada rerun: consulta só o documento do admin (em cache), não a coleção inteira
+    if buscar_hash_senha(ADMIN_USERNAME) is None:
         st.sidebar.warning(f"O usuário administrador ('{ADMIN_USERNAME}') não existe. Por favor, crie-o manualmente no Firestore ou via aba 'Gerenciar Usuários' depois de criar um admin inicial.")
         st.stop() # App não pode iniciar sem admin para criar outros usuários
     return True
 
 
+# --- Estatísticas por modelo (latência e distribuição de notas) para ajustar as rotas ---
+@st.cache_resource
+def _estatisticas_modelos():
+    return {"lock": threading.Lock(), "por_modelo": {}}
+
+def registrar_estatistica_modelo(nome_modelo, latencia=None, nota=None, falha=None):
+    estatisticas = _estatisticas_modelos()
+    with estatisticas["lock"]:
+        dados = estatisticas["por_modelo"].setdefault(nome_modelo, {
+            "latencias": deque(maxlen=1000), "notas": deque(maxlen=1000), "falhas": Counter()
+        })
+        if latencia is not None:
+            dados["latencias"].append(latencia)
+        if nota is not None:
+            dados["notas"].append(nota)
+        if falha is not None:
+            dados["falhas"][falha] += 1
+
+def _percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def latencia_p90_modelo(nome_modelo):
+    estatisticas = _estatisticas_modelos()
+    with estatisticas["lock"]:
+        dados = estatisticas["por_modelo"].get(nome_modelo)
+        return _percentil(list(dados["latencias"]), 90) if dados else None
+
+def resumo_estatisticas_modelos():
+    """Linhas por modelo: chamadas, latência p50/p90, nota média e faixas de nota, falhas por tipo."""
+    estatisticas = _estatisticas_modelos()
+    linhas = []
+    with estatisticas["lock"]:
+        for nome_modelo, dados in sorted(estatisticas["por_modelo"].items()):
+            latencias, notas = list(dados["latencias"]), list(dados["notas"])
+            faixas = Counter(min(nota // 20, 4) for nota in notas)
+            linhas.append({
+                "modelo": nome_modelo,
+                "chamadas": len(latencias),
+                "latencia_p50_s": round(_percentil(latencias, 50), 2) if latencias else None,
+                "latencia_p90_s": round(_percentil(latencias, 90), 2) if latencias else None,
+                "nota_media": round(sum(notas) / len(notas), 1) if notas else None,
+                "notas_0_19/20_39/40_59/60_79/80_100": "/".join(str(faixas.get(i, 0)) for i in range(5)),
+                "falhas": ", ".join(f"{tipo}: {qtd}" for tipo, qtd in dados["falhas"].items()) or "-",
+            })
+    return linhas
+
+def escolher_modelos(resposta_usuario, resposta_esperada, orcamento_latencia):
+    """Retorna (sequência de modelos a tentar, timeout da rota escolhida) para o tamanho e o orçamento dados."""
+    tamanho = len(resposta_usuario) + len(resposta_esperada)
+    candidatas = [rota for rota in ROTAS_MODELOS
+                  if rota.get("max_caracteres") is None or tamanho <= rota["max_caracteres"]]
+    if not candidatas:
+        candidatas = [ROTAS_MODELOS[-1]]
+    escolhida = candidatas[0]
+    for rota in candidatas:
+        p90 = latencia_p90_modelo(rota["modelo"])
+        if p90 is None or p90 <= orcamento_latencia:
+            escolhida = rota
+            break
+    sequencia = [escolhida["modelo"]]
+    if MODELO_FALLBACK and MODELO_FALLBACK != escolhida["modelo"]:
+        sequencia.append(MODELO_FALLBACK)
+    return sequencia, escolhida.get("timeout", orcamento_latencia)
+
+
+# --- CONSUMO DE TOKENS E CUSTO POR USUÁRIO (COM COTAS) ---
+# Cada correção enviada ao Gemini soma chamadas, tokens (usage_metadata), custo estimado e latência num
+# contador diário por (usuário, matéria, modelo). O contador é fragmentado em CONSUMO_SHARDS documentos
+# e cada chamada incrementa um deles ao acaso (firestore.Increment): correções simultâneas não disputam
+# o mesmo documento e não existe um documento por chamada.
+# As cotas diárias (por usuário e global) são verificadas antes da chamada. O consumo do dia é lido do
+# Firestore no máximo a cada CONSUMO_TTL_LEITURA segundos e somado ao que este processo registrou desde
+# então; correções simultâneas podem passar da cota em no máximo uma chamada cada.
+USAGE_COLLECTION = "usage_counters"
+CONSUMO_SHARDS = int(os.getenv("CONSUMO_SHARDS", "10"))
+CONSUMO_TTL_LEITURA = 30 # segundos
+CAMPOS_CONSUMO = ("chamadas", "tokens_entrada", "tokens_saida", "custo_usd", "latencia_total_s")
+# Cotas padrão (0 = sem cota). Os campos cota_diaria_tokens/cota_diaria_correcoes do documento do
+# usuário substituem as do usuário.
+COTA_DIARIA_TOKENS_USUARIO = int(os.getenv("COTA_DIARIA_TOKENS_USUARIO", "0"))
+COTA_DIARIA_CORRECOES_USUARIO = int(os.getenv("COTA_DIARIA_CORRECOES_USUARIO", "0"))
+COTA_DIARIA_CUSTO_GLOBAL_USD = float(os.getenv("COTA_DIARIA_CUSTO_GLOBAL_USD", "0"))
+# US$ por milhão de tokens [entrada, saída]; GEMINI_PRECOS_MODELOS aceita o mesmo dicionário em JSON
+PRECOS_MODELOS_PADRAO = {
+    "models/gemini-2.5-flash-lite": [0.10, 0.40],
+    "models/gemini-2.5-flash": [0.30, 2.50],
+    "models/gemini-2.0-flash": [0.10, 0.40],
+}
+
+def _carregar_precos_modelos():
+    precos_json = os.getenv("GEMINI_PRECOS_MODELOS")
+    if precos_json:
+        try:
+            return json.loads(precos_json)
+        except ValueError:
+            st.warning("GEMINI_PRECOS_MODELOS não é um JSON válido. Usando os preços padrão.")
+    return PRECOS_MODELOS_PADRAO
+
+PRECOS_MODELOS = _carregar_precos_modelos()
+
+@st.cache_resource
+def _registro_consumo():
+    """(dia, username ou None = todos) -> totais lidos do Firestore (com o instante) e totais registrados aqui desde a leitura."""
+    return {"lock": threading.Lock(), "lidos": {}, "locais": {}}
+
+def dia_consumo():
+    return datetime.date.today().isoformat()
+
+def _somar_consumo(destino, origem):
+    for campo in CAMPOS_CONSUMO:
+        destino[campo] = destino.get(campo, 0) + (origem.get(campo) or 0)
+
+def consumo_do_dia(username=None):
+    """Totais do dia (CAMPOS_CONSUMO) de um usuário ou, com username=None, de todos."""
+    dia = dia_consumo()
+    chave = (dia, username)
+    registro = _registro_consumo()
+    with registro["lock"]:
+        lido = registro["lidos"].get(chave)
+    if lido is None or time.monotonic() - lido[1] > CONSUMO_TTL_LEITURA:
+        totais = {campo: 0 for campo in CAMPOS_CONSUMO}
+        try:
+            consulta = db.collection(USAGE_COLLECTION).where("dia", "==", dia)
+            if username is not None:
+                consulta = consulta.where("username", "==", username)
+            for doc in consulta.stream():
+                _somar_consumo(totais, doc.to_dict())
+        except Exception:
+            # Sem leitura, vale o último valor conhecido: a contabilização não bloqueia as correções
+            totais = lido[0] if lido is not None else totais
+        with registro["lock"]:
+            registro["lidos"] = {c: v for c, v in registro["lidos"].items() if c[0] == dia}
+            registro["locais"] = {c: v for c, v in registro["locais"].items() if c[0] == dia and c != chave}
+            registro["lidos"][chave] = (totais, time.monotonic())
+    with registro["lock"]:
+        totais = dict(registro["lidos"][chave][0])
+        _somar_consumo(totais, registro["locais"].get(chave, {}))
+    return totais
+
+def cotas_usuario(username):
+    """(cota diária de tokens, cota diária de correções) do usuário; 0 = sem cota."""
+    cache = obter_cache_compartilhado()
+    cotas = cache.obter("cotas", username)
+    if cotas is None:
+        try:
+            doc = db.collection(USERS_COLLECTION).document(username).get()
+            dados = doc.to_dict() if doc.exists else {}
+        except Exception:
+            dados = {}
+        cotas = (dados.get("cota_diaria_tokens", COTA_DIARIA_TOKENS_USUARIO),
+                 dados.get("cota_diaria_correcoes", COTA_DIARIA_CORRECOES_USUARIO))
+        cache.gravar("cotas", username, cotas, CACHE_TTL_USUARIOS)
+    return cotas
+
+def definir_cotas_usuario(username, cota_tokens, cota_correcoes):
+    """Grava as cotas do usuário (None = volta à cota padrão)."""
+    try:
+        db.collection(USERS_COLLECTION).document(username).update({
+            "cota_diaria_tokens": firestore.DELETE_FIELD if cota_tokens is None else int(cota_tokens),
+            "cota_diaria_correcoes": firestore.DELETE_FIELD if cota_correcoes is None else int(cota_correcoes),
+        })
+        obter_cache_compartilhado().invalidar("cotas", username)
+        return True
+    except Exception as e:
+        st.error(f"Erro ao gravar as cotas de '{username}': {e}")
+        return False
+
+def verificar_cota(username):
+    """Retorna o motivo do bloqueio se a cota do dia acabou, ou None se a correção pode ser feita."""
+    if COTA_DIARIA_CUSTO_GLOBAL_USD > 0 and consumo_do_dia()["custo_usd"] >= COTA_DIARIA_CUSTO_GLOBAL_USD:
+        return "a cota diária global de uso do Gemini foi atingida. Tente novamente amanhã."
+    if username is None:
+        return None
+    cota_tokens, cota_correcoes = cotas_usuario(username)
+    if not (cota_tokens or cota_correcoes):
+        return None
+    consumo = consumo_do_dia(username)
+    if cota_tokens and consumo["tokens_entrada"] + consumo["tokens_saida"] >= cota_tokens:
+        return f"sua cota diária de {cota_tokens} tokens foi atingida. Tente novamente amanhã."
+    if cota_correcoes and consumo["chamadas"] >= cota_correcoes:
+        return f"sua cota diária de {cota_correcoes} correções foi atingida. Tente novamente amanhã."
+    return None
+
+def tokens_da_resposta(response):
+    """(tokens de entrada, tokens de saída) informados pelo Gemini; 0 quando a resposta não traz usage_metadata."""
+    uso = getattr(response, "usage_metadata", None)
+    return getattr(uso, "prompt_token_count", 0) or 0, getattr(uso, "candidates_token_count", 0) or 0
+
+def registrar_consumo(username, materia, nome_modelo, response, latencia):
+    """Soma a chamada num shard aleatório do contador diário de (usuário, matéria, modelo)."""
+    tokens_entrada, tokens_saida = tokens_da_resposta(response)
+    preco_entrada, preco_saida = PRECOS_MODELOS.get(nome_modelo, (0.0, 0.0))
+    valores = {
+        "chamadas": 1,
+        "tokens_entrada": tokens_entrada,
+        "tokens_saida": tokens_saida,
+        "custo_usd": (tokens_entrada * preco_entrada + tokens_saida * preco_saida) / 1_000_000,
+        "latencia_total_s": latencia,
+    }
+    dia = dia_consumo()
+    registro = _registro_consumo()
+    with registro["lock"]:
+        for chave in ((dia, username), (dia, None)):
+            _somar_consumo(registro["locais"].setdefault(chave, {}), valores)
+    grupo = hashlib.sha1(f"{dia}\n{username}\n{materia}\n{nome_modelo}".encode("utf-8")).hexdigest()[:16]
+    shard = secrets.randbelow(CONSUMO_SHARDS)
+    try:
+        db.collection(USAGE_COLLECTION).document(f"{dia}_{grupo}_{shard}").set({
+            "dia": dia, "username": username, "materia": materia or "", "modelo": nome_modelo, "shard": shard,
+            **{campo: firestore.Increment(valor) for campo, valor in valores.items()},
+        }, merge=True)
+    except Exception:
+        pass # A contabilização nunca derruba a correção já feita
+
+def relatorio_consumo(dias):
+    """DataFrame com os contadores (já somados entre shards) dos últimos 'dias' dias."""
+    inicio = (datetime.date.today() - datetime.timedelta(days=dias - 1)).isoformat()
+    linhas = [doc.to_dict() for doc in db.collection(USAGE_COLLECTION).where("dia", ">=", inicio).stream()]
+    if not linhas:
+        return pd.DataFrame(columns=["dia", "username", "materia", "modelo", *CAMPOS_CONSUMO])
+    tabela = pd.DataFrame(linhas)
+    tabela["username"] = tabela["username"].fillna("-")
+    return tabela.groupby(["dia", "username", "materia", "modelo"], as_index=False)[list(CAMPOS_CONSUMO)].sum()
+
+
+# --- RUBRICA POR CARTÃO ---
+# A rubrica (lista curta de pontos-chave com pesos que somam 100) é gerada uma vez quando o cartão é
+# criado ou editado e fica no documento do cartão. Na correção ela substitui a resposta esperada
+# completa no prompt: menos tokens de entrada e critérios iguais em todas as correções do cartão.
+# Vale apenas enquanto o hash da resposta esperada e a versão conferem.
+RUBRICA_VERSAO = 1
+RUBRICA_MAX_PONTOS = 8
+MODELO_RUBRICA = os.getenv("GEMINI_MODELO_RUBRICA", ROTAS_MODELOS[-1]["modelo"])
+TIMEOUT_RUBRICA = 60
+
+def _normalizar_itens_rubrica(itens):
+    """Valida a lista devolvida pelo modelo e reescala os pesos para inteiros que somam 100."""
+    validos = []
+    for item in itens if isinstance(itens, list) else []:
+        if not isinstance(item, dict):
+            continue
+        ponto = str(item.get("ponto", "")).strip()
+        try:
+            peso = float(item.get("peso", 1))
+        except (TypeError, ValueError):
+            peso = 1.0
+        if ponto and peso > 0:
+            validos.append((ponto, peso))
+    validos = validos[:RUBRICA_MAX_PONTOS]
+    if not validos:
+        return None
+    soma = sum(peso for _, peso in validos)
+    pesos = [max(1, round(100 * peso / soma)) for _, peso in validos]
+    pesos[pesos.index(max(pesos))] += 100 - sum(pesos) # Ajuste de arredondamento no maior peso
+    return [{"ponto": ponto, "peso": peso} for (ponto, _), peso in zip(validos, pesos)]
+
+def gerar_rubrica(pergunta, resposta_esperada):
+    """Pede ao Gemini os pontos-chave da resposta esperada. Retorna o dict da rubrica ou None em caso de falha."""
+    prompt = f"""
+    Extraia da 'Resposta Esperada' os pontos-chave que uma resposta correta à 'Pergunta' precisa conter.
+    Ignore números de artigo, formatação, ordem de enumeração e detalhes que a Pergunta não pede.
+    Responda apenas com um JSON no formato [{{"ponto": "descrição curta", "peso": 1 a 5}}], com no máximo {RUBRICA_MAX_PONTOS} pontos.
+    O peso indica a importância do ponto para a Pergunta.
+
+    ---
+    Pergunta:
+    {pergunta}
+
+    ---
+    Resposta Esperada:
+    {resposta_esperada}
+    ---
+    """
+    try:
+        response = obter_modelo_gemini(MODELO_RUBRICA).generate_content(
+            prompt, generation_config={"response_mime_type": "application/json"}, request_options={"timeout": TIMEOUT_RUBRICA})
+        texto = re.sub(r"^```(?:json)?|```$", "", response.text.strip()).strip()
+        itens = _normalizar_itens_rubrica(json.loads(texto))
+    except Exception:
+        return None
+    if itens is None:
+        return None
+    return {"versao": RUBRICA_VERSAO, "resposta_esperada_hash": hash_resposta_esperada(resposta_esperada), "itens": itens}
+
+def rubrica_vigente(card):
+    """Itens da rubrica do cartão, se ela corresponde à resposta esperada atual; senão None."""
+    return card.itens_rubrica if isinstance(card, Cartao) else _conferir_rubrica(card)
+
+def _conferir_rubrica(card):
+    rubrica = card.get("rubrica")
+    if (not rubrica or rubrica.get("versao") != RUBRICA_VERSAO or
+            rubrica.get("resposta_esperada_hash") != hash_resposta_esperada(card["resposta_esperada"])):
+        return None
+    return rubrica.get("itens") or None
+
+def com_rubrica(card_data):
+    """Retorna card_data com a rubrica gerada (ou sem ela, se a geração falhar; a correção usa o texto completo)."""
+    rubrica = gerar_rubrica(card_data["pergunta"], card_data["resposta_esperada"])
+    if rubrica is None:
+        st.warning("Não foi possível gerar a rubrica deste cartão agora; a correção usará o padrão de resposta completo.")
+        return card_data
+    return {**card_data, "rubrica": rubrica}
+
+
+# --- VERIFICAÇÃO ORTOGRÁFICA LOCAL ---
+# Com ORTOGRAFIA_DICIONARIO (lista de palavras pt-BR; ver verificador_ortografico.py), a resposta é
+# verificada localmente no envio (ortografia por deleções simétricas + regras de crase e concordância)
+# e o resultado aparece na hora, enquanto o Gemini corrige. Com ORTOGRAFIA_OMITIR_SECAO_GEMINI=1, a
+# seção 4 sai do prompt e o feedback usa o resultado local (resposta do Gemini mais curta).
+ORTOGRAFIA_DICIONARIO = os.getenv("ORTOGRAFIA_DICIONARIO")
+ORTOGRAFIA_INDICE = os.getenv("ORTOGRAFIA_INDICE") # padrão: <dicionário>.idx
+ORTOGRAFIA_OMITIR_SECAO_GEMINI = _flag_ambiente("ORTOGRAFIA_OMITIR_SECAO_GEMINI")
+SECAO_GRAMATICAL_AUSENTE = "Não disponível." # valor do parse_feedback_sections para seção ausente
+
+@st.cache_resource
+def verificador_ortografico():
+    """Índice do dicionário, carregado (e compilado, se preciso) uma vez por processo. None se indisponível."""
+    if not ORTOGRAFIA_DICIONARIO:
+        return None
+    try:
+        return VerificadorOrtografico(ORTOGRAFIA_DICIONARIO, ORTOGRAFIA_INDICE)
+    except (OSError, ValueError) as e:
+        st.warning(f"Verificação ortográfica local desativada: {e}")
+        return None
+
+def omitir_secao_gramatical():
+    return ORTOGRAFIA_OMITIR_SECAO_GEMINI and verificador_ortografico() is not None
+
+def verificar_resposta_localmente(card, resposta_usuario):
+    """Texto da seção de erros gramaticais/ortográficos calculado localmente (None sem dicionário)."""
+    verificador = verificador_ortografico()
+    if verificador is None:
+        return None
+    # Termos da própria pergunta e do padrão de resposta nunca são apontados (vocabulário técnico da matéria)
+    palavras_conhecidas = re.findall(r"\w+(?:-\w+)*", f"{card['pergunta']} {card['resposta_esperada']}")
+    return formatar_apontamentos(verificar_texto(resposta_usuario, verificador, palavras_conhecidas))
+
+
 # --- Função de Interação com o Gemini ---
-def comparar_respostas_com_gemini(pergunta, resposta_usuario, resposta_esperada):
+# O texto do prompt e o parser do feedback ficam em prompt_correcao.py (compartilhados com o benchmark_prompts.py).
+# Com GEMINI_FIXTURES_CORRECAO (caminho de um .jsonl), cada correção feita pelo Gemini é gravada como fixture.
+GEMINI_FIXTURES_CORRECAO = os.getenv("GEMINI_FIXTURES_CORRECAO")
+
+@st.cache_resource
+def _gravador_fixtures():
+    return GravadorFixtures(GEMINI_FIXTURES_CORRECAO) if GEMINI_FIXTURES_CORRECAO else None
+
+def comparar_respostas_com_gemini(pergunta, resposta_usuario, resposta_esperada, orcamento_latencia=None, rubrica=None,
+                                  username=None, materia=None):
     """
     Envia a resposta do usuário e a resposta esperada para o Gemini
     e pede para ele comparar o sentido, apontar erros gramaticais/grafia,
     sugerir modificações, dar uma pontuação e indicar lacunas de conteúdo.
-    O feedback será sucinto.
+    O feedback será sucinto. O modelo é escolhido por escolher_modelos() dentro
+    do orçamento de latência (segundos), com fallback automático.
+    Com 'rubrica' (itens de rubrica_vigente), os pontos-chave com pesos substituem o texto completo.
+    O consumo é atribuído a 'username'/'materia', e a chamada não é feita se a cota do dia acabou.
+    Com a verificação ortográfica local e ORTOGRAFIA_OMITIR_SECAO_GEMINI, o prompt não pede a seção 4.
     """
     if not resposta_usuario.strip() or not resposta_esperada.strip():
         return "Por favor, forneça ambas as respostas para comparação."
 
-    prompt = f"""
-    Sua tarefa é fornecer um feedback **sucinto e objetivo** para a 'Resposta do Usuário' em relação à 'Resposta Esperada' e, crucialmente, em relação à **Pergunta** feita.
-    A ideia é que o usuário ganhe agilidade no aprendizado, focando nos pontos essenciais **relevantes para a Pergunta**.
+    template = PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA if omitir_secao_gramatical() else PROMPT_CORRECAO_TEMPLATE
+    prompt, referencia = montar_prompt_correcao(pergunta, resposta_usuario, resposta_esperada, rubrica, template=template)
+    if orcamento_latencia is None:
+        orcamento_latencia = ORCAMENTO_LATENCIA_PADRAO
+    sequencia_modelos, timeout_rota = escolher_modelos(resposta_usuario, referencia, orcamento_latencia)
+
+    # Cache compartilhado de correções: a mesma pergunta/resposta não é enviada duas vezes ao Gemini.
+    # A chave leva o modelo que respondeu; vale a resposta de qualquer modelo da sequência, na ordem dela.
+    cache = obter_cache_compartilhado()
+    def chave_correcao(nome_modelo):
+        return hashlib.sha256(f"{nome_modelo}\n{prompt}".encode("utf-8")).hexdigest()
+    for nome_modelo in sequencia_modelos:
+        feedback_em_cache = cache.obter("correcoes", chave_correcao(nome_modelo))
+        if feedback_em_cache is not None:
+            return feedback_em_cache
+    cota_esgotada = verificar_cota(username)
+    if cota_esgotada:
+        return f"Erro ao comunicar com o Gemini: {cota_esgotada}"
+
+    inicio_total = time.monotonic()
+    ultimo_erro = None
+    for posicao, nome_modelo in enumerate(sequencia_modelos):
+        restante = orcamento_latencia - (time.monotonic() - inicio_total)
+        if posicao > 0 and restante < TIMEOUT_MINIMO_GEMINI:
+            break # O fallback não cabe mais no orçamento de latência
+        timeout = max(min(timeout_rota, restante), TIMEOUT_MINIMO_GEMINI)
+        inicio = time.monotonic()
+        try:
+            response = obter_modelo_gemini(nome_modelo).generate_content(prompt, request_options={"timeout": timeout})
+            feedback_text = response.text
+        except ERROS_PARA_FALLBACK as e:
+            registrar_estatistica_modelo(nome_modelo, falha=type(e).__name__)
+            ultimo_erro = e
+            continue # Tenta o próximo modelo da sequência
+        except Exception as e:
+            registrar_estatistica_modelo(nome_modelo, falha=type(e).__name__)
+            return f"Erro ao comunicar com o Gemini: {e}"
+        registrar_estatistica_modelo(nome_modelo, latencia=time.monotonic() - inicio,
+                                     nota=extrair_nota_sentido(parse_feedback_sections(feedback_text)))
+        registrar_consumo(username, materia, nome_modelo, response, time.monotonic() - inicio)
+        gravador = _gravador_fixtures()
+        if gravador is not None:
+            try:
+                gravador.gravar(pergunta, resposta_usuario, resposta_esperada, rubrica, nome_modelo, prompt, feedback_text,
+                                *tokens_da_resposta(response), time.monotonic() - inicio, versao_prompt=PROMPT_CORRECAO_VERSAO)
+            except OSError:
+                pass # A gravação de fixtures é auxiliar: não pode derrubar a correção
+        cache.gravar("correcoes", chave_correcao(nome_modelo), feedback_text, CACHE_TTL_CORRECOES)
+        return feedback_text
+    return f"Erro ao comunicar com o Gemini: {ultimo_erro}"
+
+# --- SUBMISSÕES IDEMPOTENTES DE CORREÇÃO ---
+# Duplo clique em "Verificar Resposta" ou um rerun disputando o spinner geravam uma segunda chamada
+# ao Gemini e um segundo documento no histórico. Cada submissão agora tem uma chave derivada de
+# (sessão, cartão, nonce da submissão, hash da resposta): duplicatas simultâneas aguardam a chamada em
+# andamento e, no Firestore, a entrada do histórico é criada com essa chave como ID. O nonce nasce no
+# clique em "Verificar Resposta" e é reaproveitado enquanto a correção do cartão está em andamento ou
+# por JANELA_CLIQUE_REPETIDO_SEGUNDOS após o último clique: duplo clique e reruns colapsam na mesma
+# chave, mas responder de novo depois (mesmo com o mesmo texto) é uma submissão nova, com nova
+# correção e nova entrada no histórico.
+JANELA_DEDUPLICACAO_SEGUNDOS = 600 # Quanto tempo um resultado concluído continua atendendo duplicatas
+JANELA_CLIQUE_REPETIDO_SEGUNDOS = 3 # Cliques no mesmo cartão dentro dessa janela são a mesma submissão
+PREFIXOS_FEEDBACK_ERRO = ("Erro ao comunicar com o Gemini", "Por favor, forneça ambas as respostas")
+
+def chave_cartao(card):
+    return card.get("doc_id") or "|".join(card.card_id)
+
+def nonce_submissao(card):
+    """Nonce da submissão do cartão no clique atual: o da anterior se ainda está em andamento ou foi há pouco."""
+    chave = chave_cartao(card)
+    agora = time.monotonic()
+    nonce, ultimo_clique = st.session_state.nonces_submissao.get(chave, (None, 0.0))
+    if nonce is None or (chave not in st.session_state.correcoes_pendentes and
+                         agora - ultimo_clique > JANELA_CLIQUE_REPETIDO_SEGUNDOS):
+        nonce = secrets.token_urlsafe(12)
+    st.session_state.nonces_submissao[chave] = (nonce, agora)
+    return nonce
+
+def chave_idempotencia_correcao(card, resposta_usuario, nonce):
+    hash_resposta = hashlib.sha256(resposta_usuario.strip().encode("utf-8")).hexdigest()
+    base = f"{obter_id_sessao()}|{chave_cartao(card)}|{nonce}|{hash_resposta}"
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+def feedback_eh_erro(full_feedback_text):
+    return full_feedback_text.startswith(PREFIXOS_FEEDBACK_ERRO)
+
+@st.cache_resource
+def _correcoes_em_andamento():
+    """chave -> (Future, instante de conclusão ou None), compartilhado pelas sessões do processo."""
+    return {"lock": threading.Lock(), "futuros": {}}
+
+def corrigir_com_deduplicacao(chave, pergunta, resposta_usuario, resposta_esperada, rubrica=None, username=None, materia=None):
+    """
+    Executa comparar_respostas_com_gemini uma única vez por chave. Chamadas concorrentes (ou logo
+    depois) com a mesma chave recebem o mesmo resultado. Falhas não ficam retidas: a próxima
+    submissão tenta de novo.
+    """
+    registro = _correcoes_em_andamento()
+    agora = time.monotonic()
+    with registro["lock"]:
+        for chave_antiga, (_, concluido_em) in list(registro["futuros"].items()):
+            if concluido_em is not None and agora - concluido_em > JANELA_DEDUPLICACAO_SEGUNDOS:
+                del registro["futuros"][chave_antiga]
+        existente = registro["futuros"].get(chave)
+        if existente is None:
+            futuro = Future()
+            registro["futuros"][chave] = (futuro, None)
+        else:
+            futuro = existente[0]
+    if existente is not None:
+        return futuro.result()
 
-    Ao avaliar, desconsidere detalhes da 'Resposta Esperada' (como número de artigo, formatação, ordem exata de enumeração, ou informações contextuais que a Pergunta NÃO solicitou explicitamente).
-    Foque se a 'Resposta do Usuário' aborda os pontos essenciais que a **Pergunta** exigia, conforme os critérios contidos na 'Resposta Esperada'. Caso o usuário forneça informações que não constem da resposta esperada, verifique se ela é relevante para a Pergunta. Se for, não a considere como erro.
+    try:
+        full_feedback_text = comparar_respostas_com_gemini(pergunta, resposta_usuario, resposta_esperada, rubrica=rubrica,
+                                                           username=username, materia=materia)
+    except BaseException as e:
+        with registro["lock"]:
+            registro["futuros"].pop(chave, None)
+        futuro.set_exception(e)
+        raise
+    with registro["lock"]:
+        if feedback_eh_erro(full_feedback_text):
+            registro["futuros"].pop(chave, None)
+        else:
+            registro["futuros"][chave] = (futuro, time.monotonic())
+    futuro.set_result(full_feedback_text)
+    return full_feedback_text
 
-    O feedback deve ser dividido em seções claras, sem rodeios.
 
-    Quanto às sugestões de melhoria textual, elas devem ser **concisas** e diretas, focando em clareza, concisão e correção, sem entrar em detalhes excessivos. Verifique ainda, se o texto do usuário possui ambiguidades e se a estrutura gramatical é confusa. Observe-se que, em regra, a resposta do usuário deve ser em texto corrido e, portanto, mesmo que na Resposta Esperada contenha bullet points, o usuário não precisa utilizá-los em sua resposta. Aponte as melhorias de forma direta e prática, sem rodeios.
+# --- CORREÇÃO EM SEGUNDO PLANO (SEM TRAVAR A SESSÃO) ---
+# "Verificar Resposta" apenas envia a correção para um pool de threads do processo e guarda o Future
+# na sessão. Um fragmento consulta o andamento a cada segundo (com botão de cancelar) e, quando a
+# correção termina, dispara um rerun completo: o resultado é registrado no histórico e exibido no
+# cartão a que pertence, mesmo que o aluno tenha navegado para outro cartão ou aba nesse meio tempo.
+CORRECAO_WORKERS = int(os.getenv("CORRECAO_WORKERS", "8"))
+CORRECAO_TIMEOUT_SEGUNDOS = float(os.getenv("CORRECAO_TIMEOUT_SEGUNDOS", "90"))
+CORRECAO_INTERVALO_CONSULTA = 1.0 # segundos entre as consultas do fragmento
 
-    **Estrutura de Feedback Requerida:**
+@st.cache_resource
+def _executor_correcoes():
+    return ThreadPoolExecutor(max_workers=CORRECAO_WORKERS, thread_name_prefix="correcao")
 
-    **1. Pontuação de Sentido (0-100):**
-    [Uma pontuação numérica de 0 a 100% baseada na similaridade de sentido com a Resposta Esperada, **considerando a relevância para a Pergunta**. 100% = sentido idêntico e completo **para a Pergunta**.]
+def enviar_correcao(card, resposta_usuario, atualiza_dificeis, nonce):
+    """
+    Agenda a correção da resposta ao cartão. 'atualiza_dificeis' indica se o resultado deve recalcular
+    a lista de perguntas difíceis (só respostas dadas na aba "Todas as Perguntas" fazem isso); 'nonce'
+    é o de nonce_submissao. Retorna False se o cartão já tem uma correção em andamento.
+    """
+    pendentes = st.session_state.correcoes_pendentes
+    chave = chave_cartao(card)
+    if chave in pendentes:
+        return False
+    chave_submissao = chave_idempotencia_correcao(card, resposta_usuario, nonce)
+    pendentes[chave] = {
+        "chave_submissao": chave_submissao,
+        "pergunta": card["pergunta"],
+        "resposta_esperada": card["resposta_esperada"],
+        # O cartão pode ser editado antes de a correção terminar: a entrada usa os dados do momento do envio
+        "entrada": {"materia": card["materia"], "assunto": card["assunto"], "pergunta": card["pergunta"]},
+        "campos_armazenados": campos_resposta_armazenada(card, resposta_usuario),
+        "atualiza_dificeis": atualiza_dificeis,
+        "ortografia_local": verificar_resposta_localmente(card, resposta_usuario),
+        "enviado_em": time.monotonic(),
+        "futuro": _executor_correcoes().submit(corrigir_com_deduplicacao, chave_submissao, card["pergunta"], resposta_usuario,
+                                               card["resposta_esperada"], rubrica_vigente(card),
+                                               st.session_state.logged_in_user, card["materia"]),
+    }
+    st.session_state.feedbacks_por_cartao.pop(chave, None)
+    return True
 
-    **2. Avaliação Principal do Sentido:**
-    [Feedback qualitativo muito breve (ex: "Excelente.", "Bom, mas faltou X.", "Incompleto.", "Incorreto.").]
+def cancelar_correcao(chave):
+    """Descarta a correção pendente do cartão. Se ela já estiver no Gemini, o resultado é ignorado."""
+    pendente = st.session_state.correcoes_pendentes.pop(chave, None)
+    if pendente is not None:
+        pendente["futuro"].cancel()
+
+def correcao_pronta(pendente):
+    return pendente["futuro"].done() or time.monotonic() - pendente["enviado_em"] > CORRECAO_TIMEOUT_SEGUNDOS
+
+def finalizar_correcoes_concluidas(username):
+    """Registra no histórico as correções concluídas (ou que estouraram o tempo) e guarda o feedback por cartão."""
+    pendentes = st.session_state.correcoes_pendentes
+    atualizar_dificeis = False
+    for chave, pendente in list(pendentes.items()):
+        if not correcao_pronta(pendente):
+            continue
+        del pendentes[chave]
+        futuro = pendente["futuro"]
+        if not futuro.done():
+            futuro.cancel()
+            full_feedback_text = f"Erro ao comunicar com o Gemini: tempo limite de {CORRECAO_TIMEOUT_SEGUNDOS:.0f} s excedido."
+        else:
+            try:
+                full_feedback_text = futuro.result()
+            except Exception as e:
+                full_feedback_text = f"Erro ao comunicar com o Gemini: {e}"
+        parsed_feedback = parse_feedback_sections(full_feedback_text)
+        # Sem a seção 4 do Gemini (omitida do prompt ou ausente), vale a verificação local feita no envio
+        if (pendente.get("ortografia_local") is not None and not feedback_eh_erro(full_feedback_text) and
+                parsed_feedback.get("grammar_errors") == SECAO_GRAMATICAL_AUSENTE):
+            parsed_feedback["grammar_errors"] = pendente["ortografia_local"]
+        st.session_state.feedbacks_por_cartao[chave] = {
+            "parsed": parsed_feedback,
+            "pergunta": pendente["pergunta"],
+            "resposta_esperada": pendente["resposta_esperada"],
+        }
+
+        nota = extrair_nota_sentido(parsed_feedback)
+        nova_entrada = {
+            **pendente["entrada"],
+            "nota_sentido": nota,
+            "lacunas_conteudo": parsed_feedback.get('content_gaps'),
+            "timestamp": datetime.datetime.now().isoformat(),
+        }
+        # Falhas de comunicação não contam como tentativa; duplicatas não geram segunda entrada
+        if (not feedback_eh_erro(full_feedback_text) and
+                registrar_entrada_historico({**nova_entrada, **pendente["campos_armazenados"]}, username, pendente["chave_submissao"])):
+            st.session_state.feedback_history.append(nova_entrada)
+            atualizar_dificeis = atualizar_dificeis or pendente["atualiza_dificeis"]
+            descartar_rascunho(username, chave)
+            st.toast(f"Correção concluída ({nota if nota is not None else 'N/A'}%): {pendente['pergunta'][:60]}")
+        elif feedback_eh_erro(full_feedback_text):
+            st.toast(f"Falha na correção: {pendente['pergunta'][:60]}")
+
+    if atualizar_dificeis:
+        if not FIRESTORE_LISTENERS_HISTORICO: # Com listener, as novas entradas chegam pelo snapshot
+            st.session_state.feedback_history = carregar_historico_feedback(username)
+        # Atualiza apenas a lista de difíceis (a ordem da aba é mantida até o próximo login/alteração)
+        atualizar_indices_sessao(username, reordenar=False)
+
+def feedback_para_exibir(card):
+    """Move o feedback entregue para este cartão para o estado de exibição da aba e o retorna."""
+    entregue = st.session_state.feedbacks_por_cartao.pop(chave_cartao(card), None)
+    if entregue is not None:
+        st.session_state.last_gemini_feedback_display_parsed = entregue["parsed"]
+        st.session_state.last_gemini_feedback_question = entregue["pergunta"]
+        st.session_state.last_gemini_expected_answer = entregue["resposta_esperada"]
+    if (st.session_state.last_gemini_feedback_display_parsed is not None and
+            st.session_state.last_gemini_feedback_question == card["pergunta"]):
+        return st.session_state.last_gemini_feedback_display_parsed
+    return None
+
+@st.fragment(run_every=CORRECAO_INTERVALO_CONSULTA)
+def acompanhar_correcoes(chave_atual):
+    """Mostra o andamento da correção do cartão atual e recarrega a página quando alguma correção termina."""
+    pendentes = st.session_state.correcoes_pendentes
+    if any(correcao_pronta(p) for p in pendentes.values()):
+        st.rerun()
+    pendente = pendentes.get(chave_atual)
+    if pendente is not None:
+        decorrido = time.monotonic() - pendente["enviado_em"]
+        col_status, col_cancelar = st.columns([4, 1])
+        col_status.info(f"⏳ Analisando com Gemini... {decorrido:.0f} s (limite de {CORRECAO_TIMEOUT_SEGUNDOS:.0f} s). "
+                        "Você pode navegar enquanto isso; o resultado aparece neste cartão.")
+        if col_cancelar.button("Cancelar", key=f"cancel_grading_{chave_atual}"):
+            cancelar_correcao(chave_atual)
+            st.rerun()
+        if pendente.get("ortografia_local") is not None:
+            st.markdown(f"**Erros Gramaticais/Ortográficos (verificação local):** {pendente['ortografia_local']}")
+    outras = len(pendentes) - (pendente is not None)
+    if outras:
+        st.caption(f"{outras} correção(ões) em andamento em outros cartões.")
+
+
+# --- RASCUNHOS DE RESPOSTA (AUTOSALVAMENTO COM DEBOUNCE) ---
+# A resposta em digitação se perdia no refresh ou no logout. Cada alteração da caixa de resposta só
+# atualiza um buffer do processo (a versão mais recente de cada cartão substitui a anterior); uma
+# thread grava o buffer a cada RASCUNHO_INTERVALO_SEGUNDOS, com todos os rascunhos alterados no mesmo
+# commit em lote. Assim cada cartão gera no máximo uma escrita pequena por intervalo, por mais que o
+# texto mude. O rascunho volta quando o cartão é reaberto e é apagado quando a resposta é corrigida.
+RASCUNHOS_COLLECTION = "answer_drafts" # Rascunhos de resposta por cartão (subcoleção do usuário)
+RASCUNHO_INTERVALO_SEGUNDOS = float(os.getenv("RASCUNHO_INTERVALO_SEGUNDOS", "5"))
+RASCUNHO_MAX_CARACTERES = 20000
+
+@st.cache_resource
+def _registro_rascunhos():
+    """Rascunhos ainda não gravados: (username, chave do cartão) -> texto (None = apagar o rascunho)."""
+    return {"lock": threading.Lock(), "sujos": {}, "thread": None}
+
+def _ref_rascunho(username, chave):
+    # A chave do cartão pode conter "/" (cartões antigos sem doc_id): o documento usa o hash dela
+    return (db.collection(USERS_COLLECTION).document(username).collection(RASCUNHOS_COLLECTION)
+            .document(hashlib.sha1(chave.encode("utf-8")).hexdigest()))
+
+def gravar_rascunhos_pendentes():
+    """Grava o buffer em commits em lote. O que falhar volta ao buffer (sem sobrescrever edições mais novas)."""
+    registro = _registro_rascunhos()
+    with registro["lock"]:
+        sujos, registro["sujos"] = registro["sujos"], {}
+    itens = list(sujos.items())
+    gravados = 0
+    try:
+        for inicio in range(0, len(itens), LOTE_MAX_ESCRITAS):
+            batch = db.batch()
+            for (username, chave), texto in itens[inicio:inicio + LOTE_MAX_ESCRITAS]:
+                if texto is None:
+                    batch.delete(_ref_rascunho(username, chave))
+                else:
+                    batch.set(_ref_rascunho(username, chave),
+                              {"chave": chave, "texto": texto, "atualizado_em": datetime.datetime.now().isoformat()})
+            batch.commit()
+            gravados = min(len(itens), inicio + LOTE_MAX_ESCRITAS)
+    except Exception:
+        with registro["lock"]:
+            for item, texto in itens[gravados:]:
+                registro["sujos"].setdefault(item, texto)
+    return gravados
+
+def _laco_gravacao_rascunhos():
+    while True:
+        time.sleep(RASCUNHO_INTERVALO_SEGUNDOS)
+        gravar_rascunhos_pendentes()
+
+def _marcar_rascunho(username, chave, texto):
+    registro = _registro_rascunhos()
+    with registro["lock"]:
+        registro["sujos"][(username, chave)] = texto
+        if registro["thread"] is None:
+            registro["thread"] = threading.Thread(target=_laco_gravacao_rascunhos, daemon=True, name="rascunhos")
+            registro["thread"].start()
+
+def rascunhos_sessao(username):
+    """Rascunhos do usuário (chave do cartão -> texto), lidos uma vez por sessão."""
+    if st.session_state.rascunhos is None:
+        rascunhos = {}
+        try:
+            for doc in db.collection(USERS_COLLECTION).document(username).collection(RASCUNHOS_COLLECTION).stream():
+                dados = doc.to_dict()
+                rascunhos[dados["chave"]] = dados.get("texto", "")
+        except Exception as e:
+            st.error(f"Erro ao carregar os rascunhos de resposta de '{username}': {e}")
+        # O que ainda está no buffer do processo (ex.: refresh logo após digitar) é mais novo que o gravado
+        registro = _registro_rascunhos()
+        with registro["lock"]:
+            for (dono, chave), texto in registro["sujos"].items():
+                if dono != username:
+                    continue
+                if texto is None:
+                    rascunhos.pop(chave, None)
+                else:
+                    rascunhos[chave] = texto
+        st.session_state.rascunhos = rascunhos
+    return st.session_state.rascunhos
+
+def registrar_rascunho(chave_widget, chave):
+    """Callback (on_change) da caixa de resposta: guarda o texto atual como rascunho do cartão."""
+    username = st.session_state.logged_in_user
+    texto = st.session_state.get(chave_widget) or ""
+    rascunhos = rascunhos_sessao(username)
+    if texto.strip():
+        rascunhos[chave] = texto[:RASCUNHO_MAX_CARACTERES]
+        _marcar_rascunho(username, chave, rascunhos[chave])
+    elif rascunhos.pop(chave, None) is not None:
+        _marcar_rascunho(username, chave, None)
+
+def descartar_rascunho(username, chave):
+    """Apaga o rascunho do cartão (resposta corrigida)."""
+    if rascunhos_sessao(username).pop(chave, None) is not None:
+        _marcar_rascunho(username, chave, None)
+
+def preparar_caixa_resposta(chave_widget, card):
+    """
+    Vincula a caixa de resposta ao cartão exibido e devolve a chave do cartão. Quando a caixa é
+    (re)criada para o cartão (refresh, volta da navegação ou índice que passou a apontar para outro
+    cartão), ela começa com o rascunho salvo.
+    """
+    chave = chave_cartao(card)
+    if st.session_state.caixas_resposta.get(chave_widget) != chave or chave_widget not in st.session_state:
+        st.session_state.caixas_resposta[chave_widget] = chave
+        st.session_state[chave_widget] = rascunhos_sessao(st.session_state.logged_in_user).get(chave, "")
+    return chave
+
+
+# --- RESPOSTAS ARMAZENADAS E RECORREÇÃO EM LOTE ---
+# Cada entrada do histórico guarda a resposta do aluno compactada (zlib), o cartão de origem, o hash
+# da resposta esperada usada e a versão do prompt. Quando a resposta esperada muda (ou o prompt, ao
+# incrementar PROMPT_CORRECAO_VERSAO), as entradas antigas podem ser corrigidas de novo por um job
+# em segundo plano. O job e sua fila ficam no Firestore, então podem ser pausados e retomados.
+PROMPT_CORRECAO_VERSAO = 1 # Incrementar quando o prompt de correção (prompt_correcao.py) mudar
+CAMPO_RESPOSTA_ARMAZENADA = "resposta_compactada"
+JOBS_RECORRECAO_COLLECTION = "regrading_jobs"
+RECORRECAO_WORKERS = int(os.getenv("RECORRECAO_WORKERS", "4"))
+RECORRECAO_RPM = int(os.getenv("RECORRECAO_RPM", "30")) # Abaixo da cota do Gemini, para não disputar com as correções ao vivo
+RECORRECAO_ORCAMENTO_LATENCIA = 120
+RECORRECAO_PAGINA = 50 # Itens buscados da fila por vez (e máximo em andamento)
+RECORRECAO_MAX_TENTATIVAS = 3
+RECORRECAO_NOTAS_ANTERIORES = 10 # Notas anteriores guardadas em cada entrada recorrigida
+log_recorrecao = logging.getLogger("recorrecao") # as threads do job não têm sessão: erros vão para o log, não para st.*
+
+def compactar_resposta(texto):
+    return zlib.compress(texto.encode("utf-8"), 9)
+
+def descompactar_resposta(dados):
+    return zlib.decompress(dados).decode("utf-8")
+
+def hash_resposta_esperada(resposta_esperada):
+    return hashlib.sha256(resposta_esperada.strip().encode("utf-8")).hexdigest()[:16]
+
+def campos_resposta_armazenada(card, resposta_usuario):
+    """Campos extras gravados no Firestore junto com a entrada do histórico (não ficam na sessão)."""
+    return {
+        CAMPO_RESPOSTA_ARMAZENADA: compactar_resposta(resposta_usuario),
+        "cartao_id": card.get("doc_id"),
+        "resposta_esperada_hash": hash_resposta_esperada(card["resposta_esperada"]),
+        "versao_prompt": PROMPT_CORRECAO_VERSAO,
+        "com_rubrica": rubrica_vigente(card) is not None,
+    }
 
-    **3. Lacunas de Conteúdo:**
-    [Liste os pontos-chave da Resposta Esperada que NÃO foram abordados ou foram abordados de forma insuficiente na Resposta do Usuário **E que são relevantes para a Pergunta**. Use bullet points sucintos. Se não houver lacunas, diga "Nenhuma lacuna significativa."]
+def sem_resposta_armazenada(entrada):
+    entrada.pop(CAMPO_RESPOSTA_ARMAZENADA, None)
+    return entrada
+
+def entrada_desatualizada(entrada, cartao):
+    return (entrada.get("versao_prompt") != PROMPT_CORRECAO_VERSAO or
+            entrada.get("resposta_esperada_hash") != hash_resposta_esperada(cartao["resposta_esperada"]) or
+            entrada.get("com_rubrica", False) != (rubrica_vigente(cartao) is not None))
+
+class LimitadorTaxa:
+    """Espaça as chamadas de todos os workers para no máximo 'por_minuto' chamadas por minuto."""
+    def __init__(self, por_minuto):
+        self.intervalo = 60.0 / max(por_minuto, 1)
+        self.proxima = time.monotonic()
+        self.lock = threading.Lock()
+
+    def aguardar(self, parar_evento=None):
+        with self.lock:
+            agora = time.monotonic()
+            espera = max(0.0, self.proxima - agora)
+            self.proxima = max(agora, self.proxima) + self.intervalo
+        if parar_evento is not None:
+            parar_evento.wait(espera)
+        else:
+            time.sleep(espera)
 
-    **4. Erros Gramaticais/Ortográficos:**
-    [Liste os principais erros encontrados na 'Resposta do Usuário'. Formato: 'Palavra/Frase Incorreta' -> 'Sugestão de Correção'. Se não houver, diga "Nenhum erro encontrado."]
+@st.cache_resource
+def _registro_jobs_recorrecao():
+    """Jobs em execução neste processo: job_id -> (thread, evento de parada). O limitador é único por processo."""
+    return {"lock": threading.Lock(), "em_execucao": {}, "limitador": LimitadorTaxa(RECORRECAO_RPM)}
 
-    **5. Sugestões Rápidas de Melhoria:**
-    [Sugestões muito concisas para aprimorar a resposta em termos de clareza, concisão e correção, baseadas nos erros e lacunas. Use bullet points.]
+def criar_job_recorrecao(usernames, materia=None, apenas_desatualizadas=True):
+    """
+    Monta a fila do job com as entradas do histórico que têm resposta armazenada (e, se pedido, que
+    foram corrigidas com outra resposta esperada ou outra versão do prompt). Retorna (job_id, total);
+    sem nenhuma entrada elegível o job não é criado e o retorno é (None, 0).
+    """
+    job_ref = db.collection(JOBS_RECORRECAO_COLLECTION).document()
+    itens_ref = job_ref.collection("itens")
+    total = 0
+    batch = db.batch()
+    pendentes = 0
+    for username in usernames:
+        baralho = obter_baralho(username)
+        consulta = db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION)
+        if materia:
+            consulta = consulta.where("materia", "==", materia)
+        for doc in consulta.stream():
+            entrada = doc.to_dict()
+            posicao = baralho.posicao(entrada.get("cartao_id"))
+            if CAMPO_RESPOSTA_ARMAZENADA not in entrada or posicao is None:
+                continue # Entradas antigas (sem resposta) ou de cartões excluídos não podem ser recorrigidas
+            if apenas_desatualizadas and not entrada_desatualizada(entrada, baralho.cartoes[posicao]):
+                continue
+            batch.set(itens_ref.document(), {"username": username, "entrada_id": doc.id, "status": "pendente", "tentativas": 0})
+            total += 1
+            pendentes += 1
+            if pendentes >= LOTE_MAX_ESCRITAS:
+                batch.commit()
+                batch = db.batch()
+                pendentes = 0
+    if not total:
+        return None, 0
+    batch.set(job_ref, {
+        "status": "pausado",
+        "criado_em": datetime.datetime.now().isoformat(),
+        "usuarios": list(usernames),
+        "materia": materia,
+        "apenas_desatualizadas": apenas_desatualizadas,
+        "versao_prompt": PROMPT_CORRECAO_VERSAO,
+        "total": total,
+        "concluidos": 0,
+        "falhas": 0,
+    })
+    batch.commit()
+    return job_ref.id, total
+
+def dependencias_job_recorrecao(usernames):
+    """
+    Tudo o que as threads do job usam, resolvido na thread do script: fora dela não há ScriptRunContext
+    para os getters em cache nem para st.error/st.warning. Os baralhos são os do momento em que o job começa.
+    """
+    registro = _registro_jobs_recorrecao()
+    verificador_ortografico() # carrega o índice (e mostra avisos) aqui, antes da primeira correção do job
+    return {
+        "registro": registro,
+        "limitador": registro["limitador"],
+        "cache": obter_cache_compartilhado(),
+        "compressor": compressor_textos() if ARMAZENAMENTO_COMPACTO else None,
+        "baralhos": {username: obter_baralho(username) for username in usernames},
+    }
 
-    ---
-    Pergunta:
-    {pergunta}
+def _recorrigir_item(item_snap, dependencias, parar_evento):
+    """
+    Corrige uma entrada da fila. Retorna (status, tentou): status 'concluido', 'falha' ou 'pendente'
+    (nova tentativa depois); 'tentou' diz se o Gemini chegou a ser chamado para o item.
+    """
+    item = item_snap.to_dict()
+    username = item["username"]
+    entrada_ref = db.collection(USERS_COLLECTION).document(username).collection(FEEDBACK_COLLECTION).document(item["entrada_id"])
+    entrada_snap = entrada_ref.get()
+    if not entrada_snap.exists:
+        return "falha", False
+    entrada = entrada_snap.to_dict()
+    baralho = dependencias["baralhos"].get(username)
+    posicao = baralho.posicao(entrada.get("cartao_id")) if baralho is not None else None
+    if posicao is None:
+        return "falha", False
+    cartao = baralho.cartoes[posicao]
+
+    dependencias["limitador"].aguardar(parar_evento)
+    if parar_evento.is_set():
+        return "pendente", False
+    feedback = comparar_respostas_com_gemini(cartao["pergunta"], descompactar_resposta(entrada[CAMPO_RESPOSTA_ARMAZENADA]),
+                                             cartao["resposta_esperada"], orcamento_latencia=RECORRECAO_ORCAMENTO_LATENCIA,
+                                             rubrica=rubrica_vigente(cartao), username=username, materia=cartao["materia"])
+    if feedback_eh_erro(feedback):
+        log_recorrecao.warning("Recorreção de %s/%s falhou: %s", username, item["entrada_id"], feedback)
+        return ("falha" if item.get("tentativas", 0) + 1 >= RECORRECAO_MAX_TENTATIVAS else "pendente"), True
+    parsed = parse_feedback_sections(feedback)
+    lacunas = {"lacunas_conteudo": parsed.get("content_gaps")}
+    if dependencias["compressor"] is not None:
+        lacunas = compactar_campos(lacunas, CAMPOS_HISTORICO, dependencias["compressor"], TEXTO_COMPACTAR_MIN_BYTES)
+    # A forma anterior do campo (texto ou comprimida) sai
+    lacunas.update({campo: firestore.DELETE_FIELD for campo in ("lacunas_conteudo", "lacunas_conteudo" + SUFIXO_COMPACTADO)
+                    if campo not in lacunas})
+    entrada_ref.update({
+        "nota_sentido": extrair_nota_sentido(parsed),
+        **lacunas,
+        "resposta_esperada_hash": hash_resposta_esperada(cartao["resposta_esperada"]),
+        "versao_prompt": PROMPT_CORRECAO_VERSAO,
+        "com_rubrica": rubrica_vigente(cartao) is not None,
+        "recorrigido_em": datetime.datetime.now().isoformat(),
+        # A nota anterior é mantida para comparação
+        "notas_anteriores": (entrada.get("notas_anteriores", []) + [{
+            "nota": entrada.get("nota_sentido"),
+            "versao_prompt": entrada.get("versao_prompt"),
+            "resposta_esperada_hash": entrada.get("resposta_esperada_hash"),
+        }])[-RECORRECAO_NOTAS_ANTERIORES:],
+    })
+    return "concluido", True
+
+def executar_job_recorrecao(job_id, parar_evento, dependencias):
+    """
+    Processa a fila em páginas, com no máximo RECORRECAO_WORKERS chamadas simultâneas e RECORRECAO_RPM
+    por minuto. Cada item é marcado ao terminar, então retomar o job não repete o que já foi corrigido;
+    'tentativas' só conta os itens em que o Gemini foi de fato chamado (pausar não gasta tentativas).
+    """
+    job_ref = db.collection(JOBS_RECORRECAO_COLLECTION).document(job_id)
+    itens_ref = job_ref.collection("itens")
+    usuarios_alterados = set()
+    job_ref.update({"status": "executando", "erro": None})
+    try:
+        with ThreadPoolExecutor(max_workers=RECORRECAO_WORKERS) as executor:
+            while not parar_evento.is_set():
+                pagina = list(itens_ref.where("status", "==", "pendente").limit(RECORRECAO_PAGINA).stream())
+                if not pagina:
+                    break
+                resultados = list(executor.map(lambda item: _recorrigir_item(item, dependencias, parar_evento), pagina))
+                batch = db.batch()
+                contagem = Counter(resultado for resultado, _ in resultados)
+                for item_snap, (resultado, tentou) in zip(pagina, resultados):
+                    if tentou:
+                        batch.update(item_snap.reference, {"status": resultado, "tentativas": firestore.Increment(1)})
+                    elif resultado != "pendente":
+                        batch.update(item_snap.reference, {"status": resultado})
+                    if resultado == "concluido":
+                        usuarios_alterados.add(item_snap.get("username"))
+                batch.update(job_ref, {"concluidos": firestore.Increment(contagem["concluido"]),
+                                       "falhas": firestore.Increment(contagem["falha"]),
+                                       "atualizado_em": datetime.datetime.now().isoformat()})
+                batch.commit()
+        job_ref.update({"status": "pausado" if parar_evento.is_set() else "concluido"})
+    except Exception as e:
+        log_recorrecao.exception("Job de recorreção %s interrompido", job_id)
+        try:
+            job_ref.update({"status": "pausado", "erro": str(e)})
+        except Exception:
+            log_recorrecao.exception("Não foi possível marcar o job %s como pausado", job_id)
+    finally:
+        for username in usuarios_alterados:
+            try:
+                dependencias["cache"].invalidar("agregados", username)
+            except Exception:
+                log_recorrecao.exception("Falha ao invalidar os agregados de %s", username)
+        registro = dependencias["registro"]
+        with registro["lock"]:
+            registro["em_execucao"].pop(job_id, None)
+
+def iniciar_job_recorrecao(job_id):
+    """Inicia (ou retoma) o job numa thread deste processo. Retorna False se ele já está em execução aqui."""
+    registro = _registro_jobs_recorrecao()
+    if job_id in registro["em_execucao"]:
+        return False
+    job_snap = db.collection(JOBS_RECORRECAO_COLLECTION).document(job_id).get()
+    dependencias = dependencias_job_recorrecao((job_snap.get("usuarios") or []) if job_snap.exists else [])
+    with registro["lock"]:
+        if job_id in registro["em_execucao"]:
+            return False
+        parar_evento = threading.Event()
+        thread = threading.Thread(target=executar_job_recorrecao, args=(job_id, parar_evento, dependencias),
+                                  daemon=True, name=f"recorrecao-{job_id}")
+        registro["em_execucao"][job_id] = (thread, parar_evento)
+    thread.start()
+    return True
 
-    ---
-    Resposta Esperada:
-    {resposta_esperada}
+def pausar_job_recorrecao(job_id):
+    registro = _registro_jobs_recorrecao()
+    with registro["lock"]:
+        em_execucao = registro["em_execucao"].get(job_id)
+    if em_execucao is not None:
+        em_execucao[1].set()
 
-    ---
-    Resposta do Usuário:
-    {resposta_usuario}
-    ---
+def job_recorrecao_em_execucao(job_id):
+    return job_id in _registro_jobs_recorrecao()["em_execucao"]
 
-    """
+def listar_jobs_recorrecao(limite=10):
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        docs = db.collection(JOBS_RECORRECAO_COLLECTION).order_by("criado_em", direction=firestore.Query.DESCENDING).limit(limite).stream()
+        return [{"id": doc.id, **doc.to_dict()} for doc in docs]
     except Exception as e:
-        return f"Erro ao comunicar com o Gemini: {e}"
+        st.error(f"Erro ao carregar os jobs de recorreção: {e}")
+        return []
+
 
-# --- FUNÇÃO AUXILIAR PARA PARSEAR E EXIBIR SEÇÕES DO FEEDBACK (GLOBAL E OTIMIZADA) ---
-def parse_feedback_sections(full_feedback_text):
+# --- MOTOR DE ANÁLISE DE DESEMPENHO (NUMPY, COLUNAR) ---
+# O histórico é convertido uma vez em arrays (tempo, nota, códigos de matéria/assunto/cartão);
+# filtros, médias móveis, inclinações, histogramas e tempo até o domínio são calculados de forma
+# vetorizada, sem laços Python por entrada. O resultado fica em cache na sessão até o histórico mudar.
+JANELA_MEDIA_MOVEL = 10 # tentativas
+NOTA_DOMINIO = 80 # mesma linha de corte das "perguntas mais difíceis"
+MAX_PONTOS_GRAFICO = 400 # pontos por série nos gráficos de linha
+ENTRADAS_POR_PAGINA_HISTORICO = 20
+CARTOES_POR_PAGINA_GERENCIAR = 25 # linhas por página na grade de gerenciamento de cartões
+SEGUNDOS_POR_DIA = 86400.0
+
+class AnaliseDesempenho:
+    """Histórico de um usuário em forma colunar, ordenado por tempo."""
+
+    def __init__(self, historico):
+        timestamps = pd.to_datetime([entry.get("timestamp") for entry in historico], errors="coerce")
+        ordem = np.argsort(timestamps.values, kind="stable")
+        self.timestamps = timestamps.values[ordem]
+        self.segundos = self.timestamps.astype("datetime64[s]").astype(np.float64)
+        self.datadas = ~np.isnat(self.timestamps) # timestamps ilegíveis viram NaT e ficam fora das séries temporais
+        self.notas = np.array([np.nan if entry.get("nota_sentido") is None else entry["nota_sentido"] for entry in historico],
+                              dtype=np.float64)[ordem]
+        # factorize (e não np.unique em strings) evita arrays unicode de largura fixa com perguntas longas
+        self.cod_materia, self.materias = pd.factorize(np.array([entry["materia"] for entry in historico], dtype=object)[ordem], sort=True)
+        self.cod_assunto, self.assuntos = pd.factorize(np.array([entry["assunto"] for entry in historico], dtype=object)[ordem], sort=True)
+        self.cod_cartao, self.cartoes = pd.factorize(np.array(
+            ["\x1f".join((entry["pergunta"], entry["materia"], entry["assunto"])) for entry in historico], dtype=object)[ordem])
+        self.materias, self.assuntos = np.asarray(self.materias, dtype=object), np.asarray(self.assuntos, dtype=object)
+        self.indices_originais = ordem # posição de cada linha na lista de histórico original
+
+    def __len__(self):
+        return len(self.notas)
+
+    @staticmethod
+    def _codigo(nomes, valor):
+        posicao = int(np.searchsorted(nomes, valor))
+        return posicao if posicao < len(nomes) and nomes[posicao] == valor else -1
+
+    def mascara(self, materia=None, assunto=None):
+        """Seleção booleana das linhas; None significa sem filtro."""
+        mascara = np.ones(len(self), dtype=bool)
+        if materia is not None:
+            mascara &= self.cod_materia == self._codigo(self.materias, materia)
+        if assunto is not None:
+            mascara &= self.cod_assunto == self._codigo(self.assuntos, assunto)
+        return mascara
+
+    def resumo(self, mascara):
+        notas = self.notas[mascara]
+        validas = ~np.isnan(notas)
+        return {"total": int(mascara.sum()), "soma": float(notas[validas].sum()), "validas": int(validas.sum())}
+
+    def medias_moveis(self, mascara, por="materia", janela=JANELA_MEDIA_MOVEL):
+        """
+        Média móvel das notas por grupo (matéria ou assunto), em ordem cronológica.
+        Retorna DataFrame largo (índice = tempo, uma coluna por grupo), já reduzido para o gráfico.
+        """
+        codigos, nomes = (self.cod_materia, self.materias) if por == "materia" else (self.cod_assunto, self.assuntos)
+        selecionadas = mascara & ~np.isnan(self.notas) & self.datadas
+        if not selecionadas.any():
+            return pd.DataFrame()
+        grupos, tempos, notas = codigos[selecionadas], self.timestamps[selecionadas], self.notas[selecionadas]
+        ordem = np.lexsort((self.segundos[selecionadas], grupos)) # agrupa mantendo a ordem temporal
+        grupos, tempos, notas = grupos[ordem], tempos[ordem], notas[ordem]
+        # Soma acumulada global; a janela de cada ponto não pode atravessar o início do grupo
+        acumulado = np.concatenate(([0.0], np.cumsum(notas)))
+        inicio_grupo = np.searchsorted(grupos, grupos, side="left")
+        posicao = np.arange(len(notas))
+        inicio_janela = np.maximum(posicao - janela + 1, inicio_grupo)
+        medias = (acumulado[posicao + 1] - acumulado[inicio_janela]) / (posicao + 1 - inicio_janela)
+
+        series = {}
+        for codigo in np.unique(grupos):
+            faixa = slice(np.searchsorted(grupos, codigo, "left"), np.searchsorted(grupos, codigo, "right"))
+            passo = max(1, (faixa.stop - faixa.start) // MAX_PONTOS_GRAFICO)
+            serie = pd.Series(medias[faixa][::passo], index=tempos[faixa][::passo])
+            # Tentativas com o mesmo timestamp: fica a média após a última, senão o DataFrame não alinha os grupos
+            series[str(nomes[codigo])] = serie.groupby(level=0).last()
+        return pd.DataFrame(series).sort_index()
+
+    def inclinacoes(self, mascara, por="materia"):
+        """
+        Tendência por grupo: inclinação da reta de mínimos quadrados nota x tempo, em pontos por semana.
+        Calculada com somas por grupo (np.bincount), sem laço por entrada.
+        """
+        codigos, nomes = (self.cod_materia, self.materias) if por == "materia" else (self.cod_assunto, self.assuntos)
+        selecionadas = mascara & ~np.isnan(self.notas) & self.datadas
+        if not selecionadas.any():
+            return pd.DataFrame(columns=["Grupo", "Tentativas", "Média", "Tendência (pontos/semana)"])
+        grupos = codigos[selecionadas]
+        dias = (self.segundos[selecionadas] - self.segundos[selecionadas].min()) / SEGUNDOS_POR_DIA
+        notas = self.notas[selecionadas]
+        n = np.bincount(grupos, minlength=len(nomes)).astype(np.float64)
+        soma_t = np.bincount(grupos, dias, len(nomes))
+        soma_x = np.bincount(grupos, notas, len(nomes))
+        soma_tt = np.bincount(grupos, dias * dias, len(nomes))
+        soma_tx = np.bincount(grupos, dias * notas, len(nomes))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variancia = n * soma_tt - soma_t ** 2
+            inclinacao = np.where(variancia > 1e-9, (n * soma_tx - soma_t * soma_x) / variancia, np.nan) * 7
+            media = soma_x / n
+        presentes = n > 0
+        return pd.DataFrame({
+            "Grupo": nomes[presentes],
+            "Tentativas": n[presentes].astype(int),
+            "Média": np.round(media[presentes], 1),
+            "Tendência (pontos/semana)": np.round(inclinacao[presentes], 2),
+        })
+
+    def frequencia_tentativas(self, mascara):
+        """(tentativas por dia, histograma de quantas vezes cada pergunta foi respondida)."""
+        if not mascara.any():
+            return pd.Series(dtype=np.int64), pd.Series(dtype=np.int64)
+        dias, por_dia = np.unique(self.timestamps[mascara].astype("datetime64[D]"), return_counts=True)
+        por_cartao = np.bincount(self.cod_cartao[mascara], minlength=len(self.cartoes))
+        por_cartao = por_cartao[por_cartao > 0]
+        histograma = np.bincount(por_cartao)
+        return (pd.Series(por_dia, index=pd.to_datetime(dias), name="Tentativas"),
+                pd.Series(histograma[1:], index=np.arange(1, len(histograma)), name="Perguntas"))
+
+    def tempo_ate_dominio(self, mascara, nota_dominio=NOTA_DOMINIO):
+        """
+        Para cada pergunta respondida: dias entre a primeira tentativa e a primeira nota >= nota_dominio.
+        Retorna (array de dias das perguntas dominadas, quantidade de perguntas respondidas).
+        """
+        if not mascara.any():
+            return np.array([]), 0
+        cartoes = self.cod_cartao[mascara]
+        segundos = self.segundos[mascara]
+        notas = self.notas[mascara]
+        primeira = np.full(len(self.cartoes), np.inf)
+        np.minimum.at(primeira, cartoes, segundos)
+        dominio = np.full(len(self.cartoes), np.inf)
+        dominadas = notas >= nota_dominio # NaN compara como False
+        np.minimum.at(dominio, cartoes[dominadas], segundos[dominadas])
+        respondidas = np.isfinite(primeira)
+        atingiu = respondidas & np.isfinite(dominio)
+        return (dominio[atingiu] - primeira[atingiu]) / SEGUNDOS_POR_DIA, int(respondidas.sum())
+
+def obter_analise_desempenho(historico):
     """
-    Analisa o feedback estruturado do Gemini e retorna um dicionário com as seções.
-    Retorna dicionário com chaves 'score', 'meaning_eval', 'content_gaps', etc.
+    Análise colunar do histórico da sessão, em cache até o histórico mudar
+    (tamanho ou extremos de timestamp diferentes invalidam a cópia).
     """
-    section_keys = {
-        "score": "1. Pontuação de Sentido (0-100):",
-        "meaning_eval": "2. Avaliação Principal do Sentido:",
-        "content_gaps": "3. Lacunas de Conteúdo:",
-        "grammar_errors": "4. Erros Gramaticais/Ortográficos:",
-        "suggestions": "5. Sugestões Rápidas de Melhoria:"
-    }
-    
-    parsed_data = {key: "Não disponível." for key in section_keys.keys()} # Default values
-
-    # Função auxiliar para extrair conteúdo entre chaves
-    def extract_content(full_text, start_key_title, next_key_title=None):
-        start_index = full_text.find(f"**{start_key_title}**")
-        if start_index == -1: return None
-        content_start = start_index + len(f"**{start_key_title}**")
-        
-        # Ajuste para lidar com o caractere ':' logo após a chave
-        if content_start < len(full_text) and full_text[content_start] == ':':
-            content_start += 1 
-        
-        if next_key_title:
-            next_index = full_text.find(f"**{next_key_title}**", content_start)
-            if next_index != -1: return full_text[content_start:next_index].strip()
-            else: return full_text[content_start:].strip().split('---')[0].strip()
-        else: return full_text[content_start:].strip().split('---')[0].strip()
+    assinatura = (len(historico),
+                  historico[0].get("timestamp") if historico else None,
+                  historico[-1].get("timestamp") if historico else None)
+    em_cache = st.session_state.get("analise_desempenho_cache")
+    if em_cache is not None and em_cache[0] == assinatura:
+        return em_cache[1]
+    analise = AnaliseDesempenho(historico)
+    st.session_state.analise_desempenho_cache = (assinatura, analise)
+    return analise
+
+
+# --- SESSÕES PERSISTENTES (SOBREVIVEM AO REFRESH DO NAVEGADOR) ---
+# O refresh cria uma sessão nova do Streamlit, com session_state vazio. Com SESSAO_PERSISTENTE=1, o
+# login grava um token assinado (HMAC, com validade) num cookie do navegador, lido no refresh por
+# st.context.cookies, e o usuário volta sem digitar a senha. O token fica fora da URL (histórico,
+# logs e links compartilhados não o carregam); o script não consegue marcar o cookie como HttpOnly,
+# então ele vale só até expirar, é revogado no logout e deixa de valer quando a senha muda.
+# Um snapshot da sessão (histórico, resumos e índices sobre o baralho compartilhado) fica no processo
+# por SESSAO_SNAPSHOT_TTL, limitado a SESSAO_SNAPSHOTS_MAX sessões: dentro dessa janela a sessão
+# restaurada não faz nenhuma leitura no Firestore; fora dela (ou em outra réplica) refaz a carga do login.
+# SESSAO_SEGREDO é obrigatório com o recurso ligado e deve ser o mesmo em todas as réplicas.
+SESSAO_PERSISTENTE = _flag_ambiente("SESSAO_PERSISTENTE")
+SESSAO_SEGREDO = os.getenv("SESSAO_SEGREDO", "")
+SESSAO_DURACAO_HORAS = float(os.getenv("SESSAO_DURACAO_HORAS", "12"))
+SESSAO_SNAPSHOT_TTL = int(os.getenv("SESSAO_SNAPSHOT_TTL", "1800")) # segundos
+SESSAO_SNAPSHOTS_MAX = int(os.getenv("SESSAO_SNAPSHOTS_MAX", "500"))
+SESSAO_COOKIE = "sessao_discursivas"
+SESSAO_INTERVALO_LIMPEZA = 60 # segundos entre as limpezas de snapshots expirados
+CAMPOS_SNAPSHOT_SESSAO = ("feedback_history", "historico_resumos", "historico_versao", "baralho_versao",
+                          "ordered_cards_for_session", "difficult_cards_for_session",
+                          "current_card_index", "current_card_index_difficult")
+
+if SESSAO_PERSISTENTE and not SESSAO_SEGREDO:
+    st.error("Erro: SESSAO_PERSISTENTE está ligado, mas SESSAO_SEGREDO não está definido. Defina o segredo (o mesmo em todas as réplicas) ou desligue o recurso.")
+    st.stop()
 
+@st.cache_resource
+def _registro_sessoes_persistentes():
+    """Snapshots das sessões logadas (id da sessão persistente -> estado), do mais antigo ao mais recente."""
+    return {"lock": threading.Lock(), "segredo": SESSAO_SEGREDO.encode(), "snapshots": {}, "proxima_limpeza": 0.0}
+
+def _b64(dados):
+    return base64.urlsafe_b64encode(dados).rstrip(b"=").decode()
+
+def _de_b64(texto):
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+def _assinar(segredo, dados):
+    return hmac.new(segredo, dados, hashlib.sha256).digest()
+
+def _impressao_senha(segredo, password_hash):
+    # Vai no token: trocar a senha (ou excluir o usuário) invalida os tokens já emitidos
+    return _b64(_assinar(segredo, (password_hash or "").encode())[:9])
+
+def emitir_token_sessao(username, password_hash):
+    """Gera o token assinado da sessão, o associa à sessão atual e agenda a gravação do cookie."""
+    segredo = _registro_sessoes_persistentes()["segredo"]
+    id_sessao = secrets.token_urlsafe(12)
+    expira = int(time.time() + SESSAO_DURACAO_HORAS * 3600)
+    carga = json.dumps({"u": username, "sid": id_sessao, "exp": expira,
+                        "ph": _impressao_senha(segredo, password_hash)}, separators=(",", ":")).encode()
+    st.session_state.sessao_persistente_id = id_sessao
+    st.session_state.sessao_persistente_expira = expira
+    st.session_state.cookie_sessao_pendente = (f"{_b64(carga)}.{_b64(_assinar(segredo, carga))}",
+                                               int(SESSAO_DURACAO_HORAS * 3600))
+
+def validar_token_sessao(token):
+    """
+    (username, id da sessão persistente, expiração) se o token é autêntico, não expirou, a senha não
+    mudou e não houve logout com ele; senão None.
+    """
+    segredo = _registro_sessoes_persistentes()["segredo"]
     try:
-        # Extrai cada seção usando a ordem definida
-        for i, (key, title) in enumerate(section_keys.items()):
-            next_title = None
-            if i + 1 < len(section_keys):
-                next_title = list(section_keys.values())[i+1]
-            
-            content = extract_content(full_feedback_text, title, next_title)
-            if content is not None:
-                parsed_data[key] = content
-            
-    except Exception as e:
-        return {"raw_feedback": full_feedback_text, "error": str(e)}
+        carga_b64, assinatura_b64 = token.split(".")
+        carga = _de_b64(carga_b64)
+        if not hmac.compare_digest(_de_b64(assinatura_b64), _assinar(segredo, carga)):
+            return None
+        dados = json.loads(carga)
+    except ValueError: # Formato inválido, base64 corrompido ou JSON ilegível
+        return None
+    if dados["exp"] < time.time():
+        return None
+    if not hmac.compare_digest(dados["ph"], _impressao_senha(segredo, buscar_hash_senha(dados["u"]))):
+        return None
+    if obter_cache_compartilhado().obter("sessoes_encerradas", dados["sid"]) is not None:
+        return None
+    return dados["u"], dados["sid"], dados["exp"]
+
+def aplicar_cookie_sessao_pendente():
+    """Grava (ou apaga, com validade 0) o cookie do token agendado no login/logout deste navegador."""
+    pendente = st.session_state.get("cookie_sessao_pendente")
+    if pendente is None:
+        return
+    valor, validade = pendente
+    st.html(f"""<script>
+document.cookie = "{SESSAO_COOKIE}={valor}; path=/; max-age={validade}; SameSite=Strict"
+    + (location.protocol === "https:" ? "; Secure" : "");
+</script>""", unsafe_allow_javascript=True)
+    st.session_state.cookie_sessao_pendente = None
+
+# --- CARGA INICIAL DA SESSÃO ---
+def carregar_dados_sessao(username):
+    """Carga inicial da sessão (login ou refresh sem snapshot): histórico, resumos, baralho e índices."""
+    # Com listeners ativos, os dados do usuário podem já estar no registro do processo
+    dados_via_listener = FIRESTORE_LISTENERS and anexar_listeners(username, obter_id_sessao())
+    st.session_state.historico_versao = None
+    if dados_via_listener and FIRESTORE_LISTENERS_HISTORICO:
+        sincronizar_historico_sessao(username)
+    else:
+        st.session_state.feedback_history = carregar_historico_feedback(username)
+    st.session_state.historico_resumos = carregar_resumos_historico(username)
+    if PRATICA_POR_CONSULTA:
+        # Sem leitura do baralho no login: as abas de prática consultam o Firestore por página
+        descartar_pratica_sessao()
+    else:
+        if not dados_via_listener:
+            # Relê os cartões no login e publica o baralho para as demais sessões do usuário
+            carregar_baralho(username)
+
+        # Ordem da aba "Todas as Perguntas" e lista de difíceis (no Login)
+        atualizar_indices_sessao(username)
+    st.session_state.current_card_index = 0
+    st.session_state.current_card_index_difficult = 0
 
-    return parsed_data
+def gravar_snapshot_sessao():
+    """Guarda (por referência, sem cópia) o estado da sessão logada para restaurá-lo após um refresh."""
+    id_sessao = st.session_state.get("sessao_persistente_id")
+    if id_sessao is None:
+        return
+    registro = _registro_sessoes_persistentes()
+    agora = time.monotonic()
+    snapshot = {campo: st.session_state[campo] for campo in CAMPOS_SNAPSHOT_SESSAO}
+    with registro["lock"]:
+        snapshots = registro["snapshots"]
+        if agora >= registro["proxima_limpeza"]:
+            registro["snapshots"] = snapshots = {sid: item for sid, item in snapshots.items() if item[2] > agora}
+            registro["proxima_limpeza"] = agora + SESSAO_INTERVALO_LIMPEZA
+        # Reinserir põe a sessão no fim da ordem; acima do limite saem as que estão paradas há mais tempo
+        snapshots.pop(id_sessao, None)
+        snapshots[id_sessao] = (st.session_state.logged_in_user, snapshot, agora + SESSAO_SNAPSHOT_TTL)
+        while len(snapshots) > SESSAO_SNAPSHOTS_MAX:
+            del snapshots[next(iter(snapshots))]
+
+def restaurar_sessao_persistente():
+    """
+    Restaura o login a partir do cookie do token. Com snapshot no processo, o estado volta sem leituras
+    do Firestore; sem ele, refaz a carga do login. Retorna True se a sessão foi restaurada.
+    """
+    if not SESSAO_PERSISTENTE:
+        return False
+    token = st.context.cookies.get(SESSAO_COOKIE)
+    # Os cookies são os da abertura da sessão: após o logout, o token antigo continua visível aqui
+    if not token or token == st.session_state.get("cookie_sessao_descartado"):
+        return False
+    validado = validar_token_sessao(token)
+    if validado is None:
+        st.session_state.cookie_sessao_descartado = token
+        st.session_state.cookie_sessao_pendente = ("", 0)
+        return False
+    username, id_sessao, expira = validado
+    registro = _registro_sessoes_persistentes()
+    with registro["lock"]:
+        guardado = registro["snapshots"].get(id_sessao)
+
+    st.session_state.logged_in_user = username
+    st.session_state.sessao_persistente_id = id_sessao
+    st.session_state.sessao_persistente_expira = expira
+    if guardado is not None and guardado[0] == username and guardado[2] > time.monotonic():
+        for campo, valor in guardado[1].items():
+            # Cópias: a sessão antiga (ou outra aba do mesmo navegador) pode continuar alterando os originais
+            st.session_state[campo] = copy.copy(valor)
+        if FIRESTORE_LISTENERS:
+            anexar_listeners(username, obter_id_sessao())
+    else:
+        carregar_dados_sessao(username)
+    return True
+
+def descartar_sessao_persistente():
+    """No logout: apaga o cookie, remove o snapshot do processo e revoga o token em todas as réplicas."""
+    id_sessao = st.session_state.get("sessao_persistente_id")
+    if id_sessao is None:
+        return
+    registro = _registro_sessoes_persistentes()
+    with registro["lock"]:
+        registro["snapshots"].pop(id_sessao, None)
+    # O cookie pode ter sido copiado para outro navegador: o token fica marcado como encerrado até expirar
+    restante = int(st.session_state.get("sessao_persistente_expira", 0) - time.time())
+    if restante > 0:
+        obter_cache_compartilhado().gravar("sessoes_encerradas", id_sessao, True, restante)
+    st.session_state.sessao_persistente_id = None
+    st.session_state.cookie_sessao_descartado = st.context.cookies.get(SESSAO_COOKIE)
+    st.session_state.cookie_sessao_pendente = ("", 0)
+
+
+# --- PERFIL DE DESEMPENHO POR RERUN (SOB DEMANDA, PARA O ADMIN) ---
+# "O app está lento" para um aluno depende do baralho e do histórico dele, que não se reproduzem
+# localmente. O admin pede o perfil dos próximos N reruns de um usuário: o pedido fica no cache
+# compartilhado e um aviso no canal de invalidação arma o usuário em todas as réplicas. Sem pedido, o
+# custo por rerun é um teste de pertinência num conjunto. Cada rerun perfilado registra as funções com
+# maior tempo cumulativo, a espera por Firestore e Gemini e quantos elementos o Streamlit emitiu.
+# Modos: "amostragem" (uma thread lê a pilha do script a cada PERFILADOR_INTERVALO_AMOSTRAGEM; custo
+# baixo) e "deterministico" (cProfile; conta as chamadas, mas deixa o rerun mais lento).
+PERFILADOR_MAX_RERUNS = 20
+PERFILADOR_VALIDADE_PEDIDO = 24 * 3600 # segundos até um pedido não atendido expirar
+PERFILADOR_MAX_RELATORIOS = 20 # relatórios guardados por usuário (os mais recentes)
+PERFILADOR_TTL_RELATORIOS = 7 * 24 * 3600
+PERFILADOR_INTERVALO_AMOSTRAGEM = 0.005 # segundos
+PERFILADOR_MAX_SEGUNDOS = 120 # um rerun perfilado nunca é acompanhado por mais tempo que isso
+PERFILADOR_TOP_FUNCOES = 30
+MODOS_PERFILADOR = {"amostragem": "Amostragem (baixo custo)", "deterministico": "Determinístico (cProfile)"}
+# Espera por serviço externo: tempo dentro destes pacotes a partir de código de fora deles
+PACOTES_ESPERA = {
+    "firestore": ("google/cloud/firestore", "firebase_admin"),
+    "gemini": ("google/generativeai", "google/ai/generativelanguage"),
+}
+
+@st.cache_resource
+def _registro_perfilador():
+    """Usuários com pedido de perfil possivelmente pendente nesta réplica."""
+    return {"armados": set()}
+
+def _grupo_espera(nome_arquivo):
+    nome_arquivo = nome_arquivo.replace(os.sep, "/")
+    for grupo, pacotes in PACOTES_ESPERA.items():
+        if any(pacote in nome_arquivo for pacote in pacotes):
+            return grupo
+    return None
+
+def _rotulo_funcao(nome_arquivo, linha, nome):
+    return f"{os.path.basename(nome_arquivo)}:{linha}({nome})"
+
+def solicitar_perfil(username, reruns, modo):
+    """Arma o perfil dos próximos 'reruns' reruns de 'username' (em qualquer réplica)."""
+    cache = obter_cache_compartilhado()
+    cache.gravar("perfilador", username, {"restantes": int(reruns), "modo": modo}, PERFILADOR_VALIDADE_PEDIDO)
+    cache.avisar("perfilador", username)
+
+def cancelar_perfil(username):
+    obter_cache_compartilhado().invalidar("perfilador", username)
+
+def pedido_perfil(username):
+    return obter_cache_compartilhado().obter("perfilador", username)
+
+def relatorios_perfil(username):
+    return obter_cache_compartilhado().obter("perfis", username) or []
+
+def limpar_relatorios_perfil(username):
+    obter_cache_compartilhado().invalidar("perfis", username)
+
+def _guardar_relatorio_perfil(username, relatorio):
+    relatorios = (relatorios_perfil(username) + [relatorio])[-PERFILADOR_MAX_RELATORIOS:]
+    obter_cache_compartilhado().gravar("perfis", username, relatorios, PERFILADOR_TTL_RELATORIOS)
+
+def _contar_elementos_sessao():
+    """
+    Conta os elementos (deltas) enviados ao navegador envolvendo o envio da ScriptRunContext da sessão.
+    Instalado uma vez enquanto o usuário está sendo perfilado; retorna o contador (lista com um int).
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return None
+    contador = getattr(ctx, "_contador_elementos_perfil", None)
+    if contador is None:
+        contador = [0]
+        enviar_original = ctx._enqueue
+        def enviar_contando(msg):
+            if msg.WhichOneof("type") in ("delta", "ref_hash"):
+                contador[0] += 1
+            enviar_original(msg)
+        ctx._enqueue_original_perfil = enviar_original
+        ctx._contador_elementos_perfil = contador
+        ctx._enqueue = enviar_contando
+    return contador
+
+def _remover_contador_elementos():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    if ctx is not None and getattr(ctx, "_contador_elementos_perfil", None) is not None:
+        ctx._enqueue = ctx._enqueue_original_perfil
+        ctx._contador_elementos_perfil = None
+
+def _concluir_relatorio(perfil, duracao, funcoes, espera, amostras=None, interrompido=False):
+    _guardar_relatorio_perfil(perfil["username"], {
+        "inicio": perfil["inicio_iso"],
+        "modo": perfil["modo"],
+        "duracao_s": round(duracao, 4) if duracao is not None else None,
+        "firestore_s": espera["firestore"],
+        "gemini_s": espera["gemini"],
+        "elementos": perfil["elementos"][0] - perfil["elementos_inicio"] if perfil["elementos"] else None,
+        "amostras": amostras,
+        "interrompido": interrompido,
+        "funcoes": funcoes,
+    })
+
+def _amostrar_rerun(perfil):
+    """Thread de amostragem: lê a pilha do script até o frame deste rerun sair dela (fim, st.rerun ou st.stop)."""
+    cumulativo, proprio, espera = Counter(), Counter(), Counter()
+    amostras = 0
+    while not perfil["fim"].wait(PERFILADOR_INTERVALO_AMOSTRAGEM):
+        frame = sys._current_frames().get(perfil["thread"])
+        pilha = []
+        while frame is not None:
+            pilha.append(frame)
+            frame = frame.f_back
+        if perfil["frame_modulo"] not in pilha or time.monotonic() - perfil["inicio"] > PERFILADOR_MAX_SEGUNDOS:
+            break
+        amostras += 1
+        # Só do script para dentro (as threads e o executor do Streamlit acima dele não interessam)
+        pilha = pilha[:pilha.index(perfil["frame_modulo"]) + 1]
+        chaves = [(f.f_code.co_filename, f.f_code.co_firstlineno, f.f_code.co_name) for f in pilha]
+        proprio[chaves[0]] += 1
+        cumulativo.update(set(chaves))
+        espera.update({_grupo_espera(chave[0]) for chave in chaves} - {None})
+    perfil["frame_modulo"] = None # não segura o frame (e as variáveis do script) além do necessário
+    funcoes = [{"funcao": _rotulo_funcao(*chave), "cumulativo_s": round(n * PERFILADOR_INTERVALO_AMOSTRAGEM, 4),
+                "proprio_s": round(proprio[chave] * PERFILADOR_INTERVALO_AMOSTRAGEM, 4), "chamadas": None}
+               for chave, n in cumulativo.most_common(PERFILADOR_TOP_FUNCOES)]
+    _concluir_relatorio(perfil, time.monotonic() - perfil["inicio"], funcoes,
+                        {grupo: round(espera[grupo] * PERFILADOR_INTERVALO_AMOSTRAGEM, 4) for grupo in PACOTES_ESPERA},
+                        amostras=amostras)
+
+def _estatisticas_cprofile(perfil):
+    estatisticas = pstats.Stats(perfil["cprofile"]).stats # {(arquivo, linha, nome): (cc, nc, tt, ct, chamadores)}
+    espera = dict.fromkeys(PACOTES_ESPERA, 0.0)
+    for (arquivo, _, _), (_, _, _, _, chamadores) in estatisticas.items():
+        grupo = _grupo_espera(arquivo)
+        if grupo is not None:
+            # Só as entradas no pacote vindas de fora dele (as chamadas internas já estão no tempo cumulativo)
+            espera[grupo] += sum(dados[3] for chamador, dados in chamadores.items() if _grupo_espera(chamador[0]) != grupo)
+    maiores = sorted(estatisticas.items(), key=lambda item: item[1][3], reverse=True)[:PERFILADOR_TOP_FUNCOES]
+    funcoes = [{"funcao": _rotulo_funcao(*chave), "cumulativo_s": round(ct, 4), "proprio_s": round(tt, 4), "chamadas": nc}
+               for chave, (_, nc, tt, ct, _) in maiores]
+    return funcoes, {grupo: round(valor, 4) for grupo, valor in espera.items()}
+
+def _finalizar_cprofile_pendente():
+    """Fecha o perfil determinístico de um rerun que terminou com st.rerun()/st.stop() antes da última linha."""
+    perfil = st.session_state.perfil_rerun_aberto
+    st.session_state.perfil_rerun_aberto = None
+    perfil["cprofile"].disable()
+    # Na mesma thread (st.rerun), o rerun anterior acabou agora; em outra (st.stop), a duração real é desconhecida
+    duracao = time.monotonic() - perfil["inicio"] if perfil["thread"] == threading.get_ident() else None
+    funcoes, espera = _estatisticas_cprofile(perfil)
+    _concluir_relatorio(perfil, duracao, funcoes, espera, interrompido=True)
+
+def iniciar_perfil_rerun(username):
+    """
+    Chamado no início de cada rerun do usuário logado. Sem pedido de perfil, só consulta um conjunto em
+    memória e retorna None. Com pedido, consome um rerun dele e inicia o perfil no modo pedido.
+    """
+    if st.session_state.get("perfil_rerun_aberto") is not None:
+        _finalizar_cprofile_pendente()
+    if username not in _registro_perfilador()["armados"]:
+        return None
+    pedido = pedido_perfil(username)
+    if not pedido or pedido.get("restantes", 0) <= 0:
+        _registro_perfilador()["armados"].discard(username)
+        _remover_contador_elementos()
+        return None
+    if pedido["restantes"] <= 1:
+        cancelar_perfil(username)
+    else:
+        solicitar_perfil(username, pedido["restantes"] - 1, pedido.get("modo", "amostragem"))
+    elementos = _contar_elementos_sessao()
+    perfil = {
+        "username": username,
+        "modo": pedido.get("modo", "amostragem"),
+        "inicio": time.monotonic(),
+        "inicio_iso": datetime.datetime.now().isoformat(timespec="seconds"),
+        "thread": threading.get_ident(),
+        "elementos": elementos,
+        "elementos_inicio": elementos[0] if elementos else 0,
+    }
+    if perfil["modo"] == "deterministico":
+        perfil["cprofile"] = cProfile.Profile()
+        st.session_state.perfil_rerun_aberto = perfil
+        perfil["cprofile"].enable()
+    else:
+        perfil["frame_modulo"] = sys._getframe(1) # frame do script neste rerun
+        perfil["fim"] = threading.Event()
+        threading.Thread(target=_amostrar_rerun, args=(perfil,), daemon=True, name="perfil_rerun").start()
+    return perfil
+
+def concluir_perfil_rerun(perfil):
+    """Chamado na última linha do script: encerra o perfil deste rerun, se houver."""
+    if perfil is None:
+        return
+    if perfil["modo"] == "deterministico":
+        perfil["cprofile"].disable()
+        st.session_state.perfil_rerun_aberto = None
+        funcoes, espera = _estatisticas_cprofile(perfil)
+        _concluir_relatorio(perfil, time.monotonic() - perfil["inicio"], funcoes, espera)
+    else:
+        perfil["fim"].set() # A thread de amostragem grava o relatório
 
 
 # --- INICIALIZAÇÃO DOS ESTADOS DO STREAMLIT ---
 if 'logged_in_user' not in st.session_state:
     st.session_state.logged_in_user = None
 
-# st.session_state.user_cartoes para os cartões do usuário logado
-if 'user_cartoes' not in st.session_state:
-    st.session_state.user_cartoes = []
+# ID da sessão persistente (token no cookie) que identifica o snapshot desta sessão no processo
+if 'sessao_persistente_id' not in st.session_state:
+    st.session_state.sessao_persistente_id = None
+    st.session_state.sessao_persistente_expira = 0
+    st.session_state.cookie_sessao_pendente = None
 
-# global_cartoes foi removido.
+# Os cartões do usuário logado ficam no baralho compartilhado do processo (obter_baralho);
+# a sessão guarda apenas a versão do baralho usada para calcular seus índices.
+if 'baralho_versao' not in st.session_state:
+    st.session_state.baralho_versao = None
+
+# Versão do histórico compartilhado pelo listener (modo FIRESTORE_LISTENERS_HISTORICO)
+if 'historico_versao' not in st.session_state:
+    st.session_state.historico_versao = None
 
 if 'feedback_history' not in st.session_state:
     st.session_state.feedback_history = []
 
+# Resumos por cartão das entradas já compactadas (fora da janela de retenção)
+if 'historico_resumos' not in st.session_state:
+    st.session_state.historico_resumos = []
+
 if 'current_card_index' not in st.session_state:
     st.session_state.current_card_index = 0
 # REMOVIDO: show_expected_answer não será mais necessário, a exibição é controlada pelo feedback do Gemini
@@ -449,6 +3862,21 @@ if 'last_gemini_feedback_question' not in st.session_state:
 if 'last_gemini_expected_answer' not in st.session_state:
     st.session_state.last_gemini_expected_answer = None
 
+# Correções em segundo plano: chave do cartão -> Future e dados do envio; e feedbacks já entregues por cartão
+if 'correcoes_pendentes' not in st.session_state:
+    st.session_state.correcoes_pendentes = {}
+# Nonce e instante do último clique em "Verificar Resposta" por cartão (ver nonce_submissao)
+if 'nonces_submissao' not in st.session_state:
+    st.session_state.nonces_submissao = {}
+if 'feedbacks_por_cartao' not in st.session_state:
+    st.session_state.feedbacks_por_cartao = {}
+
+# Rascunhos de resposta do usuário (carregados sob demanda) e cartão vinculado a cada caixa de resposta
+if 'rascunhos' not in st.session_state:
+    st.session_state.rascunhos = None
+if 'caixas_resposta' not in st.session_state:
+    st.session_state.caixas_resposta = {}
+
 if 'add_card_form_key_suffix' not in st.session_state:
     st.session_state.add_card_form_key_suffix = 0
 
@@ -457,21 +3885,16 @@ if 'last_materia_input' not in st.session_state:
 if 'last_assunto_input' not in st.session_state:
     st.session_state.last_assunto_input = ""
 
+# Arrays de índices para o baralho compartilhado (e não listas de cartões)
 if 'ordered_cards_for_session' not in st.session_state:
-    st.session_state.ordered_cards_for_session = []
+    st.session_state.ordered_cards_for_session = array("I")
 
 if 'difficult_cards_for_session' not in st.session_state:
-    st.session_state.difficult_cards_for_session = []
+    st.session_state.difficult_cards_for_session = array("I")
 
 if 'current_card_index_difficult' not in st.session_state:
     st.session_state.current_card_index_difficult = 0
 
-# --- NOVO: Estado para controlar a exibição do formulário de edição ---
-if 'is_editing_card' not in st.session_state:
-    st.session_state.is_editing_card = False
-# NOVO: Estado para armazenar os dados do cartão sendo editado
-if 'card_data_to_edit' not in st.session_state:
-    st.session_state.card_data_to_edit = {}
 
 
 # --- LÓGICA PRINCIPAL DO APP ---
@@ -479,6 +3902,12 @@ if 'card_data_to_edit' not in st.session_state:
 if not inicializar_admin_existencia(): 
     st.stop() # Se o admin não existe e o formulário de criação está sendo exibido, pare aqui.
 
+# Refresh do navegador: restaura o login pelo cookie do token, sem pedir a senha de novo
+if st.session_state.logged_in_user is None:
+    restaurar_sessao_persistente()
+# Cookie emitido no login ou apagado no logout do rerun anterior
+aplicar_cookie_sessao_pendente()
+
 # Se o usuário não estiver logado, exibe a tela de login
 if st.session_state.logged_in_user is None:
     st.title("Treinamento de Discursivas")
@@ -492,43 +3921,17 @@ if st.session_state.logged_in_user is None:
     with col_login_btns_1:
         if st.button("Entrar", key="login_button"):
             if username_login.strip() and password_login.strip():
-                users_data = carregar_usuarios()
-                if username_login.strip() in users_data and users_data[username_login.strip()] == hash_password(password_login.strip()):
+                stored_hash = buscar_hash_senha(username_login.strip())
+                if stored_hash is not None and stored_hash == hash_password(password_login.strip()):
                     st.session_state.logged_in_user = username_login.strip()
-                    st.session_state.feedback_history = carregar_historico_feedback(st.session_state.logged_in_user)
-                    st.session_state.user_cartoes = carregar_cartoes(st.session_state.logged_in_user)
-                    
-                    # --- Lógica de Reordenação da aba "Todas as Perguntas" (no Login) ---
-                    card_latest_scores = {}
-                    for entry in reversed(st.session_state.feedback_history):
-                        card_id = (entry["pergunta"], entry["materia"], entry["assunto"])
-                        if card_id not in card_latest_scores:
-                            card_latest_scores[card_id] = entry.get("nota_sentido")
-
-                    cards_for_ordering = []
-                    for card in st.session_state.user_cartoes: 
-                        card_id = (card["pergunta"], card["materia"], card["assunto"])
-                        score_to_order = card_latest_scores.get(card_id, -1) 
-                        cards_for_ordering.append((card, score_to_order))
-
-                    st.session_state.ordered_cards_for_session = [card_obj for card_obj, _ in sorted(cards_for_ordering, key=lambda x: x[1])]
-                    # --- FIM DA REORDENAÇÃO DA ABA "TODAS AS PERGUNTAS" NO LOGIN ---
-
-                    # --- Lógica para Identificar Perguntas Mais Difíceis (no Login) ---
-                    difficult_cards = []
-                    for card in st.session_state.user_cartoes: 
-                        card_id = (card["pergunta"], card["materia"], card["assunto"])
-                        if card_id in card_latest_scores and card_latest_scores[card_id] is not None and card_latest_scores[card_id] < 80:
-                            difficult_cards.append(card)
-                    st.session_state.difficult_cards_for_session = difficult_cards
-                    # --- FIM DA LÓGICA DE DIFÍCEIS NO LOGIN ---
+                    carregar_dados_sessao(st.session_state.logged_in_user)
+                    if SESSAO_PERSISTENTE:
+                        # Cookie com o token para que um refresh do navegador mantenha o login
+                        emitir_token_sessao(st.session_state.logged_in_user, stored_hash)
 
                     # Resetar outros estados para o novo usuário
-                    st.session_state.current_card_index = 0
-                    st.session_state.current_card_index_difficult = 0
                     st.session_state.show_expected_answer = False # Mantém o reset
                     st.session_state.last_gemini_feedback_display_parsed = None
-                    st.session_state.is_editing_card = False # Assegura que o formulário de edição não apareça no login
                     st.rerun()
                 else:
                     st.error("Nome de usuário ou senha incorretos.")
@@ -540,24 +3943,57 @@ if st.session_state.logged_in_user is None:
     pass 
     
 else: # Usuário logado
+    # Perfil sob demanda (admin): sem pedido para este usuário, não faz nada
+    perfil_rerun = iniciar_perfil_rerun(st.session_state.logged_in_user)
     st.title("Treinamento de Discursivas")
     st.write("Fortaleça sua **memória** e aprimore sua **escrita** com correções instantâneas do **Gemini**.")
     st.write(f"Bem-vindo(a), **{st.session_state.logged_in_user}**.")
 
+    # Histórico mantido pelo listener (modo opcional) e baralho compartilhado;
+    # se outra sessão/dispositivo publicou nova versão, recalcula os índices desta
+    if FIRESTORE_LISTENERS_HISTORICO:
+        sincronizar_historico_sessao(st.session_state.logged_in_user)
+    # Na prática por consulta, o baralho só é lido pelas abas que precisam dele inteiro
+    baralho_usuario = None if PRATICA_POR_CONSULTA else sincronizar_indices_sessao(st.session_state.logged_in_user)
+    # Entrega as correções em segundo plano que terminaram desde o último rerun
+    finalizar_correcoes_concluidas(st.session_state.logged_in_user)
+    gravar_snapshot_sessao()
+
     # Botão de Logout
     if st.sidebar.button("Sair", key="logout_button"):
+        if FIRESTORE_LISTENERS:
+            liberar_listeners(st.session_state.logged_in_user, obter_id_sessao())
+        descartar_sessao_persistente()
         st.session_state.logged_in_user = None
         st.session_state.feedback_history = []
-        st.session_state.user_cartoes = []
+        for chave_pendente in list(st.session_state.correcoes_pendentes):
+            cancelar_correcao(chave_pendente)
+        st.session_state.feedbacks_por_cartao = {}
+        st.session_state.nonces_submissao = {}
+        st.session_state.rascunhos = None
+        st.session_state.caixas_resposta = {}
+        st.session_state.historico_resumos = []
+        st.session_state.baralho_versao = None
         st.session_state.current_card_index = 0
         st.session_state.current_card_index_difficult = 0
         st.session_state.show_expected_answer = False
         st.session_state.last_gemini_feedback_display_parsed = None
-        st.session_state.ordered_cards_for_session = []
-        st.session_state.difficult_cards_for_session = []
-        st.session_state.is_editing_card = False
+        st.session_state.ordered_cards_for_session = array("I")
+        st.session_state.difficult_cards_for_session = array("I")
         st.rerun()
 
+    # Diagnóstico de memória da sessão (formato antigo x baralho compartilhado + índices)
+    if st.session_state.logged_in_user == ADMIN_USERNAME:
+        with st.sidebar.expander("Memória da sessão"):
+            # Medir percorre o baralho e o histórico inteiros: só sob demanda, e o último resultado fica na sessão
+            if st.button("Medir memória", key="memory_report_btn"):
+                st.session_state.relatorio_memoria = relatorio_memoria_sessao(st.session_state.logged_in_user)
+            relatorio_memoria = st.session_state.get("relatorio_memoria")
+            if relatorio_memoria is not None:
+                st.write(f"Antes (3 listas de dicionários): {relatorio_memoria['antes_bytes_por_sessao'] / 1024:.1f} KB")
+                st.write(f"Depois (arrays de índices): {relatorio_memoria['depois_bytes_por_sessao'] / 1024:.1f} KB")
+                st.write(f"Baralho compartilhado (uma vez por processo): {relatorio_memoria['baralho_compartilhado_bytes'] / 1024:.1f} KB")
+
     # Define quais abas serão exibidas e cria as referências para os blocos 'with'
     tab_options = ["Todas as Perguntas", "Perguntas Mais Difíceis", "Gerenciar Cartões", "Métricas de Desempenho", "Alterar Minha Senha"]
     
@@ -571,20 +4007,26 @@ else: # Usuário logado
     def render_tab_all_questions():
         st.header("Prática: todas as perguntas")
         
-        current_practice_cards_tab1 = st.session_state.ordered_cards_for_session 
-        
-        available_materias_tab1 = sorted(list(set([card["materia"] for card in current_practice_cards_tab1]))) if current_practice_cards_tab1 else []
-        selected_materia_tab1 = st.selectbox("Filtrar por Matéria:", ["Todas"] + available_materias_tab1, key="filter_materia_tab1")
+        pratica_tab1 = None
+        if PRATICA_POR_CONSULTA:
+            # Filtro e ordem no servidor; os cartões chegam por página (ver carregar_proxima_pagina_pratica)
+            pratica_tab1 = filtros_pratica_por_consulta("tab1")
+            filtered_cards_tab1 = pratica_tab1["cartoes"]
+        else:
+            current_practice_cards_tab1 = cartoes_por_indices(baralho_usuario, st.session_state.ordered_cards_for_session)
+            
+            available_materias_tab1 = sorted(list(set([card["materia"] for card in current_practice_cards_tab1]))) if current_practice_cards_tab1 else []
+            selected_materia_tab1 = st.selectbox("Filtrar por Matéria:", ["Todas"] + available_materias_tab1, key="filter_materia_tab1")
 
-        filtered_cards_tab1 = current_practice_cards_tab1
-        if selected_materia_tab1 != "Todas":
-            filtered_cards_tab1 = [card for card in filtered_cards_tab1 if card["materia"] == selected_materia_tab1]
+            filtered_cards_tab1 = current_practice_cards_tab1
+            if selected_materia_tab1 != "Todas":
+                filtered_cards_tab1 = [card for card in filtered_cards_tab1 if card["materia"] == selected_materia_tab1]
 
-        available_assuntos_tab1 = sorted(list(set([card["assunto"] for card in filtered_cards_tab1]))) if filtered_cards_tab1 else []
-        selected_assunto_tab1 = st.selectbox("Filtrar por Assunto:", ["Todos"] + available_assuntos_tab1, key="filter_assunto_tab1")
+            available_assuntos_tab1 = sorted(list(set([card["assunto"] for card in filtered_cards_tab1]))) if filtered_cards_tab1 else []
+            selected_assunto_tab1 = st.selectbox("Filtrar por Assunto:", ["Todos"] + available_assuntos_tab1, key="filter_assunto_tab1")
 
-        if selected_assunto_tab1 != "Todos":
-            filtered_cards_tab1 = [card for card in filtered_cards_tab1 if card["assunto"] == selected_assunto_tab1]
+            if selected_assunto_tab1 != "Todos":
+                filtered_cards_tab1 = [card for card in filtered_cards_tab1 if card["assunto"] == selected_assunto_tab1]
 
         if not filtered_cards_tab1:
             st.info("Nenhum cartão encontrado com os filtros selecionados. Altere os filtros ou adicione novos cartões.")
@@ -595,7 +4037,8 @@ else: # Usuário logado
 
         current_card_tab1 = filtered_cards_tab1[st.session_state.current_card_index]
 
-        st.subheader(f"Pergunta ({st.session_state.current_card_index + 1}/{len(filtered_cards_tab1)}):")
+        total_cards_tab1 = max(pratica_tab1["total"], len(filtered_cards_tab1)) if pratica_tab1 is not None else len(filtered_cards_tab1)
+        st.subheader(f"Pergunta ({st.session_state.current_card_index + 1}/{total_cards_tab1}):")
         # --- NOVO: Campo de "Última avaliação" ---
         last_score_found = "Esta é a primeira vez que você responde esta questão."
         for entry in reversed(st.session_state.feedback_history):
@@ -605,65 +4048,41 @@ else: # Usuário logado
                 if entry.get("nota_sentido") is not None:
                     last_score_found = f"Último resultado obtido: {entry['nota_sentido']}%"
                 break # Encontrou a última, pode parar
+        else:
+            # Sem tentativa recente: procura no histórico compactado
+            for resumo in st.session_state.historico_resumos:
+                if (resumo["pergunta"], resumo["materia"], resumo["assunto"]) == current_card_tab1.card_id:
+                    if resumo.get("ultima_nota") is not None:
+                        last_score_found = f"Último resultado obtido: {resumo['ultima_nota']}%"
+                    break
         st.markdown(f"*{last_score_found}*")
         # --- FIM NOVO ---
         
         st.info(current_card_tab1["pergunta"])
 
+        chave_caixa_tab1 = f"user_answer_input_tab1_{st.session_state.current_card_index}"
         user_answer_tab1 = st.text_area("Sua Resposta:",
                                     height=300,
-                                    key=f"user_answer_input_tab1_{st.session_state.current_card_index}")
+                                    key=chave_caixa_tab1,
+                                    on_change=registrar_rascunho,
+                                    args=(chave_caixa_tab1, preparar_caixa_resposta(chave_caixa_tab1, current_card_tab1)))
 
         if st.button("Verificar Resposta", key="check_response_btn_tab1"):
-            if user_answer_tab1.strip():
-                with st.spinner("Analisando com Gemini..."):
-                    # Passa a pergunta também para o Gemini
-                    full_feedback_text_tab1 = comparar_respostas_com_gemini(current_card_tab1["pergunta"], user_answer_tab1, current_card_tab1["resposta_esperada"]) 
-                    parsed_feedback_tab1 = parse_feedback_sections(full_feedback_text_tab1)
-                    
-                    st.session_state.last_gemini_feedback_display_parsed = parsed_feedback_tab1
-                    st.session_state.last_gemini_feedback_question = current_card_tab1["pergunta"]
-                    st.session_state.last_gemini_expected_answer = current_card_tab1["resposta_esperada"]
-                
-                stored_score_tab1 = None
-                if parsed_feedback_tab1.get('score'):
-                    score_match_tab1 = re.search(r"(\d+)", parsed_feedback_tab1['score'])
-                    if score_match_tab1:
-                        try:
-                            stored_score_tab1 = int(score_match_tab1.group(1))
-                        except ValueError:
-                            pass 
-                lacunas_stored_tab1 = parsed_feedback_tab1.get('content_gaps')
-
-                st.session_state.feedback_history.append({
-                    "materia": current_card_tab1["materia"],
-                    "assunto": current_card_tab1["assunto"],
-                    "pergunta": current_card_tab1["pergunta"],
-                    "nota_sentido": stored_score_tab1,
-                    "lacunas_conteudo": lacunas_stored_tab1,
-                    "timestamp": datetime.datetime.now().isoformat()
-                })
-                salvar_historico_feedback(st.session_state.feedback_history, st.session_state.logged_in_user)
-
-                st.session_state.feedback_history = carregar_historico_feedback(st.session_state.logged_in_user) 
-                
-                difficult_cards_updated = []
-                last_scores_for_difficult = {}
-                for entry in reversed(st.session_state.feedback_history):
-                    card_id_entry = (entry["pergunta"], entry["materia"], entry["assunto"])
-                    if card_id_entry not in last_scores_for_difficult:
-                        last_scores_for_difficult[card_id_entry] = entry.get("nota_sentido")
-
-                for card_item in st.session_state.user_cartoes: 
-                    card_id_item = (card_item["pergunta"], card_item["materia"], card_item["assunto"])
-                    if card_id_item in last_scores_for_difficult and last_scores_for_difficult[card_id_item] is not None and last_scores_for_difficult[card_id_item] < 80:
-                        difficult_cards_updated.append(card_item)
-                st.session_state.difficult_cards_for_session = difficult_cards_updated
+            cota_esgotada = verificar_cota(st.session_state.logged_in_user) if user_answer_tab1.strip() else None
+            if cota_esgotada:
+                st.warning(f"Correção não enviada: {cota_esgotada}")
+            elif user_answer_tab1.strip():
+                # A correção roda em segundo plano; o fragmento abaixo acompanha e entrega o resultado
+                if not enviar_correcao(current_card_tab1, user_answer_tab1, atualiza_dificeis=True,
+                                       nonce=nonce_submissao(current_card_tab1)):
+                    st.info("Este cartão já tem uma correção em andamento.")
             else:
                 st.warning("Por favor, digite sua resposta antes de verificar.")
 
-        if (st.session_state.last_gemini_feedback_display_parsed is not None and
-            st.session_state.last_gemini_feedback_question == current_card_tab1["pergunta"]):
+        if st.session_state.correcoes_pendentes:
+            acompanhar_correcoes(chave_cartao(current_card_tab1))
+
+        if feedback_para_exibir(current_card_tab1) is not None:
             
             parsed_feedback_to_display = st.session_state.last_gemini_feedback_display_parsed
             st.subheader("Feedback do Gemini:")
@@ -701,7 +4120,8 @@ else: # Usuário logado
                     st.info("Você está no primeiro cartão.")
         with nav_col3_tab1:
             if st.button("Próximo", key="next_card_btn_tab1"):
-                if st.session_state.current_card_index < len(filtered_cards_tab1) - 1:
+                if (st.session_state.current_card_index < len(filtered_cards_tab1) - 1 or
+                        (pratica_tab1 is not None and carregar_proxima_pagina_pratica(pratica_tab1))):
                     st.session_state.current_card_index += 1
                     st.session_state.show_expected_answer = False # Mantém o reset
                     st.session_state.last_gemini_feedback_display_parsed = None # Limpa feedback
@@ -710,6 +4130,8 @@ else: # Usuário logado
                     st.info("Você está no último cartão.")
         with nav_col4_tab1:
             if st.button("Último", key="last_card_btn_tab1"):
+                if pratica_tab1 is not None:
+                    carregar_todas_paginas_pratica(pratica_tab1)
                 st.session_state.current_card_index = len(filtered_cards_tab1) - 1
                 st.session_state.show_expected_answer = False # Mantém o reset
                 st.session_state.last_gemini_feedback_display_parsed = None # Limpa feedback
@@ -718,6 +4140,31 @@ else: # Usuário logado
 
     def render_tab_manage_cards():
         st.header("Gerenciar Cartões")
+        baralho_usuario = sincronizar_indices_sessao(st.session_state.logged_in_user) # Esta aba precisa do baralho inteiro
+
+        baralhos_disponiveis = listar_baralhos_compartilhados()
+        if baralhos_disponiveis:
+            st.subheader("Baralhos Compartilhados")
+            assinados_atuais = [deck_id for deck_id in assinaturas_usuario(st.session_state.logged_in_user)
+                                if deck_id in {b["id"] for b in baralhos_disponiveis}]
+            with st.form("shared_decks_subscription_form"):
+                assinados_escolhidos = st.multiselect(
+                    "Baralhos que você estuda (somente leitura, mantidos pelo administrador):",
+                    [b["id"] for b in baralhos_disponiveis], default=assinados_atuais,
+                    format_func=lambda deck_id: next(f"{b.get('nome', deck_id)} ({b.get('total_cartoes', 0)} cartões)"
+                                                     for b in baralhos_disponiveis if b["id"] == deck_id))
+                if st.form_submit_button("Salvar Assinaturas"):
+                    try:
+                        for deck_id in set(assinados_escolhidos) - set(assinados_atuais):
+                            alterar_assinatura(st.session_state.logged_in_user, deck_id, assinar=True)
+                        for deck_id in set(assinados_atuais) - set(assinados_escolhidos):
+                            alterar_assinatura(st.session_state.logged_in_user, deck_id, assinar=False)
+                        atualizar_indices_sessao(st.session_state.logged_in_user)
+                        st.session_state.current_card_index = 0
+                        st.session_state.current_card_index_difficult = 0
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Erro ao salvar as assinaturas: {e}")
         
         st.subheader("Adicionar Novo Cartão")
         with st.form("add_card_form"): 
@@ -734,62 +4181,69 @@ else: # Usuário logado
             nova_resposta = st.text_area("Novo Padrão de Resposta:",
                                          height=200,
                                          key=f"new_a_input_{st.session_state.add_card_form_key_suffix}")
+            ignorar_duplicatas = st.checkbox("Adicionar mesmo que exista pergunta quase idêntica",
+                                             key=f"new_ignore_dup_{st.session_state.add_card_form_key_suffix}")
             
             submitted = st.form_submit_button("Adicionar Cartão")
             if submitted:
-                if nova_materia.strip() and nova_assunto.strip() and nova_pergunta.strip() and nova_resposta.strip():
+                quase_identicas = (perguntas_quase_identicas(st.session_state.logged_in_user, nova_pergunta, baralho_usuario)
+                                   if nova_pergunta.strip() and not ignorar_duplicatas else [])
+                if quase_identicas:
+                    st.warning("Já existe pergunta quase idêntica no seu baralho. Marque a opção acima para adicionar mesmo assim.\n\n" +
+                               "\n".join(f"- {similaridade:.0%} · {cartao['materia']} - {cartao['assunto']}: {cartao['pergunta'][:120]}"
+                                         for similaridade, cartao in quase_identicas[:3]))
+                elif nova_materia.strip() and nova_assunto.strip() and nova_pergunta.strip() and nova_resposta.strip():
                     new_card_data = { # Dados do novo cartão sem doc_id ainda
                         "materia": nova_materia.strip(),
                         "assunto": nova_assunto.strip(),
                         "pergunta": nova_pergunta.strip(),
                         "resposta_esperada": nova_resposta.strip()
                     }
+                    with st.spinner("Gerando rubrica de correção..."):
+                        new_card_data = com_rubrica(new_card_data)
                     # Adiciona o cartão ao Firestore e pega o doc_id gerado
                     new_doc_id = adicionar_cartao_firestore(new_card_data, st.session_state.logged_in_user)
                     
                     if new_doc_id: # Se o cartão foi adicionado com sucesso
-                        new_card_data['doc_id'] = new_doc_id # Adiciona o doc_id à cópia em memória
-                        st.session_state.user_cartoes.append(new_card_data) # Adiciona à lista em memória
+                        # Publica nova versão do baralho compartilhado (sem reler a coleção inteira)
+                        propagar_baralho_para_replicas(publicar_alteracoes_baralho(
+                            st.session_state.logged_in_user, alterados=[Cartao.from_dict(new_card_data, doc_id=new_doc_id)]))
                         
                         st.session_state.last_materia_input = nova_materia.strip()
                         st.session_state.last_assunto_input = nova_assunto.strip()
                         st.session_state.add_card_form_key_suffix += 1
                         
-                        # --- ATUALIZAÇÃO DA ORDEM E LISTA DE DIFÍCEIS APÓS ADIÇÃO/EDIÇÃO/EXCLUSÃO ---
-                        st.session_state.user_cartoes = carregar_cartoes(st.session_state.logged_in_user) # Recarrega os cartões mais recentes
-                        st.session_state.feedback_history = carregar_historico_feedback(st.session_state.logged_in_user) # Recarrega o histórico
-                        
-                        # Recalcula ordered_cards_for_session
-                        card_latest_scores_recalc = {}
-                        for entry in reversed(st.session_state.feedback_history):
-                            card_id = (entry["pergunta"], entry["materia"], entry["assunto"])
-                            if card_id not in card_latest_scores_recalc:
-                                card_latest_scores_recalc[card_id] = entry.get("nota_sentido")
-                        cards_for_ordering_recalc = []
-                        for card in st.session_state.user_cartoes:
-                            card_id = (card["pergunta"], card["materia"], card["assunto"])
-                            score_to_order = card_latest_scores_recalc.get(card_id, -1)
-                            cards_for_ordering_recalc.append((card, score_to_order))
-                        st.session_state.ordered_cards_for_session = [card_obj for card_obj, _ in sorted(cards_for_ordering_recalc, key=lambda x: x[1])]
-
-                        # Recalcula difficult_cards_for_session
-                        difficult_cards_updated_recalc = []
-                        for card in st.session_state.user_cartoes:
-                            card_id = (card["pergunta"], card["materia"], card["assunto"])
-                            if card_id in card_latest_scores_recalc and card_latest_scores_recalc[card_id] is not None and card_latest_scores_recalc[card_id] < 80:
-                                difficult_cards_updated_recalc.append(card)
-                        st.session_state.difficult_cards_for_session = difficult_cards_updated_recalc
-                        # --- FIM DA ATUALIZAÇÃO ---
+                        # --- ATUALIZAÇÃO DA ORDEM E LISTA DE DIFÍCEIS APÓS ADIÇÃO ---
+                        atualizar_indices_sessao(st.session_state.logged_in_user)
 
                         st.rerun()
                 else:
                     st.warning("Por favor, preencha todos os campos para adicionar um cartão.")
 
         st.subheader("Cartões Existentes")
-        available_materias_manage = sorted(list(set([card["materia"] for card in st.session_state.user_cartoes]))) if st.session_state.user_cartoes else []
+        all_cards_manage = baralho_usuario.cartoes
+
+        # Cartões criados antes das rubricas (ou cuja geração falhou) podem recebê-las aqui
+        cartoes_sem_rubrica = [card for card in all_cards_manage if card.baralho_id is None and rubrica_vigente(card) is None]
+        if cartoes_sem_rubrica and st.button(f"Gerar rubricas pendentes ({len(cartoes_sem_rubrica)} cartões)", key="generate_rubrics_btn"):
+            cartoes_com_rubrica = []
+            progresso_rubricas = st.progress(0.0)
+            for n_rubrica, card in enumerate(cartoes_sem_rubrica, start=1):
+                rubrica = gerar_rubrica(card["pergunta"], card["resposta_esperada"])
+                if rubrica is not None:
+                    try:
+                        db.collection(USERS_COLLECTION).document(st.session_state.logged_in_user).collection(CARDS_COLLECTION).document(card.doc_id).update({"rubrica": rubrica})
+                        cartoes_com_rubrica.append(Cartao.from_dict({**card.to_dict(), "rubrica": rubrica}))
+                    except Exception as e:
+                        st.error(f"Erro ao salvar a rubrica do cartão {card.doc_id}: {e}")
+                progresso_rubricas.progress(n_rubrica / len(cartoes_sem_rubrica))
+            if cartoes_com_rubrica:
+                propagar_baralho_para_replicas(publicar_alteracoes_baralho(st.session_state.logged_in_user, alterados=cartoes_com_rubrica))
+            st.success(f"Rubricas geradas para {len(cartoes_com_rubrica)} de {len(cartoes_sem_rubrica)} cartões.")
+        available_materias_manage = sorted(list(set([card["materia"] for card in all_cards_manage]))) if all_cards_manage else []
         selected_materia_manage = st.selectbox("Filtrar por Matéria:", ["Todas"] + available_materias_manage, key="filter_materia_manage")
 
-        displayed_cards = st.session_state.user_cartoes
+        displayed_cards = all_cards_manage
         if selected_materia_manage != "Todas":
             displayed_cards = [card for card in displayed_cards if card["materia"] == selected_materia_manage]
         
@@ -800,176 +4254,201 @@ else: # Usuário logado
             displayed_cards = [card for card in displayed_cards if card["assunto"] == selected_assunto_manage]
 
         if not displayed_cards: # Tratamento para caso sem cartões
-            if st.session_state.user_cartoes:
+            if all_cards_manage:
                 st.info("Nenhum cartão encontrado com os filtros selecionados. Altere os filtros.")
             else:
                 st.info("Nenhum cartão adicionado ainda. Use o formulário acima para criar seu primeiro cartão.")
             return 
 
-        for i, card in enumerate(displayed_cards):
-            # Para edição/exclusão, precisamos do doc_id do Firestore
-            # Assumimos que o card já tem 'doc_id' por causa de carregar_cartoes
-            card_doc_id = card.get('doc_id') 
-
-            with st.expander(f"Cartão ({card.get('doc_id', 'Sem ID')[:6]}...) {card['materia']} - {card['assunto']}: {card['pergunta'][:50]}..."): # Mostra o ID do doc
-                st.write("**Matéria:**", card["materia"])
-                st.write("**Assunto:**", card["assunto"])
-                st.write("**Pergunta:**", card["pergunta"])
-                st.write("**Padrão de Resposta:**", card["resposta_esperada"])
-
-                col_edit, col_delete = st.columns(2)
-                with col_edit:
-                    if st.button(f"Editar", key=f"edit_card_btn_{card_doc_id}"): # Usa doc_id para key
-                        st.session_state.edit_index_doc_id = card_doc_id # Armazena o doc_id do cartão a ser editado
-                        # Carrega os dados do cartão para os inputs do formulário de edição
-                        st.session_state.edit_materia = card["materia"]
-                        st.session_state.edit_assunto = card["assunto"]
-                        st.session_state.edit_pergunta = card["pergunta"]
-                        st.session_state.edit_resposta = card["resposta_esperada"]
-                        st.session_state.is_editing_card = True # Sinaliza para exibir o formulário de edição
-                        st.rerun()
+        nomes_compartilhados = {b["id"]: b.get("nome", b["id"]) for b in baralhos_disponiveis}
+        if st.session_state.get("aviso_grade_cartoes"):
+            st.success(st.session_state.pop("aviso_grade_cartoes"))
+
+        # Só a página visível vira widget: uma tabela editável em vez de um expander (e dois botões) por cartão
+        total_paginas = max(1, -(-len(displayed_cards) // CARTOES_POR_PAGINA_GERENCIAR))
+        if st.session_state.get("manage_cards_page", 1) > total_paginas: # Exclusões/filtros podem encolher a lista
+            st.session_state.manage_cards_page = total_paginas
+        pagina_cartoes = st.number_input(f"Página (de {total_paginas}):", min_value=1, max_value=total_paginas, value=1, step=1,
+                                         key="manage_cards_page") if total_paginas > 1 else 1
+        inicio_pagina = (pagina_cartoes - 1) * CARTOES_POR_PAGINA_GERENCIAR
+        cartoes_pagina = displayed_cards[inicio_pagina:inicio_pagina + CARTOES_POR_PAGINA_GERENCIAR]
+        cartoes_pagina_por_id = {card.doc_id: card for card in cartoes_pagina}
+        st.caption(f"Cartões {inicio_pagina + 1} a {inicio_pagina + len(cartoes_pagina)} de {len(displayed_cards)}. "
+                   "Edite as células e salve a página, ou marque cartões para as ações em lote. "
+                   "Cartões de baralhos compartilhados são somente leitura.")
+
+        tabela_pagina = pd.DataFrame({
+            "Selecionar": [False] * len(cartoes_pagina),
+            "Matéria": [card.materia for card in cartoes_pagina],
+            "Assunto": [card.assunto for card in cartoes_pagina],
+            "Pergunta": [card.pergunta for card in cartoes_pagina],
+            "Padrão de Resposta": [card.resposta_esperada for card in cartoes_pagina],
+            "Rubrica": [formatar_rubrica(itens) if itens else "" for itens in map(rubrica_vigente, cartoes_pagina)],
+            "Origem": ["Próprio" if card.baralho_id is None else nomes_compartilhados.get(card.baralho_id, card.baralho_id)
+                       for card in cartoes_pagina],
+        }, index=pd.Index(list(cartoes_pagina_por_id), name="ID"))
+        # A versão do baralho e os filtros entram na chave: depois de salvar, a grade recomeça do estado gravado
+        tabela_editada = st.data_editor(
+            tabela_pagina,
+            key=f"manage_cards_grid_{baralho_usuario.versao}_{selected_materia_manage}_{selected_assunto_manage}_{pagina_cartoes}",
+            disabled=["Rubrica", "Origem"],
+            column_config={
+                "Selecionar": st.column_config.CheckboxColumn("Selecionar", width="small"),
+                "Pergunta": st.column_config.TextColumn("Pergunta", width="large"),
+                "Padrão de Resposta": st.column_config.TextColumn("Padrão de Resposta", width="large"),
+                "Rubrica": st.column_config.TextColumn("Rubrica", help="Refeita automaticamente quando a pergunta ou o padrão de resposta mudam."),
+            },
+        )
+
+        def texto_celula(valor):
+            return valor.strip() if isinstance(valor, str) else ""
+
+        def concluir_operacao_em_lote(alterados=(), removidos=(), aviso=""):
+            # Uma única nova versão do baralho para a página inteira, em vez de uma por cartão
+            baralho_atualizado = publicar_alteracoes_baralho(st.session_state.logged_in_user, alterados=alterados, removidos=removidos)
+            propagar_baralho_para_replicas(baralho_atualizado)
+            atualizar_indices_sessao(st.session_state.logged_in_user)
+            if st.session_state.current_card_index >= len(baralho_atualizado):
+                st.session_state.current_card_index = 0
+            st.session_state.aviso_grade_cartoes = aviso
+            st.rerun()
 
-                with col_delete:
-                    if st.button(f"Excluir", key=f"delete_card_{card_doc_id}"): # Usa doc_id para key
-                        # Exclui do Firestore
-                        if excluir_cartao_firestore(card_doc_id, st.session_state.logged_in_user):
-                            # Remove da lista em memória
-                            st.session_state.user_cartoes = [c for c in st.session_state.user_cartoes if c.get('doc_id') != card_doc_id]
-                        
-                            # --- ATUALIZAÇÃO DA ORDEM E LISTA DE DIFÍCEIS APÓS EXCLUSÃO ---
-                            st.session_state.user_cartoes = carregar_cartoes(st.session_state.logged_in_user) # Recarrega os cartões mais recentes
-                            st.session_state.feedback_history = carregar_historico_feedback(st.session_state.logged_in_user) # Recarrega o histórico
-                            
-                            # Recalcula ordered_cards_for_session
-                            card_latest_scores_recalc = {}
-                            for entry in reversed(st.session_state.feedback_history):
-                                card_id = (entry["pergunta"], entry["materia"], entry["assunto"])
-                                if card_id not in card_latest_scores_recalc:
-                                    card_latest_scores_recalc[card_id] = entry.get("nota_sentido")
-                            cards_for_ordering_recalc = []
-                            for card in st.session_state.user_cartoes:
-                                card_id = (card["pergunta"], card["materia"], card["assunto"])
-                                score_to_order = card_latest_scores_recalc.get(card_id, -1)
-                                cards_for_ordering_recalc.append((card, score_to_order))
-                            st.session_state.ordered_cards_for_session = [card_obj for card_obj, _ in sorted(cards_for_ordering_recalc, key=lambda x: x[1])]
-
-                            # Recalcula difficult_cards_for_session
-                            difficult_cards_updated_recalc = []
-                            for card in st.session_state.user_cartoes:
-                                card_id = (card["pergunta"], card["materia"], card["assunto"])
-                                if card_id in card_latest_scores_recalc and card_latest_scores_recalc[card_id] is not None and card_latest_scores_recalc[card_id] < 80:
-                                    difficult_cards_updated_recalc.append(card)
-                            st.session_state.difficult_cards_for_session = difficult_cards_updated_recalc
-                            # --- FIM DA ATUALIZAÇÃO ---
-
-                            if st.session_state.current_card_index >= len(st.session_state.user_cartoes):
-                                st.session_state.current_card_index = 0
-                            st.rerun()
-                st.markdown("---")
-
-        # --- Formulário de Edição (FORA DO LOOP de exibição de cartões) ---
-        # Este formulário SÓ É RENDERIZADO se st.session_state.is_editing_card for True
-        if st.session_state.is_editing_card and st.session_state.edit_index_doc_id is not None: 
-            st.subheader(f"Editar Cartão (ID: {st.session_state.edit_index_doc_id[:6]}...)")
-            
-            # O st.empty() é usado para "conter" o formulário e permitir limpeza/substituição
-            edit_form_placeholder = st.empty() # Cria um placeholder
-            with edit_form_placeholder.form(key=f"edit_card_form_{st.session_state.edit_index_doc_id}"): 
-                edited_materia = st.text_input("Matéria:", value=st.session_state.edit_materia, key="edit_m_input")
-                edited_assunto = st.text_input("Assunto:", value=st.session_state.edit_assunto, key="edit_a_input")
-                edited_pergunta = st.text_area("Pergunta:", value=st.session_state.edit_pergunta, height=200, key="edit_q_input")
-                edited_resposta = st.text_area("Padrão de Resposta:", value=st.session_state.edit_resposta, height=200, key="edit_ans_input")
-                col_save, col_cancel = st.columns(2)
-                with col_save:
-                    edited_submitted = st.form_submit_button("Salvar Edição")
-                with col_cancel:
-                    cancel_edit = st.form_submit_button("Cancelar Edição")
-
-                if edited_submitted:
-                    if edited_materia.strip() and edited_assunto.strip() and edited_pergunta.strip() and edited_resposta.strip():
-                        updated_card_data = { # Dados atualizados para enviar ao Firestore
-                            "materia": edited_materia.strip(),
-                            "assunto": edited_assunto.strip(),
-                            "pergunta": edited_pergunta.strip(),
-                            "resposta_esperada": edited_resposta.strip()
-                        }
-                        # Atualiza no Firestore usando o doc_id
-                        if atualizar_cartao_firestore(st.session_state.edit_index_doc_id, updated_card_data, st.session_state.logged_in_user):
-                            # Atualiza na lista em memória
-                            for i, card in enumerate(st.session_state.user_cartoes):
-                                if card.get('doc_id') == st.session_state.edit_index_doc_id:
-                                    st.session_state.user_cartoes[i].update(updated_card_data)
-                                    break
-                        
-                            # --- ATUALIZAÇÃO DA ORDEM E LISTA DE DIFÍCEIS APÓS EDIÇÃO ---
-                            st.session_state.user_cartoes = carregar_cartoes(st.session_state.logged_in_user) # Recarrega os cartões mais recentes
-                            st.session_state.feedback_history = carregar_historico_feedback(st.session_state.logged_in_user) # Recarrega o histórico
-                            
-                            # Recalcula ordered_cards_for_session
-                            card_latest_scores_recalc = {}
-                            for entry in reversed(st.session_state.feedback_history):
-                                card_id = (entry["pergunta"], entry["materia"], entry["assunto"])
-                                if card_id not in card_latest_scores_recalc:
-                                    card_latest_scores_recalc[card_id] = entry.get("nota_sentido")
-                            cards_for_ordering_recalc = []
-                            for card in st.session_state.user_cartoes:
-                                card_id = (card["pergunta"], card["materia"], card["assunto"])
-                                score_to_order = card_latest_scores_recalc.get(card_id, -1)
-                                cards_for_ordering_recalc.append((card, score_to_order))
-                            st.session_state.ordered_cards_for_session = [card_obj for card_obj, _ in sorted(cards_for_ordering_recalc, key=lambda x: x[1])]
-
-                            # Recalcula difficult_cards_for_session
-                            difficult_cards_updated_recalc = []
-                            for card in st.session_state.user_cartoes:
-                                card_id = (card["pergunta"], card["materia"], card["assunto"])
-                                if card_id in card_latest_scores_recalc and card_latest_scores_recalc[card_id] is not None and card_latest_scores_recalc[card_id] < 80:
-                                    difficult_cards_updated_recalc.append(card)
-                            st.session_state.difficult_cards_for_session = difficult_cards_updated_recalc
-                            # --- FIM DA ATUALIZAÇÃO ---
-
-                            st.session_state.edit_index_doc_id = None # Limpa o estado de edição
-                            st.session_state.is_editing_card = False # OCULTA O FORMULÁRIO
-                            st.rerun()
-                        else:
-                            st.warning("Por favor, preencha todos os campos para salvar a edição.")
-                    elif cancel_edit:
-                        st.session_state.edit_index_doc_id = None
-                        st.session_state.is_editing_card = False # OCULTA O FORMULÁRIO
-                        st.rerun()
+        selecionados = [doc_id for doc_id in tabela_editada.index if bool(tabela_editada.at[doc_id, "Selecionar"])]
+        selecionados_proprios = [doc_id for doc_id in selecionados if cartoes_pagina_por_id[doc_id].baralho_id is None]
+
+        if st.button("Salvar alterações da página", key="save_cards_page_btn"):
+            atualizacoes, ignorados_compartilhados, ignorados_vazios = {}, 0, 0
+            for doc_id, card in cartoes_pagina_por_id.items():
+                linha = tabela_editada.loc[doc_id]
+                novos_campos = {
+                    "materia": texto_celula(linha["Matéria"]),
+                    "assunto": texto_celula(linha["Assunto"]),
+                    "pergunta": texto_celula(linha["Pergunta"]),
+                    "resposta_esperada": texto_celula(linha["Padrão de Resposta"]),
+                }
+                if all(novos_campos[campo] == card[campo] for campo in novos_campos):
+                    continue
+                if card.baralho_id is not None:
+                    ignorados_compartilhados += 1
+                    continue
+                if not all(novos_campos.values()):
+                    ignorados_vazios += 1
+                    continue
+                # A rubrica só é refeita se a pergunta ou o padrão de resposta mudaram
+                if (card.pergunta == novos_campos["pergunta"] and card.resposta_esperada == novos_campos["resposta_esperada"]
+                        and rubrica_vigente(card) is not None):
+                    novos_campos["rubrica"] = card.rubrica
+                else:
+                    with st.spinner("Gerando rubrica de correção..."):
+                        novos_campos = com_rubrica(novos_campos)
+                atualizacoes[doc_id] = novos_campos
+
+            if ignorados_compartilhados:
+                st.warning(f"{ignorados_compartilhados} cartão(ões) de baralhos compartilhados não foram alterados (somente leitura).")
+            if ignorados_vazios:
+                st.warning(f"{ignorados_vazios} cartão(ões) com campos vazios não foram salvos. Preencha todos os campos.")
+            if not atualizacoes:
+                if not (ignorados_compartilhados or ignorados_vazios):
+                    st.info("Nenhuma alteração nesta página.")
+            elif atualizar_cartoes_em_lote(st.session_state.logged_in_user, atualizacoes):
+                concluir_operacao_em_lote(
+                    alterados=[Cartao.from_dict({**cartoes_pagina_por_id[doc_id].to_dict(), **campos}, doc_id=doc_id)
+                               for doc_id, campos in atualizacoes.items()],
+                    aviso=f"{len(atualizacoes)} cartão(ões) atualizado(s).")
+
+        st.markdown("**Ações em lote nos cartões selecionados**")
+        if len(selecionados) > len(selecionados_proprios):
+            st.caption(f"{len(selecionados) - len(selecionados_proprios)} cartão(ões) selecionado(s) de baralhos compartilhados serão ignorados.")
+        col_mover_materia, col_mover_assunto = st.columns(2)
+        with col_mover_materia:
+            nova_materia_lote = st.text_input("Nova matéria (em branco mantém a atual):", key="bulk_move_materia")
+        with col_mover_assunto:
+            novo_assunto_lote = st.text_input("Novo assunto (em branco mantém o atual):", key="bulk_move_assunto")
+        col_mover, col_excluir = st.columns(2)
+        with col_mover:
+            mover_lote = st.button(f"Mover selecionados ({len(selecionados_proprios)})", key="bulk_move_btn",
+                                   disabled=not selecionados_proprios)
+        with col_excluir:
+            excluir_lote = st.button(f"Excluir selecionados ({len(selecionados_proprios)})", key="bulk_delete_btn",
+                                     type="secondary", disabled=not selecionados_proprios)
+
+        if mover_lote:
+            campos_movidos = {campo: valor.strip() for campo, valor in (("materia", nova_materia_lote), ("assunto", novo_assunto_lote))
+                              if valor.strip()}
+            if not campos_movidos:
+                st.warning("Informe a nova matéria e/ou o novo assunto.")
+            elif atualizar_cartoes_em_lote(st.session_state.logged_in_user, {doc_id: campos_movidos for doc_id in selecionados_proprios}):
+                concluir_operacao_em_lote(
+                    alterados=[Cartao.from_dict({**cartoes_pagina_por_id[doc_id].to_dict(), **campos_movidos}, doc_id=doc_id)
+                               for doc_id in selecionados_proprios],
+                    aviso=f"{len(selecionados_proprios)} cartão(ões) movido(s).")
+
+        # Exclusão em dois passos: o botão pede a confirmação, que vale só para a seleção em que foi pedida
+        if excluir_lote:
+            st.session_state.exclusao_lote_pendente = list(selecionados_proprios)
+        exclusao_pendente = st.session_state.get("exclusao_lote_pendente")
+        if exclusao_pendente and exclusao_pendente != selecionados_proprios:
+            st.session_state.exclusao_lote_pendente = exclusao_pendente = None
+        if exclusao_pendente:
+            st.warning(f"Tem certeza que deseja excluir {len(exclusao_pendente)} cartão(ões)? Essa ação é irreversível.", icon="⚠️")
+            col_confirmar_exclusao, col_cancelar_exclusao = st.columns(2)
+            with col_confirmar_exclusao:
+                confirmar_exclusao = st.button("Confirmar Exclusão (irreversível)", key="bulk_delete_confirm_btn", type="primary")
+            with col_cancelar_exclusao:
+                cancelar_exclusao = st.button("Cancelar", key="bulk_delete_cancel_btn")
+            if cancelar_exclusao:
+                st.session_state.exclusao_lote_pendente = None
+                st.rerun()
+            if confirmar_exclusao:
+                st.session_state.exclusao_lote_pendente = None
+                if excluir_cartoes_em_lote(st.session_state.logged_in_user, exclusao_pendente):
+                    concluir_operacao_em_lote(removidos=exclusao_pendente,
+                                              aviso=f"{len(exclusao_pendente)} cartão(ões) excluído(s).")
 
 
     def render_tab_metrics():
         st.header("Métricas de Desempenho")
         st.write("Aqui você pode acompanhar seu histórico de respostas e o feedback do Gemini.")
 
-        available_materias_metrics = sorted(list(set([entry["materia"] for entry in st.session_state.feedback_history]))) if st.session_state.feedback_history else []
+        # Histórico em arrays colunares (em cache até chegar nova entrada)
+        analise = obter_analise_desempenho(st.session_state.feedback_history)
+        filtered_resumos = st.session_state.historico_resumos # Histórico compactado (um resumo por cartão)
+
+        available_materias_metrics = sorted(set(analise.materias.tolist()) | {r["materia"] for r in filtered_resumos})
         selected_materia_metrics = st.selectbox("Filtrar Histórico por Matéria:", ["Todas"] + available_materias_metrics, key="filter_materia_metrics")
 
-        filtered_history = st.session_state.feedback_history
-        if selected_materia_metrics != "Todas":
-            filtered_history = [entry for entry in filtered_history if entry["materia"] == selected_materia_metrics]
+        materia_filtro = None if selected_materia_metrics == "Todas" else selected_materia_metrics
+        if materia_filtro is not None:
+            filtered_resumos = [r for r in filtered_resumos if r["materia"] == materia_filtro]
+        mascara_materia = analise.mascara(materia=materia_filtro)
         
-        available_assuntos_metrics = sorted(list(set([entry["assunto"] for entry in filtered_history]))) if filtered_history else []
+        available_assuntos_metrics = sorted(set(analise.assuntos[np.unique(analise.cod_assunto[mascara_materia])].tolist()) |
+                                            {r["assunto"] for r in filtered_resumos})
         selected_assunto_metrics = st.selectbox("Filtrar Histórico por Assunto:", ["Todos"] + available_assuntos_metrics, key="filter_assunto_metrics")
 
-        if selected_assunto_metrics != "Todos":
-            filtered_history = [entry for entry in filtered_history if entry["assunto"] == selected_assunto_metrics]
+        assunto_filtro = None if selected_assunto_metrics == "Todos" else selected_assunto_metrics
+        if assunto_filtro is not None:
+            filtered_resumos = [r for r in filtered_resumos if r["assunto"] == assunto_filtro]
+        mascara = analise.mascara(materia=materia_filtro, assunto=assunto_filtro)
 
-        if not filtered_history:
+        if not mascara.any() and not filtered_resumos:
             st.info("Nenhuma resposta foi avaliada com os filtros selecionados. Comece a praticar na aba 'Todas as Perguntas'!")
             return 
             
         st.subheader("Resumo dos Feedbacks:")
         
-        total_pontuacao = 0
-        pontuacoes_validas = 0
-
-        for entry in filtered_history:
-            if entry.get("nota_sentido") is not None:
-                total_pontuacao += entry["nota_sentido"]
-                pontuacoes_validas += 1
-
-        total_feedbacks = len(filtered_history)
+        if materia_filtro is None and assunto_filtro is None:
+            # Sem filtros, o resumo vem dos agregados do usuário (cache compartilhado)
+            agregados = obter_agregados_usuario(st.session_state.logged_in_user, st.session_state.feedback_history,
+                                                st.session_state.historico_resumos)
+            total_pontuacao = agregados["soma_notas"]
+            pontuacoes_validas = agregados["notas_validas"]
+            total_feedbacks = agregados["total_respostas"]
+        else:
+            resumo_filtrado = analise.resumo(mascara)
+            total_pontuacao = resumo_filtrado["soma"] + sum(r.get("soma_notas", 0) for r in filtered_resumos)
+            pontuacoes_validas = resumo_filtrado["validas"] + sum(r.get("notas_validas", 0) for r in filtered_resumos)
+            total_feedbacks = resumo_filtrado["total"] + sum(r.get("tentativas", 0) for r in filtered_resumos)
 
         st.write(f"**Total de Respostas Avaliadas (com filtros):** {total_feedbacks}")
         if pontuacoes_validas > 0:
@@ -977,14 +4456,50 @@ else: # Usuário logado
         else:
             st.markdown(f"**Pontuação Média de Sentido (com filtros):** N/A (sem pontuacoes registradas)")
 
+        if mascara.any():
+            # Sem matéria escolhida, as séries são por matéria; com matéria escolhida, por assunto
+            agrupar_por = "materia" if materia_filtro is None else "assunto"
+            st.subheader("Evolução das Notas:")
+            st.caption(f"Média móvel das últimas {JANELA_MEDIA_MOVEL} tentativas, por {'matéria' if agrupar_por == 'materia' else 'assunto'}.")
+            medias_moveis = analise.medias_moveis(mascara, por=agrupar_por)
+            if not medias_moveis.empty:
+                st.line_chart(medias_moveis)
+            st.dataframe(analise.inclinacoes(mascara, por=agrupar_por), hide_index=True)
+
+            st.subheader("Frequência de Tentativas:")
+            tentativas_por_dia, tentativas_por_pergunta = analise.frequencia_tentativas(mascara)
+            col_freq_1, col_freq_2 = st.columns(2)
+            with col_freq_1:
+                st.caption("Respostas por dia")
+                st.bar_chart(tentativas_por_dia)
+            with col_freq_2:
+                st.caption("Perguntas por número de tentativas")
+                st.bar_chart(tentativas_por_pergunta)
+
+            st.subheader("Tempo até o Domínio:")
+            dias_ate_dominio, perguntas_respondidas = analise.tempo_ate_dominio(mascara)
+            col_dom_1, col_dom_2 = st.columns(2)
+            col_dom_1.metric(f"Perguntas com nota ≥ {NOTA_DOMINIO}", f"{len(dias_ate_dominio)} de {perguntas_respondidas}")
+            col_dom_2.metric("Mediana de dias até o domínio", f"{np.median(dias_ate_dominio):.1f}" if len(dias_ate_dominio) else "N/A")
+
         st.subheader("Histórico Detalhado:")
         if st.button("Limpar Histórico de Desempenho", type="secondary"):
             st.session_state.feedback_history = []
+            st.session_state.historico_resumos = []
             salvar_historico_feedback(st.session_state.feedback_history, st.session_state.logged_in_user)
+            if PRATICA_POR_CONSULTA:
+                descartar_pratica_sessao() # As listas de prática foram ordenadas pelos campos que acabaram de ser zerados
             st.rerun()
 
-        for i, entry in enumerate(reversed(filtered_history)):
-            st.markdown(f"**--- Resposta {len(filtered_history) - i} ({entry['timestamp'].split('T')[0]}) ---**")
+        # Apenas uma página do histórico vira elementos na tela (mais recentes primeiro)
+        linhas_filtradas = analise.indices_originais[mascara][::-1]
+        total_paginas = max(1, -(-len(linhas_filtradas) // ENTRADAS_POR_PAGINA_HISTORICO))
+        pagina_historico = st.number_input(f"Página (de {total_paginas}):", min_value=1, max_value=total_paginas, value=1, step=1,
+                                           key="metrics_history_page") if total_paginas > 1 else 1
+        inicio_pagina = (pagina_historico - 1) * ENTRADAS_POR_PAGINA_HISTORICO
+        for posicao, indice_entrada in enumerate(linhas_filtradas[inicio_pagina:inicio_pagina + ENTRADAS_POR_PAGINA_HISTORICO]):
+            entry = st.session_state.feedback_history[indice_entrada]
+            st.markdown(f"**--- Resposta {len(linhas_filtradas) - inicio_pagina - posicao} ({entry['timestamp'].split('T')[0]}) ---**")
             st.write(f"**Matéria:** {entry['materia']}")
             st.write(f"**Assunto:** {entry['assunto']}")
             st.write(f"**Pergunta:** {entry['pergunta']}")
@@ -997,24 +4512,42 @@ else: # Usuário logado
             
             st.markdown("---")
 
+        if filtered_resumos:
+            st.subheader("Histórico Compactado (por pergunta):")
+            st.write(f"Respostas com mais de {HISTORICO_JANELA_DIAS} dias ficam resumidas por pergunta.")
+            st.dataframe([{
+                "Matéria": r["materia"],
+                "Assunto": r["assunto"],
+                "Pergunta": r["pergunta"][:80],
+                "Tentativas": r.get("tentativas", 0),
+                "Média": round(r["soma_notas"] / r["notas_validas"], 1) if r.get("notas_validas") else None,
+                "Última nota": r.get("ultima_nota"),
+                "Lacunas mais frequentes": "; ".join(list(r.get("lacunas_frequentes", {}))[:3]),
+            } for r in filtered_resumos])
+
 
     def render_tab_difficult_questions():
         st.header("Prática: perguntas mais difíceis")
 
-        current_practice_cards_difficult = st.session_state.difficult_cards_for_session
-        
-        available_materias_difficult = sorted(list(set([card["materia"] for card in current_practice_cards_difficult]))) if current_practice_cards_difficult else []
-        selected_materia_difficult = st.selectbox("Filtrar por Matéria:", ["Todas"] + available_materias_difficult, key="filter_materia_difficult")
+        pratica_difficult = None
+        if PRATICA_POR_CONSULTA:
+            pratica_difficult = filtros_pratica_por_consulta("difficult", apenas_dificeis=True)
+            filtered_cards_difficult = pratica_difficult["cartoes"]
+        else:
+            current_practice_cards_difficult = cartoes_por_indices(baralho_usuario, st.session_state.difficult_cards_for_session)
+            
+            available_materias_difficult = sorted(list(set([card["materia"] for card in current_practice_cards_difficult]))) if current_practice_cards_difficult else []
+            selected_materia_difficult = st.selectbox("Filtrar por Matéria:", ["Todas"] + available_materias_difficult, key="filter_materia_difficult")
 
-        filtered_cards_difficult = current_practice_cards_difficult
-        if selected_materia_difficult != "Todas":
-            filtered_cards_difficult = [card for card in filtered_cards_difficult if card["materia"] == selected_materia_difficult]
+            filtered_cards_difficult = current_practice_cards_difficult
+            if selected_materia_difficult != "Todas":
+                filtered_cards_difficult = [card for card in filtered_cards_difficult if card["materia"] == selected_materia_difficult]
 
-        available_assuntos_difficult = sorted(list(set([card["assunto"] for card in filtered_cards_difficult]))) if filtered_cards_difficult else []
-        selected_assunto_difficult = st.selectbox("Filtrar por Assunto:", ["Todos"] + available_assuntos_difficult, key="filter_assunto_difficult")
+            available_assuntos_difficult = sorted(list(set([card["assunto"] for card in filtered_cards_difficult]))) if filtered_cards_difficult else []
+            selected_assunto_difficult = st.selectbox("Filtrar por Assunto:", ["Todos"] + available_assuntos_difficult, key="filter_assunto_difficult")
 
-        if selected_assunto_difficult != "Todos":
-            filtered_cards_difficult = [card for card in filtered_cards_difficult if card["assunto"] == selected_assunto_difficult]
+            if selected_assunto_difficult != "Todos":
+                filtered_cards_difficult = [card for card in filtered_cards_difficult if card["assunto"] == selected_assunto_difficult]
 
         if not filtered_cards_difficult: # Tratamento para caso sem cartões
             st.info("Parabéns! Não há perguntas classificadas como 'difíceis' com os filtros selecionados, ou elas ainda não foram respondidas e pontuadas abaixo de 80%.")
@@ -1025,51 +4558,34 @@ else: # Usuário logado
 
         current_card_difficult = filtered_cards_difficult[st.session_state.current_card_index_difficult]
 
-        st.subheader(f"Pergunta ({st.session_state.current_card_index_difficult + 1}/{len(filtered_cards_difficult)}):")
+        total_cards_difficult = (max(pratica_difficult["total"], len(filtered_cards_difficult)) if pratica_difficult is not None
+                                 else len(filtered_cards_difficult))
+        st.subheader(f"Pergunta ({st.session_state.current_card_index_difficult + 1}/{total_cards_difficult}):")
         st.info(current_card_difficult["pergunta"])
 
+        chave_caixa_difficult = f"user_answer_input_difficult_{st.session_state.current_card_index_difficult}"
         user_answer_difficult = st.text_area("Sua Resposta:",
                                     height=150,
-                                    key=f"user_answer_input_difficult_{st.session_state.current_card_index_difficult}")
+                                    key=chave_caixa_difficult,
+                                    on_change=registrar_rascunho,
+                                    args=(chave_caixa_difficult, preparar_caixa_resposta(chave_caixa_difficult, current_card_difficult)))
 
         if st.button("Verificar Resposta", key="check_response_btn_difficult"):
-            if user_answer_difficult.strip():
-                with st.spinner("Analisando com Gemini..."):
-                    # Passa a pergunta também para o Gemini
-                    full_feedback_text_difficult = comparar_respostas_com_gemini(current_card_difficult["pergunta"], user_answer_difficult, current_card_difficult["resposta_esperada"]) 
-                    parsed_feedback_difficult = parse_feedback_sections(full_feedback_text_difficult)
-                    
-                    st.session_state.last_gemini_feedback_display_parsed = parsed_feedback_difficult # Usa o mesmo para exibir
-                    st.session_state.last_gemini_feedback_question = current_card_difficult["pergunta"]
-                    st.session_state.last_gemini_expected_answer = current_card_difficult["resposta_esperada"]
-                
-                stored_score_difficult = None
-                if parsed_feedback_difficult.get('score'):
-                    score_match_difficult = re.search(r"(\d+)", parsed_feedback_difficult['score'])
-                    if score_match_difficult:
-                        try:
-                            stored_score_difficult = int(score_match_difficult.group(1))
-                        except ValueError:
-                            pass 
-                lacunas_stored_difficult = parsed_feedback_difficult.get('content_gaps')
-
-                st.session_state.feedback_history.append({
-                    "materia": current_card_difficult["materia"],
-                    "assunto": current_card_difficult["assunto"],
-                    "pergunta": current_card_difficult["pergunta"],
-                    "nota_sentido": stored_score_difficult,
-                    "lacunas_conteudo": lacunas_stored_difficult,
-                    "timestamp": datetime.datetime.now().isoformat()
-                })
-                salvar_historico_feedback(st.session_state.feedback_history, st.session_state.logged_in_user)
-
-                # NÃO ATUALIZA A LISTA DE DIFÍCEIS AQUI. APENAS NO RESPOSTA NA ABA "TODAS AS PERGUNTAS" OU NO LOGIN.
-                # Isso garante o comportamento especificado de que responder aqui não altera a lista de difíceis.
+            cota_esgotada = verificar_cota(st.session_state.logged_in_user) if user_answer_difficult.strip() else None
+            if cota_esgotada:
+                st.warning(f"Correção não enviada: {cota_esgotada}")
+            elif user_answer_difficult.strip():
+                # Responder aqui não altera a lista de difíceis (só a aba "Todas as Perguntas" ou o login fazem isso)
+                if not enviar_correcao(current_card_difficult, user_answer_difficult, atualiza_dificeis=False,
+                                       nonce=nonce_submissao(current_card_difficult)):
+                    st.info("Este cartão já tem uma correção em andamento.")
             else:
                 st.warning("Por favor, digite sua resposta antes de verificar.")
 
-        if (st.session_state.last_gemini_feedback_display_parsed is not None and
-            st.session_state.last_gemini_feedback_question == current_card_difficult["pergunta"]):
+        if st.session_state.correcoes_pendentes:
+            acompanhar_correcoes(chave_cartao(current_card_difficult))
+
+        if feedback_para_exibir(current_card_difficult) is not None:
             
             parsed_feedback_to_display = st.session_state.last_gemini_feedback_display_parsed
             st.subheader("Feedback do Gemini:")
@@ -1112,7 +4628,8 @@ else: # Usuário logado
                         st.info("Você está no primeiro cartão difícil.")
             with nav_col3_d:
                 if st.button("Próximo", key="next_card_btn_difficult"):
-                    if st.session_state.current_card_index_difficult < len(filtered_cards_difficult) - 1:
+                    if (st.session_state.current_card_index_difficult < len(filtered_cards_difficult) - 1 or
+                            (pratica_difficult is not None and carregar_proxima_pagina_pratica(pratica_difficult))):
                         st.session_state.current_card_index_difficult += 1
                         st.session_state.show_expected_answer = False
                         st.session_state.last_gemini_feedback_display_parsed = None
@@ -1121,6 +4638,8 @@ else: # Usuário logado
                         st.info("Você está no último cartão difícil.")
             with nav_col4_d:
                 if st.button("Último", key="last_card_btn_difficult"):
+                    if pratica_difficult is not None:
+                        carregar_todas_paginas_pratica(pratica_difficult)
                     st.session_state.current_card_index_difficult = len(filtered_cards_difficult) - 1
                     st.session_state.show_expected_answer = False
                     st.session_state.last_gemini_feedback_display_parsed = None
@@ -1146,14 +4665,40 @@ else: # Usuário logado
                         st.error(f"O nome de usuário '{ADMIN_USERNAME}' é reservado.")
                     elif new_username.strip() in users_data:
                         st.error(f"O nome de usuário '{new_username.strip()}' já existe.")
-                    else:
-                        users_data[new_username.strip()] = hash_password(new_password.strip())
-                        salvar_usuarios(users_data)
+                    elif criar_usuario(new_username.strip(), hash_password(new_password.strip())):
                         st.success(f"Usuário '{new_username.strip()}' criado com sucesso!")
                         st.rerun()
                 else:
                     st.error("Preencha todos os campos, as senhas devem coincidir e não podem ser vazias.")
 
+        st.subheader("Criar Contas em Lote (CSV)")
+        st.write("Envie um arquivo CSV com as colunas **usuario** e **senha** (separadas por vírgula ou ponto e vírgula).")
+        with st.form("bulk_create_users_form"):
+            arquivo_csv = st.file_uploader("Arquivo CSV:", type=["csv"], key="bulk_users_csv")
+            if st.form_submit_button("Criar Contas"):
+                if arquivo_csv is None:
+                    st.error("Selecione um arquivo CSV.")
+                else:
+                    try:
+                        linhas_csv = ler_csv_usuarios(arquivo_csv.getvalue())
+                    except (UnicodeDecodeError, csv.Error) as e:
+                        st.error(f"Não foi possível ler o CSV: {e}")
+                        linhas_csv = []
+                    if linhas_csv:
+                        with st.spinner(f"Criando {len(linhas_csv)} contas..."):
+                            st.session_state.bulk_users_report = provisionar_usuarios_em_lote(linhas_csv)
+
+        if st.session_state.get("bulk_users_report"):
+            relatorio_lote = st.session_state.bulk_users_report
+            total_criados = sum(1 for item in relatorio_lote if item["resultado"] == "Criado")
+            st.success(f"{total_criados} de {len(relatorio_lote)} linhas resultaram em novas contas.")
+            st.dataframe(relatorio_lote, use_container_width=True)
+            saida_csv = io.StringIO()
+            escritor = csv.DictWriter(saida_csv, fieldnames=["linha", "usuario", "resultado"])
+            escritor.writeheader()
+            escritor.writerows(relatorio_lote)
+            st.download_button("Baixar Relatório", saida_csv.getvalue(), file_name="relatorio_usuarios.csv", mime="text/csv")
+
         st.subheader("Alterar Senha ou Excluir Usuário Existente")
         # Mostra a lista de usuários para gerenciar, excluindo o próprio admin
         users_list_for_manage = [u for u in users_data.keys() if u != ADMIN_USERNAME]
@@ -1170,10 +4715,9 @@ else: # Usuário logado
                     confirm_pass_change = st.text_input("Confirme Nova Senha:", type="password", key=f"confirm_pass_change_{selected_user}")
                     if st.form_submit_button("Alterar Senha"):
                         if new_pass_change.strip() and new_pass_change == confirm_pass_change:
-                            users_data[selected_user] = hash_password(new_pass_change.strip())
-                            salvar_usuarios(users_data)
-                            st.success(f"Senha do usuário '{selected_user}' alterada com sucesso!")
-                            st.rerun()
+                            if atualizar_senha_usuario(selected_user, hash_password(new_pass_change.strip())):
+                                st.success(f"Senha do usuário '{selected_user}' alterada com sucesso!")
+                                st.rerun()
                         else:
                             st.error("As senhas não coincidem ou estão vazias.")
                 
@@ -1183,8 +4727,7 @@ else: # Usuário logado
                     st.warning(f"Tem certeza que deseja excluir o usuário '{selected_user}'? Essa ação é irreversível e excluirá todos os seus cartões e histórico!", icon="⚠️")
                     confirm_delete = st.button("Confirmar Exclusão (irreversível)", key=f"confirm_delete_user_{selected_user}")
                     if confirm_delete:
-                        del users_data[selected_user]
-                        salvar_usuarios(users_data)
+                        excluir_usuario(selected_user)
                         
                         # Excluir a pasta de dados do usuário
                         user_data_path_to_delete = get_user_data_path(selected_user)
@@ -1197,6 +4740,405 @@ else: # Usuário logado
         else:
             st.info("Nenhum usuário registrado além do administrador.")
 
+        st.subheader("Retenção do Histórico")
+        st.write("Entradas mais antigas que a janela são resumidas por pergunta, arquivadas no Firestore (feedback_archive) e removidas do histórico recente.")
+        with st.form("compact_history_form"):
+            janela_compactacao = st.number_input("Manter no histórico recente (dias):", min_value=1, value=HISTORICO_JANELA_DIAS, step=1)
+            alvo_compactacao = st.selectbox("Usuário:", ["Todos"] + sorted(users_data.keys()), key="compact_history_user")
+            if st.form_submit_button("Compactar Histórico"):
+                usuarios_compactacao = sorted(users_data.keys()) if alvo_compactacao == "Todos" else [alvo_compactacao]
+                with st.spinner("Compactando histórico..."):
+                    for usuario_compactacao in usuarios_compactacao:
+                        try:
+                            total_compactado, lotes_compactados = compactar_historico_usuario(usuario_compactacao, int(janela_compactacao))
+                        except Exception as e:
+                            st.error(f"Erro ao compactar o histórico de '{usuario_compactacao}': {e}")
+                            continue
+                        if total_compactado:
+                            st.write(f"**{usuario_compactacao}**: {total_compactado} entradas compactadas ({lotes_compactados} lote(s) arquivado(s)).")
+                st.success("Compactação concluída.")
+
+        st.subheader("Backup e Restauração")
+        st.write("Exporta cartões, histórico, resumos, arquivo e dicionários de compressão para .jsonl.gz em páginas (sem carregar tudo na memória). "
+                 "O incremental leva apenas o que mudou desde o último backup do mesmo escopo; exclusões não entram nele.")
+        with st.form("backup_form"):
+            alvo_backup = st.selectbox("Usuário:", ["Todos"] + sorted(users_data.keys()), key="backup_user")
+            backup_incremental = st.checkbox("Incremental (desde o último backup deste usuário/escopo)")
+            if st.form_submit_button("Gerar Backup"):
+                escopo_backup = "todos" if alvo_backup == "Todos" else alvo_backup
+                desde_backup = None
+                if backup_incremental:
+                    anterior_backup = ultimo_backup(escopo_backup)
+                    if anterior_backup is None:
+                        st.warning("Nenhum backup anterior deste escopo; gerando backup completo.")
+                    else:
+                        desde_backup = backup_firestore.marca_do_backup(anterior_backup)
+                caminho_backup = caminho_novo_backup(escopo_backup, desde_backup is not None)
+                try:
+                    with st.spinner("Gerando backup..."):
+                        resultado_backup = backup_firestore.exportar_backup(
+                            db, caminho_backup, None if alvo_backup == "Todos" else [alvo_backup], desde_backup)
+                    st.session_state.ultimo_backup_gerado = caminho_backup
+                    st.success(f"Backup gravado em `{caminho_backup}`: {sum(resultado_backup['contagens'].values())} documentos.")
+                except Exception as e:
+                    st.error(f"Erro ao gerar backup: {e}")
+
+        if st.session_state.get("ultimo_backup_gerado") and os.path.exists(st.session_state.ultimo_backup_gerado):
+            st.download_button("Baixar último backup", data=leitor_arquivo_backup(st.session_state.ultimo_backup_gerado),
+                               file_name=os.path.basename(st.session_state.ultimo_backup_gerado), mime="application/gzip")
+
+        with st.form("restore_form"):
+            arquivo_restauracao = st.file_uploader("Arquivo de backup (.jsonl.gz):", type=["gz"])
+            if st.form_submit_button("Restaurar Backup"):
+                if arquivo_restauracao is None:
+                    st.warning("Selecione um arquivo de backup.")
+                else:
+                    # O upload é salvo com nome derivado do conteúdo: reenviar o mesmo arquivo após uma falha retoma do checkpoint
+                    conteudo_restauracao = arquivo_restauracao.getvalue()
+                    os.makedirs(BACKUP_DIR, exist_ok=True)
+                    caminho_restauracao = os.path.join(BACKUP_DIR, f"restauracao_{hashlib.sha256(conteudo_restauracao).hexdigest()[:16]}.jsonl.gz")
+                    if not os.path.exists(caminho_restauracao):
+                        with open(caminho_restauracao, "wb") as destino_restauracao:
+                            destino_restauracao.write(conteudo_restauracao)
+                    try:
+                        with st.spinner("Restaurando backup..."):
+                            resultado_restauracao = backup_firestore.restaurar_backup(
+                                db, caminho_restauracao, caminho_checkpoint=backup_firestore.caminho_checkpoint_padrao(caminho_restauracao))
+                        invalidar_caches_restaurados(resultado_restauracao["usuarios"])
+                        if resultado_restauracao["retomado_da_linha"]:
+                            st.info(f"Restauração retomada a partir da linha {resultado_restauracao['retomado_da_linha']}.")
+                        st.success(f"{resultado_restauracao['documentos']} documentos restaurados para: {', '.join(resultado_restauracao['usuarios']) or 'nenhum usuário'}.")
+                    except Exception as e:
+                        st.error(f"Erro ao restaurar backup (envie o mesmo arquivo novamente para continuar de onde parou): {e}")
+
+        st.subheader("Armazenamento Compacto dos Textos")
+        st.write(f"Novas gravações no formato compacto: **{'ligado' if ARMAZENAMENTO_COMPACTO else 'desligado'}** (variável ARMAZENAMENTO_COMPACTO). "
+                 f"Respostas esperadas e lacunas a partir de {TEXTO_COMPACTAR_MIN_BYTES} bytes são comprimidas com um dicionário treinado "
+                 "com os textos atuais, e o histórico de cartões próprios guarda só a referência ao cartão. Os dois formatos são lidos normalmente.")
+        if st.button("Treinar Dicionário de Compressão", key="train_dictionary_btn"):
+            try:
+                with st.spinner("Lendo textos e treinando o dicionário..."):
+                    dicionario_treinado = treinar_e_salvar(db)
+                compressor_textos.clear()
+                taxa_dicionario = dicionario_treinado["taxa_estimada"]
+                st.success(f"Dicionário {dicionario_treinado['id']} ({dicionario_treinado['codec']}, {dicionario_treinado['tamanho']} bytes) "
+                           f"treinado com {dicionario_treinado['amostras']} textos"
+                           + (f"; textos longos ficam com ~{taxa_dicionario:.0%} do tamanho." if taxa_dicionario is not None else "."))
+            except Exception as e:
+                st.error(f"Erro ao treinar o dicionário: {e}")
+        with st.form("compact_storage_form"):
+            alvo_migracao = st.selectbox("Usuário:", ["Todos"] + sorted(users_data.keys()), key="compact_storage_user")
+            simular_migracao = st.checkbox("Só simular (calcula os tamanhos sem gravar)", value=True)
+            reverter_migracao = st.checkbox("Voltar ao formato completo")
+            if st.form_submit_button("Migrar Dados Existentes"):
+                try:
+                    with st.spinner("Migrando cartões e histórico..."):
+                        st.session_state.migracao_compacta = migrar(db, None if alvo_migracao == "Todos" else [alvo_migracao],
+                                                                    compactar=not reverter_migracao, simular=simular_migracao)
+                except Exception as e:
+                    st.error(f"Erro na migração: {e}")
+        migracao = st.session_state.get("migracao_compacta")
+        if migracao:
+            total_migracao = migracao["total"]
+            col_mig_1, col_mig_2, col_mig_3 = st.columns(3)
+            col_mig_1.metric("Antes", f"{total_migracao['bytes_antes'] / 1024:.1f} KB")
+            col_mig_2.metric("Depois", f"{total_migracao['bytes_depois'] / 1024:.1f} KB")
+            col_mig_3.metric("Economia", f"{total_migracao['bytes_economizados'] / 1024:.1f} KB",
+                             f"{100 * total_migracao['bytes_economizados'] / total_migracao['bytes_antes']:.0f}%" if total_migracao["bytes_antes"] else None)
+            st.caption(("Simulação: nada foi gravado. " if migracao["simulado"] else "")
+                       + f"{total_migracao['cartoes']} cartões e {total_migracao['entradas']} entradas do histórico "
+                       + ("a converter." if migracao["simulado"] else "convertidos.")
+                       + " Tamanhos estimados pelas regras de armazenamento do Firestore (cartões e histórico recente).")
+            st.dataframe(pd.DataFrame(migracao["usuarios"]).rename(columns={
+                "usuario": "Usuário", "cartoes": "Cartões alterados", "entradas": "Entradas alteradas",
+                "bytes_antes": "Bytes antes", "bytes_depois": "Bytes depois"}), hide_index=True)
+
+        st.subheader("Prática por Consulta no Servidor")
+        st.write(f"Prática por consulta: **{'ligada' if PRATICA_POR_CONSULTA else 'desligada'}** (variável PRATICA_POR_CONSULTA). "
+                 f"As abas de prática filtram e ordenam no Firestore e leem {PRATICA_PAGINA} cartões por vez, usando a última nota e o "
+                 "horário da última resposta gravados em cada cartão. Preencha esses campos antes de ligar o modo e depois de recorreções; "
+                 "os índices compostos necessários estão em firestore.indexes.json.")
+        with st.form("practice_fields_form"):
+            alvo_pratica = st.selectbox("Usuário:", ["Todos"] + sorted(users_data.keys()), key="practice_fields_user")
+            if st.form_submit_button("Preencher Campos de Prática"):
+                try:
+                    with st.spinner("Calculando as últimas notas a partir do histórico..."):
+                        atualizados_pratica = sum(preencher_campos_pratica(usuario) for usuario in
+                                                  (sorted(users_data.keys()) if alvo_pratica == "Todos" else [alvo_pratica]))
+                    st.success(f"{atualizados_pratica} cartões atualizados.")
+                except Exception as e:
+                    st.error(f"Erro ao preencher os campos de prática: {e}")
+
+        st.subheader("Recorreção em Lote")
+        st.write(f"Corrige de novo respostas já armazenadas, em segundo plano ({RECORRECAO_WORKERS} em paralelo, até {RECORRECAO_RPM} chamadas/min). "
+                 "Útil depois de editar a resposta esperada de um cartão ou de mudar o prompt. Respostas anteriores a esta versão não foram guardadas.")
+        with st.form("regrade_job_form"):
+            alvo_recorrecao = st.selectbox("Usuário:", ["Todos"] + sorted(users_data.keys()), key="regrade_user")
+            materia_recorrecao = st.text_input("Matéria (opcional):", key="regrade_materia").strip()
+            apenas_desatualizadas = st.checkbox("Apenas respostas corrigidas com outra resposta esperada ou outro prompt", value=True)
+            if st.form_submit_button("Criar e Iniciar Job"):
+                usuarios_recorrecao = sorted(users_data.keys()) if alvo_recorrecao == "Todos" else [alvo_recorrecao]
+                try:
+                    with st.spinner("Montando a fila de recorreção..."):
+                        job_id, total_fila = criar_job_recorrecao(usuarios_recorrecao, materia_recorrecao or None, apenas_desatualizadas)
+                    if total_fila:
+                        iniciar_job_recorrecao(job_id)
+                        st.success(f"Job '{job_id}' iniciado com {total_fila} respostas na fila.")
+                    else:
+                        st.info("Nenhuma resposta armazenada corresponde aos filtros.")
+                except Exception as e:
+                    st.error(f"Erro ao criar o job de recorreção: {e}")
+
+        for job in listar_jobs_recorrecao():
+            em_execucao = job_recorrecao_em_execucao(job["id"])
+            processados = job.get("concluidos", 0) + job.get("falhas", 0)
+            status_job = "executando" if em_execucao else job.get("status")
+            if status_job == "executando" and not em_execucao:
+                status_job = "interrompido" # O processo que executava o job foi reiniciado
+            col_job_1, col_job_2 = st.columns([4, 1])
+            with col_job_1:
+                st.progress(processados / job["total"] if job.get("total") else 1.0,
+                            text=f"{job['criado_em'][:16]} · {', '.join(job.get('usuarios', []))}"
+                                 f"{' · ' + job['materia'] if job.get('materia') else ''} · {status_job}: "
+                                 f"{job.get('concluidos', 0)} corrigidas, {job.get('falhas', 0)} falhas de {job.get('total', 0)}")
+                if job.get("erro"):
+                    st.caption(f"Último erro: {job['erro']}")
+            with col_job_2:
+                if em_execucao:
+                    if st.button("Pausar", key=f"pause_regrade_{job['id']}"):
+                        pausar_job_recorrecao(job["id"])
+                        st.rerun()
+                elif job.get("status") != "concluido":
+                    if st.button("Retomar", key=f"resume_regrade_{job['id']}"):
+                        iniciar_job_recorrecao(job["id"])
+                        st.rerun()
+
+        st.subheader("Baralhos Compartilhados")
+        st.write("Publica os cartões de um usuário como baralho somente leitura, gravado uma única vez e assinado por vários usuários. "
+                 "Republicar um baralho existente o substitui pela versão atual dos cartões de origem.")
+        baralhos_publicados = listar_baralhos_compartilhados()
+        opcoes_baralhos = {b["id"]: f"{b.get('nome', b['id'])} ({b.get('total_cartoes', 0)} cartões, versão {b.get('versao', 0)})"
+                           for b in baralhos_publicados}
+        with st.form("publish_shared_deck_form"):
+            destino_publicacao = st.selectbox("Baralho:", ["Novo baralho"] + list(opcoes_baralhos),
+                                              format_func=lambda deck_id: opcoes_baralhos.get(deck_id, deck_id))
+            nome_publicacao = st.text_input("Nome (para um baralho novo ou para renomear):").strip()
+            origem_publicacao = st.selectbox("Cartões de origem (usuário):", sorted(users_data.keys()), key="shared_deck_source_user")
+            materia_publicacao = st.text_input("Somente a matéria (opcional):", key="shared_deck_source_materia").strip()
+            if st.form_submit_button("Publicar"):
+                novo_baralho = destino_publicacao == "Novo baralho"
+                cartoes_publicacao = [c for c in obter_baralho_proprio(origem_publicacao).cartoes
+                                      if not materia_publicacao or c.materia == materia_publicacao]
+                if novo_baralho and not nome_publicacao:
+                    st.warning("Informe o nome do novo baralho.")
+                elif not cartoes_publicacao:
+                    st.warning("O usuário de origem não tem cartões com esse filtro.")
+                else:
+                    try:
+                        with st.spinner("Publicando baralho..."):
+                            deck_publicado, total_publicado = publicar_baralho_compartilhado(
+                                nome_publicacao or next(b.get("nome", b["id"]) for b in baralhos_publicados if b["id"] == destino_publicacao),
+                                cartoes_publicacao, None if novo_baralho else destino_publicacao)
+                        st.success(f"Baralho '{deck_publicado}' publicado com {total_publicado} cartões.")
+                    except Exception as e:
+                        st.error(f"Erro ao publicar o baralho: {e}")
+
+        if opcoes_baralhos:
+            with st.form("assign_shared_deck_form"):
+                baralho_atribuicao = st.selectbox("Baralho:", list(opcoes_baralhos), format_func=opcoes_baralhos.get)
+                usuarios_atribuicao = st.multiselect("Usuários:", sorted(u for u in users_data if u != ADMIN_USERNAME))
+                todos_atribuicao = st.checkbox("Todos os usuários")
+                remover_copias = st.checkbox("Excluir as cópias pessoais idênticas (mesma pergunta, matéria e assunto); o histórico é mantido")
+                col_atrib_1, col_atrib_2 = st.columns(2)
+                with col_atrib_1:
+                    assinar_atribuicao = st.form_submit_button("Assinar")
+                with col_atrib_2:
+                    cancelar_atribuicao = st.form_submit_button("Cancelar Assinatura")
+                if assinar_atribuicao or cancelar_atribuicao:
+                    alvos_atribuicao = sorted(u for u in users_data if u != ADMIN_USERNAME) if todos_atribuicao else usuarios_atribuicao
+                    copias_removidas = 0
+                    try:
+                        with st.spinner("Atualizando assinaturas..."):
+                            for usuario_atribuicao in alvos_atribuicao:
+                                alterar_assinatura(usuario_atribuicao, baralho_atribuicao, assinar=assinar_atribuicao)
+                                if assinar_atribuicao and remover_copias:
+                                    copias_removidas += remover_copias_pessoais(usuario_atribuicao, baralho_atribuicao)
+                        st.success(f"Assinaturas atualizadas para {len(alvos_atribuicao)} usuários"
+                                   f"{f'; {copias_removidas} cópias pessoais excluídas' if copias_removidas else ''}.")
+                    except Exception as e:
+                        st.error(f"Erro ao atualizar as assinaturas: {e}")
+
+        st.subheader("Perguntas Quase Duplicadas")
+        st.write(f"Procura, no baralho de um usuário, perguntas com similaridade estimada de pelo menos {DUPLICATAS_LIMIAR:.0%} "
+                 "(MinHash/LSH). Ao mesclar, o cartão escolhido fica e o histórico dos demais passa para ele.")
+        col_dup_1, col_dup_2 = st.columns([3, 1])
+        with col_dup_1:
+            alvo_duplicatas = st.selectbox("Usuário:", sorted(users_data.keys()), key="duplicates_user")
+        with col_dup_2:
+            if st.button("Procurar Duplicatas", key="find_duplicates_btn") and alvo_duplicatas:
+                with st.spinner("Indexando perguntas..."):
+                    st.session_state.relatorio_duplicatas = {
+                        "username": alvo_duplicatas,
+                        "grupos": [[cartao.doc_id for cartao in grupo] for grupo in grupos_duplicatas(alvo_duplicatas)],
+                    }
+
+        relatorio_duplicatas = st.session_state.get("relatorio_duplicatas")
+        if relatorio_duplicatas and relatorio_duplicatas["username"] == alvo_duplicatas:
+            baralho_duplicatas = obter_baralho(alvo_duplicatas)
+            grupos_atuais = [[baralho_duplicatas.cartoes[baralho_duplicatas.posicao(doc_id)] for doc_id in grupo
+                              if baralho_duplicatas.posicao(doc_id) is not None] for grupo in relatorio_duplicatas["grupos"]]
+            grupos_atuais = [grupo for grupo in grupos_atuais if len(grupo) > 1]
+            if not grupos_atuais:
+                st.info("Nenhuma pergunta quase duplicada encontrada.")
+            for n_grupo, grupo in enumerate(grupos_atuais, start=1):
+                with st.expander(f"Grupo {n_grupo}: {len(grupo)} cartões · {grupo[0]['pergunta'][:60]}..."):
+                    manter_doc_id = st.radio(
+                        "Cartão a manter:", [cartao.doc_id for cartao in grupo], key=f"dup_keep_{grupo[0].doc_id}",
+                        format_func=lambda doc_id: (lambda c: f"{c['materia']} - {c['assunto']}: {c['pergunta'][:100]}")(
+                            baralho_duplicatas.cartoes[baralho_duplicatas.posicao(doc_id)]))
+                    if st.button("Mesclar", key=f"merge_dup_{grupo[0].doc_id}"):
+                        try:
+                            excluidos, movidas = mesclar_cartoes_duplicados(alvo_duplicatas, manter_doc_id, [c.doc_id for c in grupo])
+                            if alvo_duplicatas == st.session_state.logged_in_user:
+                                st.session_state.feedback_history = carregar_historico_feedback(alvo_duplicatas)
+                                st.session_state.historico_resumos = carregar_resumos_historico(alvo_duplicatas)
+                                atualizar_indices_sessao(alvo_duplicatas)
+                            st.success(f"{excluidos} cartões mesclados; {movidas} entradas de histórico movidas.")
+                        except Exception as e:
+                            st.error(f"Erro ao mesclar os cartões: {e}")
+
+        st.subheader("Análise da Turma")
+        st.write("Cartões e assuntos mais difíceis, alunos ativos e distribuição de notas de todos os usuários, "
+                 "a partir dos agregados atualizados a cada resposta (sem ler o histórico de cada aluno).")
+        col_turma_1, col_turma_2 = st.columns([3, 1])
+        with col_turma_1:
+            carregar_turma = st.button("Carregar Análise", key="load_cohort_btn")
+        with col_turma_2:
+            if st.button("Recalcular do Histórico", key="rebuild_cohort_btn"):
+                try:
+                    with st.spinner("Somando o histórico de todos os usuários..."):
+                        total_recalculado = recalcular_agregados_turma()
+                    st.success(f"Agregados recalculados a partir de {total_recalculado} respostas.")
+                    carregar_turma = True
+                except Exception as e:
+                    st.error(f"Erro ao recalcular os agregados da turma: {e}")
+        if carregar_turma:
+            try:
+                st.session_state.analise_turma = obter_analise_turma()
+            except Exception as e:
+                st.error(f"Erro ao carregar a análise da turma: {e}")
+        analise_turma = st.session_state.get("analise_turma")
+        if analise_turma is not None:
+            col_turma_a, col_turma_b, col_turma_c, col_turma_d = st.columns(4)
+            col_turma_a.metric("Respostas", analise_turma["total_respostas"])
+            col_turma_b.metric("Nota média", analise_turma["media_geral"])
+            col_turma_c.metric("Ativos (7 dias)", analise_turma["ativos_7_dias"])
+            col_turma_d.metric("Ativos (30 dias)", f"{analise_turma['ativos_30_dias']}/{analise_turma['alunos_com_respostas']}")
+            if not analise_turma["total_respostas"]:
+                st.info("Nenhuma resposta agregada ainda. Use \"Recalcular do Histórico\" para incluir respostas antigas.")
+            else:
+                st.markdown(f"**Cartões mais difíceis** (mínimo de {ANALISE_TURMA_MIN_TENTATIVAS} notas):")
+                st.dataframe(pd.DataFrame(analise_turma["cartoes_dificeis"]))
+                st.markdown("**Assuntos por nota média:**")
+                st.dataframe(pd.DataFrame(analise_turma["assuntos"]))
+                st.markdown("**Distribuição das notas:**")
+                st.bar_chart(pd.DataFrame({"respostas": analise_turma["faixas"]},
+                                          index=[f"{i * 10}-{i * 10 + 9 if i < AGREGADOS_FAIXAS - 1 else 100}" for i in range(AGREGADOS_FAIXAS)]))
+                if analise_turma["atividade"]:
+                    st.markdown("**Respostas por dia (30 dias):**")
+                    st.line_chart(pd.DataFrame(analise_turma["atividade"]).set_index("dia"))
+
+        st.subheader("Desempenho dos Modelos do Gemini")
+        st.write("Latência e distribuição de notas por modelo desde o início deste processo, para ajustar as rotas (GEMINI_ROTAS_MODELOS).")
+        st.json(ROTAS_MODELOS, expanded=False)
+        estatisticas_modelos = resumo_estatisticas_modelos()
+        if estatisticas_modelos:
+            st.dataframe(estatisticas_modelos)
+        else:
+            st.info("Nenhuma correção registrada ainda neste processo.")
+
+        st.subheader("Consumo do Gemini (Tokens e Custo)")
+        st.write("Tokens, custo estimado e latência das correções, por usuário e matéria. "
+                 f"Cotas padrão: {COTA_DIARIA_TOKENS_USUARIO or 'sem limite de'} tokens e "
+                 f"{COTA_DIARIA_CORRECOES_USUARIO or 'sem limite de'} correções por usuário/dia; "
+                 f"global: {f'US$ {COTA_DIARIA_CUSTO_GLOBAL_USD:.2f}' if COTA_DIARIA_CUSTO_GLOBAL_USD else 'sem limite'} por dia.")
+        col_consumo_1, col_consumo_2 = st.columns([3, 1])
+        with col_consumo_1:
+            dias_consumo = st.number_input("Últimos dias:", min_value=1, max_value=90, value=7, step=1, key="usage_days")
+        with col_consumo_2:
+            if st.button("Carregar Consumo", key="load_usage_btn"):
+                try:
+                    st.session_state.relatorio_consumo = relatorio_consumo(int(dias_consumo))
+                except Exception as e:
+                    st.error(f"Erro ao carregar o consumo: {e}")
+        tabela_consumo = st.session_state.get("relatorio_consumo")
+        if tabela_consumo is not None:
+            if tabela_consumo.empty:
+                st.info("Nenhuma correção contabilizada no período.")
+            else:
+                col_total_1, col_total_2, col_total_3 = st.columns(3)
+                col_total_1.metric("Correções", int(tabela_consumo["chamadas"].sum()))
+                col_total_2.metric("Tokens", int(tabela_consumo["tokens_entrada"].sum() + tabela_consumo["tokens_saida"].sum()))
+                col_total_3.metric("Custo estimado", f"US$ {tabela_consumo['custo_usd'].sum():.4f}")
+                for titulo_consumo, coluna_consumo in (("Por usuário", "username"), ("Por matéria", "materia"), ("Por dia", "dia")):
+                    agrupado = tabela_consumo.groupby(coluna_consumo)[list(CAMPOS_CONSUMO)].sum()
+                    agrupado["latencia_media_s"] = (agrupado["latencia_total_s"] / agrupado["chamadas"]).round(2)
+                    st.markdown(f"**{titulo_consumo}:**")
+                    st.dataframe(agrupado.drop(columns="latencia_total_s").sort_values("custo_usd", ascending=False))
+
+        with st.form("usage_quota_form"):
+            st.markdown("**Cotas de um usuário**")
+            alvo_cota = st.selectbox("Usuário:", sorted(u for u in users_data.keys() if u != ADMIN_USERNAME), key="usage_quota_user")
+            usar_cota_padrao = st.checkbox("Usar as cotas padrão", value=True, key="usage_quota_default")
+            cota_tokens_usuario = st.number_input("Tokens por dia (0 = sem limite):", min_value=0, value=0, step=1000, key="usage_quota_tokens")
+            cota_correcoes_usuario = st.number_input("Correções por dia (0 = sem limite):", min_value=0, value=0, step=10, key="usage_quota_gradings")
+            if st.form_submit_button("Salvar Cotas") and alvo_cota:
+                if usar_cota_padrao:
+                    salvo = definir_cotas_usuario(alvo_cota, None, None)
+                else:
+                    salvo = definir_cotas_usuario(alvo_cota, cota_tokens_usuario, cota_correcoes_usuario)
+                if salvo:
+                    st.success(f"Cotas de '{alvo_cota}' atualizadas: {cotas_usuario(alvo_cota)[0] or 'sem limite de'} tokens e "
+                               f"{cotas_usuario(alvo_cota)[1] or 'sem limite de'} correções por dia.")
+
+        st.subheader("Perfil de Desempenho de um Usuário")
+        st.write("Perfila os próximos reruns do usuário, com o baralho e o histórico dele: funções mais demoradas, "
+                 "espera por Firestore e Gemini e elementos enviados ao navegador. Sem pedido ativo, não há custo.")
+        alvo_perfil = st.selectbox("Usuário:", sorted(users_data.keys()), key="profile_user")
+        col_perfil_1, col_perfil_2 = st.columns(2)
+        with col_perfil_1:
+            reruns_perfil = st.number_input("Próximos reruns:", min_value=1, max_value=PERFILADOR_MAX_RERUNS, value=5, step=1, key="profile_reruns")
+        with col_perfil_2:
+            modo_perfil = st.radio("Modo:", list(MODOS_PERFILADOR), format_func=MODOS_PERFILADOR.get, key="profile_mode")
+        pedido_ativo = pedido_perfil(alvo_perfil) if alvo_perfil else None
+        if pedido_ativo:
+            st.info(f"Pedido ativo: {pedido_ativo['restantes']} rerun(s) restante(s) em modo {MODOS_PERFILADOR[pedido_ativo['modo']]}.")
+        col_perfil_3, col_perfil_4, col_perfil_5 = st.columns(3)
+        with col_perfil_3:
+            if st.button("Ativar Perfil", key="profile_start_btn") and alvo_perfil:
+                solicitar_perfil(alvo_perfil, reruns_perfil, modo_perfil)
+                st.success(f"Os próximos {reruns_perfil} reruns de '{alvo_perfil}' serão perfilados.")
+        with col_perfil_4:
+            if st.button("Cancelar Pedido", key="profile_cancel_btn", disabled=not pedido_ativo):
+                cancelar_perfil(alvo_perfil)
+                st.rerun()
+        with col_perfil_5:
+            if st.button("Limpar Relatórios", key="profile_clear_btn") and alvo_perfil:
+                limpar_relatorios_perfil(alvo_perfil)
+
+        relatorios = relatorios_perfil(alvo_perfil) if alvo_perfil else []
+        if relatorios:
+            st.dataframe(pd.DataFrame([{campo: r[campo] for campo in ("inicio", "modo", "duracao_s", "firestore_s", "gemini_s",
+                                                                        "elementos", "amostras", "interrompido")}
+                                       for r in relatorios]))
+            indice_relatorio = st.selectbox("Rerun:", range(len(relatorios)), index=len(relatorios) - 1, key="profile_report_idx",
+                                            format_func=lambda i: f"{relatorios[i]['inicio']} ({relatorios[i]['duracao_s'] or '?'} s)")
+            st.dataframe(pd.DataFrame(relatorios[indice_relatorio]["funcoes"]))
+            st.download_button("Baixar Relatórios (JSON)", json.dumps(relatorios, ensure_ascii=False, indent=2),
+                               file_name=f"perfil_{alvo_perfil}.json", mime="application/json", key="profile_download_btn")
+        elif alvo_perfil:
+            st.caption("Nenhum rerun perfilado para este usuário.")
+
 
     # --- NOVO: Função de Renderização da Aba Alterar Senha ---
     def render_tab_change_password():
@@ -1214,29 +5156,39 @@ else: # Usuário logado
                 
                 if st.form_submit_button("Atualizar Senha"):
                     username = st.session_state.logged_in_user
-                    users_data = carregar_usuarios()
                     
                     if not current_password.strip() or not new_password.strip() or not confirm_new_password.strip():
                         st.error("Por favor, preencha todos os campos.")
                     elif new_password != confirm_new_password:
                         st.error("A nova senha e a confirmação não coincidem.")
-                    elif hash_password(current_password.strip()) != users_data.get(username):
+                    elif hash_password(current_password.strip()) != buscar_hash_senha(username):
                         st.error("Senha atual incorreta.")
                     else:
                         # Hash da nova senha e atualização no Firestore
                         new_hash = hash_password(new_password.strip())
-                        users_data[username] = new_hash
-                        salvar_usuarios(users_data)
+                        if not atualizar_senha_usuario(username, new_hash):
+                            return
                         
                         st.success("Senha alterada com sucesso! Você será desconectado para que possa fazer login novamente com a nova senha.")
                         
                         # Força o logout após a alteração bem-sucedida por segurança
+                        if FIRESTORE_LISTENERS:
+                            liberar_listeners(username, obter_id_sessao())
+                        descartar_sessao_persistente()
                         st.session_state.logged_in_user = None
                         st.session_state.feedback_history = []
-                        st.session_state.user_cartoes = []
+                        for chave_pendente in list(st.session_state.correcoes_pendentes):
+                            cancelar_correcao(chave_pendente)
+                        st.session_state.feedbacks_por_cartao = {}
+                        st.session_state.nonces_submissao = {}
+                        st.session_state.rascunhos = None
+                        st.session_state.caixas_resposta = {}
+                        st.session_state.historico_resumos = []
+                        st.session_state.baralho_versao = None
+                        st.session_state.ordered_cards_for_session = array("I")
+                        st.session_state.difficult_cards_for_session = array("I")
                         st.session_state.current_card_index = 0
                         st.session_state.last_gemini_feedback_display_parsed = None
-                        st.session_state.is_editing_card = False
                         st.rerun()
     
     # --- Fim da Função de Renderização da Aba Alterar Senha ---
@@ -1255,4 +5207,4 @@ else: # Usuário logado
     elif selected_tab == "Gerenciar Usuários" and st.session_state.logged_in_user == ADMIN_USERNAME:
         render_tab_manage_users()
 
-
+    concluir_perfil_rerun(perfil_rerun)
@@ -0,0 +1,393 @@
+"""
+Formato compacto (opcional) dos textos longos de cartões e histórico no Firestore.
+
+Respostas esperadas de peças jurídicas passam de alguns KB, e cada entrada do histórico copiava a
+pergunta inteira do cartão. No formato compacto (ARMAZENAMENTO_COMPACTO=1 no app):
+
+- campos de texto a partir de TEXTO_MINIMO_BYTES são gravados comprimidos em '<campo>_z' (bytes), no
+  lugar do original. A compressão usa um dicionário treinado com os próprios textos: o vocabulário
+  jurídico se repete entre cartões, e é o dicionário que torna a compressão útil em textos de poucos KB;
+- entradas do histórico de cartões próprios guardam só o cartao_id, sem a cópia da pergunta.
+
+A pergunta dos cartões continua em texto: ela é a chave do cartão (card_id) e é lida por todas as abas.
+
+O valor comprimido começa por 5 bytes: o codec (1 = zlib, 2 = zstd) e o ID do dicionário (0 = nenhum).
+O pacote 'zstandard' está em requirements.txt e o zstd é o codec de gravação. Numa instalação sem ele,
+grava-se com zlib e um dicionário pré-definido (zdict) montado com os trechos mais frequentes do corpus;
+valores zlib são sempre legíveis, mas valores zstd exigem o pacote. Os dicionários ficam na coleção
+'storage_dictionaries', com o CRC32 do conteúdo como ID, e nunca mudam: um valor gravado com um
+dicionário antigo continua legível depois que outro é treinado.
+
+A migração converte os documentos existentes (ou os devolve ao formato completo) e relata o tamanho
+das coleções antes e depois, estimado pelas regras de tamanho de documento do Firestore:
+
+    python armazenamento_compacto.py treinar
+    python armazenamento_compacto.py migrar --simular
+    python armazenamento_compacto.py migrar --usuario ana
+    python armazenamento_compacto.py migrar --reverter
+"""
+import sys
+import json
+import zlib
+import base64
+import struct
+import argparse
+import datetime
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError: # Instalação sem o requirements.txt completo: grava com zlib e dicionário pré-definido
+    zstandard = None
+
+from google.cloud.firestore import DELETE_FIELD
+
+from backup_firestore import USERS_COLLECTION, FEEDBACK_COLLECTION, RESTAURACAO_LOTE, _commit_com_retentativas, _conectar_firestore
+
+# Mesmos nomes de coleção usados pelo app.py
+CARDS_COLLECTION = "user_cards"
+SHARED_DECK_CARDS_COLLECTION = "cards"
+DICTIONARIES_COLLECTION = "storage_dictionaries"
+
+SUFIXO_COMPACTADO = "_z"
+TEXTO_MINIMO_BYTES = 512 # Abaixo disso o cabeçalho e a troca de campo não compensam
+CAMPOS_CARTAO = ("resposta_esperada",)
+CAMPOS_HISTORICO = ("lacunas_conteudo",)
+PERGUNTA_DESCONHECIDA = "(cartão excluído)" # Entrada por referência cujo cartão não existe mais
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CABECALHO = struct.Struct(">BI") # codec, ID do dicionário
+NIVEL_ZLIB = 9
+NIVEL_ZSTD = 19 # Compressão só na gravação, leitura rápida em qualquer nível
+DICIONARIO_TAMANHO_ZSTD = 64 * 1024
+DICIONARIO_TAMANHO_ZLIB = 32 * 1024 # Janela do deflate: o zdict não aproveita mais que isso
+AMOSTRAS_MAX = 3000 # Documentos lidos por coleção para treinar o dicionário
+AMOSTRAS_AVALIACAO = 200 # Textos usados para estimar a taxa de compressão do dicionário novo
+
+
+# --- COMPRESSÃO ---
+class CompressorTextos:
+    """
+    Comprime com o dicionário atual e descomprime com o dicionário indicado no cabeçalho do valor.
+    'carregar_dicionario(id)' -> (codec, bytes) ou None busca dicionários que este processo ainda não
+    conhece (treinados depois que ele subiu).
+    """
+    def __init__(self, dicionarios=None, atual=None, carregar_dicionario=None):
+        self._dicionarios = dict(dicionarios or {}) # id -> (codec, bytes)
+        self.atual = atual if atual in self._dicionarios else None
+        self._carregar_dicionario = carregar_dicionario
+
+    def _dicionario(self, id_dicionario):
+        dicionario = self._dicionarios.get(id_dicionario)
+        if dicionario is None and self._carregar_dicionario is not None:
+            dicionario = self._carregar_dicionario(id_dicionario)
+            if dicionario is not None:
+                self._dicionarios[id_dicionario] = dicionario
+        if dicionario is None:
+            raise ValueError(f"Dicionário de compressão {id_dicionario} não encontrado.")
+        return dicionario
+
+    def comprimir(self, texto):
+        codec, dicionario, id_dicionario = (CODEC_ZSTD if zstandard else CODEC_ZLIB), None, 0
+        if self.atual is not None:
+            codec_atual, dicionario_atual = self._dicionarios[self.atual]
+            if codec_atual == CODEC_ZLIB or zstandard is not None:
+                codec, dicionario, id_dicionario = codec_atual, dicionario_atual, self.atual
+        dados = texto.encode("utf-8")
+        if codec == CODEC_ZSTD:
+            corpo = zstandard.ZstdCompressor(
+                level=NIVEL_ZSTD, dict_data=zstandard.ZstdCompressionDict(dicionario) if dicionario else None).compress(dados)
+        else:
+            compressor = zlib.compressobj(NIVEL_ZLIB, zdict=dicionario) if dicionario else zlib.compressobj(NIVEL_ZLIB)
+            corpo = compressor.compress(dados) + compressor.flush()
+        return CABECALHO.pack(codec, id_dicionario) + corpo
+
+    def descomprimir(self, valor):
+        valor = bytes(valor)
+        codec, id_dicionario = CABECALHO.unpack_from(valor)
+        corpo = valor[CABECALHO.size:]
+        dicionario = self._dicionario(id_dicionario)[1] if id_dicionario else None
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("Texto comprimido com zstd, mas o pacote 'zstandard' não está instalado.")
+            dados = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dicionario) if dicionario else None).decompress(corpo)
+        elif codec == CODEC_ZLIB:
+            descompressor = zlib.decompressobj(zdict=dicionario) if dicionario else zlib.decompressobj()
+            dados = descompressor.decompress(corpo) + descompressor.flush()
+        else:
+            raise ValueError(f"Codec de compressão desconhecido: {codec}")
+        return dados.decode("utf-8")
+
+
+def _dicionario_zlib(textos, tamanho=DICIONARIO_TAMANHO_ZLIB):
+    """
+    Dicionário pré-definido do deflate: trechos de 2 a 6 palavras presentes em vários textos, por
+    (textos em que aparece - 1) x tamanho. Distâncias curtas custam menos bits, então os trechos mais
+    úteis ficam no fim do dicionário.
+    """
+    frequencia = Counter()
+    for texto in textos:
+        palavras = texto.split()
+        trechos = set()
+        for n in (2, 3, 4, 6):
+            trechos.update(" ".join(palavras[i:i + n]) for i in range(len(palavras) - n + 1))
+        frequencia.update(trechos)
+    candidatos = sorted(((quantidade - 1) * len(trecho.encode("utf-8")), trecho)
+                        for trecho, quantidade in frequencia.items() if quantidade > 1)
+    escolhidos, acumulado, total = [], "", 0
+    for _, trecho in reversed(candidatos):
+        if total >= tamanho:
+            break
+        if trecho in acumulado: # Já coberto por um trecho maior
+            continue
+        escolhidos.append(trecho)
+        acumulado += "\n" + trecho
+        total += len(trecho.encode("utf-8")) + 1
+    return "\n".join(reversed(escolhidos)).encode("utf-8")[-tamanho:]
+
+def treinar_dicionario(textos):
+    """(codec, dicionário) treinado com os textos de exemplo; zstd se disponível e com amostras suficientes."""
+    if zstandard is not None:
+        try:
+            return CODEC_ZSTD, zstandard.train_dictionary(DICIONARIO_TAMANHO_ZSTD, [t.encode("utf-8") for t in textos]).as_bytes()
+        except zstandard.ZstdError:
+            pass # Poucas amostras para o treino do zstd: usa o dicionário do zlib
+    return CODEC_ZLIB, _dicionario_zlib(textos)
+
+def id_dicionario(codec, dicionario):
+    return zlib.crc32(bytes([codec]) + dicionario) or 1 # 0 indica "sem dicionário" no cabeçalho
+
+
+# --- CAMPOS COMPACTADOS ---
+def compactar_campos(dados, campos, compressor, minimo=TEXTO_MINIMO_BYTES):
+    """Cópia de 'dados' com os campos de texto a partir de 'minimo' bytes trocados por '<campo>_z', se a compressão reduzir."""
+    resultado = dict(dados)
+    for campo in campos:
+        valor = resultado.get(campo)
+        if not isinstance(valor, str) or len(valor.encode("utf-8")) < minimo:
+            continue
+        comprimido = compressor.comprimir(valor)
+        if len(comprimido) < len(valor.encode("utf-8")):
+            del resultado[campo]
+            resultado[campo + SUFIXO_COMPACTADO] = comprimido
+    return resultado
+
+def expandir_campos(dados, compressor):
+    """Troca, no próprio dicionário, os campos '<campo>_z' pelo texto. Aceita o valor em base64 (snapshots em JSON)."""
+    for chave in [c for c in dados if c.endswith(SUFIXO_COMPACTADO)]:
+        valor = dados.pop(chave)
+        if isinstance(valor, str):
+            valor = base64.b64decode(valor)
+        dados[chave[:-len(SUFIXO_COMPACTADO)]] = compressor.descomprimir(valor)
+    return dados
+
+def campos_para_json(dados):
+    """Cópia de 'dados' com os campos '<campo>_z' em base64, para caches que guardam JSON."""
+    return {chave: base64.b64encode(valor).decode("ascii") if chave.endswith(SUFIXO_COMPACTADO) and isinstance(valor, bytes) else valor
+            for chave, valor in dados.items()}
+
+def referencia_propria(cartao_id):
+    """
+    Só entradas de cartões próprios dispensam a pergunta: o app a devolve ao histórico antes de excluir
+    o cartão. Cartões de baralhos compartilhados ("<baralho>:<cartão>") saem sem passar pelos assinantes.
+    """
+    return bool(cartao_id) and ":" not in cartao_id
+
+def formato_entrada_compacta(entrada, compressor, manter_pergunta=False, minimo=TEXTO_MINIMO_BYTES):
+    """Entrada do histórico no formato compacto: sem a cópia da pergunta (cartões próprios) e com os textos longos comprimidos."""
+    entrada = dict(entrada)
+    if not manter_pergunta and referencia_propria(entrada.get("cartao_id")):
+        entrada.pop("pergunta", None)
+    return compactar_campos(entrada, CAMPOS_HISTORICO, compressor, minimo)
+
+def formato_entrada_completa(entrada, compressor, pergunta_do_cartao):
+    """Devolve a entrada (no próprio dicionário) ao formato completo; 'pergunta_do_cartao(doc_id)' resolve as referências."""
+    expandir_campos(entrada, compressor)
+    if "pergunta" not in entrada:
+        entrada["pergunta"] = pergunta_do_cartao(entrada.get("cartao_id")) or PERGUNTA_DESCONHECIDA
+    return entrada
+
+
+# --- DICIONÁRIOS NO FIRESTORE ---
+def salvar_dicionario(db, codec, dicionario, amostras=None):
+    id_dic = id_dicionario(codec, dicionario)
+    db.collection(DICTIONARIES_COLLECTION).document(str(id_dic)).set({
+        "codec": codec,
+        "dados": dicionario,
+        "tamanho": len(dicionario),
+        "amostras": amostras,
+        "criado_em": datetime.datetime.now().isoformat(),
+    })
+    return id_dic
+
+def carregar_compressor(db):
+    """CompressorTextos com os dicionários salvos; o mais recente (utilizável neste processo) comprime."""
+    dicionarios, atual, criado_atual = {}, None, ""
+    for doc in db.collection(DICTIONARIES_COLLECTION).stream():
+        dados = doc.to_dict()
+        dicionarios[int(doc.id)] = (dados["codec"], bytes(dados["dados"]))
+        utilizavel = dados["codec"] == CODEC_ZLIB or zstandard is not None
+        if utilizavel and dados.get("criado_em", "") >= criado_atual:
+            atual, criado_atual = int(doc.id), dados.get("criado_em", "")
+
+    def carregar_dicionario(id_dic):
+        snap = db.collection(DICTIONARIES_COLLECTION).document(str(id_dic)).get()
+        if not snap.exists:
+            return None
+        dados = snap.to_dict()
+        return dados["codec"], bytes(dados["dados"])
+    return CompressorTextos(dicionarios, atual, carregar_dicionario)
+
+def coletar_amostras(db, compressor=None, limite=AMOSTRAS_MAX):
+    """Textos para o treino: respostas esperadas (cartões próprios e compartilhados) e lacunas do histórico."""
+    compressor = compressor or carregar_compressor(db)
+    textos = []
+    for colecao, campos in ((CARDS_COLLECTION, CAMPOS_CARTAO), (SHARED_DECK_CARDS_COLLECTION, CAMPOS_CARTAO),
+                            (FEEDBACK_COLLECTION, CAMPOS_HISTORICO)):
+        for doc in db.collection_group(colecao).limit(limite).stream():
+            dados = expandir_campos(doc.to_dict(), compressor)
+            textos.extend(dados[campo] for campo in campos if isinstance(dados.get(campo), str) and dados[campo].strip())
+    return textos
+
+def treinar_e_salvar(db):
+    """Treina um dicionário com os textos atuais e o torna o dicionário de compressão. Retorna um resumo."""
+    compressor = carregar_compressor(db)
+    textos = coletar_amostras(db, compressor)
+    if not textos:
+        raise ValueError("Não há textos para treinar o dicionário.")
+    codec, dicionario = treinar_dicionario(textos)
+    id_dic = salvar_dicionario(db, codec, dicionario, amostras=len(textos))
+    novo = CompressorTextos({id_dic: (codec, dicionario)}, id_dic)
+    avaliados = [t for t in textos if len(t.encode("utf-8")) >= TEXTO_MINIMO_BYTES][:AMOSTRAS_AVALIACAO]
+    original = sum(len(t.encode("utf-8")) for t in avaliados)
+    return {
+        "id": id_dic,
+        "codec": "zstd" if codec == CODEC_ZSTD else "zlib",
+        "tamanho": len(dicionario),
+        "amostras": len(textos),
+        "taxa_estimada": round(sum(len(novo.comprimir(t)) for t in avaliados) / original, 3) if original else None,
+    }
+
+
+# --- MIGRAÇÃO ---
+def tamanho_armazenado(valor):
+    """Bytes de um valor pelas regras de tamanho de documento do Firestore."""
+    if valor is None or isinstance(valor, bool):
+        return 1
+    if isinstance(valor, (int, float, datetime.datetime)):
+        return 8
+    if isinstance(valor, str):
+        return len(valor.encode("utf-8")) + 1
+    if isinstance(valor, bytes):
+        return len(valor)
+    if isinstance(valor, dict):
+        return sum(len(chave.encode("utf-8")) + 1 + tamanho_armazenado(v) for chave, v in valor.items())
+    if isinstance(valor, (list, tuple)):
+        return sum(tamanho_armazenado(v) for v in valor)
+    return 16
+
+class _EscritorLotes:
+    def __init__(self, db, simular):
+        self._db, self._simular = db, simular
+        self._batch, self._operacoes = db.batch(), 0
+
+    def atualizar(self, referencia, campos):
+        if self._simular:
+            return
+        self._batch.update(referencia, campos)
+        self._operacoes += 1
+        if self._operacoes >= RESTAURACAO_LOTE:
+            self.concluir()
+
+    def concluir(self):
+        if self._operacoes:
+            _commit_com_retentativas(self._batch)
+            self._batch, self._operacoes = self._db.batch(), 0
+
+def _diferenca(antes, depois):
+    """Campos para update(): os alterados e DELETE_FIELD para os que saíram."""
+    campos = {chave: valor for chave, valor in depois.items() if antes.get(chave) != valor}
+    campos.update({chave: DELETE_FIELD for chave in antes if chave not in depois})
+    return campos
+
+def migrar_usuario(db, username, compressor, compactar=True, simular=False):
+    """
+    Converte cartões e histórico recente do usuário para o formato compacto (ou de volta, com
+    compactar=False). Textos já comprimidos com um dicionário mais antigo passam para o atual.
+    Pode ser repetida: documentos já no formato pedido não são regravados. Uma edição do mesmo
+    cartão durante a migração pode ser sobrescrita, então prefira rodá-la fora do horário de uso.
+    """
+    user_ref = db.collection(USERS_COLLECTION).document(username)
+    relatorio = {"usuario": username, "cartoes": 0, "entradas": 0, "bytes_antes": 0, "bytes_depois": 0}
+    escritor = _EscritorLotes(db, simular)
+
+    def registrar(tipo, doc, antes, depois):
+        relatorio["bytes_antes"] += tamanho_armazenado(antes) + 32 # 32: custo fixo por documento
+        relatorio["bytes_depois"] += tamanho_armazenado(depois) + 32
+        campos = _diferenca(antes, depois)
+        if campos:
+            relatorio[tipo] += 1
+            escritor.atualizar(doc.reference, campos)
+
+    perguntas = {}
+    for doc in user_ref.collection(CARDS_COLLECTION).stream():
+        antes = doc.to_dict()
+        completo = expandir_campos(dict(antes), compressor)
+        perguntas[doc.id] = completo.get("pergunta")
+        registrar("cartoes", doc, antes, compactar_campos(completo, CAMPOS_CARTAO, compressor) if compactar else completo)
+
+    for doc in user_ref.collection(FEEDBACK_COLLECTION).stream():
+        antes = doc.to_dict()
+        completo = formato_entrada_completa(dict(antes), compressor, perguntas.get)
+        if compactar:
+            # A cópia só sai se ainda é a pergunta do cartão: entradas de antes de uma edição continuam com o texto antigo
+            depois = formato_entrada_compacta(completo, compressor,
+                                              manter_pergunta=perguntas.get(completo.get("cartao_id")) != completo["pergunta"])
+        else:
+            depois = completo
+        registrar("entradas", doc, antes, depois)
+    escritor.concluir()
+    return relatorio
+
+def migrar(db, usernames=None, compactar=True, simular=False, ao_progredir=None):
+    """Migra os usuários informados (padrão: todos). Retorna os relatórios por usuário e o total."""
+    compressor = carregar_compressor(db)
+    if usernames is None:
+        usernames = [doc.id for doc in db.collection(USERS_COLLECTION).stream()]
+    relatorios = []
+    for username in usernames:
+        relatorios.append(migrar_usuario(db, username, compressor, compactar, simular))
+        if ao_progredir:
+            ao_progredir(relatorios[-1])
+    total = {campo: sum(r[campo] for r in relatorios) for campo in ("cartoes", "entradas", "bytes_antes", "bytes_depois")}
+    total["bytes_economizados"] = total["bytes_antes"] - total["bytes_depois"]
+    return {"simulado": simular, "compactar": compactar, "total": total, "usuarios": relatorios}
+
+
+# --- LINHA DE COMANDO ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Formato compacto dos textos longos no Firestore: dicionário e migração.")
+    parser.add_argument("--credenciais", help="Chave de conta de serviço (padrão: a mesma do backup_firestore.py)")
+    parser.add_argument("--projeto", help="ID do projeto do Google Cloud")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("treinar", help="Treina um dicionário com os textos atuais e passa a comprimir com ele")
+    mig = sub.add_parser("migrar", help="Converte os documentos existentes e relata os bytes economizados")
+    mig.add_argument("--usuario", action="append", help="Migrar só este usuário (pode repetir; padrão: todos)")
+    mig.add_argument("--simular", action="store_true", help="Só calcula os tamanhos, sem gravar")
+    mig.add_argument("--reverter", action="store_true", help="Volta ao formato completo (texto e pergunta copiada)")
+
+    args = parser.parse_args(argv)
+    db = _conectar_firestore(args.credenciais, args.projeto)
+    if args.comando == "treinar":
+        resultado = treinar_e_salvar(db)
+    else:
+        resultado = migrar(db, args.usuario, compactar=not args.reverter, simular=args.simular,
+                           ao_progredir=lambda r: print(f"{r['usuario']}: {r['bytes_antes']} -> {r['bytes_depois']} bytes", file=sys.stderr))
+    print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
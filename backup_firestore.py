@@ -0,0 +1,303 @@
+"""
+Backup e restauração dos dados dos usuários no Firestore, em JSON Lines compactado (gzip).
+
+Os documentos são lidos em páginas e gravados um por linha, então a memória usada não depende do
+tamanho do baralho ou do histórico. Os dicionários de compressão (formato compacto dos textos) vão
+em todo backup, antes dos usuários: sem eles os campos '<campo>_z' restaurados não podem ser lidos. Pode ser usado pelo app (ação de administrador em "Gerenciar
+Usuários") ou pela linha de comando, por exemplo para migrar dados entre projetos:
+
+    python backup_firestore.py exportar --saida data/backups/todos.jsonl.gz
+    python backup_firestore.py exportar --usuario ana --desde-backup data/backups/todos.jsonl.gz --saida ana_incr.jsonl.gz
+    python backup_firestore.py restaurar data/backups/todos.jsonl.gz --credenciais outro_projeto.json
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import base64
+import datetime
+import argparse
+
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+
+# Mesmos nomes de coleção usados pelo app.py
+USERS_COLLECTION = "users"
+SUBCOLECOES_USUARIO = ("user_cards", "feedback_history", "feedback_summaries", "feedback_archive")
+FEEDBACK_COLLECTION = "feedback_history"
+COLECOES_GLOBAIS = ("storage_dictionaries",) # Fora dos usuários, mas necessárias para ler os dados deles
+
+SERVICE_ACCOUNT_KEY_PATH_LOCAL = "gcp_service_account_key.json"
+BACKUP_VERSAO_FORMATO = 1
+BACKUP_PAGINA_LEITURA = 300 # Documentos por consulta (cursores evitam um stream único muito longo)
+RESTAURACAO_LOTE = 400 # Escritas por commit (limite do Firestore: 500)
+RESTAURACAO_TENTATIVAS = 5
+MARGEM_HISTORICO_INCREMENTAL = datetime.timedelta(days=1) # 'timestamp' do histórico é hora local do servidor do app
+ERROS_TRANSITORIOS = (DeadlineExceeded, ResourceExhausted, ServiceUnavailable)
+
+
+# --- SERIALIZAÇÃO ---
+# JSON não tem datas nem bytes; esses valores viram objetos marcados para voltarem ao tipo original na restauração.
+def _codificar(valor):
+    if isinstance(valor, datetime.datetime):
+        return {"$datetime": valor.isoformat()}
+    if isinstance(valor, bytes):
+        return {"$bytes": base64.b64encode(valor).decode("ascii")}
+    raise TypeError(f"Tipo não suportado no backup: {type(valor).__name__}")
+
+def _decodificar(obj):
+    if len(obj) == 1:
+        if "$datetime" in obj:
+            return datetime.datetime.fromisoformat(obj["$datetime"])
+        if "$bytes" in obj:
+            return base64.b64decode(obj["$bytes"])
+    return obj
+
+def _agora_utc():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# --- EXPORTAÇÃO ---
+def _paginar(consulta, pagina=BACKUP_PAGINA_LEITURA):
+    """Percorre a consulta em páginas com start_after, sem manter mais de uma página em memória."""
+    ultimo = None
+    while True:
+        q = consulta.limit(pagina)
+        if ultimo is not None:
+            q = q.start_after(ultimo)
+        docs = list(q.stream())
+        yield from docs
+        if len(docs) < pagina:
+            return
+        ultimo = docs[-1]
+
+def _alterado_desde(doc, desde):
+    atualizado = getattr(doc, "update_time", None)
+    return desde is None or atualizado is None or atualizado >= desde
+
+def _consulta_subcolecao(user_ref, colecao, desde):
+    ref = user_ref.collection(colecao)
+    if desde is not None and colecao == FEEDBACK_COLLECTION:
+        # O histórico só recebe inserções: o filtro no servidor evita reler entradas antigas
+        limite_local = (desde.astimezone() - MARGEM_HISTORICO_INCREMENTAL).replace(tzinfo=None).isoformat()
+        return ref.where("timestamp", ">=", limite_local).order_by("timestamp")
+    return ref.order_by("__name__")
+
+def _usuarios_para_backup(db, usernames):
+    if usernames:
+        for username in usernames:
+            yield db.collection(USERS_COLLECTION).document(username).get()
+    else:
+        yield from _paginar(db.collection(USERS_COLLECTION).order_by("__name__"))
+
+def exportar_backup(db, caminho_saida, usernames=None, desde=None, ao_progredir=None):
+    """
+    Grava os usuários (ou todos, se 'usernames' for vazio) e suas subcoleções em 'caminho_saida'.
+    Com 'desde' (datetime com fuso), só entram documentos alterados a partir dessa marca; exclusões
+    não aparecem em backups incrementais. A primeira linha é um cabeçalho com a marca d'água deste
+    backup (início da exportação), para ser usada como 'desde' no próximo incremental.
+    Retorna o cabeçalho com as contagens por coleção.
+    """
+    cabecalho = {
+        "tipo": "cabecalho",
+        "versao": BACKUP_VERSAO_FORMATO,
+        "marca": _agora_utc().isoformat(),
+        "desde": desde.isoformat() if desde else None,
+        "usuarios": sorted(usernames) if usernames else None,
+    }
+    contagens = {}
+    pasta = os.path.dirname(caminho_saida)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
+    caminho_parcial = caminho_saida + ".parcial"
+    with gzip.open(caminho_parcial, "wt", encoding="utf-8") as arquivo:
+        arquivo.write(json.dumps(cabecalho, ensure_ascii=False) + "\n")
+        for colecao in COLECOES_GLOBAIS:
+            for doc in _paginar(db.collection(colecao).order_by("__name__")):
+                if not _alterado_desde(doc, desde):
+                    continue
+                arquivo.write(json.dumps({"tipo": "global", "colecao": colecao, "doc_id": doc.id, "dados": doc.to_dict()},
+                                         ensure_ascii=False, default=_codificar) + "\n")
+                contagens[colecao] = contagens.get(colecao, 0) + 1
+        for user_snap in _usuarios_para_backup(db, usernames):
+            if not user_snap.exists:
+                continue
+            username = user_snap.id
+            if _alterado_desde(user_snap, desde):
+                arquivo.write(json.dumps({"tipo": "usuario", "username": username, "dados": user_snap.to_dict()},
+                                         ensure_ascii=False, default=_codificar) + "\n")
+                contagens[USERS_COLLECTION] = contagens.get(USERS_COLLECTION, 0) + 1
+            for colecao in SUBCOLECOES_USUARIO:
+                for doc in _paginar(_consulta_subcolecao(user_snap.reference, colecao, desde)):
+                    if not _alterado_desde(doc, desde):
+                        continue
+                    arquivo.write(json.dumps({"tipo": "documento", "username": username, "colecao": colecao,
+                                              "doc_id": doc.id, "dados": doc.to_dict()},
+                                             ensure_ascii=False, default=_codificar) + "\n")
+                    contagens[colecao] = contagens.get(colecao, 0) + 1
+            if ao_progredir:
+                ao_progredir(username, contagens)
+    # Só um backup completo recebe o nome final (um arquivo truncado nunca parece válido)
+    os.replace(caminho_parcial, caminho_saida)
+    return {**cabecalho, "contagens": contagens}
+
+def ler_cabecalho_backup(caminho):
+    with gzip.open(caminho, "rt", encoding="utf-8") as arquivo:
+        cabecalho = json.loads(arquivo.readline())
+    if cabecalho.get("tipo") != "cabecalho":
+        raise ValueError(f"'{caminho}' não é um backup válido (cabeçalho ausente).")
+    return cabecalho
+
+def marca_do_backup(caminho):
+    """Marca d'água de um backup anterior, para usar como 'desde' no próximo backup incremental."""
+    return datetime.datetime.fromisoformat(ler_cabecalho_backup(caminho)["marca"])
+
+
+# --- RESTAURAÇÃO ---
+def caminho_checkpoint_padrao(caminho_backup):
+    return caminho_backup + ".restauracao.json"
+
+def _ler_checkpoint(caminho_checkpoint, marca):
+    """Retorna (linhas já aplicadas, usuários já restaurados)."""
+    if not caminho_checkpoint or not os.path.exists(caminho_checkpoint):
+        return 0, set()
+    with open(caminho_checkpoint, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    # Checkpoint de outro backup (mesmo nome de arquivo, conteúdo diferente) não vale
+    if checkpoint.get("marca") != marca:
+        return 0, set()
+    return checkpoint.get("linhas_aplicadas", 0), set(checkpoint.get("usuarios", []))
+
+def _gravar_checkpoint(caminho_checkpoint, marca, linhas_aplicadas, usuarios):
+    if not caminho_checkpoint:
+        return
+    temporario = caminho_checkpoint + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({"marca": marca, "linhas_aplicadas": linhas_aplicadas, "usuarios": sorted(usuarios),
+                   "atualizado_em": _agora_utc().isoformat()}, f)
+    os.replace(temporario, caminho_checkpoint)
+
+def _commit_com_retentativas(batch):
+    for tentativa in range(RESTAURACAO_TENTATIVAS):
+        try:
+            batch.commit()
+            return
+        except ERROS_TRANSITORIOS:
+            if tentativa == RESTAURACAO_TENTATIVAS - 1:
+                raise
+            time.sleep(min(2 ** tentativa, 30))
+
+def restaurar_backup(db, caminho_backup, usernames=None, caminho_checkpoint=None, ao_progredir=None):
+    """
+    Aplica um backup com set() em lotes. Depois de cada commit o número de linhas já aplicadas vai para
+    o checkpoint; se a restauração falhar, chamar de novo com o mesmo checkpoint continua de onde parou
+    (reaplicar um lote é inofensivo, pois cada documento mantém seu ID). O checkpoint é removido no fim.
+    Retorna {"documentos": n, "usuarios": [...], "retomado_da_linha": n}; 'usuarios' inclui os das execuções anteriores.
+    """
+    cabecalho = ler_cabecalho_backup(caminho_backup)
+    if cabecalho.get("versao") != BACKUP_VERSAO_FORMATO:
+        raise ValueError(f"Versão de backup não suportada: {cabecalho.get('versao')}")
+    filtro = set(usernames) if usernames else None
+    marca = cabecalho["marca"]
+    ja_aplicadas, usuarios = _ler_checkpoint(caminho_checkpoint, marca)
+
+    aplicados = 0
+    batch = db.batch()
+    pendentes = 0
+    numero_linha = 0
+    with gzip.open(caminho_backup, "rt", encoding="utf-8") as arquivo:
+        next(arquivo) # cabeçalho
+        for numero_linha, linha in enumerate(arquivo, start=1):
+            if numero_linha <= ja_aplicadas:
+                continue
+            registro = json.loads(linha, object_hook=_decodificar)
+            if registro["tipo"] == "global":
+                # Sempre restauradas, mesmo com filtro de usuários (os IDs dos dicionários não mudam)
+                batch.set(db.collection(registro["colecao"]).document(registro["doc_id"]), registro["dados"])
+            else:
+                username = registro["username"]
+                if filtro is not None and username not in filtro:
+                    continue
+                user_ref = db.collection(USERS_COLLECTION).document(username)
+                if registro["tipo"] == "usuario":
+                    batch.set(user_ref, registro["dados"])
+                else:
+                    batch.set(user_ref.collection(registro["colecao"]).document(registro["doc_id"]), registro["dados"])
+                usuarios.add(username)
+            pendentes += 1
+            if pendentes >= RESTAURACAO_LOTE:
+                _commit_com_retentativas(batch)
+                aplicados += pendentes
+                _gravar_checkpoint(caminho_checkpoint, marca, numero_linha, usuarios)
+                if ao_progredir:
+                    ao_progredir(aplicados)
+                batch = db.batch()
+                pendentes = 0
+    if pendentes:
+        _commit_com_retentativas(batch)
+        aplicados += pendentes
+        if ao_progredir:
+            ao_progredir(aplicados)
+    if caminho_checkpoint and os.path.exists(caminho_checkpoint):
+        os.remove(caminho_checkpoint)
+    return {"documentos": aplicados, "usuarios": sorted(usuarios), "retomado_da_linha": ja_aplicadas}
+
+
+# --- LINHA DE COMANDO ---
+def _conectar_firestore(caminho_credenciais=None, projeto=None):
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    opcoes = {"projectId": projeto} if projeto else None
+    caminho_credenciais = caminho_credenciais or (SERVICE_ACCOUNT_KEY_PATH_LOCAL if os.path.exists(SERVICE_ACCOUNT_KEY_PATH_LOCAL) else None)
+    if caminho_credenciais:
+        firebase_admin.initialize_app(credentials.Certificate(caminho_credenciais), opcoes)
+    else:
+        firebase_admin.initialize_app(options=opcoes)
+    return firestore.client()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backup e restauração dos dados dos usuários (Firestore <-> JSON Lines gzip).")
+    parser.add_argument("--credenciais", help=f"Chave de conta de serviço (padrão: {SERVICE_ACCOUNT_KEY_PATH_LOCAL}, se existir; senão, credenciais padrão)")
+    parser.add_argument("--projeto", help="ID do projeto do Google Cloud")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    exp = sub.add_parser("exportar", help="Exporta usuários para um arquivo .jsonl.gz")
+    exp.add_argument("--saida", required=True)
+    exp.add_argument("--usuario", action="append", help="Usuário a exportar (pode repetir; padrão: todos)")
+    incremental = exp.add_mutually_exclusive_group()
+    incremental.add_argument("--desde", help="Só documentos alterados a partir desta data/hora ISO (UTC se sem fuso)")
+    incremental.add_argument("--desde-backup", help="Só documentos alterados depois do backup informado")
+
+    rest = sub.add_parser("restaurar", help="Restaura um arquivo .jsonl.gz (retoma do checkpoint, se houver)")
+    rest.add_argument("arquivo")
+    rest.add_argument("--usuario", action="append", help="Restaurar só este usuário (pode repetir)")
+    rest.add_argument("--checkpoint", help="Arquivo de checkpoint (padrão: <arquivo>.restauracao.json)")
+    rest.add_argument("--do-inicio", action="store_true", help="Ignora o checkpoint existente")
+
+    args = parser.parse_args(argv)
+    db = _conectar_firestore(args.credenciais, args.projeto)
+
+    if args.comando == "exportar":
+        desde = None
+        if args.desde_backup:
+            desde = marca_do_backup(args.desde_backup)
+        elif args.desde:
+            desde = datetime.datetime.fromisoformat(args.desde)
+            if desde.tzinfo is None:
+                desde = desde.replace(tzinfo=datetime.timezone.utc)
+        resultado = exportar_backup(db, args.saida, args.usuario, desde,
+                                    ao_progredir=lambda u, c: print(f"{u}: {sum(c.values())} documentos até agora", file=sys.stderr))
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    else:
+        checkpoint = args.checkpoint or caminho_checkpoint_padrao(args.arquivo)
+        if args.do_inicio and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        resultado = restaurar_backup(db, args.arquivo, args.usuario, checkpoint,
+                                     ao_progredir=lambda n: print(f"{n} documentos aplicados", file=sys.stderr))
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
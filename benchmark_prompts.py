@@ -0,0 +1,292 @@
+"""
+Benchmark de variantes do prompt de correção contra correções reais gravadas (fixtures).
+
+As fixtures vêm do próprio app: com GEMINI_FIXTURES_CORRECAO=data/fixtures_correcao.jsonl, cada correção
+feita pelo Gemini é gravada (pergunta, respostas, rubrica, modelo, hash do prompt, feedback, tokens e
+latência). Cada variante é um arquivo de texto com o template do prompt, com os campos {pergunta},
+{titulo_referencia}, {referencia} e {resposta_usuario}; o prompt atual do app entra sempre como 'atual'.
+
+O cliente do modelo é plugável (qualquer objeto com gerar(modelo, prompt) -> dict ou None):
+  replay  (padrão, offline) devolve a resposta gravada para o mesmo (modelo, prompt), das fixtures ou de
+          --gravacoes. Prompts nunca enviados não têm resposta: entram só nos tokens de entrada (estimados
+          pela razão tokens/caracteres das fixtures) e aparecem como "sem gravação".
+  gemini  chama o modelo de verdade (GEMINI_API_KEY) e acrescenta cada resposta em --gravacoes, para que
+          a mesma comparação possa ser repetida depois sem rede e sem custo.
+
+    python benchmark_prompts.py --exportar-template prompts/atual.txt
+    python benchmark_prompts.py data/fixtures_correcao.jsonl --variante curto=prompts/curto.txt
+    python benchmark_prompts.py data/fixtures_correcao.jsonl --variante curto=prompts/curto.txt \\
+        --cliente gemini --gravacoes data/gravacoes_prompts.jsonl --limite 50 --json resultado.json
+
+Relata, por variante: tokens de entrada e saída, latência, taxa de falha do parse_feedback_sections e
+variação da nota em relação à nota gravada na fixture (a correção real).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prompt_correcao import (PROMPT_CORRECAO_TEMPLATE, PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA, GravadorFixtures, carregar_fixtures, extrair_nota_sentido,
+                             hash_prompt, montar_prompt_correcao, parse_feedback_sections, validar_template)
+
+CARACTERES_POR_TOKEN_PADRAO = 4.0 # Estimativa quando as fixtures não trazem tokens
+LIMIAR_VARIACAO_NOTA = 10 # pontos percentuais
+
+
+# --- CLIENTES DO MODELO ---
+class ClienteReplay:
+    """Responde com as gravações de (modelo, hash do prompt); None para prompts nunca enviados."""
+    nome = "replay"
+
+    def __init__(self, fixtures, caminhos_gravacoes=()):
+        self.gravacoes = {}
+        registros = list(fixtures)
+        for caminho in caminhos_gravacoes:
+            if os.path.exists(caminho):
+                registros.extend(carregar_fixtures(caminho))
+        for registro in registros:
+            if registro.get("prompt_sha256") and registro.get("resposta") is not None:
+                self.gravacoes[(registro.get("modelo"), registro["prompt_sha256"])] = registro
+
+    def gerar(self, modelo, prompt):
+        registro = self.gravacoes.get((modelo, hash_prompt(prompt)))
+        if registro is None:
+            return None
+        return {
+            "texto": registro["resposta"],
+            "tokens_entrada": registro.get("tokens_entrada") or 0,
+            "tokens_saida": registro.get("tokens_saida") or 0,
+            "latencia_s": registro.get("latencia_s"),
+        }
+
+
+class ClienteGemini:
+    """Chama o Gemini de verdade, com uma instância de GenerativeModel por modelo."""
+    nome = "gemini"
+
+    def __init__(self, timeout=60):
+        import google.generativeai as genai
+        chave = os.getenv("GEMINI_API_KEY")
+        if not chave:
+            raise SystemExit("Defina GEMINI_API_KEY para usar --cliente gemini.")
+        genai.configure(api_key=chave)
+        self._genai = genai
+        self._modelos = {}
+        self._lock = threading.Lock()
+        self.timeout = timeout
+
+    def _modelo(self, nome_modelo):
+        with self._lock:
+            if nome_modelo not in self._modelos:
+                self._modelos[nome_modelo] = self._genai.GenerativeModel(nome_modelo)
+            return self._modelos[nome_modelo]
+
+    def gerar(self, modelo, prompt):
+        inicio = time.monotonic()
+        response = self._modelo(modelo).generate_content(prompt, request_options={"timeout": self.timeout})
+        latencia = time.monotonic() - inicio
+        uso = getattr(response, "usage_metadata", None)
+        return {
+            "texto": response.text,
+            "tokens_entrada": getattr(uso, "prompt_token_count", 0) or 0,
+            "tokens_saida": getattr(uso, "candidates_token_count", 0) or 0,
+            "latencia_s": latencia,
+        }
+
+
+# --- EXECUÇÃO ---
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def _media(valores):
+    return sum(valores) / len(valores) if valores else None
+
+def caracteres_por_token(fixtures):
+    """Razão caracteres/token observada nas fixtures, para estimar os tokens de prompts sem gravação."""
+    caracteres = sum(f.get("caracteres_prompt") or 0 for f in fixtures if f.get("tokens_entrada"))
+    tokens = sum(f.get("tokens_entrada") or 0 for f in fixtures if f.get("caracteres_prompt"))
+    return caracteres / tokens if caracteres and tokens else CARACTERES_POR_TOKEN_PADRAO
+
+def nota_gravada(fixture):
+    return extrair_nota_sentido(parse_feedback_sections(fixture.get("resposta") or ""))
+
+def falha_de_parse(texto, dispensadas=()):
+    """O feedback não segue a estrutura esperada: erro no parser, seção ausente ou nota ilegível."""
+    parsed = parse_feedback_sections(texto)
+    if "error" in parsed:
+        return True, None
+    nota = extrair_nota_sentido(parsed)
+    return nota is None or any(valor == "Não disponível." for chave, valor in parsed.items() if chave not in dispensadas), nota
+
+def avaliar_variante(nome, template, fixtures, cliente, modelo=None, paralelo=1, gravador=None, fator_caracteres=None):
+    """Envia cada fixture com o template da variante e resume tokens, latência, falhas de parse e variação da nota."""
+    fator_caracteres = fator_caracteres or caracteres_por_token(fixtures)
+    # Um template sem a seção 4 (verificação ortográfica local) não falha por ela estar ausente
+    dispensadas = () if "4. Erros Gramaticais/Ortográficos:" in template else ("grammar_errors",)
+
+    def executar(fixture):
+        prompt, _ = montar_prompt_correcao(fixture["pergunta"], fixture["resposta_usuario"], fixture["resposta_esperada"],
+                                           fixture.get("rubrica"), template=template)
+        nome_modelo = modelo or fixture.get("modelo")
+        try:
+            resultado = cliente.gerar(nome_modelo, prompt)
+        except Exception as e:
+            return {"prompt": prompt, "erro": f"{type(e).__name__}: {e}"}
+        if resultado is not None and gravador is not None:
+            gravador.gravar(fixture["pergunta"], fixture["resposta_usuario"], fixture["resposta_esperada"], fixture.get("rubrica"),
+                            nome_modelo, prompt, resultado["texto"], resultado["tokens_entrada"], resultado["tokens_saida"],
+                            resultado["latencia_s"] or 0.0, versao_prompt=nome)
+        return {"prompt": prompt, "resultado": resultado}
+
+    with ThreadPoolExecutor(max_workers=max(1, paralelo)) as executor:
+        execucoes = list(executor.map(executar, fixtures))
+
+    tokens_entrada, tokens_saida, latencias, variacoes = [], [], [], []
+    sem_gravacao = falhas_chamada = falhas_parse = respondidas = 0
+    tokens_estimados = False
+    for fixture, execucao in zip(fixtures, execucoes):
+        resultado = execucao.get("resultado")
+        if "erro" in execucao:
+            falhas_chamada += 1
+            continue
+        if resultado is None:
+            sem_gravacao += 1
+        if resultado is None or not resultado["tokens_entrada"]:
+            tokens_entrada.append(len(execucao["prompt"]) / fator_caracteres)
+            tokens_estimados = True
+        else:
+            tokens_entrada.append(resultado["tokens_entrada"])
+        if resultado is None:
+            continue
+        respondidas += 1
+        tokens_saida.append(resultado["tokens_saida"])
+        if resultado["latencia_s"] is not None:
+            latencias.append(resultado["latencia_s"])
+        falhou, nota = falha_de_parse(resultado["texto"], dispensadas)
+        falhas_parse += falhou
+        referencia = nota_gravada(fixture)
+        if nota is not None and referencia is not None:
+            variacoes.append(nota - referencia)
+
+    return {
+        "variante": nome,
+        "fixtures": len(fixtures),
+        "respondidas": respondidas,
+        "sem_gravacao": sem_gravacao,
+        "falhas_chamada": falhas_chamada,
+        "exemplos_de_falha": [e["erro"] for e in execucoes if "erro" in e][:3],
+        "tokens_entrada_medio": round(_media(tokens_entrada), 1) if tokens_entrada else None,
+        "tokens_entrada_estimados": tokens_estimados,
+        "tokens_saida_medio": round(_media(tokens_saida), 1) if tokens_saida else None,
+        "latencia_p50_s": round(_percentil(latencias, 50), 3) if latencias else None,
+        "latencia_p90_s": round(_percentil(latencias, 90), 3) if latencias else None,
+        "falha_parse_pct": round(100 * falhas_parse / respondidas, 1) if respondidas else None,
+        "variacao_nota_media_abs": round(_media([abs(v) for v in variacoes]), 2) if variacoes else None,
+        "variacao_nota_vies": round(_media(variacoes), 2) if variacoes else None,
+        f"notas_fora_de_{LIMIAR_VARIACAO_NOTA}_pct": (round(100 * sum(abs(v) > LIMIAR_VARIACAO_NOTA for v in variacoes) / len(variacoes), 1)
+                                                      if variacoes else None),
+    }
+
+def executar_benchmark(fixtures, variantes, cliente, modelo=None, paralelo=1, gravador=None):
+    """'variantes' é uma lista de (nome, template). Retorna um resumo por variante, na mesma ordem."""
+    fator_caracteres = caracteres_por_token(fixtures)
+    return [avaliar_variante(nome, template, fixtures, cliente, modelo=modelo, paralelo=paralelo, gravador=gravador,
+                             fator_caracteres=fator_caracteres)
+            for nome, template in variantes]
+
+def imprimir_relatorio(resumos):
+    base = resumos[0]
+    print(f"\nFixtures: {base['fixtures']}")
+    print(f"\n{'variante':<16}{'resp.':>7}{'s/grav.':>8}{'tok.ent':>9}{'Δent':>8}{'tok.saí':>9}{'p50 s':>8}{'p90 s':>8}"
+          f"{'parse%':>8}{'|Δnota|':>9}{'viés':>7}")
+    for r in resumos:
+        delta = ""
+        if r["tokens_entrada_medio"] and base["tokens_entrada_medio"]:
+            delta = f"{100 * (r['tokens_entrada_medio'] / base['tokens_entrada_medio'] - 1):+.0f}%"
+        def fmt(valor, formato):
+            return "-" if valor is None else format(valor, formato)
+        print(f"{r['variante']:<16}{r['respondidas']:>7}{r['sem_gravacao']:>8}"
+              f"{fmt(r['tokens_entrada_medio'], '.0f') + ('*' if r['tokens_entrada_estimados'] else ''):>9}{delta:>8}"
+              f"{fmt(r['tokens_saida_medio'], '.0f'):>9}{fmt(r['latencia_p50_s'], '.2f'):>8}{fmt(r['latencia_p90_s'], '.2f'):>8}"
+              f"{fmt(r['falha_parse_pct'], '.1f'):>8}{fmt(r['variacao_nota_media_abs'], '.1f'):>9}{fmt(r['variacao_nota_vies'], '+.1f'):>7}")
+        for exemplo in r["exemplos_de_falha"]:
+            print(f"  falha ({r['variante']}): {exemplo}")
+    if any(r["tokens_entrada_estimados"] for r in resumos):
+        print("\n* tokens de entrada estimados pela razão caracteres/token das fixtures (prompt sem gravação).")
+    if any(r["sem_gravacao"] for r in resumos):
+        print("Variantes sem gravação: rode com --cliente gemini --gravacoes ARQUIVO para medir saída, latência e nota.")
+
+
+def _ler_variante(especificacao):
+    nome, separador, caminho = especificacao.partition("=")
+    if not separador or not nome or not caminho:
+        raise argparse.ArgumentTypeError(f"use NOME=ARQUIVO (recebido: {especificacao!r})")
+    with open(caminho, encoding="utf-8") as f:
+        template = f.read()
+    try:
+        validar_template(template)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"{caminho}: {e}") from e
+    return nome, template
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara variantes do prompt de correção contra correções gravadas.")
+    parser.add_argument("fixtures", nargs="?", help="Arquivo .jsonl gravado pelo app (GEMINI_FIXTURES_CORRECAO)")
+    parser.add_argument("--variante", action="append", default=[], type=_ler_variante, metavar="NOME=ARQUIVO",
+                        help="Template candidato (pode repetir)")
+    parser.add_argument("--cliente", choices=["replay", "gemini"], default="replay")
+    parser.add_argument("--gravacoes", help="Respostas de variantes: lidas no replay e acrescentadas com --cliente gemini")
+    parser.add_argument("--modelo", help="Usa este modelo em todas as fixtures (padrão: o modelo gravado em cada uma)")
+    parser.add_argument("--limite", type=int, help="Usa só as N fixtures mais recentes")
+    parser.add_argument("--paralelo", type=int, default=4, help="Chamadas simultâneas com --cliente gemini")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout (s) de cada chamada com --cliente gemini")
+    parser.add_argument("--sem-atual", action="store_true", help="Não inclui o prompt atual do app como referência")
+    parser.add_argument("--sem-gramatica", action="store_true",
+                        help="Inclui a variante do app sem a seção 4 (ORTOGRAFIA_OMITIR_SECAO_GEMINI) como 'sem_gramatica'")
+    parser.add_argument("--exportar-template", metavar="ARQUIVO", help="Grava o template atual (ponto de partida de uma variante) e sai")
+    parser.add_argument("--json", help="Grava o resultado neste arquivo JSON")
+    args = parser.parse_args(argv)
+
+    if args.exportar_template:
+        with open(args.exportar_template, "w", encoding="utf-8") as f:
+            f.write(PROMPT_CORRECAO_TEMPLATE)
+        print(f"Template atual gravado em {args.exportar_template}.")
+        return 0
+    if not args.fixtures:
+        parser.error("informe o arquivo de fixtures")
+
+    fixtures = [f for f in carregar_fixtures(args.fixtures)
+                if f.get("pergunta") and f.get("resposta_usuario") and f.get("resposta_esperada")]
+    fixtures.sort(key=lambda f: f.get("gravado_em") or "")
+    if args.limite:
+        fixtures = fixtures[-args.limite:]
+    if not fixtures:
+        print("Nenhuma fixture utilizável.")
+        return 1
+    variantes = ([] if args.sem_atual else [("atual", PROMPT_CORRECAO_TEMPLATE)]) + args.variante
+    if args.sem_gramatica:
+        variantes.append(("sem_gramatica", PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA))
+    if not variantes:
+        parser.error("nenhuma variante para avaliar")
+
+    if args.cliente == "gemini":
+        cliente = ClienteGemini(timeout=args.timeout)
+        gravador = GravadorFixtures(args.gravacoes) if args.gravacoes else None
+    else:
+        cliente = ClienteReplay(fixtures, [args.gravacoes] if args.gravacoes else [])
+        gravador = None
+    resumos = executar_benchmark(fixtures, variantes, cliente, modelo=args.modelo,
+                                 paralelo=args.paralelo if args.cliente == "gemini" else 1, gravador=gravador)
+    imprimir_relatorio(resumos)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"cliente": cliente.nome, "fixtures": len(fixtures), "variantes": resumos}, f, ensure_ascii=False, indent=2)
+    return 0 if not any(r["falhas_chamada"] for r in resumos) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+Prompt de correção do Gemini e leitura do feedback, sem dependência do Streamlit.
+
+Fica fora do app.py para que o mesmo texto de prompt e o mesmo parser sejam usados pelo app e pelo
+benchmark_prompts.py, que compara variantes do prompt (tokens, latência, falhas de parse e variação
+da nota) contra correções reais gravadas. Com GEMINI_FIXTURES_CORRECAO definido, o app grava cada
+correção feita pelo Gemini (pergunta, respostas, prompt e feedback) em JSON Lines nesse arquivo.
+Os campos de substituição do template são {pergunta}, {titulo_referencia}, {referencia} e {resposta_usuario}.
+"""
+import re
+import json
+import hashlib
+import datetime
+import threading
+
+TITULO_REFERENCIA_COMPLETA = "Resposta Esperada"
+TITULO_REFERENCIA_RUBRICA = "Resposta Esperada (pontos-chave com pesos entre parênteses; a pontuação é a soma dos pesos dos pontos atendidos)"
+CAMPOS_TEMPLATE = ("pergunta", "titulo_referencia", "referencia", "resposta_usuario")
+
+# --- PROMPT DE CORREÇÃO ---
+# Ao alterar o texto (depois de medir com o benchmark_prompts.py), incremente PROMPT_CORRECAO_VERSAO no app.py.
+PROMPT_CORRECAO_TEMPLATE = """
+    Sua tarefa é fornecer um feedback **sucinto e objetivo** para a 'Resposta do Usuário' em relação à 'Resposta Esperada' e, crucialmente, em relação à **Pergunta** feita.
+    A ideia é que o usuário ganhe agilidade no aprendizado, focando nos pontos essenciais **relevantes para a Pergunta**.
+
+    Ao avaliar, desconsidere detalhes da 'Resposta Esperada' (como número de artigo, formatação, ordem exata de enumeração, ou informações contextuais que a Pergunta NÃO solicitou explicitamente).
+    Foque se a 'Resposta do Usuário' aborda os pontos essenciais que a **Pergunta** exigia, conforme os critérios contidos na 'Resposta Esperada'. Caso o usuário forneça informações que não constem da resposta esperada, verifique se ela é relevante para a Pergunta. Se for, não a considere como erro.
+
+    O feedback deve ser dividido em seções claras, sem rodeios.
+
+    Quanto às sugestões de melhoria textual, elas devem ser **concisas** e diretas, focando em clareza, concisão e correção, sem entrar em detalhes excessivos. Verifique ainda, se o texto do usuário possui ambiguidades e se a estrutura gramatical é confusa. Observe-se que, em regra, a resposta do usuário deve ser em texto corrido e, portanto, mesmo que na Resposta Esperada contenha bullet points, o usuário não precisa utilizá-los em sua resposta. Aponte as melhorias de forma direta e prática, sem rodeios.
+
+    **Estrutura de Feedback Requerida:**
+
+    **1. Pontuação de Sentido (0-100):**
+    [Uma pontuação numérica de 0 a 100% baseada na similaridade de sentido com a Resposta Esperada, **considerando a relevância para a Pergunta**. 100% = sentido idêntico e completo **para a Pergunta**.]
+
+    **2. Avaliação Principal do Sentido:**
+    [Feedback qualitativo muito breve (ex: "Excelente.", "Bom, mas faltou X.", "Incompleto.", "Incorreto.").]
+
+    **3. Lacunas de Conteúdo:**
+    [Liste os pontos-chave da Resposta Esperada que NÃO foram abordados ou foram abordados de forma insuficiente na Resposta do Usuário **E que são relevantes para a Pergunta**. Use bullet points sucintos. Se não houver lacunas, diga "Nenhuma lacuna significativa."]
+
+    **4. Erros Gramaticais/Ortográficos:**
+    [Liste os principais erros encontrados na 'Resposta do Usuário'. Formato: 'Palavra/Frase Incorreta' -> 'Sugestão de Correção'. Se não houver, diga "Nenhum erro encontrado."]
+
+    **5. Sugestões Rápidas de Melhoria:**
+    [Sugestões muito concisas para aprimorar a resposta em termos de clareza, concisão e correção, baseadas nos erros e lacunas. Use bullet points.]
+
+    ---
+    Pergunta:
+    {pergunta}
+
+    ---
+    {titulo_referencia}:
+    {referencia}
+
+    ---
+    Resposta do Usuário:
+    {resposta_usuario}
+    ---
+
+    """
+
+# Variante sem a seção 4, para quando a verificação ortográfica local (verificador_ortografico.py) a preenche.
+# Os títulos das demais seções mantêm a numeração, que é o que o parser procura.
+SECAO_GRAMATICAL_PROMPT = """    **4. Erros Gramaticais/Ortográficos:**
+    [Liste os principais erros encontrados na 'Resposta do Usuário'. Formato: 'Palavra/Frase Incorreta' -> 'Sugestão de Correção'. Se não houver, diga "Nenhum erro encontrado."]
+
+"""
+PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA = PROMPT_CORRECAO_TEMPLATE.replace(SECAO_GRAMATICAL_PROMPT, "").replace(
+    "**Estrutura de Feedback Requerida:**",
+    "**Estrutura de Feedback Requerida** (a seção 4, de erros gramaticais, é feita à parte; não a inclua):")
+
+
+def formatar_rubrica(itens):
+    return "\n".join(f"- ({item['peso']}) {item['ponto']}" for item in itens)
+
+def montar_prompt_correcao(pergunta, resposta_usuario, resposta_esperada, rubrica=None, template=PROMPT_CORRECAO_TEMPLATE):
+    """
+    Retorna (prompt, referência). Com 'rubrica' (itens com pesos), os pontos-chave substituem a resposta
+    esperada completa como referência.
+    """
+    if rubrica:
+        titulo_referencia, referencia = TITULO_REFERENCIA_RUBRICA, formatar_rubrica(rubrica)
+    else:
+        titulo_referencia, referencia = TITULO_REFERENCIA_COMPLETA, resposta_esperada
+    prompt = template.format(pergunta=pergunta, titulo_referencia=titulo_referencia,
+                             referencia=referencia, resposta_usuario=resposta_usuario)
+    return prompt, referencia
+
+def validar_template(template):
+    """Levanta ValueError se o template tiver campos desconhecidos ou não incluir a resposta do usuário."""
+    try:
+        template.format(**{campo: "" for campo in CAMPOS_TEMPLATE})
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"template inválido: {e!r}. Campos aceitos: {', '.join(CAMPOS_TEMPLATE)}") from e
+    if "{resposta_usuario}" not in template or "{referencia}" not in template:
+        raise ValueError("o template precisa conter {resposta_usuario} e {referencia}")
+
+def hash_prompt(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+# --- LEITURA DO FEEDBACK ---
+def parse_feedback_sections(full_feedback_text):
+    """
+    Analisa o feedback estruturado do Gemini e retorna um dicionário com as seções.
+    Retorna dicionário com chaves 'score', 'meaning_eval', 'content_gaps', etc.
+    """
+    section_keys = {
+        "score": "1. Pontuação de Sentido (0-100):",
+        "meaning_eval": "2. Avaliação Principal do Sentido:",
+        "content_gaps": "3. Lacunas de Conteúdo:",
+        "grammar_errors": "4. Erros Gramaticais/Ortográficos:",
+        "suggestions": "5. Sugestões Rápidas de Melhoria:"
+    }
+    
+    parsed_data = {key: "Não disponível." for key in section_keys.keys()} # Default values
+
+    # Função auxiliar para extrair conteúdo entre chaves
+    def extract_content(full_text, start_key_title, next_key_titles=()):
+        start_index = full_text.find(f"**{start_key_title}**")
+        if start_index == -1: return None
+        content_start = start_index + len(f"**{start_key_title}**")
+        
+        # Ajuste para lidar com o caractere ':' logo após a chave
+        if content_start < len(full_text) and full_text[content_start] == ':':
+            content_start += 1 
+        
+        # O conteúdo vai até a próxima seção presente (uma seção pode faltar, como a 4 no prompt sem gramática)
+        next_indexes = [i for i in (full_text.find(f"**{t}**", content_start) for t in next_key_titles) if i != -1]
+        if next_indexes: return full_text[content_start:min(next_indexes)].strip()
+        else: return full_text[content_start:].strip().split('---')[0].strip()
+
+    try:
+        # Extrai cada seção usando a ordem definida
+        titles = list(section_keys.values())
+        for i, (key, title) in enumerate(section_keys.items()):
+            content = extract_content(full_feedback_text, title, titles[i+1:])
+            if content is not None:
+                parsed_data[key] = content
+            
+    except Exception as e:
+        return {"raw_feedback": full_feedback_text, "error": str(e)}
+
+    return parsed_data
+
+def extrair_nota_sentido(parsed_feedback):
+    """Converte a seção de pontuação do feedback em inteiro (ou None)."""
+    if parsed_feedback.get('score'):
+        score_match = re.search(r"(\d+)", parsed_feedback['score'])
+        if score_match:
+            try:
+                return int(score_match.group(1))
+            except ValueError:
+                pass
+    return None
+
+
+# --- GRAVAÇÃO DE FIXTURES (CORREÇÕES REAIS) ---
+class GravadorFixtures:
+    """Acrescenta correções a um arquivo JSON Lines; seguro para as threads de correção do app."""
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+
+    def gravar(self, pergunta, resposta_usuario, resposta_esperada, rubrica, modelo, prompt, resposta,
+               tokens_entrada, tokens_saida, latencia_s, versao_prompt=None):
+        registro = {
+            "id": hashlib.sha256(f"{pergunta}\n{resposta_esperada}\n{resposta_usuario}".encode("utf-8")).hexdigest()[:16],
+            "pergunta": pergunta,
+            "resposta_usuario": resposta_usuario,
+            "resposta_esperada": resposta_esperada,
+            "rubrica": rubrica,
+            "modelo": modelo,
+            "versao_prompt": versao_prompt,
+            "prompt_sha256": hash_prompt(prompt),
+            "caracteres_prompt": len(prompt),
+            "resposta": resposta,
+            "tokens_entrada": tokens_entrada,
+            "tokens_saida": tokens_saida,
+            "latencia_s": round(latencia_s, 3),
+            "gravado_em": datetime.datetime.now().isoformat(),
+        }
+        linha = json.dumps(registro, ensure_ascii=False) + "\n"
+        with self._lock, open(self.caminho, "a", encoding="utf-8") as f:
+            f.write(linha)
+
+def carregar_fixtures(caminho):
+    """Lê um arquivo JSON Lines de fixtures (linhas vazias ou corrompidas são ignoradas)."""
+    fixtures = []
+    with open(caminho, encoding="utf-8") as f:
+        for linha in f:
+            linha = linha.strip()
+            if not linha:
+                continue
+            try:
+                fixtures.append(json.loads(linha))
+            except ValueError:
+                continue
+    return fixtures
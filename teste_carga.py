@@ -0,0 +1,623 @@
+"""
+Teste de carga: simula N sessões simultâneas de alunos executando o app.py (login, navegação entre
+abas, respostas corrigidas pelo Gemini e consulta às métricas) e mede quanto uma réplica aguenta
+antes de os reruns começarem a enfileirar atrás das chamadas bloqueantes ao Firestore e ao Gemini.
+
+As sessões rodam o script real via streamlit.testing (AppTest), no mesmo processo, cada uma em sua
+thread. Por padrão Firestore e Gemini são substituídos por backends falsos em memória com latência
+e taxa de erro configuráveis; com --firestore real / --gemini real são usados os serviços configurados
+(credenciais como no app; usuários de teste 'carga_NN' são criados e, com --limpar, removidos no fim).
+
+    python teste_carga.py --sessoes 20 --duracao 60
+    python teste_carga.py --sessoes 50 --latencia-firestore 0.05 --latencia-gemini 4 --erro-gemini 0.05
+    python teste_carga.py --sessoes 5 --firestore real --gemini falso --limpar --json resultado.json
+
+Relata vazão (reruns/s), percentis de latência por etapa, pico de threads e crescimento de memória.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import AlreadyExists, NotFound, DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+
+CAMINHO_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+PREFIXO_USUARIO = "carga_"
+SENHA_USUARIO = "carga123"
+ABAS_ALUNO = ["Todas as Perguntas", "Perguntas Mais Difíceis", "Métricas de Desempenho", "Gerenciar Cartões"]
+
+
+# --- BACKENDS FALSOS (LATÊNCIA E ERROS CONFIGURÁVEIS) ---
+class Perturbacao:
+    """Atraso aleatório em torno da latência média e falhas com a probabilidade dada."""
+    def __init__(self, latencia, taxa_erro, erros, semente=None):
+        self.latencia = latencia
+        self.taxa_erro = taxa_erro
+        self.erros = erros
+        self.rng = random.Random(semente)
+        self.lock = threading.Lock()
+
+    def aplicar(self):
+        with self.lock:
+            atraso = self.latencia * self.rng.uniform(0.5, 1.5)
+            falha = self.rng.random() < self.taxa_erro
+            erro = self.rng.choice(self.erros)
+        if atraso:
+            time.sleep(atraso)
+        if falha:
+            raise erro("Falha simulada pelo teste de carga")
+
+
+class _SnapshotFalso:
+    def __init__(self, referencia, dados, atualizado_em=None):
+        self.reference = referencia
+        self.id = referencia.id
+        self._dados = dados
+        self.exists = dados is not None
+        self.update_time = atualizado_em
+
+    def to_dict(self):
+        return dict(self._dados) if self._dados is not None else None
+
+    def get(self, campo):
+        return (self._dados or {}).get(campo)
+
+
+def _aplicar_campos(atual, campos):
+    novo = dict(atual)
+    for campo, valor in campos.items():
+        if type(valor).__name__ == "Increment":
+            novo[campo] = novo.get(campo, 0) + valor.value
+        else:
+            novo[campo] = valor
+    return novo
+
+
+class _DocumentoFalso:
+    def __init__(self, banco, caminho):
+        self._banco = banco
+        self._caminho = caminho
+        self.id = caminho[-1]
+
+    def collection(self, nome):
+        return _ColecaoFalsa(self._banco, self._caminho + (nome,))
+
+    def get(self, *args, **kwargs):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            dados = self._banco.docs.get(self._caminho)
+            return _SnapshotFalso(self, dados, self._banco.atualizados.get(self._caminho))
+
+    def _gravar(self, dados):
+        self._banco.docs[self._caminho] = dados
+        self._banco.atualizados[self._caminho] = datetime.datetime.now(datetime.timezone.utc)
+
+    def set(self, dados, merge=False):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            atual = self._banco.docs.get(self._caminho) if merge else None
+            self._gravar(_aplicar_campos(atual or {}, dados))
+
+    def create(self, dados):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            if self._caminho in self._banco.docs:
+                raise AlreadyExists(f"Documento já existe: {'/'.join(self._caminho)}")
+            self._gravar(dict(dados))
+
+    def update(self, campos):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            if self._caminho not in self._banco.docs:
+                raise NotFound(f"Documento não encontrado: {'/'.join(self._caminho)}")
+            self._gravar(_aplicar_campos(self._banco.docs[self._caminho], campos))
+
+    def delete(self):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            self._banco.docs.pop(self._caminho, None)
+
+
+_OPERADORES = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+
+class _ConsultaFalsa:
+    def __init__(self, banco, caminho, filtros=(), ordem=(), limite=None, depois_de=None):
+        self._banco = banco
+        self._caminho = caminho
+        self._filtros = tuple(filtros)
+        self._ordem = tuple(ordem)
+        self._limite = limite
+        self._depois_de = depois_de
+
+    def _copiar(self, **alteracoes):
+        atributos = {"filtros": self._filtros, "ordem": self._ordem, "limite": self._limite, "depois_de": self._depois_de}
+        atributos.update(alteracoes)
+        return _ConsultaFalsa(self._banco, self._caminho, **atributos)
+
+    def where(self, campo=None, operador=None, valor=None, filter=None):
+        if filter is not None:
+            campo, operador, valor = filter.field_path, filter.op_string, filter.value
+        return self._copiar(filtros=self._filtros + ((campo, operador, valor),))
+
+    def order_by(self, campo, direction="ASCENDING"):
+        return self._copiar(ordem=self._ordem + ((campo, direction == "DESCENDING"),))
+
+    def limit(self, n):
+        return self._copiar(limite=n)
+
+    def start_after(self, snapshot):
+        return self._copiar(depois_de=snapshot)
+
+    def select(self, campos):
+        return self # Projeção: o falso devolve os documentos inteiros
+
+    def count(self, alias=None):
+        return _ContagemFalsa(self)
+
+    def stream(self, *args, **kwargs):
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            encontrados = [
+                (caminho, dict(dados)) for caminho, dados in self._banco.docs.items()
+                if len(caminho) == len(self._caminho) + 1 and caminho[:-1] == self._caminho
+                and all(_OPERADORES[op](dados.get(campo), valor) for campo, op, valor in self._filtros)
+            ]
+            atualizados = {caminho: self._banco.atualizados.get(caminho) for caminho, _ in encontrados}
+        for campo, decrescente in reversed(self._ordem or (("__name__", False),)):
+            chave = (lambda item: item[0][-1]) if campo == "__name__" else (lambda item, c=campo: (item[1].get(c) is None, item[1].get(c)))
+            encontrados.sort(key=chave, reverse=decrescente)
+        if self._depois_de is not None:
+            ids = [caminho[-1] for caminho, _ in encontrados]
+            if self._depois_de.id in ids:
+                encontrados = encontrados[ids.index(self._depois_de.id) + 1:]
+        if self._limite is not None:
+            encontrados = encontrados[:self._limite]
+        return iter([_SnapshotFalso(_DocumentoFalso(self._banco, caminho), dados, atualizados[caminho])
+                     for caminho, dados in encontrados])
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        raise RuntimeError("O Firestore falso não implementa listeners; rode sem FIRESTORE_LISTENERS.")
+
+
+class _ContagemFalsa:
+    """Agregação count(): get() devolve [[resultado]] como o cliente real."""
+    def __init__(self, consulta):
+        self._consulta = consulta
+
+    def get(self, *args, **kwargs):
+        class _Resultado:
+            alias = "count"
+            value = len(self._consulta.get())
+        return [[_Resultado()]]
+
+
+class _ColecaoFalsa(_ConsultaFalsa):
+    def document(self, doc_id=None):
+        return _DocumentoFalso(self._banco, self._caminho + (doc_id or uuid.uuid4().hex[:20],))
+
+    def add(self, dados):
+        referencia = self.document()
+        referencia.set(dados)
+        return None, referencia
+
+
+class _LoteFalso:
+    def __init__(self, banco):
+        self._banco = banco
+        self._operacoes = []
+
+    def set(self, referencia, dados, merge=False):
+        self._operacoes.append(("set", referencia, dados, merge))
+
+    def create(self, referencia, dados):
+        self._operacoes.append(("create", referencia, dados, False))
+
+    def update(self, referencia, dados):
+        self._operacoes.append(("update", referencia, dados, False))
+
+    def delete(self, referencia):
+        self._operacoes.append(("delete", referencia, None, False))
+
+    def commit(self):
+        # Um commit é uma única ida ao servidor: uma perturbação para o lote inteiro
+        self._banco.perturbacao.aplicar()
+        with self._banco.lock:
+            for tipo, referencia, dados, merge in self._operacoes:
+                caminho = referencia._caminho
+                if tipo == "delete":
+                    self._banco.docs.pop(caminho, None)
+                    continue
+                if tipo == "create" and caminho in self._banco.docs:
+                    raise AlreadyExists(f"Documento já existe: {'/'.join(caminho)}")
+                if tipo == "update" and caminho not in self._banco.docs:
+                    raise NotFound(f"Documento não encontrado: {'/'.join(caminho)}")
+                base = self._banco.docs.get(caminho, {}) if (merge or tipo == "update") else {}
+                referencia._gravar(_aplicar_campos(base, dados))
+        self._operacoes = []
+
+
+class FirestoreFalso:
+    """Subconjunto do cliente do Firestore usado pelo app.py, em memória e seguro entre threads."""
+    def __init__(self, perturbacao):
+        self.perturbacao = perturbacao
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.atualizados = {}
+
+    def collection(self, nome):
+        return _ColecaoFalsa(self, (nome,))
+
+    def batch(self):
+        return _LoteFalso(self)
+
+    def get_all(self, referencias):
+        self.perturbacao.aplicar()
+        with self.lock:
+            return [_SnapshotFalso(ref, self.docs.get(ref._caminho), self.atualizados.get(ref._caminho)) for ref in referencias]
+
+    def recursive_delete(self, referencia):
+        self.perturbacao.aplicar()
+        with self.lock:
+            prefixo = referencia._caminho
+            for caminho in [c for c in self.docs if c[:len(prefixo)] == prefixo]:
+                del self.docs[caminho]
+
+
+class _RespostaGeminiFalsa:
+    def __init__(self, texto):
+        self.text = texto
+
+
+class ModeloGeminiFalso:
+    """Devolve feedback no formato esperado pelo parser do app (ou uma rubrica em JSON)."""
+    def __init__(self, nome_modelo, perturbacao):
+        self.model_name = nome_modelo
+        self._perturbacao = perturbacao
+
+    def generate_content(self, prompt, **kwargs):
+        self._perturbacao.aplicar()
+        if "Extraia da 'Resposta Esperada'" in prompt:
+            return _RespostaGeminiFalsa(json.dumps([{"ponto": "Ponto principal", "peso": 3}, {"ponto": "Ponto secundário", "peso": 1}]))
+        nota = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16) % 101
+        return _RespostaGeminiFalsa(
+            f"**1. Pontuação de Sentido (0-100):** {nota}%\n"
+            "**2. Avaliação Principal do Sentido:** Bom, mas incompleto.\n"
+            "**3. Lacunas de Conteúdo:**\n- Ponto secundário\n"
+            "**4. Erros Gramaticais/Ortográficos:** Nenhum erro encontrado.\n"
+            "**5. Sugestões Rápidas de Melhoria:**\n- Cite o ponto secundário.\n"
+        )
+
+
+def instalar_backends(args):
+    """Substitui Firestore e/ou Gemini antes de o app ser executado. Retorna o cliente do Firestore a ser populado."""
+    import firebase_admin
+    from firebase_admin import firestore
+    import google.generativeai as genai
+
+    if args.gemini == "falso":
+        perturbacao_gemini = Perturbacao(args.latencia_gemini, args.erro_gemini,
+                                         (DeadlineExceeded, ResourceExhausted, ServiceUnavailable), args.semente)
+        genai.configure = lambda **kwargs: None
+        genai.GenerativeModel = lambda nome_modelo, *a, **k: ModeloGeminiFalso(nome_modelo, perturbacao_gemini)
+        os.environ.setdefault("GEMINI_API_KEY", "teste-de-carga")
+
+    if args.firestore == "falso":
+        db = FirestoreFalso(Perturbacao(args.latencia_firestore, args.erro_firestore,
+                                        (DeadlineExceeded, ServiceUnavailable), args.semente))
+        firebase_admin.get_app = lambda *a, **k: object()
+        firestore.client = lambda *a, **k: db
+        return db
+
+    import backup_firestore
+    return backup_firestore._conectar_firestore(args.credenciais, args.projeto)
+
+
+def popular_dados(db, n_usuarios, cartoes_por_usuario, historico_por_usuario, semente=None, criar_admin=False):
+    """
+    Cria (ou reaproveita) os usuários de teste, com cartões e histórico. Escritas em lote, sem perturbação de erro.
+    'criar_admin' só vale para o Firestore falso: num banco real, o admin (com senha conhecida) nunca é criado aqui.
+    """
+    rng = random.Random(semente)
+    hash_senha = hashlib.sha256(SENHA_USUARIO.encode()).hexdigest()
+    materias = ["Constitucional", "Administrativo", "Tributário", "Civil"]
+    usuarios = [f"{PREFIXO_USUARIO}{i:02d}" for i in range(n_usuarios)]
+    admin_ref = db.collection("users").document("admin")
+    if criar_admin and not admin_ref.get().exists: # Sem admin o app não passa da tela inicial
+        admin_ref.set({"password_hash": hash_senha})
+    for username in usuarios:
+        user_ref = db.collection("users").document(username)
+        if user_ref.get().exists:
+            continue
+        batch = db.batch()
+        batch.set(user_ref, {"password_hash": hash_senha})
+        for i in range(cartoes_por_usuario):
+            batch.set(user_ref.collection("user_cards").document(), {
+                "materia": materias[i % len(materias)], "assunto": f"Assunto {i % 7}",
+                "pergunta": f"Pergunta {i} de {username}?", "resposta_esperada": f"Resposta esperada {i}. " * 20,
+            })
+        inicio = datetime.datetime.now() - datetime.timedelta(days=60)
+        for i in range(historico_por_usuario):
+            carta = rng.randrange(cartoes_por_usuario)
+            batch.set(user_ref.collection("feedback_history").document(), {
+                "materia": materias[carta % len(materias)], "assunto": f"Assunto {carta % 7}",
+                "pergunta": f"Pergunta {carta} de {username}?", "nota_sentido": rng.randint(0, 100),
+                "lacunas_conteudo": "- Ponto secundário",
+                "timestamp": (inicio + datetime.timedelta(minutes=30 * i)).isoformat(),
+            })
+        batch.commit()
+    return usuarios
+
+def limpar_dados(db, usuarios):
+    for username in usuarios:
+        db.recursive_delete(db.collection("users").document(username))
+
+
+# --- ROTEIRO DE UMA SESSÃO E COLETA DE MÉTRICAS ---
+class Metricas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {} # etapa -> [segundos]
+        self.excecoes = 0
+        self.falhas_roteiro = []
+
+    def registrar(self, etapa, segundos, com_excecao):
+        with self.lock:
+            self.latencias.setdefault(etapa, []).append(segundos)
+            if com_excecao:
+                self.excecoes += 1
+
+
+def _rerun(at, etapa, metricas, acao=None):
+    inicio = time.perf_counter()
+    (acao() if acao else at).run()
+    metricas.registrar(etapa, time.perf_counter() - inicio, bool(at.exception))
+    if at.exception:
+        raise RuntimeError(f"Exceção no app durante '{etapa}': {at.exception[0].message}")
+
+def _aguardar_correcao(at, metricas, tempo_limite, intervalo=0.25):
+    """
+    A correção roda em segundo plano: repete o rerun (como faz o fragmento de acompanhamento no
+    navegador) até o resultado ser entregue, e registra o tempo total da correção como uma etapa.
+    """
+    inicio = time.perf_counter()
+    while at.session_state.correcoes_pendentes and time.perf_counter() - inicio < tempo_limite:
+        time.sleep(intervalo)
+        _rerun(at, "aguardar", metricas)
+    metricas.registrar("correcao", time.perf_counter() - inicio, bool(at.session_state.correcoes_pendentes))
+
+def _preparar_apptest_concorrente():
+    """
+    O AppTest foi feito para uma sessão por vez; duas adaptações permitem várias em threads:
+    - cada AppTest compila o app.py na primeira execução, e ast.parse concorrente pode falhar no
+      CPython ("AST constructor recursion depth mismatch"): só a compilação é serializada;
+    - cada execução instala um Runtime simulado global e o remove ao terminar, derrubando as outras
+      sessões em andamento: Runtime.instance() passa a devolver o último Runtime simulado visto.
+    """
+    from streamlit.runtime.scriptrunner import magic
+    from streamlit.runtime.runtime import Runtime
+
+    if getattr(magic.add_magic, "_serializado", False):
+        return
+    lock = threading.Lock()
+    add_magic_original = magic.add_magic
+
+    def add_magic(*args, **kwargs):
+        with lock:
+            return add_magic_original(*args, **kwargs)
+    add_magic._serializado = True
+    magic.add_magic = add_magic
+
+    ultimo_runtime = []
+    def instance(cls):
+        if cls._instance is not None:
+            ultimo_runtime[:] = [cls._instance]
+            return cls._instance
+        if ultimo_runtime:
+            return ultimo_runtime[0]
+        raise RuntimeError("Runtime hasn't been created!")
+    Runtime.instance = classmethod(instance)
+
+def roteiro_sessao(username, metricas, rng, tempo_limite, iteracoes):
+    """Uma sessão: login e depois ciclos de responder, avançar cartão e consultar outras abas."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(CAMINHO_APP, default_timeout=tempo_limite)
+    _rerun(at, "abrir", metricas)
+    at.text_input(key="username_login_input_form").input(username)
+    at.text_input(key="password_login_input_form").input(SENHA_USUARIO)
+    _rerun(at, "login", metricas, lambda: at.button(key="login_button").click())
+
+    for iteracao in range(iteracoes):
+        if at.sidebar.radio(key="main_tab_selector").value != "Todas as Perguntas":
+            _rerun(at, "navegar", metricas, lambda: at.sidebar.radio(key="main_tab_selector").set_value("Todas as Perguntas"))
+        campos_resposta = [w for w in at.text_area if str(w.key).startswith("user_answer_input_tab1_")]
+        if campos_resposta:
+            # Texto distinto por sessão e iteração: a deduplicação de submissões não pode mascarar a carga
+            campos_resposta[0].input(f"Resposta {iteracao} de {username}: " + "conteúdo " * rng.randint(10, 120))
+            _rerun(at, "responder", metricas, lambda: at.button(key="check_response_btn_tab1").click())
+            _aguardar_correcao(at, metricas, tempo_limite)
+            _rerun(at, "proximo_cartao", metricas, lambda: at.button(key="next_card_btn_tab1").click())
+        aba = rng.choice(ABAS_ALUNO[1:])
+        _rerun(at, "navegar", metricas, lambda: at.sidebar.radio(key="main_tab_selector").set_value(aba))
+
+    _rerun(at, "logout", metricas, lambda: at.sidebar.button(key="logout_button").click())
+
+
+def _memoria_rss_mb():
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # pico, em sistemas sem /proc
+
+class Amostrador(threading.Thread):
+    """Amostra threads ativas e memória enquanto o teste roda."""
+    def __init__(self, intervalo=0.5):
+        super().__init__(daemon=True)
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.amostras = []
+
+    def run(self):
+        while not self.parar.is_set():
+            atual, _ = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+            self.amostras.append((time.monotonic(), threading.active_count(), _memoria_rss_mb(), atual / 2**20))
+            self.parar.wait(self.intervalo)
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def executar_teste(args, usuarios):
+    metricas = Metricas()
+    _preparar_apptest_concorrente()
+    if args.tracemalloc:
+        tracemalloc.start() # Detalha a memória Python, mas deixa o interpretador bem mais lento
+    amostrador = Amostrador()
+    amostrador.start()
+    rss_inicial = _memoria_rss_mb()
+    fim = time.monotonic() + args.duracao if args.duracao else None
+    inicio = time.monotonic()
+
+    def trabalhador(indice):
+        rng = random.Random(None if args.semente is None else args.semente + indice)
+        username = usuarios[indice % len(usuarios)]
+        time.sleep(rng.uniform(0, args.rampa)) # Chegada escalonada das sessões
+        while True:
+            try:
+                roteiro_sessao(username, metricas, rng, args.tempo_limite, args.iteracoes)
+            except Exception as e:
+                with metricas.lock:
+                    metricas.falhas_roteiro.append(f"{username}: {e}")
+            if fim is None or time.monotonic() >= fim:
+                return
+
+    with ThreadPoolExecutor(max_workers=args.sessoes) as executor:
+        list(executor.map(trabalhador, range(args.sessoes)))
+    duracao = time.monotonic() - inicio
+    amostrador.parar.set()
+    amostrador.join()
+    _, pico_tracemalloc = tracemalloc.get_traced_memory() if args.tracemalloc else (0, 0)
+    tracemalloc.stop()
+
+    todas = [s for valores in metricas.latencias.values() for s in valores]
+    return {
+        "sessoes": args.sessoes,
+        "duracao_s": round(duracao, 2),
+        "reruns": len(todas),
+        "vazao_reruns_por_s": round(len(todas) / duracao, 2) if duracao else None,
+        "excecoes_no_app": metricas.excecoes,
+        "falhas_de_roteiro": len(metricas.falhas_roteiro),
+        "exemplos_de_falha": metricas.falhas_roteiro[:5],
+        "latencia_por_etapa_s": {
+            etapa: {"n": len(v), "p50": round(_percentil(v, 50), 3), "p90": round(_percentil(v, 90), 3),
+                    "p99": round(_percentil(v, 99), 3), "max": round(max(v), 3)}
+            for etapa, v in sorted(metricas.latencias.items())
+        },
+        "latencia_geral_s": {"p50": round(_percentil(todas, 50), 3), "p90": round(_percentil(todas, 90), 3),
+                             "p99": round(_percentil(todas, 99), 3)} if todas else None,
+        "threads_pico": max((a[1] for a in amostrador.amostras), default=threading.active_count()),
+        "memoria_rss_mb": {"inicio": round(rss_inicial, 1), "fim": round(_memoria_rss_mb(), 1),
+                           "pico": round(max((a[2] for a in amostrador.amostras), default=rss_inicial), 1)},
+        "memoria_python_mb": {"pico_tracemalloc": round(pico_tracemalloc / 2**20, 1),
+                              "fim_tracemalloc": round(amostrador.amostras[-1][3], 1) if amostrador.amostras else None}
+                             if args.tracemalloc else None,
+    }
+
+def imprimir_relatorio(resultado):
+    print(f"\nSessões simultâneas: {resultado['sessoes']}   duração: {resultado['duracao_s']} s")
+    print(f"Reruns: {resultado['reruns']}   vazão: {resultado['vazao_reruns_por_s']} reruns/s   "
+          f"exceções no app: {resultado['excecoes_no_app']}   roteiros com falha: {resultado['falhas_de_roteiro']}")
+    print(f"\n{'etapa':<16}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for etapa, l in resultado["latencia_por_etapa_s"].items():
+        print(f"{etapa:<16}{l['n']:>7}{l['p50']:>9.3f}{l['p90']:>9.3f}{l['p99']:>9.3f}{l['max']:>9.3f}")
+    memoria = resultado["memoria_rss_mb"]
+    print(f"\nThreads (pico): {resultado['threads_pico']}")
+    print(f"Memória RSS: {memoria['inicio']} MB -> {memoria['fim']} MB (pico {memoria['pico']} MB)")
+    if resultado["memoria_python_mb"]:
+        print(f"Memória Python (tracemalloc): pico {resultado['memoria_python_mb']['pico_tracemalloc']} MB, "
+              f"fim {resultado['memoria_python_mb']['fim_tracemalloc']} MB")
+    for exemplo in resultado["exemplos_de_falha"]:
+        print(f"  falha: {exemplo}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga com sessões simultâneas do app.")
+    parser.add_argument("--sessoes", type=int, default=10, help="Sessões simultâneas")
+    parser.add_argument("--usuarios", type=int, help="Usuários distintos (padrão: um por sessão)")
+    parser.add_argument("--duracao", type=float, default=0, help="Repetir roteiros por N segundos (0: um roteiro por sessão)")
+    parser.add_argument("--iteracoes", type=int, default=5, help="Respostas por roteiro")
+    parser.add_argument("--rampa", type=float, default=2.0, help="Janela (s) em que as sessões começam")
+    parser.add_argument("--tempo-limite", type=float, default=120, help="Tempo máximo (s) de um rerun")
+    parser.add_argument("--cartoes", type=int, default=40, help="Cartões por usuário de teste")
+    parser.add_argument("--historico", type=int, default=300, help="Entradas de histórico por usuário de teste")
+    parser.add_argument("--firestore", choices=["falso", "real"], default="falso")
+    parser.add_argument("--gemini", choices=["falso", "real"], default="falso")
+    parser.add_argument("--latencia-firestore", type=float, default=0.02, help="Latência média (s) por operação no Firestore falso")
+    parser.add_argument("--erro-firestore", type=float, default=0.0, help="Probabilidade de erro por operação no Firestore falso")
+    parser.add_argument("--latencia-gemini", type=float, default=2.0, help="Latência média (s) do Gemini falso")
+    parser.add_argument("--erro-gemini", type=float, default=0.0, help="Probabilidade de erro do Gemini falso")
+    parser.add_argument("--credenciais", help="Chave de conta de serviço para --firestore real")
+    parser.add_argument("--projeto", help="ID do projeto para --firestore real")
+    parser.add_argument("--limpar", action="store_true", help="Remove os usuários de teste no fim (--firestore real)")
+    parser.add_argument("--semente", type=int, help="Semente para resultados reproduzíveis")
+    parser.add_argument("--tracemalloc", action="store_true", help="Mede também a memória Python alocada (deixa tudo mais lento)")
+    parser.add_argument("--json", help="Grava o resultado neste arquivo JSON")
+    args = parser.parse_args(argv)
+    # Mesma leitura do app.py (_flag_ambiente): o Firestore falso não tem listeners on_snapshot
+    if args.firestore == "falso" and os.getenv("FIRESTORE_LISTENERS", "").strip().lower() in ("1", "true", "sim", "yes"):
+        parser.error("FIRESTORE_LISTENERS não é suportado com --firestore falso (sem listeners on_snapshot); "
+                     "remova a variável ou use --firestore real.")
+
+    db = instalar_backends(args)
+    if args.firestore == "real" and not db.collection("users").document("admin").get().exists:
+        # Criar o admin aqui deixaria no banco real uma conta administrativa com a senha pública SENHA_USUARIO
+        parser.error("o Firestore real não tem o usuário 'admin'; crie-o pelo app antes de rodar o teste de carga.")
+    # A carga inicial não deve falhar nem pagar a latência simulada
+    perturbacao = getattr(db, "perturbacao", None)
+    if perturbacao is not None:
+        latencia, taxa_erro = perturbacao.latencia, perturbacao.taxa_erro
+        perturbacao.latencia, perturbacao.taxa_erro = 0, 0
+    usuarios = popular_dados(db, args.usuarios or args.sessoes, args.cartoes, args.historico, args.semente,
+                             criar_admin=args.firestore == "falso")
+    if perturbacao is not None:
+        perturbacao.latencia, perturbacao.taxa_erro = latencia, taxa_erro
+
+    try:
+        resultado = executar_teste(args, usuarios)
+    finally:
+        if args.limpar and args.firestore == "real":
+            limpar_dados(db, usuarios)
+    imprimir_relatorio(resultado)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+    return 0 if not resultado["falhas_de_roteiro"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import pytest
+
+import armazenamento_compacto
+from armazenamento_compacto import (CODEC_ZLIB, CODEC_ZSTD, PERGUNTA_DESCONHECIDA, CompressorTextos, _dicionario_zlib,
+                                    campos_para_json, compactar_campos, expandir_campos, formato_entrada_compacta,
+                                    formato_entrada_completa, id_dicionario, treinar_dicionario)
+
+TEXTOS = [f"Cabe recurso de apelação contra a sentença que extingue o processo sem resolução do mérito, caso {i}. "
+          f"O prazo para interposição é de quinze dias úteis, contados da intimação da decisão número {i}." for i in range(40)]
+LONGO = " ".join(TEXTOS[:8])
+
+
+def _compressor_zlib():
+    dicionario = _dicionario_zlib(TEXTOS)
+    id_zlib = id_dicionario(CODEC_ZLIB, dicionario)
+    return CompressorTextos({id_zlib: (CODEC_ZLIB, dicionario)}, atual=id_zlib), id_zlib, dicionario
+
+
+def test_ida_e_volta_sem_dicionario():
+    compressor = CompressorTextos()
+    valor = compressor.comprimir(LONGO)
+    assert compressor.descomprimir(valor) == LONGO
+
+
+def test_ida_e_volta_zlib_sem_zstandard(monkeypatch):
+    monkeypatch.setattr(armazenamento_compacto, "zstandard", None)
+    compressor = CompressorTextos()
+    valor = compressor.comprimir(LONGO)
+    assert valor[0] == CODEC_ZLIB
+    assert compressor.descomprimir(valor) == LONGO
+
+
+def test_dicionario_zlib_comprime_melhor_e_carrega_sob_demanda():
+    compressor, id_zlib, dicionario = _compressor_zlib()
+    com_dicionario = compressor.comprimir(TEXTOS[0])
+    assert len(com_dicionario) < len(CompressorTextos().comprimir(TEXTOS[0]))
+    # Outro processo, que ainda não conhece o dicionário, o busca pelo ID do cabeçalho
+    pedidos = []
+    leitor = CompressorTextos(carregar_dicionario=lambda id_dic: pedidos.append(id_dic) or (CODEC_ZLIB, dicionario))
+    assert leitor.descomprimir(com_dicionario) == TEXTOS[0]
+    assert leitor.descomprimir(com_dicionario) == TEXTOS[0]
+    assert pedidos == [id_zlib]
+
+
+def test_dicionario_desconhecido():
+    compressor, _, _ = _compressor_zlib()
+    with pytest.raises(ValueError):
+        CompressorTextos().descomprimir(compressor.comprimir(TEXTOS[0]))
+
+
+def test_ida_e_volta_zstd_com_dicionario_treinado():
+    pytest.importorskip("zstandard")
+    codec, dicionario = treinar_dicionario(TEXTOS * 10)
+    id_dic = id_dicionario(codec, dicionario)
+    compressor = CompressorTextos({id_dic: (codec, dicionario)}, atual=id_dic)
+    valor = compressor.comprimir(LONGO)
+    assert valor[0] == codec
+    assert compressor.descomprimir(valor) == LONGO
+
+
+def test_zstd_ilegivel_sem_zstandard(monkeypatch):
+    pytest.importorskip("zstandard")
+    valor = CompressorTextos().comprimir(LONGO)
+    assert valor[0] == CODEC_ZSTD
+    monkeypatch.setattr(armazenamento_compacto, "zstandard", None)
+    with pytest.raises(RuntimeError):
+        CompressorTextos().descomprimir(valor)
+
+
+def test_compactar_e_expandir_campos():
+    compressor, _, _ = _compressor_zlib()
+    dados = {"pergunta": "Cabe recurso?", "resposta_esperada": LONGO}
+    compactado = compactar_campos(dados, ("resposta_esperada", "pergunta"), compressor)
+    assert set(compactado) == {"pergunta", "resposta_esperada_z"} # textos curtos ficam como estão
+    assert expandir_campos(dict(compactado), compressor) == dados
+    # Snapshots em JSON guardam os bytes em base64
+    assert expandir_campos(campos_para_json(compactado), compressor) == dados
+
+
+def test_entrada_compacta_so_dispensa_a_pergunta_de_cartao_proprio():
+    compressor, _, _ = _compressor_zlib()
+    propria = {"cartao_id": "abc", "pergunta": "Cabe recurso?", "lacunas_conteudo": LONGO}
+    compartilhada = {**propria, "cartao_id": "baralho:abc"}
+    compacta = formato_entrada_compacta(propria, compressor)
+    assert "pergunta" not in compacta and "lacunas_conteudo_z" in compacta
+    assert formato_entrada_compacta(compartilhada, compressor)["pergunta"] == "Cabe recurso?"
+    assert formato_entrada_completa(dict(compacta), compressor, {"abc": "Cabe recurso?"}.get) == propria
+    assert formato_entrada_completa(dict(compacta), compressor, lambda _: None)["pergunta"] == PERGUNTA_DESCONHECIDA
@@ -0,0 +1,96 @@
+import datetime
+import gzip
+import json
+import os
+
+import pytest
+
+import backup_firestore
+import teste_carga
+from backup_firestore import caminho_checkpoint_padrao, exportar_backup, marca_do_backup, restaurar_backup
+
+
+def _banco():
+    return teste_carga.FirestoreFalso(teste_carga.Perturbacao(0, 0, (teste_carga.ServiceUnavailable,)))
+
+
+def _popular(db, username, cartoes=5):
+    user_ref = db.collection("users").document(username)
+    user_ref.set({"password_hash": "x"})
+    for i in range(cartoes):
+        user_ref.collection("user_cards").document(f"c{i}").set({"pergunta": f"Pergunta {i}?", "resposta_esperada": "R."})
+    user_ref.collection("feedback_history").document("antiga").set({"pergunta": "Pergunta 0?", "nota_sentido": 50,
+                                                                    "timestamp": "2025-01-01T10:00:00"})
+    return user_ref
+
+
+def _registros(caminho):
+    with gzip.open(caminho, "rt", encoding="utf-8") as arquivo:
+        return [json.loads(linha) for linha in arquivo][1:]
+
+
+def test_restauracao_retoma_do_checkpoint(tmp_path, monkeypatch):
+    origem = _banco()
+    _popular(origem, "ana")
+    _popular(origem, "bia")
+    caminho = str(tmp_path / "backup.jsonl.gz")
+    exportar_backup(origem, caminho)
+    total = len(_registros(caminho))
+
+    destino = _banco()
+    checkpoint = caminho_checkpoint_padrao(caminho)
+    monkeypatch.setattr(backup_firestore, "RESTAURACAO_LOTE", 3)
+    commit_original = teste_carga._LoteFalso.commit
+    commits = []
+    def commit_que_falha_no_terceiro(lote):
+        commits.append(1)
+        if len(commits) == 3:
+            raise RuntimeError("queda no meio da restauração")
+        commit_original(lote)
+    monkeypatch.setattr(teste_carga._LoteFalso, "commit", commit_que_falha_no_terceiro)
+
+    with pytest.raises(RuntimeError):
+        restaurar_backup(destino, caminho, caminho_checkpoint=checkpoint)
+    with open(checkpoint, encoding="utf-8") as f:
+        assert json.load(f)["linhas_aplicadas"] == 6
+    assert len(destino.docs) == 6
+
+    resultado = restaurar_backup(destino, caminho, caminho_checkpoint=checkpoint)
+    assert resultado["retomado_da_linha"] == 6
+    assert resultado["documentos"] == total - 6
+    assert resultado["usuarios"] == ["ana", "bia"]
+    assert destino.docs == origem.docs
+    assert not os.path.exists(checkpoint)
+
+
+def test_checkpoint_de_outro_backup_e_ignorado(tmp_path):
+    origem = _banco()
+    _popular(origem, "ana")
+    caminho = str(tmp_path / "backup.jsonl.gz")
+    exportar_backup(origem, caminho)
+    checkpoint = caminho_checkpoint_padrao(caminho)
+    with open(checkpoint, "w", encoding="utf-8") as f:
+        json.dump({"marca": "2000-01-01T00:00:00+00:00", "linhas_aplicadas": 4, "usuarios": ["zeca"]}, f)
+
+    destino = _banco()
+    resultado = restaurar_backup(destino, caminho, caminho_checkpoint=checkpoint)
+    assert resultado["retomado_da_linha"] == 0 and resultado["usuarios"] == ["ana"]
+    assert destino.docs == origem.docs
+
+
+def test_incremental_leva_so_o_que_mudou_desde_a_marca(tmp_path):
+    db = _banco()
+    user_ref = _popular(db, "ana")
+    completo = str(tmp_path / "completo.jsonl.gz")
+    exportar_backup(db, completo)
+
+    user_ref.collection("user_cards").document("c2").set({"pergunta": "Pergunta 2 editada?", "resposta_esperada": "R."})
+    user_ref.collection("feedback_history").document("nova").set(
+        {"pergunta": "Pergunta 1?", "nota_sentido": 80, "timestamp": datetime.datetime.now().isoformat()})
+    incremental = str(tmp_path / "incremental.jsonl.gz")
+    cabecalho = exportar_backup(db, incremental, desde=marca_do_backup(completo))
+
+    registros = _registros(incremental)
+    assert sorted((r["colecao"], r["doc_id"]) for r in registros) == [("feedback_history", "nova"), ("user_cards", "c2")]
+    assert cabecalho["desde"] == marca_do_backup(completo).isoformat()
+    assert cabecalho["contagens"] == {"user_cards": 1, "feedback_history": 1}
@@ -0,0 +1,108 @@
+import argparse
+import os
+import runpy
+
+import pytest
+
+import teste_carga
+
+CARTOES = [
+    ("c1", "Constitucional", "Controle", "Quais são os legitimados para propor a ação direta de inconstitucionalidade?"),
+    ("c2", "Constitucional", "Controle", "Quais são os legitimados para propor a ação direta de inconstitucionalidade ?"),
+    ("c3", "Civil", "Prescrição", "Qual o prazo prescricional da pretensão de reparação civil?"),
+    ("c4", "Administrativo", "Licitações", "Quais são as modalidades de licitação previstas na Lei 14.133/2021?"),
+]
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    """Globais do app.py rodando sobre o Firestore e o Gemini falsos do teste de carga (sem sessão do Streamlit)."""
+    db = teste_carga.instalar_backends(argparse.Namespace(
+        firestore="falso", gemini="falso", latencia_firestore=0, erro_firestore=0, latencia_gemini=0, erro_gemini=0, semente=1))
+    db.collection("users").document("admin").set({"password_hash": "x"})
+    diretorio = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        globais = runpy.run_path(teste_carga.CAMINHO_APP)
+    finally:
+        os.chdir(diretorio)
+    globais["db_falso"] = db
+    return globais
+
+
+def _popular_usuario(db, username):
+    user_ref = db.collection("users").document(username)
+    user_ref.set({"password_hash": "x"})
+    for doc_id, materia, assunto, pergunta in CARTOES:
+        user_ref.collection("user_cards").document(doc_id).set(
+            {"materia": materia, "assunto": assunto, "pergunta": pergunta, "resposta_esperada": f"Resposta de {doc_id}."})
+    return user_ref
+
+
+def test_assinatura_ignora_caixa_acentos_e_pontuacao(app):
+    a = app["assinatura_minhash"]("Qual é o prazo da apelação?")
+    b = app["assinatura_minhash"]("qual e o prazo da APELACAO")
+    assert app["similaridade_assinaturas"](a, b) == 1.0
+
+
+def test_similares_acha_quase_identica_e_ignora_as_demais(app):
+    indice = app["IndiceDuplicatas"]()
+    for doc_id, _, _, pergunta in CARTOES:
+        indice.adicionar(doc_id, pergunta)
+    encontrados = indice.similares("Quais são os legitimados para propor a ação direta de inconstitucionalidade?", ignorar="c1")
+    assert [doc_id for _, doc_id in encontrados] == ["c2"]
+    assert indice.similares("Como se calcula o ICMS na substituição tributária?") == []
+
+
+def test_candidatos_lsh_nao_percorrem_o_baralho(app):
+    indice = app["IndiceDuplicatas"]()
+    for i in range(300):
+        indice.adicionar(f"d{i}", f"Pergunta {i * 7919} sobre o tema {i * 104729} e o artigo {i * 1299709} do código")
+    indice.adicionar("alvo", CARTOES[2][3])
+    candidatos = indice._candidatos(app["assinatura_minhash"](CARTOES[2][3]))
+    assert "alvo" in candidatos and len(candidatos) < 30
+
+
+def test_remover_limpa_os_baldes(app):
+    indice = app["IndiceDuplicatas"]()
+    indice.adicionar("c1", CARTOES[0][3])
+    indice.remover("c1")
+    assert indice.baldes == {} and indice.similares(CARTOES[0][3]) == []
+
+
+def test_grupos_une_os_pares_acima_do_limiar(app):
+    indice = app["IndiceDuplicatas"]()
+    for doc_id, _, _, pergunta in CARTOES:
+        indice.adicionar(doc_id, pergunta)
+    indice.adicionar("c5", "Quais são os legitimados para propor a ação direta de inconstitucionalidade")
+    assert indice.grupos() == [["c1", "c2", "c5"]]
+
+
+def test_mesclar_cartoes_duplicados_move_historico_e_resumo(app):
+    db = app["db_falso"]
+    user_ref = _popular_usuario(db, "mescla")
+    historico = user_ref.collection("feedback_history")
+    # Uma entrada completa e uma só com a referência ao cartão (formato compacto)
+    historico.document("h1").set({"materia": "Constitucional", "assunto": "Controle", "pergunta": CARTOES[1][3],
+                                  "nota_sentido": 40, "timestamp": "2026-01-01T10:00:00"})
+    historico.document("h2").set({"materia": "Constitucional", "assunto": "Controle", "cartao_id": "c2",
+                                  "nota_sentido": 60, "timestamp": "2026-01-02T10:00:00"})
+    historico.document("h3").set({"materia": "Civil", "assunto": "Prescrição", "pergunta": CARTOES[2][3],
+                                  "nota_sentido": 90, "timestamp": "2026-01-03T10:00:00"})
+    resumos = user_ref.collection("feedback_summaries")
+    id_resumo = app["id_resumo_cartao"]
+    resumos.document(id_resumo((CARTOES[1][3], "Constitucional", "Controle"))).set(
+        {"pergunta": CARTOES[1][3], "materia": "Constitucional", "assunto": "Controle", "tentativas": 3, "soma_notas": 150,
+         "notas_validas": 3, "notas": [{"nota": 50, "timestamp": "2025-06-01"}], "ultimo_timestamp": "2025-06-01", "ultima_nota": 50})
+
+    assert app["mesclar_cartoes_duplicados"]("mescla", "c1", ["c2"]) == (1, 2)
+
+    assert not user_ref.collection("user_cards").document("c2").get().exists
+    assert user_ref.collection("user_cards").document("c1").get().exists
+    movidas = {doc.id: doc.to_dict() for doc in historico.stream()}
+    assert movidas["h1"]["pergunta"] == CARTOES[0][3] and movidas["h1"]["cartao_id"] == "c1"
+    assert movidas["h2"]["cartao_id"] == "c1" and "pergunta" not in movidas["h2"]
+    assert movidas["h3"]["pergunta"] == CARTOES[2][3] # Outro cartão: não é tocado
+    assert not resumos.document(id_resumo((CARTOES[1][3], "Constitucional", "Controle"))).get().exists
+    resumo_mantido = resumos.document(id_resumo((CARTOES[0][3], "Constitucional", "Controle"))).get().to_dict()
+    assert (resumo_mantido["tentativas"], resumo_mantido["soma_notas"], resumo_mantido["pergunta"]) == (3, 150, CARTOES[0][3])
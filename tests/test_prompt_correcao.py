@@ -0,0 +1,60 @@
+import pytest
+
+from prompt_correcao import (PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA, TITULO_REFERENCIA_RUBRICA, extrair_nota_sentido,
+                             montar_prompt_correcao, parse_feedback_sections, validar_template)
+
+FEEDBACK = """**1. Pontuação de Sentido (0-100):** 70%
+**2. Avaliação Principal do Sentido:** Bom, mas faltou o prazo.
+**3. Lacunas de Conteúdo:**
+- faltou o prazo
+**4. Erros Gramaticais/Ortográficos:** Nenhum erro encontrado.
+**5. Sugestões Rápidas de Melhoria:**
+- cite o prazo
+---
+"""
+
+
+def test_parse_feedback_completo():
+    secoes = parse_feedback_sections(FEEDBACK)
+    assert secoes == {
+        "score": "70%",
+        "meaning_eval": "Bom, mas faltou o prazo.",
+        "content_gaps": "- faltou o prazo",
+        "grammar_errors": "Nenhum erro encontrado.",
+        "suggestions": "- cite o prazo",
+    }
+    assert extrair_nota_sentido(secoes) == 70
+
+
+def test_parse_feedback_sem_secao_4():
+    sem_gramatica = FEEDBACK.replace("**4. Erros Gramaticais/Ortográficos:** Nenhum erro encontrado.\n", "")
+    secoes = parse_feedback_sections(sem_gramatica)
+    # As lacunas terminam na seção 5, e não engolem o resto do texto
+    assert secoes["content_gaps"] == "- faltou o prazo"
+    assert secoes["grammar_errors"] == "Não disponível."
+    assert secoes["suggestions"] == "- cite o prazo"
+
+
+def test_parse_feedback_sem_nota():
+    secoes = parse_feedback_sections("Resposta fora do formato.")
+    assert set(secoes.values()) == {"Não disponível."}
+    assert extrair_nota_sentido(secoes) is None
+
+
+def test_prompt_com_rubrica_substitui_a_resposta_esperada():
+    rubrica = [{"ponto": "Prazo de 15 dias", "peso": 60}, {"ponto": "Cabe apelação", "peso": 40}]
+    prompt, referencia = montar_prompt_correcao("Qual o recurso?", "Apelação.", "Texto completo da resposta.", rubrica)
+    assert referencia == "- (60) Prazo de 15 dias\n- (40) Cabe apelação"
+    assert TITULO_REFERENCIA_RUBRICA in prompt and "Texto completo da resposta." not in prompt
+
+
+def test_template_sem_gramatica_nao_pede_a_secao_4():
+    prompt, _ = montar_prompt_correcao("P", "R", "E", template=PROMPT_CORRECAO_TEMPLATE_SEM_GRAMATICA)
+    assert "**4. Erros Gramaticais/Ortográficos:**" not in prompt
+    assert "**5. Sugestões Rápidas de Melhoria:**" in prompt
+
+
+@pytest.mark.parametrize("template", ["{pergunta} {desconhecido}", "{pergunta} {referencia}"])
+def test_validar_template_invalido(template):
+    with pytest.raises(ValueError):
+        validar_template(template)
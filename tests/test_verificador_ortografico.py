@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from verificador_ortografico import (SEM_ERROS, VerificadorOrtografico, distancia_edicao, formatar_apontamentos,
+                                     verificar_gramatica, verificar_texto)
+
+PALAVRAS = {"casa": 100, "caso": 50, "causa": 10, "prazo": 5, "recurso": 20, "cabe": 30, "contra": 40,
+            "decisão": 15, "a": 500, "o": 500, "de": 400, "da": 300}
+
+
+@pytest.fixture
+def verificador(tmp_path):
+    caminho = tmp_path / "dicionario.txt"
+    caminho.write_text("".join(f"{palavra} {frequencia}\n" for palavra, frequencia in PALAVRAS.items()), encoding="utf-8")
+    verificador = VerificadorOrtografico(str(caminho))
+    yield verificador
+    verificador.fechar()
+
+
+def test_distancia_edicao_conta_transposicao_como_uma_edicao():
+    assert distancia_edicao("csaa", "casa", 2) == 1
+    assert distancia_edicao("casa", "casa", 2) == 0
+    assert distancia_edicao("a", "prazos", 2) == 3 # acima do limite vira limite + 1
+
+
+def test_contem_ignora_maiusculas(verificador):
+    assert verificador.contem("Casa")
+    assert verificador.contem("decisão")
+    assert not verificador.contem("casaa")
+
+
+def test_sugestoes_ordenadas_por_distancia_e_frequencia(verificador):
+    assert verificador.sugestoes("casq") == ["casa", "caso", "cabe"] # "cabe" (30) antes de "causa" (10), ambas a 2 edições
+    assert verificador.sugestoes("csaa")[0] == "casa"
+    assert verificador.sugestoes("xyzwk") == []
+
+
+def test_indice_refeito_quando_o_dicionario_muda(tmp_path, verificador):
+    caminho = tmp_path / "dicionario.txt"
+    assert os.path.exists(f"{caminho}.idx")
+    caminho.write_text("casa 1\nagravo 1\n", encoding="utf-8")
+    os.utime(caminho, ns=(os.stat(caminho).st_atime_ns, os.stat(caminho).st_mtime_ns + 1_000_000_000))
+    novo = VerificadorOrtografico(str(caminho))
+    try:
+        assert novo.contem("agravo")
+        assert not novo.contem("prazo")
+    finally:
+        novo.fechar()
+
+
+@pytest.mark.parametrize("texto, trecho, sugestao", [
+    ("Vale à partir de hoje.", "à partir", "a partir"),
+    ("Começou à chover.", "à chover", "a chover"),
+    ("Eles é competentes.", "Eles é", "Eles são"),
+    ("A gente vamos recorrer.", "A gente vamos", "A gente vai"),
+    ("Haviam muitos recursos.", "Haviam muitos", "Havia muitos"),
+    ("Fazem dois anos que recorreu.", "Fazem dois anos", "Faz dois anos"),
+    ("Recorreu afim de anular.", "afim de", "a fim de"),
+    ("Ocorre as vezes.", "as vezes", "às vezes"),
+])
+def test_regras_gramaticais(texto, trecho, sugestao):
+    apontamentos = verificar_gramatica(texto)
+    assert [(a["trecho"], a["sugestao"]) for a in apontamentos] == [(trecho, sugestao)]
+
+
+@pytest.mark.parametrize("texto", [
+    "Todas as vezes que recorreu.", # "as vezes" depois de "todas" não leva crase
+    "Entregou à mulher.", # substantivo terminado em -er não é infinitivo
+    "Eles são competentes.",
+])
+def test_regras_gramaticais_sem_falso_positivo(texto):
+    assert verificar_gramatica(texto) == []
+
+
+def test_verificar_texto_aponta_grafia_com_sugestao(verificador):
+    apontamentos = verificar_texto("A casq da decisão", verificador)
+    assert [(a["trecho"], a["motivo"]) for a in apontamentos] == [("casq", "grafia")]
+    assert apontamentos[0]["sugestao"] == "casa / caso / cabe"
+
+
+def test_verificar_texto_ignora_palavras_conhecidas_e_nomes_proprios(verificador):
+    texto = "O agravo contra Fulano cabe. Xpto"
+    apontamentos = verificar_texto(texto, verificador, palavras_conhecidas=["agravo"])
+    # "Fulano" (maiúscula no meio da frase) é nome próprio; "Xpto" começa frase e não está no dicionário
+    assert [a["trecho"] for a in apontamentos] == ["Xpto"]
+    assert apontamentos[0]["motivo"] == "palavra não reconhecida"
+
+
+def test_formatar_apontamentos():
+    assert formatar_apontamentos([]) == SEM_ERROS
+    texto = formatar_apontamentos([{"trecho": "à partir", "sugestao": "a partir", "motivo": "crase"},
+                                   {"trecho": "xpto", "sugestao": None, "motivo": "palavra não reconhecida"}])
+    assert texto == "\n- 'à partir' -> 'a partir' (crase)\n- 'xpto' (palavra não reconhecida)"
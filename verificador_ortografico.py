@@ -0,0 +1,327 @@
+"""
+Verificação ortográfica e gramatical local (pt-BR) da resposta do usuário, sem dependência do Streamlit.
+
+A seção "Erros Gramaticais/Ortográficos" do feedback não precisa esperar o Gemini: a ortografia é
+conferida contra um dicionário com um índice de deleções simétricas (SymSpell) e a gramática com
+regras de padrão para os erros mais comuns (crase, concordância verbal, verbos impessoais e
+locuções). O resultado sai em milissegundos, no momento do envio.
+
+O dicionário é uma lista de palavras em texto (uma por linha, opcionalmente seguida da frequência,
+"palavra 1234"; listas do hunspell, "palavra/FLAGS", também servem; .gz aceito). Na primeira carga
+é compilado um índice binário ao lado dele (<dicionário>.idx), refeito quando o dicionário muda. O
+índice é aberto com mmap: os processos do servidor compartilham as mesmas páginas e só as
+consultadas são lidas do disco. Para compilar antes do deploy ou testar um texto:
+
+    python verificador_ortografico.py dicionario_pt_br.txt --texto "A gente vamos à partir de agora"
+"""
+import os
+import re
+import sys
+import gzip
+import mmap
+import zlib
+import bisect
+import struct
+import argparse
+import unicodedata
+from array import array
+
+INDICE_MAGICO = b"SYMDEL01"
+# magico, distância máxima, tamanho do prefixo, nº de palavras, nº de entradas, mtime_ns e tamanho do dicionário
+INDICE_CABECALHO = struct.Struct("<8sIIQQQQ")
+DISTANCIA_MAXIMA_PADRAO = 2
+PREFIXO_PADRAO = 7 # As deleções são geradas só sobre os 7 primeiros caracteres (índice bem menor; mesmas sugestões)
+MAX_SUGESTOES = 3
+MAX_APONTAMENTOS = 15
+SEM_ERROS = "Nenhum erro encontrado."
+
+_RE_PALAVRA = re.compile(r"[^\W\d_]+(?:-[^\W\d_]+)*")
+PRONOMES_ENCLITICOS = {"o", "a", "os", "as", "lo", "la", "los", "las", "no", "na", "nos", "nas",
+                       "me", "te", "se", "lhe", "lhes", "vos"}
+
+
+def normalizar_palavra(palavra):
+    return unicodedata.normalize("NFC", palavra).lower()
+
+def _hash_delecao(texto):
+    dados = texto.encode("utf-8")
+    return (zlib.crc32(dados) << 32) | zlib.adler32(dados)
+
+def _delecoes(palavra, distancia_maxima, prefixo):
+    """A palavra (limitada ao prefixo) e todas as variantes com até 'distancia_maxima' letras removidas."""
+    palavra = palavra[:prefixo]
+    resultado, fronteira = {palavra}, {palavra}
+    for _ in range(distancia_maxima):
+        novas = {p[:i] + p[i + 1:] for p in fronteira if len(p) > 1 for i in range(len(p))} - resultado
+        resultado |= novas
+        fronteira = novas
+    return resultado
+
+def distancia_edicao(a, b, limite):
+    """Distância de Damerau-Levenshtein (transposições adjacentes); qualquer valor > limite vira limite + 1."""
+    if abs(len(a) - len(b)) > limite:
+        return limite + 1
+    anterior2, anterior = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        atual = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            custo = a[i - 1] != b[j - 1]
+            atual[j] = min(anterior[j] + 1, atual[j - 1] + 1, anterior[j - 1] + custo)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                atual[j] = min(atual[j], anterior2[j - 2] + 1)
+        if min(atual) > limite:
+            return limite + 1
+        anterior2, anterior = anterior, atual
+    return min(anterior[-1], limite + 1)
+
+
+# --- ÍNDICE DE DELEÇÕES SIMÉTRICAS ---
+def ler_dicionario(caminho):
+    """Lê a lista de palavras: {palavra normalizada: frequência}."""
+    abrir = gzip.open if caminho.endswith(".gz") else open
+    frequencias = {}
+    with abrir(caminho, "rt", encoding="utf-8") as f:
+        for linha in f:
+            partes = linha.split()
+            if not partes:
+                continue
+            palavra = normalizar_palavra(partes[0].split("/")[0])
+            if not _RE_PALAVRA.fullmatch(palavra):
+                continue # Contagem na primeira linha do .dic, números, siglas com dígitos...
+            frequencia = int(partes[1]) if len(partes) > 1 and partes[1].isdigit() else 1
+            frequencias[palavra] = frequencias.get(palavra, 0) + frequencia
+    return frequencias
+
+def compilar_indice(caminho_dicionario, caminho_indice, distancia_maxima=DISTANCIA_MAXIMA_PADRAO, prefixo=PREFIXO_PADRAO):
+    """
+    Compila o índice binário: cabeçalho, deslocamentos das palavras, frequências, hashes das deleções
+    (ordenados) com o índice da palavra de cada um e, por fim, as palavras em UTF-8. Grava num arquivo
+    temporário e troca no fim, então processos concorrentes nunca abrem um índice pela metade.
+    """
+    estado = os.stat(caminho_dicionario)
+    frequencias = ler_dicionario(caminho_dicionario)
+    palavras = sorted(frequencias)
+    entradas = []
+    for indice, palavra in enumerate(palavras):
+        entradas.extend((_hash_delecao(d) << 32) | indice for d in _delecoes(palavra, distancia_maxima, prefixo))
+    entradas.sort()
+
+    textos = [p.encode("utf-8") for p in palavras]
+    deslocamentos = array("Q", [0])
+    for texto in textos:
+        deslocamentos.append(deslocamentos[-1] + len(texto))
+    temporario = f"{caminho_indice}.{os.getpid()}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(INDICE_CABECALHO.pack(INDICE_MAGICO, distancia_maxima, prefixo, len(palavras), len(entradas),
+                                      estado.st_mtime_ns, estado.st_size))
+        f.write(deslocamentos.tobytes())
+        f.write(array("Q", (frequencias[p] for p in palavras)).tobytes())
+        f.write(array("Q", (e >> 32 for e in entradas)).tobytes())
+        f.write(array("Q", (e & 0xFFFFFFFF for e in entradas)).tobytes())
+        f.write(b"".join(textos))
+    os.replace(temporario, caminho_indice)
+
+def _indice_atualizado(caminho_dicionario, caminho_indice, distancia_maxima, prefixo):
+    try:
+        with open(caminho_indice, "rb") as f:
+            cabecalho = INDICE_CABECALHO.unpack(f.read(INDICE_CABECALHO.size))
+    except (OSError, struct.error):
+        return False
+    estado = os.stat(caminho_dicionario)
+    return cabecalho[0] == INDICE_MAGICO and cabecalho[1:3] == (distancia_maxima, prefixo) and \
+        cabecalho[5:] == (estado.st_mtime_ns, estado.st_size)
+
+
+class VerificadorOrtografico:
+    """Consulta o índice em mmap. Seguro para várias threads (só leitura)."""
+    def __init__(self, caminho_dicionario, caminho_indice=None, distancia_maxima=DISTANCIA_MAXIMA_PADRAO, prefixo=PREFIXO_PADRAO):
+        caminho_indice = caminho_indice or f"{caminho_dicionario}.idx"
+        if not _indice_atualizado(caminho_dicionario, caminho_indice, distancia_maxima, prefixo):
+            compilar_indice(caminho_dicionario, caminho_indice, distancia_maxima, prefixo)
+        with open(caminho_indice, "rb") as f:
+            self._mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, self.distancia_maxima, self.prefixo, n_palavras, n_entradas, _, _ = INDICE_CABECALHO.unpack_from(self._mapa)
+        self._visao = memoryview(self._mapa)
+        inicio = INDICE_CABECALHO.size
+        secoes = []
+        for tamanho in (n_palavras + 1, n_palavras, n_entradas, n_entradas):
+            secoes.append(self._visao[inicio:inicio + 8 * tamanho].cast("Q"))
+            inicio += 8 * tamanho
+        self._deslocamentos, self._frequencias, self._hashes, self._ids = secoes
+        self._inicio_palavras = inicio
+        self.total_palavras = n_palavras
+
+    def _palavra(self, indice):
+        inicio = self._inicio_palavras + self._deslocamentos[indice]
+        return self._mapa[inicio:self._inicio_palavras + self._deslocamentos[indice + 1]].decode("utf-8")
+
+    def _candidatos(self, delecao):
+        h = _hash_delecao(delecao)
+        posicao = bisect.bisect_left(self._hashes, h)
+        while posicao < len(self._hashes) and self._hashes[posicao] == h:
+            yield self._ids[posicao]
+            posicao += 1
+
+    def contem(self, palavra):
+        palavra = normalizar_palavra(palavra)
+        return any(self._palavra(i) == palavra for i in self._candidatos(palavra[:self.prefixo]))
+
+    def sugestoes(self, palavra, maximo=MAX_SUGESTOES):
+        """Palavras do dicionário a até distancia_maxima edições, das mais próximas e frequentes para as demais."""
+        palavra = normalizar_palavra(palavra)
+        vistos, encontrados = set(), []
+        for delecao in _delecoes(palavra, self.distancia_maxima, self.prefixo):
+            for indice in self._candidatos(delecao):
+                if indice in vistos:
+                    continue
+                vistos.add(indice)
+                candidata = self._palavra(indice)
+                distancia = distancia_edicao(palavra, candidata, self.distancia_maxima)
+                if distancia <= self.distancia_maxima:
+                    encontrados.append((distancia, -self._frequencias[indice], candidata))
+        return [candidata for _, _, candidata in sorted(encontrados)[:maximo]]
+
+    def fechar(self):
+        for visao in (self._deslocamentos, self._frequencias, self._hashes, self._ids, self._visao):
+            visao.release()
+        self._mapa.close()
+
+
+# --- REGRAS GRAMATICAIS ---
+# (padrão, sugestão, motivo, palavras anteriores que anulam a regra). A sugestão é um modelo de
+# re.Match.expand ou uma função do match.
+_CONCORDANCIA_PLURAL = {"é": "são", "está": "estão", "foi": "foram", "tem": "têm", "vem": "vêm", "pode": "podem",
+                        "deve": "devem", "faz": "fazem", "vai": "vão", "era": "eram", "estava": "estavam"}
+_CONCORDANCIA_SINGULAR = {plural: singular for singular, plural in _CONCORDANCIA_PLURAL.items()}
+_A_GENTE = {"vamos": "vai", "fomos": "foi", "estamos": "está", "somos": "é", "temos": "tem", "podemos": "pode",
+            "devemos": "deve", "queremos": "quer", "fizemos": "fez", "sabemos": "sabe", "precisamos": "precisa"}
+_HAVER_IMPESSOAL = {"haviam": "havia", "houveram": "houve", "haverão": "haverá", "haveriam": "haveria", "hajam": "haja"}
+_QUANTIFICADORES = r"(?:muitos|muitas|vários|várias|alguns|algumas|poucos|poucas|diversos|diversas|inúmeros|inúmeras|dois|duas|três|tantos|tantas)"
+_INFINITIVO = r"([^\W\d_]+(?:ar|er|ir))"
+_NAO_INFINITIVOS = {"mulher", "colher", "qualquer", "lugar", "par", "mar", "bar", "lar", "éter"}
+
+REGRAS_GRAMATICAIS = [
+    (r"\bà\s+(partir|ele|eles|este|esse|isso|isto|aquilo|você|vocês|mim|nós|cada|qualquer|todo|todos|nível)\b",
+     r"a \1", "não há crase antes de palavra masculina, pronome pessoal ou indefinido", ()),
+    (r"\bà\s+" + _INFINITIVO + r"\b", lambda m: None if m.group(1).lower() in _NAO_INFINITIVOS else f"a {m.group(1)}",
+     "não há crase antes de verbo", ()),
+    (r"\bas vezes\b", "às vezes", "locução adverbial feminina leva crase",
+     ("todas", "algumas", "muitas", "poucas", "várias", "das", "nas", "pelas", "quantas", "duas", "três", "tantas")),
+    (r"\ba medida que\b", "à medida que", "locução conjuntiva leva crase", ()),
+    (r"\ba proporção que\b", "à proporção que", "locução conjuntiva leva crase", ()),
+    (r"\b(eles|elas)\s+(" + "|".join(_CONCORDANCIA_PLURAL) + r")\b",
+     lambda m: f"{m.group(1)} {_CONCORDANCIA_PLURAL[m.group(2).lower()]}", "o verbo concorda com o sujeito no plural", ()),
+    (r"\b(ele|ela)\s+(" + "|".join(_CONCORDANCIA_SINGULAR) + r")\b",
+     lambda m: f"{m.group(1)} {_CONCORDANCIA_SINGULAR[m.group(2).lower()]}", "o verbo concorda com o sujeito no singular", ()),
+    (r"\ba gente\s+(" + "|".join(_A_GENTE) + r")\b", lambda m: f"a gente {_A_GENTE[m.group(1).lower()]}",
+     "'a gente' pede o verbo na 3ª pessoa do singular", ()),
+    (r"\b(" + "|".join(_HAVER_IMPESSOAL) + r")\s+(" + _QUANTIFICADORES + r")\b",
+     lambda m: f"{_HAVER_IMPESSOAL[m.group(1).lower()]} {m.group(2)}", "'haver' no sentido de existir é impessoal (fica no singular)", ()),
+    (r"\bfazem\s+(\d+|dois|duas|três|quatro|cinco|seis|sete|oito|nove|dez|muitos|muitas|vários|várias|alguns|algumas)\s+"
+     r"(anos|meses|dias|semanas|horas|minutos|décadas|séculos)\b",
+     r"faz \1 \2", "'fazer' indicando tempo decorrido é impessoal", ()),
+    (r"\bhá\s+(\S+)\s+(anos|meses|dias|semanas|horas|décadas|séculos)\s+atrás\b",
+     r"há \1 \2", "redundância: use 'há ...' ou '... atrás', não os dois", ()),
+    (r"\bpara mim\s+" + _INFINITIVO + r"\b", lambda m: None if m.group(1).lower() in _NAO_INFINITIVOS else f"para eu {m.group(1)}",
+     "o sujeito do infinitivo fica no caso reto ('eu')", ()),
+    (r"\bafim de\b", "a fim de", "locução de finalidade se escreve separada", ()),
+    (r"\bapartir\b", "a partir", "locução se escreve separada", ()),
+    (r"\bderrepente\b", "de repente", "locução se escreve separada", ()),
+    (r"\bconcerteza\b", "com certeza", "locução se escreve separada", ()),
+    (r"\bporisso\b", "por isso", "locução se escreve separada", ()),
+    (r"\bmenas\b", "menos", "'menos' é invariável", ()),
+    (r"\b(seje|esteje)\b", lambda m: m.group(1)[:-2] + "ja", "forma verbal inexistente", ()),
+]
+_REGRAS_COMPILADAS = [(re.compile(padrao, re.IGNORECASE), sugestao, motivo, set(anteriores))
+                      for padrao, sugestao, motivo, anteriores in REGRAS_GRAMATICAIS]
+
+def _palavra_anterior(texto, inicio):
+    anteriores = _RE_PALAVRA.findall(texto[max(0, inicio - 40):inicio])
+    return anteriores[-1].lower() if anteriores else None
+
+def verificar_gramatica(texto):
+    """
+    Apontamentos das regras gramaticais: dicionários com 'inicio', 'fim', 'trecho', 'sugestao' e 'motivo'.
+    Um trecho já apontado por uma regra anterior (mais específica) não é apontado de novo.
+    """
+    apontamentos = []
+    for padrao, sugestao, motivo, anteriores in _REGRAS_COMPILADAS:
+        for m in padrao.finditer(texto):
+            if any(a["inicio"] < m.end() and m.start() < a["fim"] for a in apontamentos):
+                continue
+            if anteriores and _palavra_anterior(texto, m.start()) in anteriores:
+                continue
+            correcao = sugestao(m) if callable(sugestao) else m.expand(sugestao)
+            if correcao is not None and m.group(0)[0].isupper():
+                correcao = correcao[0].upper() + correcao[1:]
+            if correcao is not None and correcao.lower() != m.group(0).lower():
+                apontamentos.append({"inicio": m.start(), "fim": m.end(), "trecho": m.group(0),
+                                     "sugestao": correcao, "motivo": motivo})
+    return apontamentos
+
+
+# --- VERIFICAÇÃO DO TEXTO ---
+def _inicio_de_frase(texto, inicio):
+    anterior = texto[:inicio].rstrip()
+    return not anterior or anterior[-1] in ".!?:;\n-•*"
+
+def verificar_texto(texto, verificador=None, palavras_conhecidas=()):
+    """
+    Verifica a gramática e, com um VerificadorOrtografico, a ortografia do texto. 'palavras_conhecidas'
+    (por exemplo, as palavras da pergunta e do padrão de resposta) nunca são apontadas: termos técnicos
+    e nomes próprios da matéria costumam faltar no dicionário. Retorna os apontamentos em ordem no texto.
+    """
+    apontamentos = verificar_gramatica(texto)
+    if verificador is not None:
+        conhecidas = {normalizar_palavra(p) for p in palavras_conhecidas}
+        cobertos = [(a["inicio"], a["fim"]) for a in apontamentos]
+        vistas = set()
+        for m in _RE_PALAVRA.finditer(texto):
+            palavra = m.group(0)
+            normalizada = normalizar_palavra(palavra)
+            if (len(palavra) < 2 or normalizada in conhecidas or normalizada in vistas or
+                    any(inicio <= m.start() < fim for inicio, fim in cobertos)):
+                continue
+            # Maiúsculas fora do início da frase: siglas e nomes próprios, que o dicionário não cobre
+            if not palavra.islower() and (palavra.isupper() or not _inicio_de_frase(texto, m.start())):
+                continue
+            partes = normalizada.split("-")
+            if verificador.contem(normalizada) or (len(partes) > 1 and (
+                    all(verificador.contem(p) for p in partes) or partes[-1] in PRONOMES_ENCLITICOS)):
+                continue
+            vistas.add(normalizada)
+            sugestoes = verificador.sugestoes(normalizada)
+            apontamentos.append({"inicio": m.start(), "fim": m.end(), "trecho": palavra,
+                                 "sugestao": " / ".join(sugestoes) if sugestoes else None,
+                                 "motivo": "grafia" if sugestoes else "palavra não reconhecida"})
+    return sorted(apontamentos, key=lambda a: a["inicio"])[:MAX_APONTAMENTOS]
+
+def formatar_apontamentos(apontamentos):
+    """Texto no formato da seção 4 do feedback ('Palavra/Frase Incorreta' -> 'Sugestão de Correção')."""
+    if not apontamentos:
+        return SEM_ERROS
+    linhas = []
+    for a in apontamentos:
+        if a["sugestao"]:
+            linhas.append(f"- '{a['trecho']}' -> '{a['sugestao']}' ({a['motivo']})")
+        else:
+            linhas.append(f"- '{a['trecho']}' ({a['motivo']})")
+    return "\n" + "\n".join(linhas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compila o índice do dicionário e verifica textos (ortografia e gramática pt-BR).")
+    parser.add_argument("dicionario", help="Lista de palavras (uma por linha, opcionalmente com a frequência)")
+    parser.add_argument("--indice", help="Arquivo do índice (padrão: <dicionário>.idx)")
+    parser.add_argument("--texto", help="Texto a verificar (padrão: lê da entrada padrão, se houver)")
+    args = parser.parse_args(argv)
+
+    verificador = VerificadorOrtografico(args.dicionario, args.indice)
+    print(f"Índice pronto: {verificador.total_palavras} palavras.", file=sys.stderr)
+    texto = args.texto if args.texto is not None else (None if sys.stdin.isatty() else sys.stdin.read())
+    if texto:
+        print(formatar_apontamentos(verificar_texto(texto, verificador)).strip())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())